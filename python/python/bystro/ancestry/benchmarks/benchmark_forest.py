@@ -0,0 +1,35 @@
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier  # type: ignore
+
+from bystro.ancestry.forest import FlatForest
+
+# Synthetic principal components, and one population label per sample, as in the ancestry models
+N_PCS = 30
+N_POPS = 26
+N_TRAIN_SAMPLES = 5_000
+N_SAMPLES = 100_000
+
+rng = np.random.default_rng(0)
+train_pcs = rng.normal(size=(N_TRAIN_SAMPLES, N_PCS))
+train_pops = rng.integers(0, N_POPS, N_TRAIN_SAMPLES)
+rfc = RandomForestClassifier(n_estimators=100, random_state=0).fit(train_pcs, train_pops)
+forest = FlatForest.from_sklearn(rfc)
+
+pcs = rng.normal(size=(N_SAMPLES, N_PCS)).astype(np.float32)
+expected = rfc.predict_proba(pcs)
+
+
+def test_sklearn_predict_proba(benchmark):
+    benchmark(rfc.predict_proba, pcs)
+
+
+def test_flat_forest_predict_proba(benchmark):
+    proba = benchmark(forest.predict_proba, pcs)
+
+    assert np.array_equal(proba, expected)
+
+
+def test_flat_forest_predict_proba_one_thread(benchmark):
+    proba = benchmark(forest.predict_proba, pcs, n_jobs=1)
+
+    assert np.array_equal(proba, expected)
@@ -0,0 +1,48 @@
+cimport cython
+from libc.stdint cimport int32_t
+
+
+# The layout of FlatForest.nodes, one 24 byte record per node, so a step through a tree reads one record
+cdef packed struct Node:
+    double threshold
+    int32_t feature
+    int32_t left
+    int32_t right
+    int32_t padding
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate_tree_proba(
+    const float[:, :] X,
+    const Node[:] nodes,
+    const double[:, :] value,
+    const int32_t[:] roots,
+    double[:, :] proba):
+    """
+    Add the leaf probabilities of every tree to each sample's row of `proba`, in the order of the trees
+
+    Each sample walks each tree from its root, going left while its float32 feature
+    is <= the node's float64 threshold, as in sklearn's trees, until it reaches a leaf (children -1).
+    """
+
+    cdef Py_ssize_t i, c, t
+    cdef int32_t node
+    cdef Py_ssize_t n_samples = X.shape[0], n_classes = value.shape[1], n_trees = roots.shape[0]
+
+    if proba.shape[0] != n_samples or proba.shape[1] != n_classes:
+        raise ValueError("proba must have one row per sample and one column per class")
+
+    with nogil:
+        # Trees in the outer loop, so each tree's nodes stay in cache while the samples walk it
+        for t in range(n_trees):
+            for i in range(n_samples):
+                node = roots[t]
+                while nodes[node].left != -1:
+                    if X[i, nodes[node].feature] <= nodes[node].threshold:
+                        node = nodes[node].left
+                    else:
+                        node = nodes[node].right
+
+                for c in range(n_classes):
+                    proba[i, c] += value[node, c]
@@ -6,39 +6,49 @@ import os
 import psutil
 import warnings
 
-from msgspec import Struct
+from msgspec import Struct, structs
 import numpy as np
 import pandas as pd
 
 import pyarrow as pa  # type: ignore
-import pyarrow.compute as pc  # type: ignore
+import pyarrow.dataset as ds  # type: ignore
 from pyarrow.dataset import Dataset  # type: ignore
+from pyarrow.fs import FileSystem, LocalFileSystem  # type: ignore
+import ray
 
 from sklearn.ensemble import RandomForestClassifier  # type: ignore
 
-from bystro.ancestry.ancestry_types import (
-    AncestryResults,
-    AncestryScoresOneSample,
-    AncestryTopHit,
-    PopulationVector,
-    ProbabilityInterval,
-    SuperpopVector,
-)
-from bystro.ancestry.asserts import assert_equals
-from bystro.ancestry.train import POPS, SUPERPOP_FROM_POP, SUPERPOPS
+from bystro.ancestry.ancestry_types import AncestryResults
+from bystro.ancestry.forest import FlatForest
+from bystro.ancestry.locus_index import LocusIndex, hash_loci
+from bystro.ancestry.results_table import AncestryResultsTable
+from bystro.ancestry.train import POPS
+from bystro.utils.instrumentation import count, span
 from bystro.utils.timer import Timer
 
 logger = logging.getLogger(__name__)
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
-ANCESTRY_SCORE_SAMPLE_CHUNK_SIZE = int(os.getenv("ANCESTRY_SCORE_SAMPLE_CHUNK_SIZE", 200))
+# The number of loci read from the dosage matrix at a time, for all samples
+ANCESTRY_SCORE_LOCUS_BATCH_SIZE = int(os.getenv("ANCESTRY_SCORE_LOCUS_BATCH_SIZE", 2048))
+# The number of Ray tasks the samples of a file-backed dosage matrix are partitioned across,
+# each projecting its own sample columns; 1 projects all samples in this process
+ANCESTRY_SCORE_N_WORKERS = int(os.getenv("ANCESTRY_SCORE_N_WORKERS", 1))
 
 
 class AncestryModel(Struct, frozen=True, forbid_unknown_fields=True, rename="camel"):
-    """Bundle together PCA and RFC models for bookkeeping purposes."""
+    """
+    Bundle together PCA and RFC models for bookkeeping purposes.
+
+    The locus index of the PCA loadings is typically built, or loaded, when the model is loaded;
+    if not given, it is built on first use. The RFC's trees are exported to a `FlatForest`,
+    which predicts the same probabilities as the RFC, faster.
+    """
 
     pca_loadings_df: pd.DataFrame
     rfc: RandomForestClassifier
+    locus_index: LocusIndex | None = None
+    forest: FlatForest | None = None
 
     def __post_init__(self) -> None:
         """Ensure that PCA and RFC features line up correctly."""
@@ -51,6 +61,23 @@ class AncestryModel(Struct, frozen=True, forbid_unknown_fields=True, rename="cam
             )
             raise ValueError(err_msg)
 
+        if self.locus_index is not None and len(self.locus_index) != len(self.pca_loadings_df):
+            err_msg = (
+                f"Locus index has {len(self.locus_index)} loci, "
+                f"but PC loadings have {len(self.pca_loadings_df)}"
+            )
+            raise ValueError(err_msg)
+
+        if self.forest is None:
+            structs.force_setattr(self, "forest", FlatForest.from_sklearn(self.rfc))
+
+    def get_locus_index(self) -> LocusIndex:
+        """The locus index of the PCA loadings, built now if the model was loaded without one."""
+        if self.locus_index is not None:
+            return self.locus_index
+
+        return LocusIndex.from_loci(self.pca_loadings_df.index)
+
     def predict_proba(self, genotypes: pd.DataFrame) -> tuple[dict[str, list[float]], pd.DataFrame]:
         """
         Predict population probabilities from dosage matrix.
@@ -65,64 +92,29 @@ class AncestryModel(Struct, frozen=True, forbid_unknown_fields=True, rename="cam
             Xpc = genotypes.T @ self.pca_loadings_df
 
         logger.debug("finished computing PCA transformation in %f seconds", timer.elapsed_time)
-        logger.debug("computing RFC classification")
-
-        with Timer() as timer:
-            probs = self.rfc.predict_proba(Xpc)
-
-        logger.debug("finished computing RFC classification in %f seconds", timer.elapsed_time)
 
         Xpc_dict = Xpc.T.to_dict(orient="list")
 
-        return Xpc_dict, pd.DataFrame(probs, index=genotypes.columns, columns=POPS)
+        return Xpc_dict, self.predict_proba_from_pcs(Xpc)
 
+    def predict_proba_from_pcs(self, Xpc: pd.DataFrame) -> pd.DataFrame:
+        """
+        Predict population probabilities from the projection of genotypes onto the PCA loadings.
 
-def _package_ancestry_response_from_pop_probs(
-    pcs_for_plotting: dict[str, list[float]],
-    pop_probs_df: pd.DataFrame,
-    n_snps: int,
-) -> AncestryResults:
-    """Fill out AncestryResults using filepath, numerical model output and sample-wise missingnesses."""
-    superpop_probs_df = _superpop_probs_from_pop_probs(pop_probs_df)
-    ancestry_results = []
-
-    for (sample_id, sample_pop_probs), (_sample_id2, sample_superpop_probs) in zip(
-        pop_probs_df.iterrows(), superpop_probs_df.iterrows(), strict=True
-    ):
-        if not isinstance(sample_id, str):
-            # just spoonfeeding mypy here-- this should never raise
-            err_msg = (
-                f"Expected sample_id of type str, got {sample_id} of type({type(sample_id)}) instead"
-            )
-            raise TypeError(err_msg)
+        Args:
+            Xpc: pd.DataFrame, shape (m_samples, n_pcs)
+                The principal components of each sample, with samples as rows.
+        """
+        logger.debug("computing RFC classification")
 
-        pop_probs_dict = dict(sample_pop_probs)
-        max_value = float(max(pop_probs_dict.values()))
-        top_pops = [pop for pop, value in pop_probs_dict.items() if value == max_value]
+        assert self.forest is not None
 
-        pop_vector = PopulationVector(
-            **{
-                pop: _make_trivial_probability_interval(value)
-                for (pop, value) in dict(sample_pop_probs).items()
-            }
-        )
-        superpop_vector = SuperpopVector(
-            **{
-                superpop: _make_trivial_probability_interval(value)
-                for (superpop, value) in dict(sample_superpop_probs).items()
-            }
-        )
-        ancestry_results.append(
-            AncestryScoresOneSample(
-                sample_id=sample_id,
-                top_hit=AncestryTopHit(probability=max_value, populations=top_pops),
-                populations=pop_vector,
-                superpops=superpop_vector,
-                n_snps=n_snps,
-            )
-        )
+        with Timer() as timer:
+            probs = self.forest.predict_proba(Xpc.to_numpy())
+
+        logger.debug("finished computing RFC classification in %f seconds", timer.elapsed_time)
 
-    return AncestryResults(results=ancestry_results, pcs=pcs_for_plotting)
+        return pd.DataFrame(probs, index=Xpc.index, columns=POPS)
 
 
 class AncestryModels(Struct, frozen=True, forbid_unknown_fields=True, rename="camel"):
@@ -135,10 +127,14 @@ class AncestryModels(Struct, frozen=True, forbid_unknown_fields=True, rename="ca
     array_model: AncestryModel
 
 
-def infer_ancestry(ancestry_models: AncestryModels, genotypes: Dataset) -> AncestryResults:
+def infer_ancestry(
+    ancestry_models: AncestryModels, genotypes: Dataset, n_workers: int = ANCESTRY_SCORE_N_WORKERS
+) -> AncestryResults:
     """
     Infer ancestry from genotypes using a trained model.
 
+    This is the view of `infer_ancestry_table`'s results as one Struct per sample.
+
     Parameters
     ----------
     ancestry_models: AncestryModels
@@ -147,6 +143,10 @@ def infer_ancestry(ancestry_models: AncestryModels, genotypes: Dataset) -> Ances
     genotypes: Arrow Dataset, shape (n_variants, m_samples)
         A dataset containing genotypes to be classified.
 
+    n_workers: int
+        The number of worker processes to project the samples' genotypes in,
+        as in `infer_ancestry_table`.
+
     Returns
     -------
     AncestryResults
@@ -170,6 +170,34 @@ def infer_ancestry(ancestry_models: AncestryModels, genotypes: Dataset) -> Ances
         - num_snps_selected: int
             The number of SNPs used to infer ancestry for the sample.
     """
+    return infer_ancestry_table(ancestry_models, genotypes, n_workers).to_results()
+
+
+def infer_ancestry_table(
+    ancestry_models: AncestryModels, genotypes: Dataset, n_workers: int = ANCESTRY_SCORE_N_WORKERS
+) -> AncestryResultsTable:
+    """
+    Infer ancestry from genotypes using a trained model, returning the results as arrays.
+
+    Parameters
+    ----------
+    ancestry_models: AncestryModels
+        A Struct of trained models for predicting ancestry,
+
+    genotypes: Arrow Dataset, shape (n_variants, m_samples)
+        A dataset containing genotypes to be classified.
+
+    n_workers: int
+        The number of worker processes to project the samples' genotypes in. If greater than 1,
+        and the genotypes are read from files, the samples are partitioned across Ray tasks,
+        each of which opens (memory-mapping local files) the same dosage matrix
+        and reads only its own sample columns. Otherwise, all samples are projected in this process.
+
+    Returns
+    -------
+    AncestryResultsTable
+        The population and superpopulation probabilities, and principal components, of each sample.
+    """
 
     logger.debug("Beginning ancestry inference")
 
@@ -180,18 +208,18 @@ def infer_ancestry(ancestry_models: AncestryModels, genotypes: Dataset) -> Ances
 
     pool = pa.default_memory_pool()
 
-    with Timer() as timer:
-        gnomad_model = ancestry_models.gnomad_model
-        array_model = ancestry_models.array_model
-
-        mask_gnomad = pc.field("locus").isin(gnomad_model.pca_loadings_df.index)
-        mask_array = pc.field("locus").isin(array_model.pca_loadings_df.index)
-
-        scanner_gnomad = genotypes.filter(mask_gnomad)
-        scanner_array = genotypes.filter(mask_array)
+    with span("select_model") as timer:
+        gnomad_rows, array_rows = _locus_rows(
+            genotypes,
+            [
+                ancestry_models.gnomad_model.get_locus_index(),
+                ancestry_models.array_model.get_locus_index(),
+            ],
+            pool,
+        )
 
-        gnomad_matching_row_count = scanner_gnomad.count_rows(memory_pool=pool)
-        array_matching_row_count = scanner_array.count_rows(memory_pool=pool)
+        gnomad_matching_row_count = int((gnomad_rows >= 0).sum())
+        array_matching_row_count = int((array_rows >= 0).sum())
 
         logger.debug(
             "Found %d rows in genotypes matching gnomAD PCA loadings",
@@ -209,121 +237,238 @@ def infer_ancestry(ancestry_models: AncestryModels, genotypes: Dataset) -> Ances
 
         num_snps_selected = max(gnomad_matching_row_count, array_matching_row_count)
         if gnomad_matching_row_count >= array_matching_row_count:
-            scanner = scanner_gnomad
-            ancestry_model = gnomad_model
+            locus_rows = gnomad_rows
+            ancestry_model = ancestry_models.gnomad_model
 
             logger.debug("Using gnomAD PCA loadings for ancestry inference due to lower missingness")
-
-            del scanner_array
-            del array_model
         else:
-            scanner = scanner_array
-            ancestry_model = array_model
+            locus_rows = array_rows
+            ancestry_model = ancestry_models.array_model
 
             logger.debug("Using array PCA loadings for ancestry inference due to lower missingness")
 
-            del scanner_gnomad
-            del gnomad_model
+        del gnomad_rows
+        del array_rows
 
     logger.info("Completed ancestry model selection in %f seconds", timer.elapsed_time)
 
     samples = [name for name in genotypes.schema.names if name != "locus"]
 
-    # Take chunks of up to 500 samples
-    chunk_size = ANCESTRY_SCORE_SAMPLE_CHUNK_SIZE
-    num_samples = len(samples)
-    start = 0
+    with span("project_genotypes") as timer:
+        n_workers = min(n_workers, len(samples))
+        if n_workers > 1 and isinstance(genotypes, ds.FileSystemDataset):
+            pcs = _project_genotypes_in_workers(
+                genotypes, samples, ancestry_model.pca_loadings_df, locus_rows, n_workers
+            )
+        else:
+            pcs = _project_genotypes(
+                genotypes, samples, ancestry_model.pca_loadings_df, locus_rows, pool
+            )
+        count("samples", len(samples))
 
-    all_pcs_for_plotting = {}
-    all_pop_probs_df = []
-    while start < num_samples:
-        with Timer() as timer:
-            end = min(start + chunk_size, num_samples)
-            chunk_samples = samples[start:end]
+    pool.release_unused()
+    gc.collect()
 
-            genotypes_chunk_table = scanner.to_table(["locus", *chunk_samples], memory_pool=pool)
+    logger.info(
+        "Completed PCA projection of %d samples in %f seconds. RSS: %s (MB)",
+        len(samples),
+        timer.elapsed_time,
+        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+    )
 
-            logger.info(
-                "Memory usage after dosage matrix filtering for samples %d to %d: %s (MB)",
-                start,
-                end,
-                psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-            )
+    with span("classify"):
+        Xpc = pd.DataFrame(pcs, index=samples, columns=ancestry_model.pca_loadings_df.columns)
+        pop_probs_df = ancestry_model.predict_proba_from_pcs(Xpc)
 
-            genotypes_df = genotypes_chunk_table.to_pandas().set_index("locus")
+    return AncestryResultsTable(
+        sample_ids=samples,
+        pop_probs=pop_probs_df.to_numpy(),
+        pcs=pcs,
+        pc_names=[str(column) for column in Xpc.columns],
+        n_snps=num_snps_selected,
+    )
 
-            # If there are duplicates, log them and remove them
-            if genotypes_df.index.duplicated().any():
-                logger.warning("Found duplicate loci in genotypes, removing duplicates")
-                genotypes_df = genotypes_df[~genotypes_df.index.duplicated(keep="first")]
 
-            logger.info(
-                "Memory usage after converting table to Pandas dataframe, for samples %d to %d: %s (MB)",
-                start,
-                end,
-                psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-            )
+def _locus_rows(
+    genotypes: Dataset,
+    locus_indices: list[LocusIndex],
+    pool: pa.MemoryPool,
+    batch_size: int = ANCESTRY_SCORE_LOCUS_BATCH_SIZE,
+) -> list[np.ndarray]:
+    """
+    Align the loci of the genotypes to the PCA loadings of each model, in one pass over the loci.
 
-            missing_rows = list(set(ancestry_model.pca_loadings_df.index) - set(genotypes_df.index))
-            if missing_rows:
-                missing_rows_df = pd.DataFrame(
-                    np.ones((len(missing_rows), len(genotypes_df.columns))),
-                    index=missing_rows,
-                    columns=genotypes_df.columns,
-                )
-                genotypes_df = pd.concat([genotypes_df, missing_rows_df])
+    Returns
+    -------
+    list[np.ndarray]
+        For each locus index, the loadings row of each row of the genotypes, or -1 for loci
+        not in the model.
+    """
+    rows: list[list[np.ndarray]] = [[] for _ in locus_indices]
+    for batch in genotypes.to_batches(columns=["locus"], batch_size=batch_size, memory_pool=pool):
+        keys = hash_loci(batch.column(0))
+        for model_rows, locus_index in zip(rows, locus_indices, strict=True):
+            model_rows.append(locus_index.lookup_keys(keys))
+
+    return [
+        np.concatenate(model_rows) if model_rows else np.empty(0, dtype=np.int32) for model_rows in rows
+    ]
+
+
+def _project_genotypes(
+    genotypes: Dataset,
+    samples: list[str],
+    pca_loadings_df: pd.DataFrame,
+    locus_rows: np.ndarray,
+    pool: pa.MemoryPool,
+    batch_size: int = ANCESTRY_SCORE_LOCUS_BATCH_SIZE,
+) -> np.ndarray:
+    """
+    Project the genotypes of all samples onto the PCA loadings, reading the dosage matrix once.
 
-            genotypes_df[genotypes_df.isna() | (genotypes_df < 0)] = 1
+    Missing and negative dosages, and loci of the loadings that are absent from the genotypes,
+    are scored as a dosage of 1. So each sample's projection starts as the sum of the loadings,
+    and each locus read adds (dosage - 1) times its loadings. Only the first row of a duplicated
+    locus is scored.
 
-            pcs_for_plotting, pop_probs_df = ancestry_model.predict_proba(genotypes_df)
+    Parameters
+    ----------
+    genotypes: Arrow Dataset, shape (n_variants, m_samples)
+        The genotypes, with a "locus" column and one column per sample.
+    samples: list[str]
+        The sample columns to project.
+    pca_loadings_df: pd.DataFrame, shape (n_pcs_loci, n_pcs)
+        The PCA loadings, indexed by locus.
+    locus_rows: np.ndarray, shape (n_variants,)
+        The loadings row of each row of the genotypes, or -1 for loci not in the loadings,
+        as found by `_locus_rows`.
+    pool: pa.MemoryPool
+        The memory pool to read batches into.
+    batch_size: int
+        The maximum number of loci read at a time.
 
-            all_pcs_for_plotting.update(pcs_for_plotting)
-            all_pop_probs_df.append(pop_probs_df)
+    Returns
+    -------
+    np.ndarray, shape (m_samples, n_pcs)
+        The float32 projection of each sample.
+    """
+    loadings = pca_loadings_df.to_numpy(dtype=np.float32)
 
-        # We must manually free memory, because
-        # otherwise it appears Python has a tough time coping
-        # with the size of allocations, which can reach into gigabytes per loop iteration
-        del genotypes_df
-        del genotypes_chunk_table
-        pool.release_unused()
-        gc.collect()
+    projection = np.empty((len(samples), loadings.shape[1]), dtype=np.float32)
+    projection[:] = loadings.sum(axis=0)
 
-        logger.info(
-            "Completed ancestry inference for samples %d to %d in %f seconds. RSS: %s (MB)",
-            start,
-            end,
-            timer.elapsed_time,
-            psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-        )
+    # The rows of the genotypes that are scored: the first row of each locus in the loadings
+    keep = np.zeros(len(locus_rows), dtype=bool)
+    keep[np.unique(locus_rows, return_index=True)[1]] = True
+    keep &= locus_rows >= 0
 
-        start = end
+    n_duplicates = int((locus_rows >= 0).sum() - keep.sum())
+    if n_duplicates > 0:
+        logger.warning("Found %d duplicate loci in genotypes, using the first of each", n_duplicates)
 
-    return _package_ancestry_response_from_pop_probs(
-        all_pcs_for_plotting, pd.concat(all_pop_probs_df), num_snps_selected
-    )
+    dosages = np.empty((batch_size, len(samples)), dtype=np.float32)
+    offset = 0
+    for batch in genotypes.to_batches(columns=samples, batch_size=batch_size, memory_pool=pool):
+        batch_keep = keep[offset : offset + batch.num_rows]
+        batch_rows = locus_rows[offset : offset + batch.num_rows][batch_keep]
+        offset += batch.num_rows
+
+        if len(batch_rows) == 0:
+            continue
+
+        if len(batch_rows) < batch.num_rows:
+            batch = batch.filter(pa.array(batch_keep))
+
+        if batch.num_rows > len(dosages):
+            dosages = np.empty((batch.num_rows, len(samples)), dtype=np.float32)
+
+        batch_dosages = dosages[: batch.num_rows]
+        for i in range(len(samples)):
+            batch_dosages[:, i] = batch.column(i).to_numpy(zero_copy_only=False)
 
+        # Missing (NaN) and negative dosages are scored as 1, adding nothing to the projection
+        batch_dosages -= 1
+        batch_dosages[~(batch_dosages >= -1)] = 0
 
-def _superpop_probs_from_pop_probs(pop_probs: pd.DataFrame) -> pd.DataFrame:
-    """Given a matrix of population probabilities, convert to matrix of superpop probabilities."""
-    N = len(pop_probs)
-    pops = sorted(SUPERPOP_FROM_POP.keys())
-    superpops = sorted(set(SUPERPOP_FROM_POP.values()))
-    superpop_projection_matrix = pd.DataFrame(
-        np.array([[int(superpop == SUPERPOP_FROM_POP[pop]) for superpop in superpops] for pop in pops]),
-        index=POPS,
-        columns=SUPERPOPS,
+        projection += batch_dosages.T @ loadings[batch_rows]
+
+    if offset != len(locus_rows):
+        raise ValueError(f"Expected {len(locus_rows)} rows of genotypes, read {offset}")
+
+    return projection
+
+
+@ray.remote
+def _project_genotypes_task(
+    files: list[str],
+    file_format: ds.FileFormat,
+    filesystem: FileSystem,
+    samples: list[str],
+    pca_loadings_df: pd.DataFrame,
+    locus_rows: np.ndarray,
+    batch_size: int,
+) -> np.ndarray:
+    """Project one partition of the samples, reading their columns of the dosage matrix files."""
+    genotypes = ds.dataset(files, format=file_format, filesystem=filesystem)
+
+    return _project_genotypes(
+        genotypes, samples, pca_loadings_df, locus_rows, pa.default_memory_pool(), batch_size
     )
-    superpop_probs = pop_probs @ superpop_projection_matrix
-    assert_equals(
-        "Expected superpop_probs shape (N x |superpops|):",
-        superpop_probs.shape,
-        "Actual shape",
-        (N, len(superpops)),
+
+
+def _project_genotypes_in_workers(
+    genotypes: ds.FileSystemDataset,
+    samples: list[str],
+    pca_loadings_df: pd.DataFrame,
+    locus_rows: np.ndarray,
+    n_workers: int,
+    batch_size: int = ANCESTRY_SCORE_LOCUS_BATCH_SIZE,
+) -> np.ndarray:
+    """
+    Project the genotypes of the samples as `_project_genotypes` does, partitioning the samples
+    into `n_workers` contiguous ranges, each projected by a Ray task.
+
+    The loadings and locus rows are put in the object store once, and shared by the tasks.
+    Each task opens the dosage matrix files itself, memory-mapped if they are local,
+    so only its own sample columns are read, and the driver concatenates the projections
+    in the order of the samples.
+
+    Returns
+    -------
+    np.ndarray, shape (m_samples, n_pcs)
+        The float32 projection of each sample.
+    """
+    if not ray.is_initialized():
+        ray.init()
+
+    filesystem = genotypes.filesystem
+    if isinstance(filesystem, LocalFileSystem):
+        filesystem = LocalFileSystem(use_mmap=True)
+
+    loadings_ref = ray.put(pca_loadings_df)
+    locus_rows_ref = ray.put(locus_rows)
+
+    partitions = [
+        partition.tolist() for partition in np.array_split(np.asarray(samples, dtype=object), n_workers)
+    ]
+    logger.info(
+        "Projecting %d samples in %d workers, of up to %d samples each",
+        len(samples),
+        len(partitions),
+        max(len(partition) for partition in partitions),
     )
-    return superpop_probs
 
+    tasks = [
+        _project_genotypes_task.remote(
+            genotypes.files,
+            genotypes.format,
+            filesystem,
+            partition,
+            loadings_ref,
+            locus_rows_ref,
+            batch_size,
+        )
+        for partition in partitions
+    ]
 
-def _make_trivial_probability_interval(x: float) -> ProbabilityInterval:
-    """Promote a value to a trivial ProbabilityInterval with equal lower, upper bounds."""
-    # The ancestry calculations come out as np.float64, which is not JSON serializable in msgspec.
-    return ProbabilityInterval(float(x), float(x))
+    return np.concatenate(ray.get(tasks))
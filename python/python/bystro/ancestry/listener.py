@@ -2,18 +2,18 @@
 
 import argparse
 import logging
+import os
 from pathlib import Path
 
-import msgspec
 import pyarrow.dataset as ds  # type: ignore
 from ruamel.yaml import YAML
 
-from bystro.ancestry.ancestry_types import AncestryResults
-from bystro.ancestry.inference import infer_ancestry
+from bystro.ancestry.inference import infer_ancestry_table
+from bystro.ancestry.results_table import AncestryResultsTable
 from bystro.beanstalkd.messages import BaseMessage, CompletedJobMessage, SubmittedJobMessage
 from bystro.beanstalkd.worker import ProgressPublisher, QueueConf, get_progress_reporter, listen
 
-from bystro.ancestry.model import get_models_from_s3
+from bystro.ancestry.model import get_models_from_s3, preload_models
 
 logging.basicConfig(
     filename="ancestry_listener.log",
@@ -24,6 +24,9 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 ANCESTRY_TUBE = "ancestry"
+# The results are always written as a Parquet table; with "json", the default,
+# the JSON view of the results is written as well, and is the result path sent to the API server
+ANCESTRY_RESULTS_FORMAT = os.getenv("ANCESTRY_RESULTS_FORMAT", "json")
 
 class AncestryJobData(BaseMessage, frozen=True, rename="camel"):
     """
@@ -59,7 +62,7 @@ def _load_queue_conf(queue_conf_path: str) -> QueueConf:
     return QueueConf(addresses=beanstalk_conf["addresses"], tubes=beanstalk_conf["tubes"])
 
 
-def handler_fn(publisher: ProgressPublisher, job_data: AncestryJobData) -> AncestryResults:
+def handler_fn(publisher: ProgressPublisher, job_data: AncestryJobData) -> AncestryResultsTable:
     """Do ancestry job, wrapping infer_ancestry for beanstalk."""
     # Separating _handler_fn from infer_ancestry in order to separate ML from infra concerns,
     # and especially to keep infer_ancestry eager.
@@ -72,7 +75,7 @@ def handler_fn(publisher: ProgressPublisher, job_data: AncestryJobData) -> Ances
 
     ancestry_models = get_models_from_s3(job_data.assembly)
 
-    return infer_ancestry(ancestry_models, dataset)
+    return infer_ancestry_table(ancestry_models, dataset)
 
 
 def submit_msg_fn(ancestry_job_data: AncestryJobData) -> SubmittedJobMessage:
@@ -82,17 +85,17 @@ def submit_msg_fn(ancestry_job_data: AncestryJobData) -> SubmittedJobMessage:
 
 
 def completed_msg_fn(
-    ancestry_job_data: AncestryJobData, results: AncestryResults
+    ancestry_job_data: AncestryJobData, results: AncestryResultsTable
 ) -> AncestryJobCompleteMessage:
-    """Send job complete message."""
+    """Write the results, and send job complete message."""
     logger.debug("entering completed_msg_fn: %s", ancestry_job_data)
 
-    json_data = msgspec.json.encode(results)
+    out_path = str(Path(ancestry_job_data.out_dir) / "ancestry_results.parquet")
+    results.write_parquet(out_path)
 
-    out_path = str(Path(ancestry_job_data.out_dir) / "ancestry_results.json")
-
-    with open(out_path, "wb") as f:
-        f.write(json_data)
+    if ANCESTRY_RESULTS_FORMAT == "json":
+        out_path = str(Path(ancestry_job_data.out_dir) / "ancestry_results.json")
+        results.write_json(out_path)
 
     return AncestryJobCompleteMessage(
         submission_id=ancestry_job_data.submission_id, result_path=out_path
@@ -107,9 +110,17 @@ if __name__ == "__main__":
         help="Path to the beanstalkd queue config yaml file (e.g beanstalk1.yml)",
         required=True,
     )
+    parser.add_argument(
+        "--preload_assemblies",
+        nargs="*",
+        default=[],
+        help="Assemblies whose ancestry models are loaded before listening (e.g. hg38 hg19)",
+    )
     args = parser.parse_args()
     queue_conf = _load_queue_conf(args.queue_conf)
 
+    preload_models(args.preload_assemblies)
+
     logger.info(
         "Ancestry worker is listening on addresses: %s, tube: %s...", queue_conf.addresses, ANCESTRY_TUBE
     )
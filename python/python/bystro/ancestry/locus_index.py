@@ -0,0 +1,145 @@
+"""
+Hashed index of the loci of an ancestry model's PCA loadings
+
+Each `chrom:pos:ref:alt` locus is hashed to a uint64 key, with pandas' stable (keyed SipHash)
+`hash_array`, and the keys are kept sorted, alongside the loadings row of each. Looking up the loci
+of a dosage matrix is then one vectorized hash and binary search per batch of loci, rather than
+building a set of the model's loci for every job.
+
+Keys are checked to be unique when the index is built. A locus absent from the model could
+share a key with one of the model's loci, but with 64-bit keys this is vanishingly unlikely.
+
+The index of a model is saved next to its PCA loadings file, and is rebuilt when that file changes.
+"""
+
+import logging
+import os
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+LOCUS_INDEX_SUFFIX = ".locus_index.npz"
+
+
+def hash_loci(loci: Sequence[str] | np.ndarray | pa.Array | pa.ChunkedArray) -> np.ndarray:
+    """Hash `chrom:pos:ref:alt` loci to uint64 keys"""
+    if isinstance(loci, pa.Array | pa.ChunkedArray):
+        loci = loci.to_numpy(zero_copy_only=False)
+
+    return pd.util.hash_array(np.asarray(loci, dtype=object))
+
+
+class LocusIndex:
+    """
+    Sorted uint64 keys of a model's loci, with the row of each in the model's PCA loadings
+
+    Args:
+        keys (np.ndarray): The sorted, unique, uint64 keys of the loci
+        rows (np.ndarray): The row of each key's locus in the PCA loadings
+    """
+
+    def __init__(self, keys: np.ndarray, rows: np.ndarray):
+        if len(keys) != len(rows):
+            raise ValueError(f"Expected one row per key, got {len(keys)} keys and {len(rows)} rows")
+
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_loci(cls, loci: Sequence[str] | pd.Index) -> "LocusIndex":
+        """Index the loci of a model's PCA loadings, in the order of its rows"""
+        keys = hash_loci(np.asarray(loci, dtype=object))
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+            raise ValueError("PCA loadings loci must be unique, and have unique hashes")
+
+        return cls(keys, order.astype(np.int32))
+
+    def lookup(self, loci: Sequence[str] | np.ndarray | pa.Array | pa.ChunkedArray) -> np.ndarray:
+        """The loadings row of each locus, or -1 for loci not in the model"""
+        return self.lookup_keys(hash_loci(loci))
+
+    def lookup_keys(self, keys: np.ndarray) -> np.ndarray:
+        """The loadings row of each locus key, or -1 for keys not in the model"""
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int32)
+
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys
+
+        return np.where(found, self.rows[positions], -1).astype(np.int32, copy=False)
+
+    def save(self, path: str, source_path: str | None = None):
+        """
+        Save the index, recording the size and modification time of the file it was built from
+
+        Args:
+            path (str): The path to save the index to
+            source_path (str, optional): The PCA loadings file the index was built from
+        """
+        source_stat = _file_stat(source_path) if source_path is not None else np.zeros(2, np.int64)
+
+        # Written under a temporary name, so a concurrent load never sees a partial index
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, keys=self.keys, rows=self.rows, source_stat=source_stat)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, source_path: str | None = None) -> "LocusIndex | None":
+        """
+        Load a saved index, or return None if it is missing, unreadable,
+        or was built from a different version of `source_path`
+        """
+        try:
+            with np.load(path) as saved:
+                if source_path is not None and not np.array_equal(
+                    saved["source_stat"], _file_stat(source_path)
+                ):
+                    return None
+
+                return cls(saved["keys"], saved["rows"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def _file_stat(path: str) -> np.ndarray:
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_or_build_locus_index(pca_path: str, loci: Sequence[str] | pd.Index) -> LocusIndex:
+    """
+    Load the locus index saved next to a PCA loadings file, or build it from `loci` and save it
+
+    Args:
+        pca_path (str): The path of the PCA loadings file
+        loci (Sequence[str] | pd.Index): The loci of the PCA loadings, in the order of its rows
+
+    Returns:
+        LocusIndex: The index of the loadings' loci
+    """
+    index_path = f"{pca_path}{LOCUS_INDEX_SUFFIX}"
+
+    locus_index = LocusIndex.load(index_path, pca_path)
+    if locus_index is not None and len(locus_index) == len(loci):
+        logger.info("Loaded locus index %s", index_path)
+        return locus_index
+
+    locus_index = LocusIndex.from_loci(loci)
+    try:
+        locus_index.save(index_path, pca_path)
+        logger.info("Saved locus index %s", index_path)
+    except OSError:
+        logger.exception("Couldn't save locus index %s", index_path)
+
+    return locus_index
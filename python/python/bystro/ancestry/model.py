@@ -1,14 +1,32 @@
-"""Provide a worker for the ancestry model."""
+"""
+Provide a worker for the ancestry model.
+
+Parsing the PCA loadings CSV is slow, so once parsed, a model is written
+to a binary bundle in a versioned cache directory, ANCESTRY_MODEL_CACHE_DIR/v<MODEL_BUNDLE_VERSION>:
+    - loadings.npy: the float32 PCA loadings, memory-mapped when loaded
+    - loci.arrow: the locus of each row of the loadings, as an Arrow IPC file
+    - rfc.skops: the RFC, stored with skops, as the RFC files are, since the cache directory is shared
+    - manifest.json: the bundle's version, the PC columns, and the size and modification time
+      of the files the bundle was built from, so that it is rebuilt when they change
+Later loads, in this or any other process, read the bundle instead.
+"""
 
 import logging
+import shutil
 from pathlib import Path
 
 import boto3  # type: ignore
 from botocore.exceptions import ClientError  # type: ignore
+import msgspec
+from msgspec import Struct
+import numpy as np
 import pandas as pd
-from skops.io import load as skops_load  # type: ignore
+import pyarrow as pa  # type: ignore
+import sklearn  # type: ignore
+from skops.io import dump as skops_dump, load as skops_load  # type: ignore
 
 from bystro.ancestry.inference import AncestryModel, AncestryModels
+from bystro.ancestry.locus_index import load_or_build_locus_index
 
 from bystro.utils.timer import Timer
 import os
@@ -28,7 +46,145 @@ GNOMAD_RFC_FILE = "gnomadset_rfc.skop"
 ARRAY_PCA_FILE = "arrayset_pca.csv"
 ARRAY_RFC_FILE = "arrayset_rfc.skop"
 
+# Bump when the layout of model bundles changes, so that older bundles are ignored rather than misread
+MODEL_BUNDLE_VERSION = 2
+ANCESTRY_MODEL_CACHE_DIR = os.getenv(
+    "ANCESTRY_MODEL_CACHE_DIR", str(Path(ANCESTRY_MODEL_DIR) / "model_cache")
+)
+MODEL_BUNDLE_MANIFEST = "manifest.json"
+MODEL_BUNDLE_LOADINGS = "loadings.npy"
+MODEL_BUNDLE_LOCI = "loci.arrow"
+MODEL_BUNDLE_RFC = "rfc.skops"
+
 models_cache: dict[str, AncestryModels] = {}
+# The number of assemblies whose models are kept in models_cache; raised by preload_models
+models_cache_size = 1
+
+
+class ModelBundleManifest(Struct, frozen=True):
+    """
+    Describes a binary model bundle, and the files it was built from
+
+    Attributes:
+        version: int
+            The MODEL_BUNDLE_VERSION the bundle was written with
+        sklearn_version: str
+            The version of scikit-learn the RFC was stored with
+        pca_path: str
+            The PCA loadings file the bundle was built from
+        pca_stat: list[int]
+            The size and modification time, in nanoseconds, of the PCA loadings file
+        rfc_path: str
+            The RFC file the bundle was built from
+        rfc_stat: list[int]
+            The size and modification time, in nanoseconds, of the RFC file
+        pc_columns: list[str]
+            The columns of the PCA loadings
+    """
+
+    version: int
+    sklearn_version: str
+    pca_path: str
+    pca_stat: list[int]
+    rfc_path: str
+    rfc_stat: list[int]
+    pc_columns: list[str]
+
+
+def _file_stat(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _bundle_dir(pca_path: str) -> Path:
+    return Path(ANCESTRY_MODEL_CACHE_DIR) / f"v{MODEL_BUNDLE_VERSION}" / Path(pca_path).stem
+
+
+def write_model_bundle(model: AncestryModel, bundle_dir: Path, pca_path: str, rfc_path: str) -> None:
+    """
+    Write a model to a binary bundle, replacing any stale bundle in `bundle_dir`.
+
+    Args:
+        model (AncestryModel): The model to write.
+        bundle_dir (Path): The directory of the bundle.
+        pca_path (str): The PCA loadings file the model was loaded from.
+        rfc_path (str): The RFC file the model was loaded from.
+    """
+    manifest = ModelBundleManifest(
+        version=MODEL_BUNDLE_VERSION,
+        sklearn_version=sklearn.__version__,
+        pca_path=str(Path(pca_path).resolve()),
+        pca_stat=_file_stat(pca_path),
+        rfc_path=str(Path(rfc_path).resolve()),
+        rfc_stat=_file_stat(rfc_path),
+        pc_columns=[str(column) for column in model.pca_loadings_df.columns],
+    )
+
+    # Written to a temporary directory first, so that a concurrent load never sees a partial bundle
+    tmp_dir = bundle_dir.with_name(f"{bundle_dir.name}.{os.getpid()}.tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        np.save(tmp_dir / MODEL_BUNDLE_LOADINGS, model.pca_loadings_df.to_numpy(dtype=np.float32))
+
+        loci = pa.table({"locus": pa.array(model.pca_loadings_df.index.astype(str), pa.string())})
+        with (
+            pa.OSFile(str(tmp_dir / MODEL_BUNDLE_LOCI), "wb") as sink,
+            pa.ipc.new_file(sink, loci.schema) as writer,
+        ):
+            writer.write_table(loci)
+
+        skops_dump(model.rfc, tmp_dir / MODEL_BUNDLE_RFC)
+
+        with open(tmp_dir / MODEL_BUNDLE_MANIFEST, "wb") as fh:
+            fh.write(msgspec.json.encode(manifest))
+
+        if bundle_dir.exists():
+            shutil.rmtree(bundle_dir)
+        os.replace(tmp_dir, bundle_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_model_bundle(bundle_dir: Path, pca_path: str, rfc_path: str) -> AncestryModel | None:
+    """
+    Load a model from its binary bundle, memory-mapping the PCA loadings.
+
+    Args:
+        bundle_dir (Path): The directory of the bundle.
+        pca_path (str): The PCA loadings file the bundle should have been built from.
+        rfc_path (str): The RFC file the bundle should have been built from.
+
+    Returns:
+        AncestryModel | None: The model, or None if the bundle is missing, of another version,
+            or was built from other files, or other versions of them.
+    """
+    try:
+        with open(bundle_dir / MODEL_BUNDLE_MANIFEST, "rb") as fh:
+            manifest = msgspec.json.decode(fh.read(), type=ModelBundleManifest)
+    except (OSError, msgspec.DecodeError):
+        return None
+
+    if (
+        manifest.version != MODEL_BUNDLE_VERSION
+        or manifest.sklearn_version != sklearn.__version__
+        or manifest.pca_path != str(Path(pca_path).resolve())
+        or manifest.rfc_path != str(Path(rfc_path).resolve())
+        or manifest.pca_stat != _file_stat(pca_path)
+        or manifest.rfc_stat != _file_stat(rfc_path)
+    ):
+        return None
+
+    loadings = np.load(bundle_dir / MODEL_BUNDLE_LOADINGS, mmap_mode="r")
+    with pa.memory_map(str(bundle_dir / MODEL_BUNDLE_LOCI)) as source:
+        loci = pa.ipc.open_file(source).read_all().column("locus").to_numpy(zero_copy_only=False)
+
+    rfc = skops_load(bundle_dir / MODEL_BUNDLE_RFC)
+
+    pca_loadings_df = pd.DataFrame(loadings, index=loci, columns=manifest.pc_columns, copy=False)
+
+    locus_index = load_or_build_locus_index(pca_path, pca_loadings_df.index)
+
+    return AncestryModel(pca_loadings_df, rfc, locus_index)
 
 
 def get_one_model_from_s3(
@@ -81,6 +237,14 @@ def get_one_model_from_s3(
     return get_one_model_from_file_system(pca_local_path, rfc_local_path)
 
 
+def _cache_models(assembly: str, models: AncestryModels) -> None:
+    """Add the models of an assembly to models_cache, removing the oldest to keep to its size"""
+    while len(models_cache) >= models_cache_size:
+        oldest_assembly = next(iter(models_cache))
+        del models_cache[oldest_assembly]
+    models_cache[assembly] = models
+
+
 def get_models_from_s3(assembly: str) -> AncestryModels:
     """
     Load the ancestry models for the given assembly from S3.
@@ -128,12 +292,7 @@ def get_models_from_s3(assembly: str) -> AncestryModels:
 
         models = AncestryModels(gnomad_model, array_model)
 
-    # Update the cache with the new model
-    if len(models_cache) >= 1:
-        # Remove the oldest loaded model to maintain cache size
-        oldest_assembly = next(iter(models_cache))
-        del models_cache[oldest_assembly]
-    models_cache[assembly] = models
+    _cache_models(assembly, models)
 
     return models
 
@@ -142,6 +301,11 @@ def get_one_model_from_file_system(pca_path: str, rfc_path: str) -> AncestryMode
     """
     Load an ancestry model from the local file system.
 
+    The model is loaded from its binary bundle if one was built from these files;
+    otherwise the files are parsed, and the bundle is written for later loads.
+    The locus index of the PCA loadings is loaded from next to the PCA file,
+    or built and saved there if missing or stale.
+
     Args:
         pca_path (str): The path to the PCA file.
         rfc_path (str): The path to the RFC file.
@@ -149,16 +313,55 @@ def get_one_model_from_file_system(pca_path: str, rfc_path: str) -> AncestryMode
     Returns:
         AncestryModel: The loaded ancestry model.
     """
+    bundle_dir = _bundle_dir(pca_path)
+
+    with Timer() as timer:
+        model = load_model_bundle(bundle_dir, pca_path, rfc_path)
+
+    if model is not None:
+        logger.debug("Loaded model bundle %s in %f seconds", bundle_dir, timer.elapsed_time)
+        return model
+
     with Timer() as timer:
         logger.info("Loading PCA file %s", pca_path)
-        pca_loadings_df = pd.read_csv(pca_path, index_col=0)
+        pca_loadings_df = pd.read_csv(pca_path, index_col=0).astype(np.float32)
 
         logger.info("Loading RFC file %s", rfc_path)
         rfc = skops_load(rfc_path)
 
+        locus_index = load_or_build_locus_index(pca_path, pca_loadings_df.index)
+
     logger.debug("Loaded PCA and RFC files in %f seconds", timer.elapsed_time)
 
-    return AncestryModel(pca_loadings_df, rfc)
+    model = AncestryModel(pca_loadings_df, rfc, locus_index)
+
+    try:
+        write_model_bundle(model, bundle_dir, pca_path, rfc_path)
+        logger.info("Wrote model bundle %s", bundle_dir)
+    except OSError:
+        logger.exception("Couldn't write model bundle %s", bundle_dir)
+
+    return model
+
+
+def preload_models(assemblies: list[str]) -> None:
+    """
+    Load the ancestry models of each assembly, so that the first job of a listener doesn't wait on them.
+
+    Models are fetched from S3 if not on disk, and their binary bundles are written if missing.
+    The in-process cache is made large enough to keep the models of every preloaded assembly.
+
+    Args:
+        assemblies (list[str]): The genome assemblies to load the models for.
+    """
+    global models_cache_size
+    models_cache_size = max(models_cache_size, len(set(assemblies)))
+
+    for assembly in assemblies:
+        with Timer() as timer:
+            get_models_from_s3(assembly)
+
+        logger.info("Preloaded ancestry models for %s in %f seconds", assembly, timer.elapsed_time)
 
 
 def get_models_from_file_system(assembly: str) -> AncestryModels:
@@ -197,12 +400,7 @@ def get_models_from_file_system(assembly: str) -> AncestryModels:
 
     models = AncestryModels(gnomad_model, array_model)
 
-    # Update the cache with the new model
-    if len(models_cache) >= 1:
-        # Remove the oldest loaded model to maintain cache size
-        oldest_assembly = next(iter(models_cache))
-        del models_cache[oldest_assembly]
-    models_cache[assembly] = models
+    _cache_models(assembly, models)
 
     return models
 
@@ -0,0 +1,179 @@
+"""
+Columnar ancestry results
+
+`AncestryResultsTable` holds the results of an ancestry job as arrays, samples by
+populations, superpopulations, and principal components, rather than as one msgspec Struct
+per sample. It is written as a Parquet table, with the columns:
+    - sample_id: the sample's id
+    - n_snps: the number of SNPs used to infer ancestry
+    - top_hit_population, top_hit_probability: the sample's most probable population
+      (the first, in the order of POPS, if several are tied), and its probability
+    - populations.<pop>: the probability of each population, in the order of POPS
+    - superpops.<superpop>: the probability of each superpopulation, in the order of SUPERPOPS
+    - pcs.<pc>: the sample's principal components
+
+The JSON `AncestryResults` are a view of the table, generated on request with `to_results`.
+"""
+
+import numpy as np
+import pyarrow as pa  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
+from msgspec import json
+
+from bystro.ancestry.ancestry_types import (
+    AncestryResults,
+    AncestryScoresOneSample,
+    AncestryTopHit,
+    PopulationVector,
+    ProbabilityInterval,
+    SuperpopVector,
+)
+from bystro.ancestry.asserts import assert_equals
+from bystro.ancestry.train import POPS, SUPERPOP_FROM_POP, SUPERPOPS
+
+# Maps population probabilities, in the order of POPS, to superpopulation probabilities,
+# in the order of SUPERPOPS
+_SUPERPOP_PROJECTION = np.array(
+    [[float(superpop == SUPERPOP_FROM_POP[pop]) for superpop in SUPERPOPS] for pop in POPS]
+)
+
+
+def superpop_probs_from_pop_probs(pop_probs: np.ndarray) -> np.ndarray:
+    """Given a matrix of population probabilities, convert to matrix of superpop probabilities."""
+    superpop_probs = pop_probs @ _SUPERPOP_PROJECTION
+    assert_equals(
+        "Expected superpop_probs shape (N x |superpops|):",
+        superpop_probs.shape,
+        "Actual shape",
+        (len(pop_probs), len(SUPERPOPS)),
+    )
+    return superpop_probs
+
+
+class AncestryResultsTable:
+    """
+    The ancestry results of a study, as arrays with one row per sample
+
+    Args:
+        sample_ids (list[str]): The id of each sample
+        pop_probs (np.ndarray): The probability of each population, in the order of POPS,
+            shape (n_samples, n_pops)
+        pcs (np.ndarray): The principal components of each sample, shape (n_samples, n_pcs)
+        pc_names (list[str]): The name of each principal component
+        n_snps (int): The number of SNPs used to infer ancestry
+    """
+
+    def __init__(
+        self,
+        sample_ids: list[str],
+        pop_probs: np.ndarray,
+        pcs: np.ndarray,
+        pc_names: list[str],
+        n_snps: int,
+    ):
+        if pop_probs.shape != (len(sample_ids), len(POPS)):
+            raise ValueError(
+                f"Expected population probabilities of shape {(len(sample_ids), len(POPS))}, "
+                f"got {pop_probs.shape}"
+            )
+        if pcs.shape != (len(sample_ids), len(pc_names)):
+            raise ValueError(
+                f"Expected principal components of shape {(len(sample_ids), len(pc_names))}, "
+                f"got {pcs.shape}"
+            )
+
+        self.sample_ids = sample_ids
+        self.pop_probs = pop_probs
+        self.superpop_probs = superpop_probs_from_pop_probs(pop_probs)
+        self.pcs = pcs
+        self.pc_names = pc_names
+        self.n_snps = n_snps
+
+    def __len__(self) -> int:
+        return len(self.sample_ids)
+
+    def to_table(self) -> pa.Table:
+        top_hits = np.argmax(self.pop_probs, axis=1)
+        rows = np.arange(len(self))
+
+        columns = {
+            "sample_id": pa.array(self.sample_ids, pa.string()),
+            "n_snps": pa.array(np.full(len(self), self.n_snps, dtype=np.int64)),
+            "top_hit_population": pa.array(POPS[top_hits], pa.string()),
+            "top_hit_probability": pa.array(self.pop_probs[rows, top_hits]),
+        }
+        for i, pop in enumerate(POPS):
+            columns[f"populations.{pop}"] = pa.array(self.pop_probs[:, i])
+        for i, superpop in enumerate(SUPERPOPS):
+            columns[f"superpops.{superpop}"] = pa.array(self.superpop_probs[:, i])
+        for i, pc_name in enumerate(self.pc_names):
+            columns[f"pcs.{pc_name}"] = pa.array(self.pcs[:, i])
+
+        return pa.table(columns)
+
+    def write_parquet(self, path: str) -> None:
+        pq.write_table(self.to_table(), path)
+
+    @classmethod
+    def read_parquet(cls, path: str) -> "AncestryResultsTable":
+        table = pq.read_table(path)
+
+        def matrix(prefix: str, names: list[str]) -> np.ndarray:
+            if not names:
+                return np.empty((table.num_rows, 0))
+            return np.column_stack([table.column(f"{prefix}.{name}").to_numpy() for name in names])
+
+        pc_names = [name[len("pcs.") :] for name in table.column_names if name.startswith("pcs.")]
+        n_snps = table.column("n_snps")
+
+        return cls(
+            sample_ids=table.column("sample_id").to_pylist(),
+            pop_probs=matrix("populations", list(POPS)),
+            pcs=matrix("pcs", pc_names),
+            pc_names=pc_names,
+            n_snps=int(n_snps[0].as_py()) if len(n_snps) > 0 else 0,
+        )
+
+    def to_results(self) -> AncestryResults:
+        """The results as msgspec Structs, one per sample, as written to the JSON results"""
+        top_probs = self.pop_probs.max(axis=1)
+        is_top = self.pop_probs == top_probs[:, np.newaxis]
+
+        results = []
+        for sample_id, pop_probs, superpop_probs, top_prob, sample_is_top in zip(
+            self.sample_ids,
+            self.pop_probs.tolist(),
+            self.superpop_probs.tolist(),
+            top_probs.tolist(),
+            is_top,
+            strict=True,
+        ):
+            results.append(
+                AncestryScoresOneSample(
+                    sample_id=sample_id,
+                    top_hit=AncestryTopHit(
+                        probability=top_prob, populations=POPS[sample_is_top].tolist()
+                    ),
+                    populations=PopulationVector(
+                        **{
+                            pop: ProbabilityInterval(prob, prob)
+                            for pop, prob in zip(POPS, pop_probs, strict=True)
+                        }
+                    ),
+                    superpops=SuperpopVector(
+                        **{
+                            superpop: ProbabilityInterval(prob, prob)
+                            for superpop, prob in zip(SUPERPOPS, superpop_probs, strict=True)
+                        }
+                    ),
+                    n_snps=self.n_snps,
+                )
+            )
+
+        pcs = dict(zip(self.sample_ids, self.pcs.tolist(), strict=True))
+
+        return AncestryResults(results=results, pcs=pcs)
+
+    def write_json(self, path: str) -> None:
+        with open(path, "wb") as fh:
+            fh.write(json.encode(self.to_results()))
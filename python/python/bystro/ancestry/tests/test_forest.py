@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier  # type: ignore
+
+from bystro.ancestry.forest import FlatForest
+
+
+@pytest.mark.parametrize(("n_estimators", "max_depth"), [(1, 1), (10, None), (50, 8)])
+def test_flat_forest_is_bit_identical_to_sklearn(n_estimators, max_depth):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(500, 6))
+    y = rng.integers(0, 5, 500)
+    rfc = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=0).fit(
+        X, y
+    )
+
+    forest = FlatForest.from_sklearn(rfc)
+    # float64 features, some of them exactly on the float32 thresholds
+    X_test = rng.normal(size=(1000, 6))
+    X_test[:10, 0] = rfc.estimators_[0].tree_.threshold[0]
+
+    expected = rfc.predict_proba(X_test)
+
+    assert np.array_equal(forest.predict_proba(X_test), expected)
+    assert np.array_equal(forest.predict_proba(X_test, n_jobs=4, batch_size=64), expected)
+    assert forest.predict_proba(X_test[:0]).shape == (0, 5)
+    assert list(forest.classes) == list(rfc.classes_)
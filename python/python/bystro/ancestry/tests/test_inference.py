@@ -7,8 +7,17 @@ from sklearn.ensemble import RandomForestClassifier  # type: ignore
 
 import pyarrow as pa  # type: ignore
 import pyarrow.dataset as ds  # type: ignore
-
-from bystro.ancestry.inference import AncestryModel, AncestryModels, infer_ancestry
+import pyarrow.feather as feather  # type: ignore
+
+from bystro.ancestry.inference import (
+    AncestryModel,
+    AncestryModels,
+    _locus_rows,
+    _project_genotypes,
+    infer_ancestry,
+    infer_ancestry_table,
+)
+from bystro.ancestry.locus_index import LocusIndex
 from bystro.ancestry.train import POPS
 from bystro.ancestry.model import get_models_from_s3
 
@@ -82,6 +91,51 @@ def test_infer_ancestry():
     assert len(samples) == len(ancestry_response.results)
 
 
+def test_project_genotypes():
+    rng = np.random.default_rng(0)
+    loci = [f"variant{i}" for i in range(10)]
+    pca_loadings_df = pd.DataFrame(rng.random((len(loci), 3)), index=loci, columns=["pc1", "pc2", "pc3"])
+
+    # variant9 is absent, variant2 is duplicated, and variant10 is not in the loadings
+    genotype_loci = ["variant0", "variant2", "variant1", "variant10", "variant2", *loci[3:9]]
+    dosages = rng.integers(0, 3, (len(genotype_loci), 3)).astype(float)
+    dosages[0, 0] = np.nan
+    dosages[1, 1] = -1
+    genotypes = pd.DataFrame(dosages, columns=["sample1", "sample2", "sample3"])
+    genotypes.insert(0, "locus", genotype_loci)
+    dataset = ds.dataset(pa.Table.from_pandas(genotypes, preserve_index=False))
+
+    pool = pa.default_memory_pool()
+    (locus_rows,) = _locus_rows(dataset, [LocusIndex.from_loci(loci)], pool, batch_size=4)
+    assert list(locus_rows) == [0, 2, 1, -1, 2, 3, 4, 5, 6, 7, 8]
+
+    projection = _project_genotypes(
+        dataset, ["sample3", "sample1"], pca_loadings_df, locus_rows, pool, batch_size=3
+    )
+
+    expected_genotypes = genotypes.drop_duplicates("locus").set_index("locus").reindex(loci)
+    expected_genotypes[expected_genotypes.isna() | (expected_genotypes < 0)] = 1
+    expected = expected_genotypes[["sample3", "sample1"]].T @ pca_loadings_df
+
+    assert projection.dtype == np.float32
+    np.testing.assert_allclose(projection, expected.to_numpy(), rtol=1e-5)
+
+
+def test_infer_ancestry_table_in_workers(tmp_path):
+    path = str(tmp_path / "dosage.feather")
+    feather.write_feather(FAKE_GENOTYPES_DOSAGE_MATRIX.to_table(), path)
+    dataset = ds.dataset(path, format="arrow")
+    ancestry_models = AncestryModels(ANCESTRY_MODEL, ANCESTRY_MODEL)
+
+    serial = infer_ancestry_table(ancestry_models, dataset, n_workers=1)
+    parallel = infer_ancestry_table(ancestry_models, dataset, n_workers=3)
+
+    assert parallel.sample_ids == serial.sample_ids == SAMPLES
+    np.testing.assert_array_equal(parallel.pcs, serial.pcs)
+    np.testing.assert_array_equal(parallel.pop_probs, serial.pop_probs)
+    assert parallel.n_snps == serial.n_snps
+
+
 @pytest.mark.integration()
 def test_infer_ancestry_from_model():
     ancestry_models = get_models_from_s3("hg38")
@@ -97,7 +151,7 @@ def test_infer_ancestry_from_model():
     # randomly set 10% of the genotypes to missing to ensure we test missing data handling
     drop_snps_n = int(0.1 * len(genotypes))
     retained_snps_n = len(genotypes) - drop_snps_n
-    drop_indices = np.random.choice(genotypes.index, size=drop_snps_n, replace=False) # noqa: NPY002
+    drop_indices = np.random.choice(genotypes.index, size=drop_snps_n, replace=False)  # noqa: NPY002
     genotypes = genotypes.drop(list(drop_indices))
 
     genotypes = genotypes.reset_index()
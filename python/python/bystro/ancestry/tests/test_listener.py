@@ -1,3 +1,5 @@
+import os
+
 from msgspec import json
 import pyarrow.feather as feather  # type: ignore
 
@@ -8,14 +10,14 @@ from bystro.ancestry.listener import (
     completed_msg_fn,
     SubmittedJobMessage,
     AncestryJobCompleteMessage,
-    AncestryResults,
 )
-from bystro.ancestry.inference import AncestryModels
+from bystro.ancestry.ancestry_types import AncestryResults
+from bystro.ancestry.inference import AncestryModels, infer_ancestry_table
+from bystro.ancestry.results_table import AncestryResultsTable
 from bystro.ancestry.tests.test_inference import (
     ANCESTRY_MODEL,
     FAKE_GENOTYPES,
     FAKE_GENOTYPES_DOSAGE_MATRIX,
-    _infer_ancestry,
 )
 from bystro.beanstalkd.messages import ProgressMessage
 from bystro.beanstalkd.worker import ProgressPublisher
@@ -52,12 +54,12 @@ def test_handler_fn_happy_path(mocker, tmpdir):
     )
     ancestry_response = handler_fn(publisher, ancestry_job_data)
 
-    assert isinstance(ancestry_response, AncestryResults)
+    assert isinstance(ancestry_response, AncestryResultsTable)
 
     # Demonstrate that all expected sample_ids are accounted for
     samples_seen = set()
     expected_samples = set(FAKE_GENOTYPES.columns)
-    for result in ancestry_response.results:
+    for result in ancestry_response.to_results().results:
         samples_seen.add(result.sample_id)
 
     assert samples_seen == expected_samples
@@ -71,11 +73,41 @@ def test_completion_fn(tmpdir):
         assembly="hg38",
     )
 
-    ancestry_results, _ = _infer_ancestry()
+    ancestry_results = infer_ancestry_table(
+        AncestryModels(ANCESTRY_MODEL, ANCESTRY_MODEL), FAKE_GENOTYPES_DOSAGE_MATRIX
+    )
 
     completed_msg = completed_msg_fn(ancestry_job_data, ancestry_results)
 
     assert isinstance(completed_msg, AncestryJobCompleteMessage)
+    assert completed_msg.result_path == os.path.join(str(tmpdir), "ancestry_results.json")
+
+    with open(completed_msg.result_path, "rb") as f:
+        assert json.decode(f.read(), type=AncestryResults) == ancestry_results.to_results()
+
+    parquet_results = AncestryResultsTable.read_parquet(
+        os.path.join(str(tmpdir), "ancestry_results.parquet")
+    )
+    assert parquet_results.sample_ids == ancestry_results.sample_ids
+
+
+def test_completion_fn_parquet_only(mocker, tmpdir):
+    mocker.patch("bystro.ancestry.listener.ANCESTRY_RESULTS_FORMAT", "parquet")
+    ancestry_job_data = AncestryJobData(
+        submission_id="my_submission_id2",
+        dosage_matrix_path="some_dosage.feather",
+        out_dir=str(tmpdir),
+        assembly="hg38",
+    )
+
+    ancestry_results = infer_ancestry_table(
+        AncestryModels(ANCESTRY_MODEL, ANCESTRY_MODEL), FAKE_GENOTYPES_DOSAGE_MATRIX
+    )
+
+    completed_msg = completed_msg_fn(ancestry_job_data, ancestry_results)
+
+    assert completed_msg.result_path == os.path.join(str(tmpdir), "ancestry_results.parquet")
+    assert os.listdir(str(tmpdir)) == ["ancestry_results.parquet"]
 
 
 def test_completion_message():
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pyarrow as pa  # type: ignore
+import pytest
+
+from bystro.ancestry.locus_index import (
+    LOCUS_INDEX_SUFFIX,
+    LocusIndex,
+    hash_loci,
+    load_or_build_locus_index,
+)
+
+LOCI = ["chr1:100:A:T", "chr2:200:G:C", "chrX:300:T:TA", "chr1:100:A:G"]
+
+
+def test_lookup():
+    locus_index = LocusIndex.from_loci(LOCI)
+
+    assert len(locus_index) == 4
+    assert list(locus_index.lookup(["chr1:100:A:G", "chr3:1:A:T", "chr1:100:A:T"])) == [3, -1, 0]
+    assert list(locus_index.lookup(pa.chunked_array([["chrX:300:T:TA"], ["chr2:200:G:C"]]))) == [2, 1]
+    assert list(LocusIndex.from_loci([]).lookup(LOCI)) == [-1, -1, -1, -1]
+
+    # Keys are stable across processes, so they can be saved
+    assert hash_loci(["chr1:100:A:T"])[0] == np.uint64(17989483601520681436)
+
+
+def test_from_loci_rejects_duplicates():
+    with pytest.raises(ValueError, match="unique"):
+        LocusIndex.from_loci([*LOCI, "chr1:100:A:T"])
+
+
+def test_load_or_build_locus_index(tmp_path):
+    pca_path = str(tmp_path / "pca.csv")
+    with open(pca_path, "w") as fh:
+        fh.write("loadings")
+
+    built = load_or_build_locus_index(pca_path, LOCI)
+    assert os.path.exists(f"{pca_path}{LOCUS_INDEX_SUFFIX}")
+
+    loaded = LocusIndex.load(f"{pca_path}{LOCUS_INDEX_SUFFIX}", pca_path)
+    assert loaded is not None
+    assert np.array_equal(loaded.keys, built.keys)
+    assert np.array_equal(loaded.rows, built.rows)
+
+    # A changed PCA file makes the saved index stale
+    with open(pca_path, "w") as fh:
+        fh.write("new loadings")
+    assert LocusIndex.load(f"{pca_path}{LOCUS_INDEX_SUFFIX}", pca_path) is None
+
+    rebuilt = load_or_build_locus_index(pca_path, LOCI[:2])
+    assert len(rebuilt) == 2
+    assert LocusIndex.load(f"{pca_path}{LOCUS_INDEX_SUFFIX}", pca_path) is not None
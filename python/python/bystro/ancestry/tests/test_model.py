@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+from skops.io import dump as skops_dump  # type: ignore
+
+from bystro.ancestry import model as ancestry_model
+from bystro.ancestry.model import get_one_model_from_file_system
+from bystro.ancestry.tests.test_inference import ANCESTRY_MODEL
+
+
+def test_model_bundle(mocker, tmp_path):
+    mocker.patch.object(ancestry_model, "ANCESTRY_MODEL_CACHE_DIR", str(tmp_path / "cache"))
+    pca_path = str(tmp_path / "hg38_gnomadset_pca.csv")
+    rfc_path = str(tmp_path / "hg38_gnomadset_rfc.skop")
+    ANCESTRY_MODEL.pca_loadings_df.to_csv(pca_path)
+    skops_dump(ANCESTRY_MODEL.rfc, rfc_path)
+
+    parsed = get_one_model_from_file_system(pca_path, rfc_path)
+    bundle_dir = tmp_path / "cache" / f"v{ancestry_model.MODEL_BUNDLE_VERSION}" / "hg38_gnomadset_pca"
+    assert sorted(os.listdir(bundle_dir)) == ["loadings.npy", "loci.arrow", "manifest.json", "rfc.skops"]
+
+    skops_load = mocker.spy(ancestry_model, "skops_load")
+    bundled = get_one_model_from_file_system(pca_path, rfc_path)
+
+    # The second load reads the bundle, with the loadings memory-mapped, read-only
+    skops_load.assert_called_once_with(bundle_dir / "rfc.skops")
+    assert not bundled.pca_loadings_df.to_numpy().flags.writeable
+    assert bundled.pca_loadings_df.dtypes.eq(np.float32).all()
+    assert bundled.pca_loadings_df.equals(parsed.pca_loadings_df)
+    assert np.array_equal(bundled.get_locus_index().keys, parsed.get_locus_index().keys)
+
+    genotypes = ANCESTRY_MODEL.pca_loadings_df.T.reset_index(drop=True).T
+    assert bundled.predict_proba(genotypes)[1].equals(parsed.predict_proba(genotypes)[1])
+
+    # A changed source file invalidates the bundle
+    ANCESTRY_MODEL.pca_loadings_df.to_csv(pca_path, float_format="%.3f")
+    os.utime(pca_path, ns=(0, 0))
+    get_one_model_from_file_system(pca_path, rfc_path)
+    skops_load.assert_called_with(rfc_path)
+
+
+def test_preload_models_keeps_every_assembly(mocker, tmp_path):
+    mocker.patch.object(ancestry_model, "ANCESTRY_MODEL_DIR", str(tmp_path))
+    mocker.patch.object(ancestry_model, "models_cache", {})
+    mocker.patch.object(ancestry_model, "models_cache_size", 1)
+    get_one_model_from_s3 = mocker.patch.object(
+        ancestry_model, "get_one_model_from_s3", return_value=ANCESTRY_MODEL
+    )
+
+    ancestry_model.preload_models(["hg38", "hg19"])
+    assert list(ancestry_model.models_cache) == ["hg38", "hg19"]
+
+    # Jobs for either assembly use the preloaded models
+    ancestry_model.get_models_from_s3("hg38")
+    ancestry_model.get_models_from_s3("hg19")
+    assert get_one_model_from_s3.call_count == 4
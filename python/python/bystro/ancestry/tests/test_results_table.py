@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from bystro.ancestry.results_table import AncestryResultsTable, superpop_probs_from_pop_probs
+from bystro.ancestry.train import POPS, SUPERPOP_FROM_POP, SUPERPOPS
+
+
+def _make_results_table(n_samples: int = 3) -> AncestryResultsTable:
+    rng = np.random.default_rng(0)
+    pop_probs = rng.random((n_samples, len(POPS)))
+    pop_probs /= pop_probs.sum(axis=1, keepdims=True)
+
+    return AncestryResultsTable(
+        sample_ids=[f"sample{i}" for i in range(n_samples)],
+        pop_probs=pop_probs,
+        pcs=rng.random((n_samples, 2)),
+        pc_names=["pc1", "pc2"],
+        n_snps=10,
+    )
+
+
+def test_superpop_probs_from_pop_probs():
+    pop_probs = np.eye(len(POPS))
+    superpop_probs = superpop_probs_from_pop_probs(pop_probs)
+
+    for pop, probs in zip(POPS, superpop_probs, strict=True):
+        assert SUPERPOPS[np.argmax(probs)] == SUPERPOP_FROM_POP[pop]
+        assert probs.sum() == 1
+
+
+def test_results_table_shapes_checked():
+    with pytest.raises(ValueError, match="population probabilities"):
+        AncestryResultsTable(["sample1"], np.ones((1, 2)), np.ones((1, 2)), ["pc1", "pc2"], 10)
+
+    with pytest.raises(ValueError, match="principal components"):
+        AncestryResultsTable(["sample1"], np.ones((1, len(POPS))), np.ones((1, 3)), ["pc1"], 10)
+
+
+def test_to_table():
+    results_table = _make_results_table()
+    table = results_table.to_table()
+
+    assert table.num_rows == 3
+    assert table.column("sample_id").to_pylist() == ["sample0", "sample1", "sample2"]
+    assert table.column("n_snps").to_pylist() == [10, 10, 10]
+    assert table.column("top_hit_population").to_pylist() == list(
+        POPS[np.argmax(results_table.pop_probs, axis=1)]
+    )
+    assert np.array_equal(
+        table.column("top_hit_probability").to_numpy(), results_table.pop_probs.max(axis=1)
+    )
+    assert np.array_equal(
+        table.column(f"populations.{POPS[0]}").to_numpy(), results_table.pop_probs[:, 0]
+    )
+    assert np.array_equal(
+        table.column(f"superpops.{SUPERPOPS[0]}").to_numpy(), results_table.superpop_probs[:, 0]
+    )
+    assert np.array_equal(table.column("pcs.pc2").to_numpy(), results_table.pcs[:, 1])
+
+
+def test_parquet_round_trip(tmp_path):
+    results_table = _make_results_table()
+    path = str(tmp_path / "ancestry_results.parquet")
+    results_table.write_parquet(path)
+
+    read_table = AncestryResultsTable.read_parquet(path)
+
+    assert read_table.sample_ids == results_table.sample_ids
+    assert np.array_equal(read_table.pop_probs, results_table.pop_probs)
+    assert np.array_equal(read_table.pcs, results_table.pcs)
+    assert read_table.pc_names == results_table.pc_names
+    assert read_table.n_snps == results_table.n_snps
+    assert read_table.to_results() == results_table.to_results()
+
+
+def test_to_results():
+    results_table = _make_results_table()
+    results = results_table.to_results()
+
+    assert [result.sample_id for result in results.results] == results_table.sample_ids
+    assert results.pcs == {
+        sample_id: pcs for sample_id, pcs in zip(results_table.sample_ids, results_table.pcs.tolist())
+    }
+
+    for result, pop_probs in zip(results.results, results_table.pop_probs, strict=True):
+        assert result.n_snps == 10
+        assert result.top_hit.populations == [POPS[np.argmax(pop_probs)]]
+        assert result.top_hit.probability == pop_probs.max()
+        assert getattr(result.populations, POPS[1]).lower_bound == pop_probs[1]
+        assert getattr(result.populations, POPS[1]).upper_bound == pop_probs[1]
+
+
+def test_to_results_ties():
+    pop_probs = np.zeros((1, len(POPS)))
+    pop_probs[0, [1, 4]] = 0.5
+    results_table = AncestryResultsTable(["sample1"], pop_probs, np.zeros((1, 0)), [], 10)
+
+    (result,) = results_table.to_results().results
+
+    assert result.top_hit.populations == [POPS[1], POPS[4]]
+    assert result.top_hit.probability == 0.5
+    # The table's top hit is the first of the tied populations
+    assert results_table.to_table().column("top_hit_population").to_pylist() == [POPS[1]]
@@ -0,0 +1,288 @@
+"""
+Long-lived connections to the beanstalkd hosts of a queue, which poll every host for jobs
+
+A listener used to rotate through one client per host, blocking in a reserve on each in turn,
+so a job on one host waited out the reserve timeouts of every idle host before it.
+`BeanstalkdPool` keeps one asyncio connection per host, which watches the submission tube
+and uses the events tube once, when it connects. While a job is wanted, the hosts are asked
+for one in turn, with reserves that don't wait, every `RESERVE_POLL_INTERVAL` seconds,
+so a job waits at most about that long, only the job handed out is reserved,
+and commands about reserved jobs are never stuck behind a reserve on their connection.
+A lost connection is reopened with exponential backoff, while the other hosts keep serving jobs.
+
+The connections run on an event loop in a background thread, so the pool can be used
+from the synchronous listener, and from handlers that run an event loop of their own.
+A job must be deleted, touched, or released on the connection that reserved it,
+so these, and the messages about a job, are sent through the pool.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections.abc import Coroutine
+from typing import Any, TypeVar
+
+from msgspec import Struct
+from pystalk import BeanstalkError  # type: ignore
+
+from bystro.beanstalkd.messages import BeanstalkJobID
+
+BEANSTALK_ERR_TIMEOUT = "TIMED_OUT"
+BEANSTALK_ERR_DEADLINE_SOON = "DEADLINE_SOON"
+# Raised, as a BeanstalkError, when a host can't be reached
+BEANSTALK_ERR_DISCONNECTED = "DISCONNECTED"
+SOCKET_TIMEOUT_TIME = 10
+
+# The number of seconds between asking every host for a job, while none has one
+RESERVE_POLL_INTERVAL = float(os.getenv("BEANSTALKD_RESERVE_POLL_INTERVAL", 0.1))
+# The bounds of the delay before reconnecting to a lost host, in seconds
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = float(os.getenv("BEANSTALKD_RECONNECT_MAX_DELAY", 30))
+
+# The defaults of pystalk's put_job and release_job
+DEFAULT_PRIORITY = 65536
+DEFAULT_TTR = 120
+
+R = TypeVar("R")
+
+_CONNECTION_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+
+
+class ReservedJob(Struct, frozen=True):
+    """
+    A job reserved from one of the pool's hosts
+
+    Attributes:
+        job_id: BeanstalkJobID
+            The id of the job on its host
+        job_data: bytes
+            The job's body
+        host: str
+            The host the job was reserved from
+        port: int
+            The port of the host the job was reserved from
+    """
+
+    job_id: BeanstalkJobID
+    job_data: bytes
+    host: str
+    port: int
+
+
+class _HostConnection:
+    """A connection to one beanstalkd host, speaking the beanstalkd protocol over asyncio streams"""
+
+    def __init__(self, host: str, port: int, watch_tube: str, use_tube: str):
+        self.host = host
+        self.port = port
+        self.watch_tube = watch_tube
+        self.use_tube = use_tube
+
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        # Replies come back in the order commands were sent, so one command is in flight at a time
+        self._lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+
+        # While disconnected, when to try to reconnect, and how long to wait the next time
+        self.retry_at = 0.0
+        self.retry_delay = RECONNECT_MIN_DELAY
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def ensure_connected(self):
+        """Connect, and set up the tubes, unless already connected"""
+        async with self._connect_lock:
+            if self.connected:
+                return
+
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), SOCKET_TIMEOUT_TIME
+            )
+
+            try:
+                await self.command(f"use {self.use_tube}", b"USING")
+                await self.command(f"watch {self.watch_tube}", b"WATCHING")
+                if self.watch_tube != "default":
+                    await self.command("ignore default", b"WATCHING")
+            except BeanstalkError:
+                self.close()
+                raise
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+        self._reader = None
+        self._writer = None
+
+    async def _read_reply(self, timeout: float) -> tuple[list[bytes], bytes | None]:
+        """Read a reply line, and the body that follows it for replies that have one"""
+        assert self._reader is not None
+
+        line = await asyncio.wait_for(self._reader.readuntil(b"\r\n"), timeout)
+        words = line.rstrip().split(b" ")
+
+        body = None
+        if words[0] in (b"RESERVED", b"OK"):
+            n_bytes = int(words[-1])
+            body = (await asyncio.wait_for(self._reader.readexactly(n_bytes + 2), timeout))[:-2]
+
+        return words, body
+
+    async def command(
+        self,
+        line: str,
+        *expected: bytes,
+        body: bytes | None = None,
+        timeout: float = SOCKET_TIMEOUT_TIME,
+    ) -> tuple[list[bytes], bytes | None]:
+        """Send a command, raising a BeanstalkError if the reply is not one of `expected`"""
+        async with self._lock:
+            if self._writer is None:
+                raise ConnectionError(f"Not connected to {self.host}:{self.port}")
+
+            try:
+                message = line.encode("utf-8") + b"\r\n"
+                if body is not None:
+                    message += body + b"\r\n"
+                self._writer.write(message)
+                await self._writer.drain()
+
+                words, reply_body = await self._read_reply(timeout)
+            except _CONNECTION_ERRORS:
+                self.close()
+                raise
+
+        if words[0] not in expected:
+            raise BeanstalkError(words[0])
+
+        return words, reply_body
+
+    async def reserve(self, timeout: int) -> ReservedJob:
+        words, body = await self.command(
+            f"reserve-with-timeout {timeout}", b"RESERVED", timeout=timeout + SOCKET_TIMEOUT_TIME
+        )
+        assert body is not None
+
+        return ReservedJob(job_id=int(words[1]), job_data=body, host=self.host, port=self.port)
+
+
+class BeanstalkdPool:
+    """
+    One connection to each beanstalkd host, reserving from `watch_tube` and putting to `use_tube`
+
+    Args:
+        addresses (list[tuple[str, int]]): The host and port of each beanstalkd server
+        watch_tube (str): The tube jobs are reserved from
+        use_tube (str): The tube messages about jobs are put into
+    """
+
+    def __init__(self, addresses: list[tuple[str, int]], watch_tube: str, use_tube: str):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="beanstalkd-pool", daemon=True
+        )
+        self._thread.start()
+
+        self._connections = {
+            (host, int(port)): _HostConnection(host, int(port), watch_tube, use_tube)
+            for host, port in addresses
+        }
+        # The hosts are asked for jobs in turn, starting after the last to have one
+        self._rotation = list(self._connections.values())
+        self._next_host = 0
+
+    def _run(self, coro: Coroutine[Any, Any, R], timeout: float | None = None) -> R:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    async def _try_reserve(self, connection: _HostConnection) -> ReservedJob | None:
+        """Reserve a job from one host without waiting, or return None if it has none to give"""
+        if not connection.connected and time.monotonic() < connection.retry_at:
+            return None
+
+        try:
+            await connection.ensure_connected()
+            connection.retry_delay = RECONNECT_MIN_DELAY
+
+            return await connection.reserve(0)
+        except BeanstalkError as err:
+            # DEADLINE_SOON means a job reserved on this connection is about to time out
+            if err.message not in (BEANSTALK_ERR_TIMEOUT, BEANSTALK_ERR_DEADLINE_SOON):
+                print(
+                    f"Couldn't reserve job from {connection.host}:{connection.port}: {err.message}",
+                    file=sys.stderr,
+                )
+        except _CONNECTION_ERRORS as err:
+            connection.close()
+            print(
+                f"Lost connection to beanstalkd at {connection.host}:{connection.port} ({err!r}), "
+                f"reconnecting in {connection.retry_delay}s",
+                file=sys.stderr,
+            )
+            connection.retry_at = time.monotonic() + connection.retry_delay
+            connection.retry_delay = min(connection.retry_delay * 2, RECONNECT_MAX_DELAY)
+
+        return None
+
+    async def _reserve(self, timeout: float) -> ReservedJob:
+        deadline = time.monotonic() + timeout
+        while True:
+            for _ in range(len(self._rotation)):
+                connection = self._rotation[self._next_host]
+                self._next_host = (self._next_host + 1) % len(self._rotation)
+
+                job = await self._try_reserve(connection)
+                if job is not None:
+                    return job
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BeanstalkError(BEANSTALK_ERR_TIMEOUT.encode("ascii"))
+
+            await asyncio.sleep(min(RESERVE_POLL_INTERVAL, remaining))
+
+    async def _command(self, job: ReservedJob, line: str, *expected: bytes, body: bytes | None = None):
+        connection = self._connections[(job.host, job.port)]
+        try:
+            await connection.ensure_connected()
+            await connection.command(line, *expected, body=body)
+        except _CONNECTION_ERRORS as err:
+            connection.close()
+            raise BeanstalkError(BEANSTALK_ERR_DISCONNECTED.encode("ascii")) from err
+
+    def reserve_job(self, timeout: float) -> ReservedJob:
+        """Reserve the first job to arrive on any host, or raise a TIMED_OUT error after `timeout`"""
+        return self._run(self._reserve(timeout))
+
+    def put_job(
+        self, job: ReservedJob, data: bytes, priority: int = DEFAULT_PRIORITY, ttr: int = DEFAULT_TTR
+    ):
+        """Put a message about `job` into the events tube of the host it was reserved from"""
+        self._run(self._command(job, f"put {priority} 0 {ttr} {len(data)}", b"INSERTED", body=data))
+
+    def delete_job(self, job: ReservedJob):
+        self._run(self._command(job, f"delete {job.job_id}", b"DELETED"))
+
+    def touch_job(self, job: ReservedJob):
+        """Reset the time-to-run of a reserved job"""
+        self._run(self._command(job, f"touch {job.job_id}", b"TOUCHED"))
+
+    def release_job(self, job: ReservedJob, priority: int = DEFAULT_PRIORITY):
+        self._run(self._command(job, f"release {job.job_id} {priority} 0", b"RELEASED", b"BURIED"))
+
+    def close(self):
+        """Close the connections, and stop the event loop"""
+
+        async def stop():
+            for connection in self._connections.values():
+                connection.close()
+
+        self._run(stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,246 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from pystalk import BeanstalkError  # type: ignore
+
+from bystro.beanstalkd import connections
+from bystro.beanstalkd.connections import BeanstalkdPool
+
+
+class FakeBeanstalkd:
+    """
+    A beanstalkd server, on a background event loop, with one tube for jobs and one for messages
+
+    Implements only the commands the pool sends
+    """
+
+    def __init__(self, port: int = 0):
+        self.port = port
+        self.ready: list[tuple[int, int, bytes]] = []
+        self.reserved: dict[int, tuple[int, bytes, object]] = {}
+        self.put: list[bytes] = []
+        self.commands: list[str] = []
+        self.touched: list[int] = []
+        self.deleted: list[int] = []
+        self.next_job_id = 1
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._server: asyncio.AbstractServer | None = None
+        self.start()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(10)
+
+    def start(self):
+        async def start():
+            self._server = await asyncio.start_server(self._serve, "127.0.0.1", self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+        self._call(start())
+
+    def stop(self):
+        """Close the server and its connections; reserved jobs go back to the ready queue"""
+
+        async def stop():
+            assert self._server is not None
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+        self._call(stop())
+
+    def shutdown(self):
+        self.stop()
+
+        async def cancel_tasks():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._call(cancel_tasks())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def add_job(self, data: bytes, priority: int = 1024):
+        def add():
+            self.ready.append((priority, self.next_job_id, data))
+            self.next_job_id += 1
+
+        self._loop.call_soon_threadsafe(add)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = (await reader.readuntil(b"\r\n")).rstrip().decode()
+                self.commands.append(line)
+                words = line.split(" ")
+                reply = await self._reply(words, reader, writer)
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            for job_id, (priority, data, owner) in list(self.reserved.items()):
+                if owner is writer:
+                    del self.reserved[job_id]
+                    self.ready.append((priority, job_id, data))
+
+    async def _reply(self, words: list[str], reader, writer) -> bytes:
+        command = words[0]
+        if command == "use":
+            return f"USING {words[1]}\r\n".encode()
+        if command in ("watch", "ignore"):
+            return b"WATCHING 1\r\n"
+        if command == "reserve-with-timeout":
+            deadline = time.monotonic() + int(words[1])
+            while not self.ready:
+                if time.monotonic() >= deadline:
+                    return b"TIMED_OUT\r\n"
+                await asyncio.sleep(0.01)
+            self.ready.sort()
+            priority, job_id, data = self.ready.pop(0)
+            self.reserved[job_id] = (priority, data, writer)
+            return f"RESERVED {job_id} {len(data)}\r\n".encode() + data + b"\r\n"
+        if command == "put":
+            data = (await reader.readexactly(int(words[4]) + 2))[:-2]
+            self.put.append(data)
+            return b"INSERTED 1000\r\n"
+
+        job_id = int(words[1])
+        if job_id not in self.reserved or self.reserved[job_id][2] is not writer:
+            return b"NOT_FOUND\r\n"
+        if command == "delete":
+            del self.reserved[job_id]
+            self.deleted.append(job_id)
+            return b"DELETED\r\n"
+        if command == "touch":
+            self.touched.append(job_id)
+            return b"TOUCHED\r\n"
+        if command == "release":
+            _, data, _ = self.reserved.pop(job_id)
+            self.ready.append((int(words[2]), job_id, data))
+            return b"RELEASED\r\n"
+        if command == "stats-job":
+            body = f"---\nid: {job_id}\ntube: test\nstate: reserved\npri: {self.reserved[job_id][0]}\n"
+            return f"OK {len(body)}\r\n{body}\r\n".encode()
+
+        return b"UNKNOWN_COMMAND\r\n"
+
+
+@pytest.fixture
+def servers():
+    servers = [FakeBeanstalkd(), FakeBeanstalkd()]
+    yield servers
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def pool(servers):
+    pool = BeanstalkdPool([("127.0.0.1", server.port) for server in servers], "test", "test_events")
+    yield pool
+    pool.close()
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_reserve_from_any_host(servers, pool):
+    servers[1].add_job(b"job")
+
+    start = time.monotonic()
+    job = pool.reserve_job(5)
+
+    # The job is handed out at once, without waiting on the idle host
+    assert time.monotonic() - start < 1
+    assert (job.job_data, job.port) == (b"job", servers[1].port)
+
+    pool.put_job(job, b"started")
+    pool.touch_job(job)
+    pool.delete_job(job)
+
+    # Messages and commands go to the host the job was reserved from
+    assert servers[1].put == [b"started"]
+    assert servers[1].touched == [job.job_id]
+    assert servers[1].deleted == [job.job_id]
+    assert servers[0].put == []
+
+    with pytest.raises(BeanstalkError) as err:
+        pool.touch_job(job)
+    assert err.value.message == "NOT_FOUND"
+
+    # The tubes are set up once per connection
+    for server in servers:
+        assert server.commands[:3] == ["use test_events", "watch test", "ignore default"]
+        assert server.commands.count("watch test") == 1
+
+
+def test_reserve_times_out(pool):
+    with pytest.raises(BeanstalkError) as err:
+        pool.reserve_job(0.2)
+
+    assert err.value.message == connections.BEANSTALK_ERR_TIMEOUT
+
+
+def test_reserves_only_the_job_handed_out(servers, pool):
+    servers[0].add_job(b"first", priority=10)
+    servers[1].add_job(b"second", priority=20)
+
+    jobs = [pool.reserve_job(5)]
+
+    # The other host's job is left ready, rather than reserved and released
+    assert sum(len(server.ready) for server in servers) == 1
+    assert not any(command.startswith("release") for server in servers for command in server.commands)
+
+    jobs.append(pool.reserve_job(5))
+    assert sorted(job.job_data for job in jobs) == [b"first", b"second"]
+
+
+def test_commands_are_not_held_up_by_reserves(mocker, servers, pool):
+    mocker.patch.object(connections, "RESERVE_POLL_INTERVAL", 0.05)
+    servers[0].add_job(b"job")
+    job = pool.reserve_job(5)
+
+    # Another thread polls for a job while the job is touched
+    waiting = threading.Thread(target=lambda: pytest.raises(BeanstalkError, pool.reserve_job, 2))
+    waiting.start()
+
+    start = time.monotonic()
+    pool.touch_job(job)
+    assert time.monotonic() - start < 0.5
+    assert servers[0].touched == [job.job_id]
+
+    waiting.join()
+
+
+def test_reconnect(mocker, servers, pool):
+    mocker.patch.object(connections, "RECONNECT_MIN_DELAY", 0.05)
+
+    # Wait until both hosts are connected
+    with pytest.raises(BeanstalkError):
+        pool.reserve_job(0.2)
+
+    servers[0].stop()
+    servers[1].add_job(b"other")
+    # The host that's still up keeps serving jobs
+    assert pool.reserve_job(5).job_data == b"other"
+
+    servers[0].start()
+    servers[0].add_job(b"job")
+
+    job = pool.reserve_job(10)
+    assert (job.job_data, job.port) == (b"job", servers[0].port)
+    assert servers[0].commands.count("watch test") == 2
@@ -0,0 +1,326 @@
+import os
+import signal
+import time
+from unittest.mock import MagicMock
+
+import pytest
+import ray
+from msgspec import json
+from pystalk import BeanstalkError  # type: ignore
+
+from bystro.beanstalkd import worker
+from bystro.beanstalkd.connections import ReservedJob
+from bystro.beanstalkd.messages import (
+    BaseMessage,
+    CompletedJobMessage,
+    ProgressMessage,
+    SubmittedJobMessage,
+)
+from bystro.beanstalkd.worker import (
+    BeanstalkdProgressReporter,
+    BufferedProgressReporter,
+    JobResources,
+    ProgressPublisher,
+    QueueConf,
+    _listen_concurrently,
+    _record_job_report,
+    listen,
+)
+from bystro.utils.instrumentation import JobReport, MetricsRegistry
+
+TUBE_CONF = {"submission": "test", "events": "test_events"}
+
+
+class FakePool:
+    """A pool serving jobs from a list, which sends SIGTERM once the list is empty"""
+
+    def __init__(self, jobs: list[bytes]):
+        self.jobs = jobs
+        self.next_job_id = 1
+        self.put: list[dict] = []
+        self.deleted: list[int] = []
+        self.touched: list[int] = []
+        self.terminated = False
+
+    def reserve_job(self, timeout: float):
+        if not self.jobs:
+            if not self.terminated:
+                self.terminated = True
+                os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(min(timeout, 0.1))
+            raise BeanstalkError(b"TIMED_OUT")
+
+        job = ReservedJob(
+            job_id=self.next_job_id, job_data=self.jobs.pop(0), host="127.0.0.1", port=11300
+        )
+        self.next_job_id += 1
+        return job
+
+    def put_job(self, _job: ReservedJob, data: bytes):
+        self.put.append(json.decode(data))
+
+    def delete_job(self, job: ReservedJob):
+        self.deleted.append(job.job_id)
+
+    def touch_job(self, job: ReservedJob):
+        self.touched.append(job.job_id)
+
+    def release_job(self, _job: ReservedJob):
+        pass
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _ray():
+    ray.init(ignore_reinit_error=True)
+
+
+def _job(submission_id: str) -> bytes:
+    return json.encode(BaseMessage(submission_id=submission_id))
+
+
+def _run(pool: FakePool, job_slots: int, **kwargs) -> dict[str, list[float]]:
+    results: dict[str, list[float]] = {}
+
+    def completed_msg_fn(job_data, res):
+        results[job_data.submission_id] = res
+        return CompletedJobMessage(submission_id=job_data.submission_id)
+
+    # Handlers are sent to Ray workers, which can't import this module, so it's defined in place
+    def handler_fn(_publisher, job_data):
+        kind, seconds = str(job_data.submission_id).split("-")[:2]
+        start = time.time()
+        time.sleep(float(seconds))
+        if kind == "fail":
+            raise ValueError("handler failed")
+        return [start, time.time()]
+
+    _listen_concurrently(
+        job_data_type=BaseMessage,
+        handler_fn=handler_fn,
+        submit_msg_fn=lambda job_data: SubmittedJobMessage(submission_id=job_data.submission_id),
+        completed_msg_fn=completed_msg_fn,
+        tube_conf=kwargs.pop("tube_conf", TUBE_CONF),
+        pool=pool,
+        failed_msg_fn=worker.default_failed_msg_fn,
+        job_slots=job_slots,
+        **kwargs,
+    )
+
+    return results
+
+
+def _max_overlap(intervals: list[list[float]]) -> int:
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    overlap = max_overlap = 0
+    for _, change in events:
+        overlap += change
+        max_overlap = max(max_overlap, overlap)
+    return max_overlap
+
+
+def test_listen_concurrently():
+    pool = FakePool(
+        [_job("ok-1"), _job("fail-0"), json.encode({"foo": 1}), _job("ok-1.5"), _job("ok-1.2")]
+    )
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    results = _run(pool, job_slots=2)
+
+    # Jobs ran two at a time, and all finished before the listener drained
+    assert sorted(results) == ["ok-1", "ok-1.2", "ok-1.5"]
+    assert _max_overlap(list(results.values())) == 2
+    assert sorted(pool.deleted) == [1, 2, 3, 4, 5]
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+    failed = [msg for msg in pool.put if msg.get("event") == "failed"]
+    assert {"submissionId": "fail-0", "reason": "handler failed", "event": "failed"} in failed
+    assert any(msg.get("queueId") == 3 for msg in failed)
+    assert len([msg for msg in pool.put if msg.get("event") == "started"]) == 4
+    assert len([msg for msg in pool.put if msg.get("event") == "completed"]) == 3
+
+
+def test_listen_concurrently_touches_running_jobs():
+    pool = FakePool([_job("ok-3")])
+
+    # Touches are due every 0.5s, but sent at most once per poll of the running jobs
+    _run(pool, job_slots=2, touch_interval=0.5)
+
+    assert len(pool.touched) >= 2
+    assert set(pool.touched) == {1}
+
+
+def test_listen_concurrently_admits_by_resources(mocker):
+    pool = FakePool([_job(f"ok-0.5-{i}") for i in range(3)])
+    mocker.patch.object(ray, "available_resources", return_value={"CPU": 1.0, "memory": 2 * 1024**3})
+
+    # With 1 CPU available, but 2 needed, a job is only admitted when no other job runs
+    results = _run(pool, job_slots=3, tube_conf={**TUBE_CONF, "resources": {"num_cpus": 2}})
+
+    assert len(results) == 3
+    assert _max_overlap(list(results.values())) == 1
+
+
+def test_listen_concurrently_counts_running_jobs_resources(mocker):
+    pool = FakePool([_job(f"ok-0.5-{i}") for i in range(3)])
+    mocker.patch.object(ray, "cluster_resources", return_value={"CPU": 1.0})
+    # Ray's view of the available resources may lag behind the jobs just submitted
+    mocker.patch.object(ray, "available_resources", return_value={"CPU": 1.0})
+
+    results = _run(pool, job_slots=3, tube_conf={**TUBE_CONF, "resources": {"num_cpus": 0.5}})
+
+    assert len(results) == 3
+    assert _max_overlap(list(results.values())) == 2
+
+
+def test_listen_concurrently_records_job_metrics():
+    pool = FakePool([_job("ok-0.1"), _job("fail-0")])
+    registry = MetricsRegistry()
+
+    _run(pool, job_slots=2, registry=registry)
+
+    lines = registry.to_prometheus().splitlines()
+    assert 'bystro_jobs_total{job="test",status="completed"} 1' in lines
+    assert 'bystro_jobs_total{job="test",status="failed"} 1' in lines
+
+
+def test_record_job_report(mocker, tmp_path):
+    report = JobReport(
+        name="test",
+        submission_id="1",
+        status="completed",
+        seconds=1.0,
+        peak_rss_mb=10.0,
+        spans=[],
+        counters={},
+    )
+
+    # Reports are only written when a directory is configured
+    mocker.patch.object(worker, "BYSTRO_METRICS_REPORT_DIR", None)
+    _record_job_report(report, MetricsRegistry())
+    assert list(tmp_path.iterdir()) == []
+
+    report_dir = tmp_path / "reports"
+    mocker.patch.object(worker, "BYSTRO_METRICS_REPORT_DIR", str(report_dir))
+    _record_job_report(report, MetricsRegistry())
+    assert [path.name for path in report_dir.iterdir()] == ["test.1.metrics.json"]
+
+
+def test_job_resources_fits():
+    resources = JobResources(num_cpus=4, memory_gb=2)
+
+    assert resources.fits({"CPU": 4.0, "memory": 2 * 1024**3})
+    assert not resources.fits({"CPU": 3.0, "memory": 2 * 1024**3})
+    assert not resources.fits({"CPU": 4.0, "memory": 1024**3})
+    assert JobResources().fits({"CPU": 1.0})
+
+
+def test_job_resources_fits_alongside():
+    resources = JobResources(num_cpus=2)
+    cluster = {"CPU": 5.0}
+
+    assert resources.fits_alongside(1, cluster, available=cluster)
+    # The running jobs' resources are counted, though Ray doesn't report them as reserved yet
+    assert not resources.fits_alongside(2, cluster, available=cluster)
+    # Resources reserved by others are counted
+    assert not resources.fits_alongside(1, cluster, available={"CPU": 1.0})
+
+
+def test_listen_uses_job_slots(mocker):
+    listen_concurrently = mocker.patch("bystro.beanstalkd.worker._listen_concurrently")
+    pool = mocker.patch("bystro.beanstalkd.worker.BeanstalkdPool")
+
+    listen(
+        job_data_type=BaseMessage,
+        handler_fn=lambda _publisher, job_data: job_data,
+        submit_msg_fn=lambda job_data: job_data,
+        completed_msg_fn=lambda job_data, _res: job_data,
+        queue_conf=QueueConf(addresses=["127.0.0.1:11300"], tubes={"test": TUBE_CONF}),
+        tube="test",
+        job_slots=4,
+    )
+
+    listen_concurrently.assert_called_once()
+    assert listen_concurrently.call_args.kwargs["job_slots"] == 4
+    pool.assert_called_once_with([("127.0.0.1", 11300)], "test", "test_events")
+    pool.return_value.close.assert_called_once()
+
+
+def _written(client) -> list:
+    messages = [json.decode(call.args[0]) for call in client.put_job.call_args_list]
+    return [
+        message["data"] if isinstance(message["data"], str) else message["data"]["progress"]
+        for message in messages
+    ]
+
+
+def test_beanstalkd_progress_reporter_coalesces(mocker):
+    client = mocker.patch("bystro.beanstalkd.worker.BeanstalkClient").return_value
+    publisher = ProgressPublisher(
+        host="127.0.0.1", port=11300, queue="test_events", message=ProgressMessage(submission_id="1")
+    )
+
+    # The actor's class, run in process
+    reporter = BeanstalkdProgressReporter.__ray_actor_class__(
+        publisher, update_interval=10, write_interval=0.5
+    )
+
+    reporter.message("a")
+    reporter.message("b")
+    reporter.increment_and_write_progress_message(10, "Fetched", "variants")
+    reporter.increment_and_write_progress_message(10, "Fetched", "variants")
+    # The first message is written at once, the rest wait for the interval and are then written
+    # one message each, the first progress string superseded by the second
+    assert _written(client) == ["a"]
+
+    time.sleep(0.8)
+    assert _written(client) == ["a", "b", "Fetched 20 variants"]
+
+    # Repeated messages are not superseded
+    reporter.message("c")
+    reporter.message("c")
+    reporter.increment(1, force=True)
+    assert _written(client) == ["a", "b", "Fetched 20 variants", "c", "c", 21]
+
+    stats = reporter.get_stats()
+    assert (stats.n_calls, stats.n_flushes, stats.n_coalesced) == (7, 6, 1)
+
+
+def test_beanstalkd_progress_reporter_keeps_distinct_messages(mocker):
+    client = mocker.patch("bystro.beanstalkd.worker.BeanstalkClient").return_value
+    publisher = ProgressPublisher(
+        host="127.0.0.1", port=11300, queue="test_events", message=ProgressMessage(submission_id="1")
+    )
+    reporter = BeanstalkdProgressReporter.__ray_actor_class__(
+        publisher, update_interval=1, write_interval=60
+    )
+
+    reporter.message("Started")
+    reporter.increment_and_write_progress_message(1, "Fetched", "variants")
+    reporter.message("Filtering")
+    # Supersedes the pending progress string, but not the message after it
+    reporter.increment_and_write_progress_message(1, "Fetched", "variants")
+    reporter.flush()
+
+    assert _written(client) == ["Started", "Filtering", "Fetched 2 variants"]
+    assert reporter.get_stats().n_coalesced == 1
+
+
+def test_buffered_progress_reporter():
+    reporter = MagicMock()
+    buffered = BufferedProgressReporter(reporter, flush_interval=60, max_pending=2)
+
+    buffered.increment(10, "Fetched", "variants")
+    buffered.increment(5, "Fetched", "variants")
+    buffered.message("x")
+    buffered.message("x")
+    reporter.report.remote.assert_not_called()
+
+    buffered.message("y")
+    reporter.report.remote.assert_called_once_with(15, ["x", "y"], ("Fetched", "variants"), False)
+
+    assert buffered.flush() is None
+    assert buffered.flush(force=True) is not None
+    reporter.report.remote.assert_called_with(0, [], ("Fetched", "variants"), True)
+
+    stats = buffered.stats
+    assert (stats.n_calls, stats.n_flushes, stats.n_coalesced) == (5, 2, 1)
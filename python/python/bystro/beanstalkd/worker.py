@@ -1,7 +1,11 @@
 """TODO: Add description here"""
 
 import abc
+import math
+import os
+import signal
 import sys
+import threading
 import time
 import traceback
 from collections.abc import Callable
@@ -9,10 +13,14 @@ from textwrap import dedent
 from typing import Any, TypeVar
 
 import ray
-from msgspec import DecodeError, Struct, ValidationError, json
+from msgspec import DecodeError, Struct, ValidationError, convert, json
 from pystalk import BeanstalkClient, BeanstalkError  # type: ignore
-from pystalk.client import Job  # type: ignore
 
+from bystro.beanstalkd.connections import (
+    BEANSTALK_ERR_TIMEOUT,
+    BeanstalkdPool,
+    ReservedJob,
+)
 from bystro.beanstalkd.messages import (
     BeanstalkJobID,
     BaseMessage,
@@ -21,11 +29,33 @@ from bystro.beanstalkd.messages import (
     ProgressMessage,
     ProgressStringMessage,
 )
+from bystro.utils.instrumentation import (
+    BYSTRO_METRICS_PROMETHEUS_FILE,
+    BYSTRO_METRICS_REPORT_DIR,
+    JobMetrics,
+    JobReport,
+    MetricsRegistry,
+    job_report_path,
+    write_job_report,
+)
+from bystro.utils.timer import Timer
 
-BEANSTALK_ERR_TIMEOUT = "TIMED_OUT"
-SOCKET_TIMEOUT_TIME = 10
 JOB_TIMEOUT_TIME = 5
 
+# The number of jobs a listener runs at once; with more than 1, jobs are run as Ray tasks
+BEANSTALKD_JOB_SLOTS = int(os.getenv("BEANSTALKD_JOB_SLOTS", 1))
+# The number of seconds between touches of a running job, which reset its time-to-run
+BEANSTALKD_TOUCH_INTERVAL = float(os.getenv("BEANSTALKD_TOUCH_INTERVAL", 30))
+# The number of seconds to wait for a job, or for a running job to finish, while other jobs run
+CONCURRENT_POLL_TIME = 1
+
+# The minimum number of seconds between progress messages put into a job's events tube
+BEANSTALKD_PROGRESS_WRITE_INTERVAL = float(os.getenv("BEANSTALKD_PROGRESS_WRITE_INTERVAL", 1))
+# The minimum number of seconds between a producer's batches of progress reports
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 1))
+# The number of messages a producer buffers before sending them, regardless of the interval
+PROGRESS_FLUSH_MAX_PENDING = int(os.getenv("PROGRESS_FLUSH_MAX_PENDING", 100))
+
 T = TypeVar("T", bound=BaseMessage)
 T2 = TypeVar("T2", bound=BaseMessage)
 T3 = TypeVar("T3", bound=BaseMessage)
@@ -57,6 +87,45 @@ class QueueConf(Struct):
         return hosts, ports
 
 
+class JobResources(Struct, frozen=True):
+    """
+    The resources a single job of a tube needs, declared under `resources` in the tube's config
+
+    Attributes:
+        num_cpus: float
+            The number of CPUs reserved for the job
+        memory_gb: float
+            The memory reserved for the job, in gigabytes
+    """
+
+    num_cpus: float = 1
+    memory_gb: float = 0
+
+    @property
+    def memory(self) -> int:
+        return int(self.memory_gb * 1024**3)
+
+    def fits(self, available: dict[str, float]) -> bool:
+        """Whether `available`, as returned by `ray.available_resources`, covers these resources"""
+        return available.get("CPU", 0) >= self.num_cpus and available.get("memory", 0) >= self.memory
+
+    def fits_alongside(
+        self, n_running: int, cluster: dict[str, float], available: dict[str, float]
+    ) -> bool:
+        """
+        Whether another job fits alongside the `n_running` jobs, each with these resources, we run
+
+        `available`, as returned by `ray.available_resources`, may not yet count the resources
+        of jobs just submitted, so the resources of the running jobs are also subtracted
+        from `cluster`, as returned by `ray.cluster_resources`
+        """
+        unreserved = {
+            "CPU": cluster.get("CPU", 0) - n_running * self.num_cpus,
+            "memory": cluster.get("memory", 0) - n_running * self.memory,
+        }
+        return self.fits(unreserved) and self.fits(available)
+
+
 def default_failed_msg_fn(
     job_data: T | None, job_id: BeanstalkJobID, err: Exception
 ) -> FailedJobMessage | InvalidJobMessage:  # noqa: E501
@@ -66,6 +135,29 @@ def default_failed_msg_fn(
     return FailedJobMessage(submission_id=job_data.submission_id, reason=str(err))
 
 
+def _record_job_report(report: JobReport | None, registry: MetricsRegistry):
+    """Write a job's report to BYSTRO_METRICS_REPORT_DIR, if set, and add it to the listener's metrics"""
+    if report is None:
+        return
+
+    print(
+        f"Job {report.submission_id} {report.status} in {report.seconds:.3f} seconds, "
+        f"peak memory {report.peak_rss_mb:.1f} MB",
+        file=sys.stderr,
+    )
+
+    try:
+        if BYSTRO_METRICS_REPORT_DIR:
+            os.makedirs(BYSTRO_METRICS_REPORT_DIR, exist_ok=True)
+            write_job_report(report, job_report_path(report, BYSTRO_METRICS_REPORT_DIR))
+
+        registry.observe(report)
+        if BYSTRO_METRICS_PROMETHEUS_FILE:
+            registry.write(BYSTRO_METRICS_PROMETHEUS_FILE)
+    except OSError:
+        traceback.print_exc()
+
+
 def listen(
     job_data_type: type[T],
     handler_fn: Callable[[ProgressPublisher, T], Any],
@@ -76,35 +168,73 @@ def listen(
     failed_msg_fn: Callable[
         [T | None, BeanstalkJobID, Exception], FailedJobMessage | InvalidJobMessage
     ] = default_failed_msg_fn,  # noqa: E501
+    job_slots: int = BEANSTALKD_JOB_SLOTS,
 ):
     """Listen on a Beanstalkd channel, waiting for work.
     When work is available call the work handler
+
+    With more than one job slot, up to `job_slots` jobs run at once, see `_listen_concurrently`
+
+    Each job's spans, counters, and peak memory are collected (see `bystro.utils.instrumentation`);
+    if BYSTRO_METRICS_REPORT_DIR is set, each job's report is written there as JSON,
+    and if BYSTRO_METRICS_PROMETHEUS_FILE is set, the metrics of all jobs the listener ran
+    are written there, in the Prometheus text format.
     """
     hosts, ports = queue_conf.split_host_port()
 
     tube_conf = queue_conf.tubes[tube]
-    clients = tuple(
-        BeanstalkClient(host, port, socket_timeout=SOCKET_TIMEOUT_TIME)
-        for (host, port) in zip(hosts, ports)
+    pool = BeanstalkdPool(
+        list(zip(hosts, [int(port) for port in ports])), tube_conf["submission"], tube_conf["events"]
     )
 
-    i = 0
-    while True:
-        i += 1
+    registry = MetricsRegistry()
+
+    try:
+        if job_slots > 1:
+            _listen_concurrently(
+                job_data_type=job_data_type,
+                handler_fn=handler_fn,
+                submit_msg_fn=submit_msg_fn,
+                completed_msg_fn=completed_msg_fn,
+                tube_conf=tube_conf,
+                pool=pool,
+                failed_msg_fn=failed_msg_fn,
+                job_slots=job_slots,
+                registry=registry,
+            )
+        else:
+            _listen_sequentially(
+                job_data_type=job_data_type,
+                handler_fn=handler_fn,
+                submit_msg_fn=submit_msg_fn,
+                completed_msg_fn=completed_msg_fn,
+                tube_conf=tube_conf,
+                pool=pool,
+                failed_msg_fn=failed_msg_fn,
+                registry=registry,
+            )
+    finally:
+        pool.close()
+
 
-        job: Job | None = None
+def _listen_sequentially(
+    job_data_type: type[T],
+    handler_fn: Callable[[ProgressPublisher, T], Any],
+    submit_msg_fn: Callable[[T], T2],
+    completed_msg_fn: Callable[[T, Any], T3],
+    tube_conf: dict,
+    pool: BeanstalkdPool,
+    failed_msg_fn: Callable[[T | None, BeanstalkJobID, Exception], FailedJobMessage | InvalidJobMessage],
+    registry: MetricsRegistry,
+):
+    """Run one job at a time, reserving the next once the last finishes"""
+    while True:
+        job: ReservedJob | None = None
         job_id: BeanstalkJobID | None = None
         job_data: T | None = None
-        client: BeanstalkClient | None = None
         try:
-            offset = i % len(hosts)
-            client = clients[offset]
-
-            client.watch(tube_conf["submission"])
-            client.use(tube_conf["events"])
-
-            job = client.reserve_job(JOB_TIMEOUT_TIME)
-            job_id = int(job.job_id)  # type: ignore
+            job = pool.reserve_job(JOB_TIMEOUT_TIME)
+            job_id = job.job_id
 
             try:
                 job_data = json.decode(job.job_data, type=job_data_type)
@@ -116,8 +246,8 @@ def listen(
                             Decoding failed with: `{err}`"""
                 )
                 traceback.print_exc()
-                client.put_job(json.encode(failed_msg_fn(job_data, job_id, ValueError(msg))))
-                client.delete_job(job.job_id)
+                pool.put_job(job, json.encode(failed_msg_fn(job_data, job_id, ValueError(msg))))
+                pool.delete_job(job)
                 continue
             except DecodeError as err:
                 msg = dedent(
@@ -126,40 +256,46 @@ def listen(
                             Decoding `{str(job.job_data)}`, failed with: `{err}`"""
                 )
                 traceback.print_exc()
-                client.put_job(json.encode(failed_msg_fn(job_data, job_id, ValueError(msg))))
-                client.delete_job(job_id)
+                pool.put_job(job, json.encode(failed_msg_fn(job_data, job_id, ValueError(msg))))
+                pool.delete_job(job)
                 continue
             except Exception:
                 traceback.print_exc()
 
-                client.put_job(
+                pool.put_job(
+                    job,
                     json.encode(
                         failed_msg_fn(job_data, job_id, Exception("Unknown error, check admin logs"))
-                    )
+                    ),
                 )
-                client.delete_job(job_id)
+                pool.delete_job(job)
 
             try:
                 # Typeguard
                 assert job_data is not None
 
                 publisher = ProgressPublisher(
-                    host=client.host,
-                    port=client.port,
+                    host=job.host,
+                    port=job.port,
                     queue=tube_conf["events"],
                     message=ProgressMessage(submission_id=job_data.submission_id),
                 )
 
-                client.put_job(json.encode(submit_msg_fn(job_data)))
-                res = handler_fn(publisher, job_data)
-                client.put_job(json.encode(completed_msg_fn(job_data, res)))
-                client.delete_job(job.job_id)
+                pool.put_job(job, json.encode(submit_msg_fn(job_data)))
+                metrics = JobMetrics(tube_conf["submission"], job_data.submission_id)
+                try:
+                    with metrics:
+                        res = handler_fn(publisher, job_data)
+                finally:
+                    _record_job_report(metrics.report, registry)
+                pool.put_job(job, json.encode(completed_msg_fn(job_data, res)))
+                pool.delete_job(job)
             except Exception as err:
                 traceback.print_exc()
 
                 failed_msg = failed_msg_fn(job_data, job_id, err)
-                client.put_job(json.encode(failed_msg))
-                client.delete_job(job.job_id)
+                pool.put_job(job, json.encode(failed_msg))
+                pool.delete_job(job)
 
                 continue
 
@@ -170,21 +306,270 @@ def listen(
 
             traceback.print_exc()
 
-            if client is None:
-                print("Couldn't connect to Beanstalkd server, sleeping for 10s", file=sys.stderr)
-                time.sleep(10)
-                continue
-
+            # Lost hosts are reconnected to by the pool, which keeps reserving from the others
             if job is None:
-                print("Couldn't reserve job, sleeping for 10s", file=sys.stderr)
-                time.sleep(10)
                 continue
 
-            client.release_job(job.job_id)
+            try:
+                pool.release_job(job)
+            except BeanstalkError:
+                traceback.print_exc()
             time.sleep(1)
             continue
 
 
+class _HandlerResult(Struct, frozen=True):
+    """The result of a handler run as a Ray task, or the reason it failed"""
+
+    value: Any = None
+    error: str | None = None
+    report: JobReport | None = None
+
+
+def _run_handler(
+    handler_fn: Callable[[ProgressPublisher, T], Any],
+    publisher: ProgressPublisher,
+    job_data: T,
+    job_name: str,
+):
+    metrics = JobMetrics(job_name, job_data.submission_id)
+    try:
+        with metrics:
+            value = handler_fn(publisher, job_data)
+        return _HandlerResult(value=value, report=metrics.report)
+    except Exception as err:
+        traceback.print_exc()
+        return _HandlerResult(error=str(err), report=metrics.report)
+
+
+class _RunningJob(Struct):
+    """A job reserved by a concurrent listener, and the Ray task running it"""
+
+    job: ReservedJob
+    job_data: Any
+    task: ray.ObjectRef
+    last_touched: float
+
+
+def _decode_job_data(job: ReservedJob, job_id: BeanstalkJobID, job_data_type: type[T]) -> T:
+    try:
+        return json.decode(job.job_data, type=job_data_type)
+    except ValidationError as err:
+        msg = dedent(
+            f"""
+                    Job {job_id} JSON does not have the data expected.
+                    Expected {job_data_type.keys_with_types()}.
+                    Decoding failed with: `{err}`"""
+        )
+        raise ValueError(msg) from err
+    except DecodeError as err:
+        msg = dedent(
+            f"""
+                    Job {job_id} JSON is invalid.
+                    Decoding `{str(job.job_data)}`, failed with: `{err}`"""
+        )
+        raise ValueError(msg) from err
+
+
+def _listen_concurrently(
+    job_data_type: type[T],
+    handler_fn: Callable[[ProgressPublisher, T], Any],
+    submit_msg_fn: Callable[[T], T2],
+    completed_msg_fn: Callable[[T, Any], T3],
+    tube_conf: dict,
+    pool: BeanstalkdPool,
+    failed_msg_fn: Callable[[T | None, BeanstalkJobID, Exception], FailedJobMessage | InvalidJobMessage],
+    job_slots: int,
+    touch_interval: float = BEANSTALKD_TOUCH_INTERVAL,
+    registry: MetricsRegistry | None = None,
+):
+    """Run up to `job_slots` jobs at once, each as a Ray task
+
+    A job is only reserved when a slot is free and the Ray cluster has the resources
+    declared for the tube (`JobResources`) available, beyond those of the jobs already running,
+    so jobs that would only wait
+    for resources stay in the queue, where other listeners can take them.
+    Running jobs are touched every `touch_interval` seconds, on the connection that reserved them,
+    so that jobs longer than their time-to-run are not released back to the queue.
+
+    On SIGTERM, no more jobs are reserved, and the listener returns once the running jobs finish.
+    """
+    resources = convert(tube_conf.get("resources", {}), JobResources)
+    if registry is None:
+        registry = MetricsRegistry()
+
+    if not ray.is_initialized():
+        ray.init()
+
+    run_handler = ray.remote(_run_handler).options(  # type: ignore
+        num_cpus=resources.num_cpus, memory=resources.memory or None, max_retries=0
+    )
+
+    draining = False
+
+    def drain(_signum, _frame):
+        nonlocal draining
+        print("Received SIGTERM, finishing running jobs before exiting", file=sys.stderr)
+        draining = True
+
+    try:
+        previous_handler = signal.signal(signal.SIGTERM, drain)
+    except ValueError:
+        # Signal handlers can only be set in the main thread
+        previous_handler = None
+
+    running: dict[ray.ObjectRef, _RunningJob] = {}
+
+    def finish(running_job: _RunningJob):
+        job = running_job.job
+        try:
+            res: _HandlerResult = ray.get(running_job.task)
+            _record_job_report(res.report, registry)
+            if res.error is None:
+                pool.put_job(job, json.encode(completed_msg_fn(running_job.job_data, res.value)))
+            else:
+                pool.put_job(
+                    job,
+                    json.encode(failed_msg_fn(running_job.job_data, job.job_id, Exception(res.error))),
+                )
+        except Exception as err:
+            # The task itself failed, e.g. its worker died
+            traceback.print_exc()
+            pool.put_job(job, json.encode(failed_msg_fn(running_job.job_data, job.job_id, err)))
+
+        pool.delete_job(job)
+
+    def touch_due(now: float):
+        for running_job in running.values():
+            if now - running_job.last_touched < touch_interval:
+                continue
+
+            try:
+                pool.touch_job(running_job.job)
+            except BeanstalkError:
+                traceback.print_exc()
+                print(f"Couldn't touch job {running_job.job.job_id}", file=sys.stderr)
+
+            running_job.last_touched = now
+
+    def has_capacity() -> bool:
+        if len(running) >= job_slots:
+            return False
+
+        # A job that needs more than the cluster has may still run alone
+        return len(running) == 0 or resources.fits_alongside(
+            len(running), ray.cluster_resources(), ray.available_resources()
+        )
+
+    try:
+        while running or not draining:
+            admitting = not draining and has_capacity()
+
+            if running:
+                done, _ = ray.wait(
+                    list(running),
+                    num_returns=len(running),
+                    timeout=0 if admitting else CONCURRENT_POLL_TIME,
+                )
+                for task in done:
+                    running_job = running.pop(task)
+                    try:
+                        finish(running_job)
+                    except BeanstalkError:
+                        traceback.print_exc()
+
+                touch_due(time.monotonic())
+
+            if not admitting:
+                continue
+
+            job: ReservedJob | None = None
+            job_data: T | None = None
+            try:
+                job = pool.reserve_job(CONCURRENT_POLL_TIME if running else JOB_TIMEOUT_TIME)
+
+                try:
+                    job_data = _decode_job_data(job, job.job_id, job_data_type)
+                except ValueError as err:
+                    traceback.print_exc()
+                    pool.put_job(job, json.encode(failed_msg_fn(None, job.job_id, err)))
+                    pool.delete_job(job)
+                    continue
+
+                publisher = ProgressPublisher(
+                    host=job.host,
+                    port=job.port,
+                    queue=tube_conf["events"],
+                    message=ProgressMessage(submission_id=job_data.submission_id),
+                )
+
+                pool.put_job(job, json.encode(submit_msg_fn(job_data)))
+                task = run_handler.remote(handler_fn, publisher, job_data, tube_conf["submission"])
+                running[task] = _RunningJob(
+                    job=job,
+                    job_data=job_data,
+                    task=task,
+                    last_touched=time.monotonic(),
+                )
+            except BeanstalkError as err:
+                if err.message == BEANSTALK_ERR_TIMEOUT:
+                    continue
+
+                traceback.print_exc()
+
+                # Lost hosts are reconnected to by the pool, which keeps reserving from the others
+                if job is None:
+                    continue
+
+                try:
+                    pool.release_job(job)
+                except BeanstalkError:
+                    traceback.print_exc()
+                time.sleep(1)
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+
+class ProgressStats(Struct):
+    """
+    Counters of a progress reporter, to measure the cost of reporting
+
+    Attributes:
+        n_calls: int
+            The number of reports received
+        n_flushes: int
+            The number of writes, to beanstalkd for a reporter actor,
+            or to the reporter actor for a `BufferedProgressReporter`
+        n_coalesced: int
+            The number of messages merged into another, or dropped as duplicates
+        flush_seconds: float
+            The total time spent flushing
+        max_flush_seconds: float
+            The longest flush
+    """
+
+    n_calls: int = 0
+    n_flushes: int = 0
+    n_coalesced: int = 0
+    flush_seconds: float = 0.0
+    max_flush_seconds: float = 0.0
+
+    def record_flush(self, seconds: float):
+        self.n_flushes += 1
+        self.flush_seconds += seconds
+        self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+
+    def merge(self, other: "ProgressStats") -> "ProgressStats":
+        return ProgressStats(
+            n_calls=self.n_calls + other.n_calls,
+            n_flushes=self.n_flushes + other.n_flushes,
+            n_coalesced=self.n_coalesced + other.n_coalesced,
+            flush_seconds=self.flush_seconds + other.flush_seconds,
+            max_flush_seconds=max(self.max_flush_seconds, other.max_flush_seconds),
+        )
+
+
 class ProgressReporter(abc.ABC):
     @abc.abstractmethod
     def increment(self, count: int, force: bool = False):
@@ -201,6 +586,24 @@ class ProgressReporter(abc.ABC):
         """Increment the counter by processed variant count
         and report to the beanstalk queue as a string message"""
 
+    @abc.abstractmethod
+    def report(
+        self,
+        count: int,
+        messages: list[str],
+        progress_message: tuple[str, str] | None = None,
+        force: bool = False,
+    ):
+        """Report a batch of increments and messages, buffered by a `BufferedProgressReporter`
+
+        The increments are reported as by `increment_and_write_progress_message`
+        when `progress_message` (the prefix and suffix) is given, and as by `increment` otherwise
+        """
+
+    @abc.abstractmethod
+    def flush(self):
+        """Send every pending report"""
+
     @abc.abstractmethod
     def clear_progress(self):
         """Clear the progress counter"""
@@ -209,26 +612,118 @@ class ProgressReporter(abc.ABC):
     def get_counter(self) -> int:
         """Get the current value of the counter"""
 
+    @abc.abstractmethod
+    def get_stats(self) -> ProgressStats:
+        """Get the reporter's counters"""
+
 
 @ray.remote(num_cpus=0)
 class BeanstalkdProgressReporter(ProgressReporter):
-    """A Ray class to report progress to a beanstalk queue"""
+    """A Ray class to report progress to a beanstalk queue
 
-    def __init__(self, publisher: ProgressPublisher, update_interval: int = 100_000):
+    Reports are batched, so that the queue is written at most once every `write_interval` seconds:
+    the status strings pending in the interval are then sent in order, one message each,
+    except that a progress string replaces the pending progress string it supersedes.
+    Pending reports are written by a background thread once the interval has passed,
+    or at once when forced.
+    """
+
+    def __init__(
+        self,
+        publisher: ProgressPublisher,
+        update_interval: int = 100_000,
+        write_interval: float = BEANSTALKD_PROGRESS_WRITE_INTERVAL,
+    ):
         self._message = publisher.message
         self._client = BeanstalkClient(publisher.host, publisher.port, socket_timeout=10)
         self._client.use(publisher.queue)
         self._update_interval = update_interval
+        self._write_interval = write_interval
 
         self._last_updated = 0
 
+        self._pending_texts: list[str] = []
+        # The position in _pending_texts of the progress string, which a later one supersedes
+        self._pending_progress_text: int | None = None
+        self._pending_progress = False
+        self._last_write = -math.inf
+        self._stats = ProgressStats()
+
+        # The writer thread and the actor's method calls share the pending reports,
+        # the progress message and the client
+        self._lock = threading.Lock()
+        self._has_pending = threading.Event()
+        self._writer = threading.Thread(target=self._write_periodically, daemon=True)
+        self._writer.start()
+
+    def _put(self, message: BaseMessage):
+        with Timer() as timer:
+            self._client.put_job(json.encode(message))
+
+        self._stats.record_flush(timer.elapsed_time)
+        self._last_write = time.monotonic()
+
+    def _write_pending(self, force: bool):
+        """Write the pending reports, if forced or if the interval has passed"""
+        with self._lock:
+            if not force and time.monotonic() - self._last_write < self._write_interval:
+                return
+
+            texts = self._pending_texts
+            self._pending_texts = []
+            self._pending_progress_text = None
+            for text in texts:
+                self._put(ProgressStringMessage(submission_id=self._message.submission_id, data=text))
+            wrote_text = len(texts) > 0
+
+            if self._pending_progress and (force or not wrote_text):
+                self._pending_progress = False
+                self._put(self._message)
+
+            if not self._pending_texts and not self._pending_progress:
+                self._has_pending.clear()
+
+    def _write_periodically(self):
+        while True:
+            self._has_pending.wait()
+            time.sleep(max(0.0, self._last_write + self._write_interval - time.monotonic()))
+            try:
+                self._write_pending(force=False)
+            except Exception:
+                traceback.print_exc()
+
+    def _queue_text(self, text: str, is_progress: bool = False):
+        """Queue a status string. The caller holds the lock."""
+        if is_progress and self._pending_progress_text is not None:
+            del self._pending_texts[self._pending_progress_text]
+            self._stats.n_coalesced += 1
+
+        self._pending_texts.append(text)
+        if is_progress:
+            self._pending_progress_text = len(self._pending_texts) - 1
+        self._has_pending.set()
+
+    def _add_progress(self, count: int, progress_message: tuple[str, str] | None, force: bool):
+        with self._lock:
+            self._message.data.progress += count
+
+            if force or self._message.data.progress - self._last_updated >= self._update_interval:
+                if progress_message is None:
+                    self._pending_progress = True
+                    self._has_pending.set()
+                else:
+                    msg_prefix, msg_suffix = progress_message
+                    self._queue_text(
+                        f"{msg_prefix} {self._message.data.progress} {msg_suffix}", is_progress=True
+                    )
+
+                self._last_updated = self._message.data.progress
+
     def increment(self, count: int, force: bool = False):
         """Increment the counter by processed variant count and report to the beanstalk queue"""
-        self._message.data.progress += count
-
-        if force or self._message.data.progress - self._last_updated >= self._update_interval:
-            self._client.put_job(json.encode(self._message))
-            self._last_updated = self._message.data.progress
+        self._stats.n_calls += 1
+        self._add_progress(count, None, force)
+        self._write_pending(force)
 
     def increment_and_write_progress_message(
         self, count: int, msg_prefix: str, msg_suffix: str = "", force: bool = False
@@ -236,30 +731,53 @@ class BeanstalkdProgressReporter(ProgressReporter):
         """Increment the counter by processed variant count
         and report to the beanstalk queue as a string message
         """
-        self._message.data.progress += count
-
-        if force or self._message.data.progress - self._last_updated >= self._update_interval:
-            message = f"{msg_prefix} {self._message.data.progress} {msg_suffix}"
-            progress_message = ProgressStringMessage(
-                submission_id=self._message.submission_id, data=message
-            )
-            self._client.put_job(json.encode(progress_message))
-            self._last_updated = self._message.data.progress
+        self._stats.n_calls += 1
+        self._add_progress(count, (msg_prefix, msg_suffix), force)
+        self._write_pending(force)
+
+    def report(
+        self,
+        count: int,
+        messages: list[str],
+        progress_message: tuple[str, str] | None = None,
+        force: bool = False,
+    ):
+        """Report a batch of increments and messages, buffered by a `BufferedProgressReporter`"""
+        self._stats.n_calls += 1
+        self._add_progress(count, progress_message, force)
+        with self._lock:
+            for msg in messages:
+                self._queue_text(msg)
+        self._write_pending(force)
+
+    def flush(self):
+        """Send every pending report"""
+        self._write_pending(force=True)
 
     def clear_progress(self):
         """Clear the progress counter"""
-        self._message.data.progress = 0
-        self._last_updated = 0
+        # Pending reports hold the count being cleared
+        self._write_pending(force=True)
+
+        with self._lock:
+            self._message.data.progress = 0
+            self._last_updated = 0
 
     def message(self, msg: str):
         """Send a message to the beanstalk queue"""
-        progress_message = ProgressStringMessage(submission_id=self._message.submission_id, data=msg)
-        self._client.put_job(json.encode(progress_message))
+        self._stats.n_calls += 1
+        with self._lock:
+            self._queue_text(msg)
+        self._write_pending(force=False)
 
     def get_counter(self) -> int:
         """Get the current value of the counter"""
         return self._message.data.progress
 
+    def get_stats(self) -> ProgressStats:
+        """Get the reporter's counters"""
+        return self._stats
+
 
 @ray.remote(num_cpus=0)
 class DebugProgressReporter(ProgressReporter):
@@ -267,28 +785,131 @@ class DebugProgressReporter(ProgressReporter):
 
     def __init__(self):
         self._value = 0
+        self._stats = ProgressStats()
 
     def increment(self, count: int, _force: bool = False):
+        self._stats.n_calls += 1
         self._value += count
         print(f"Processed {self._value} records")
 
     def increment_and_write_progress_message(
         self, count: int, msg_prefix: str, msg_suffix: str = "", _force: bool = False
     ):
+        self._stats.n_calls += 1
         self._value += count
         print(f"{msg_prefix} {self._value} {msg_suffix}")
 
+    def report(
+        self,
+        count: int,
+        messages: list[str],
+        progress_message: tuple[str, str] | None = None,
+        _force: bool = False,
+    ):
+        self._stats.n_calls += 1
+        self._value += count
+        if progress_message is not None:
+            print(f"{progress_message[0]} {self._value} {progress_message[1]}")
+        for msg in messages:
+            print(msg)
+
+    def flush(self):
+        pass
+
     def clear_progress(self):
         """Clear the progress counter"""
         self._value = 0
 
     def message(self, msg: str):
         """Send a message to the beanstalk queue"""
+        self._stats.n_calls += 1
         print(msg)
 
     def get_counter(self):
         return self._value
 
+    def get_stats(self) -> ProgressStats:
+        return self._stats
+
+
+class BufferedProgressReporter:
+    """
+    Buffers the reports of one producer, such as a fetch actor, and sends them to a reporter in batches
+
+    Producers that each call the reporter actor for every increment flood it with calls
+    under heavy fan-out. Here, increments are summed and messages collected locally,
+    and sent in one `report` call once `flush_interval` seconds have passed since the last,
+    or once `max_pending` messages are pending. Consecutive duplicate messages are dropped.
+    `flush` must be called when the producer is done, to send what remains.
+
+    Args:
+        reporter (ProgressReporter): The reporter actor
+        flush_interval (float, optional): The minimum number of seconds between calls to the reporter
+        max_pending (int, optional): The number of pending messages that triggers a flush
+    """
+
+    def __init__(
+        self,
+        reporter: ProgressReporter,
+        flush_interval: float = PROGRESS_FLUSH_INTERVAL,
+        max_pending: int = PROGRESS_FLUSH_MAX_PENDING,
+    ):
+        self._reporter = reporter
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._count = 0
+        self._messages: list[str] = []
+        self._progress_message: tuple[str, str] | None = None
+        self._last_flush = time.monotonic()
+        self.stats = ProgressStats()
+
+    def _maybe_flush(self):
+        if (
+            len(self._messages) >= self._max_pending
+            or time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            self.flush()
+
+    def increment(self, count: int, msg_prefix: str | None = None, msg_suffix: str = ""):
+        """Add to the counter; with `msg_prefix`, progress is reported as a string message"""
+        self.stats.n_calls += 1
+        self._count += count
+        if msg_prefix is not None:
+            self._progress_message = (msg_prefix, msg_suffix)
+
+        self._maybe_flush()
+
+    def message(self, msg: str):
+        self.stats.n_calls += 1
+        if self._messages and self._messages[-1] == msg:
+            self.stats.n_coalesced += 1
+        else:
+            self._messages.append(msg)
+
+        self._maybe_flush()
+
+    def flush(self, force: bool = False) -> ray.ObjectRef | None:
+        """Send the pending reports; with `force`, the reporter writes them at once
+
+        Returns:
+            ray.ObjectRef | None: The call to the reporter, or None if nothing was sent
+        """
+        if self._count == 0 and not self._messages and not force:
+            return None
+
+        with Timer() as timer:
+            report = self._reporter.report.remote(  # type: ignore
+                self._count, self._messages, self._progress_message, force
+            )
+
+        self.stats.record_flush(timer.elapsed_time)
+        self._count = 0
+        self._messages = []
+        self._last_flush = time.monotonic()
+
+        return report
+
 
 def get_progress_reporter(
     publisher: ProgressPublisher | None = None, update_interval: int = 100_000
@@ -1,14 +1,23 @@
 """Query an annotation file and return a list of sample_ids and genes meeting the query criteria."""
 import logging
-import math
-from typing import Any, Callable
+import os
+from typing import Any, Callable, Iterable, Iterator
 
 from msgspec import Struct
 import numpy as np
 import pandas as pd
-from opensearchpy import OpenSearch
+import pyarrow as pa  # type: ignore
+import ray
+from opensearchpy import AsyncOpenSearch, OpenSearch
 
 from bystro.proteomics.fragpipe_tandem_mass_tag import TandemMassTagDataset
+from bystro.search.save.slice_planner import SlicePlan, get_index_slice_settings, plan_slices
+from bystro.search.utils.sliced_fetch import (
+    iter_fetched_slices,
+    iter_hit_pages,
+    iter_hit_pages_sync,
+    prepare_slice_query_body,
+)
 
 logger = logging.getLogger(__file__)
 
@@ -16,6 +25,10 @@ HETEROZYGOTE_DOSAGE = 1
 HOMOZYGOTE_DOSAGE = 2
 MISSING_GENO_DOSAGE = np.nan
 ONE_DAY = "1d"  # default keep_alive time for opensearch point in time index
+# The maximum number of annotation rows joined to proteomics abundances at a time
+PROTEOMICS_JOIN_BATCH_SIZE = int(os.getenv("PROTEOMICS_JOIN_BATCH_SIZE", 65_536))
+# Feather V2 files are Arrow IPC files, compressed with lz4 by default
+_FEATHER_WRITE_OPTIONS = pa.ipc.IpcWriteOptions(compression="lz4")
 
 # The fields to return for each variant matched by the query
 OUTPUT_FIELDS = [
@@ -36,6 +49,7 @@ class OpenSearchQueryConfig(Struct):
     max_query_size: int = 10_000
     max_slices: int = 1024
     keep_alive: str = ONE_DAY
+    max_concurrency_per_worker: int = 4
 
 
 OPENSEARCH_QUERY_CONFIG = OpenSearchQueryConfig()
@@ -45,105 +59,190 @@ def _flatten(xs: Any) -> list[Any]:  # noqa: ANN401 (`Any` is really correct her
     """Flatten an arbitrarily nested list."""
     if not isinstance(xs, list):
         return [xs]
-    return sum([_flatten(x) for x in xs], [])
-
-
-def _extract_samples(samples):
-    return [sample[0] for sample in samples]
-
-
-def _get_samples_genes_dosages_from_hit(hit: dict[str, Any]) -> pd.DataFrame:
-    """Given a document hit, return a dataframe of samples, genes and dosages."""
-    source = hit["_source"]
-    chrom = _flatten(source["chrom"])[0]
-    pos = _flatten(source["pos"])[0]
-    ref = _flatten(source["ref"])[0]
-    alt = _flatten(source["alt"])[0]
-    unique_gene_names = set(_flatten(source["refSeq"]["name2"]))
-    # homozygotes, heterozygotes may not be present in response, so
-    # represent them as empty lists if not.
-
-    heterozygotes = _flatten(source.get("heterozygotes", []))
-    homozygotes = _flatten(source.get("homozygotes", []))
-    missing_genos = _flatten(source.get("missingGenos", []))
-    rows = []
-    for gene_name in unique_gene_names:
-        for heterozygote in heterozygotes:
-            rows.append(
-                {
-                    "sample_id": heterozygote,
-                    "chrom": chrom,
-                    "pos": pos,
-                    "ref": ref,
-                    "alt": alt,
-                    "gene_name": gene_name,
-                    "dosage": HETEROZYGOTE_DOSAGE,
-                }
-            )
-        for homozygote in homozygotes:
-            rows.append(
-                {
-                    "sample_id": homozygote,
-                    "chrom": chrom,
-                    "pos": pos,
-                    "ref": ref,
-                    "alt": alt,
-                    "gene_name": gene_name,
-                    "dosage": HOMOZYGOTE_DOSAGE,
-                }
-            )
-        for missing_geno in missing_genos:
-            rows.append(
-                {
-                    "sample_id": missing_geno,
-                    "chrom": chrom,
-                    "pos": pos,
-                    "ref": ref,
-                    "alt": alt,
-                    "gene_name": gene_name,
-                    "dosage": MISSING_GENO_DOSAGE,
-                }
-            )
 
-    return pd.DataFrame(rows)
+    flat: list[Any] = []
+    _extend_flattened(flat, xs)
+    return flat
 
 
-def _execute_query(
-    client: OpenSearch,
-    query_args: dict,
-) -> pd.DataFrame:
-    """Process OpenSearch query and return results."""
-    resp = client.search(**query_args)
-    return _process_response(resp)
+def _extend_flattened(flat: list[Any], xs: list[Any]) -> None:
+    for x in xs:
+        if isinstance(x, list):
+            _extend_flattened(flat, x)
+        else:
+            flat.append(x)
 
 
-def _process_response(resp: dict[str, Any]) -> pd.DataFrame:
-    """Postprocess query response from opensearch client."""
+def _codes(codes: dict[Any, int], values: list[Any]) -> np.ndarray:
+    """Dictionary-encode values, adding those not seen before to `codes`"""
+    return np.fromiter(
+        (codes.setdefault(value, len(codes)) for value in values), dtype=np.int32, count=len(values)
+    )
+
+
+# The dosage code of a missing genotype; its dosage is null in the table,
+# and MISSING_GENO_DOSAGE in pandas
+_MISSING_GENO_CODE = -1
+
+
+class _SampleGeneDosageBuilder:
+    """
+    Accumulates the samples, genes and dosages of the variants of a response, as flat arrays of codes.
+
+    Each hit adds one row for every pair of one of its genes, and one of its heterozygous,
+    homozygous, or missing samples. Samples, genes, and variants are dictionary-encoded as hits
+    are added, so a row is four integers, rather than a dict, until the table is built.
+    """
+
+    def __init__(self) -> None:
+        self._sample_codes: dict[str, int] = {}
+        self._gene_codes: dict[str, int] = {}
+        self._variant_codes: dict[tuple[Any, Any, Any, Any], int] = {}
+
+        self._samples: list[np.ndarray] = []
+        self._variants: list[np.ndarray] = []
+        self._genes: list[np.ndarray] = []
+        self._dosages: list[np.ndarray] = []
+
+        self.n_hits = 0
+
+    def add_hits(self, hits: list[dict[str, Any]]) -> None:
+        for hit in hits:
+            self.add_hit(hit)
+
+    def add_hit(self, hit: dict[str, Any]) -> None:
+        self.n_hits += 1
+
+        source = hit["_source"]
+        variant = (
+            _flatten(source["chrom"])[0],
+            _flatten(source["pos"])[0],
+            _flatten(source["ref"])[0],
+            _flatten(source["alt"])[0],
+        )
+        variant_code = self._variant_codes.setdefault(variant, len(self._variant_codes))
+        gene_codes = _codes(self._gene_codes, list(dict.fromkeys(_flatten(source["refSeq"]["name2"]))))
+
+        # homozygotes, heterozygotes may not be present in response, so
+        # represent them as empty lists if not.
+        heterozygotes, homozygotes, missing_genos = (
+            [sample for sample in _flatten(source.get(field) or []) if sample is not None]
+            for field in ("heterozygotes", "homozygotes", "missingGenos")
+        )
+        sample_codes = _codes(self._sample_codes, heterozygotes + homozygotes + missing_genos)
+        dosage_codes = np.repeat(
+            np.array([HETEROZYGOTE_DOSAGE, HOMOZYGOTE_DOSAGE, _MISSING_GENO_CODE], dtype=np.int8),
+            [len(heterozygotes), len(homozygotes), len(missing_genos)],
+        )
+
+        n_rows = len(gene_codes) * len(sample_codes)
+        if n_rows == 0:
+            return
+
+        self._samples.append(np.tile(sample_codes, len(gene_codes)))
+        self._variants.append(np.full(n_rows, variant_code, dtype=np.int32))
+        self._genes.append(np.repeat(gene_codes, len(sample_codes)))
+        self._dosages.append(np.tile(dosage_codes, len(gene_codes)))
+
+    def to_table(self) -> pa.Table:
+        """
+        The rows, with duplicates dropped, as a table of the columns:
+        sample_id and gene_name, dictionary-encoded, the string chrom, ref and alt, the int64 pos,
+        and the int8 dosage, which is null for missing genotypes
+        """
+        samples = np.concatenate(self._samples) if self._samples else np.empty(0, dtype=np.int32)
+        variants = np.concatenate(self._variants) if self._variants else np.empty(0, dtype=np.int32)
+        genes = np.concatenate(self._genes) if self._genes else np.empty(0, dtype=np.int32)
+        dosages = np.concatenate(self._dosages) if self._dosages else np.empty(0, dtype=np.int8)
+
+        # we may have the same variant in several hits, so keep only
+        # the first of each duplicated row.
+        rows = np.column_stack([samples, variants, genes, dosages.astype(np.int32)])
+        first = np.sort(np.unique(rows, axis=0, return_index=True)[1])
+        samples, variants, genes, dosages = samples[first], variants[first], genes[first], dosages[first]
+
+        chroms, positions, refs, alts = (
+            zip(*self._variant_codes, strict=True) if self._variant_codes else ([], [], [], [])
+        )
+        variant_indices = pa.array(variants)
+
+        return pa.table(
+            {
+                "sample_id": pa.DictionaryArray.from_arrays(
+                    samples, pa.array(list(self._sample_codes), pa.string())
+                ),
+                "chrom": pa.array(list(chroms), pa.string()).take(variant_indices),
+                # positions may be indexed as strings, so parse them
+                "pos": pa.array(list(positions)).cast(pa.int64()).take(variant_indices),
+                "ref": pa.array(list(refs), pa.string()).take(variant_indices),
+                "alt": pa.array(list(alts), pa.string()).take(variant_indices),
+                "gene_name": pa.DictionaryArray.from_arrays(
+                    genes, pa.array(list(self._gene_codes), pa.string())
+                ),
+                "dosage": pa.array(dosages, mask=dosages == _MISSING_GENO_CODE),
+            }
+        )
+
+
+def _response_table(resp: dict[str, Any]) -> pa.Table:
+    """Build the table of samples, genes and dosages of the hits of an opensearch response."""
     num_hits = len(resp["hits"]["hits"])
     total_value = resp["hits"]["total"]["value"]
     if num_hits != total_value:
         err_msg = f"Number of hits: {num_hits} didn't equal total value: {total_value}. This is a bug."
         raise ValueError(err_msg)
 
-    samples_genes_dosages_df = pd.concat(
-        [_get_samples_genes_dosages_from_hit(hit) for hit in resp["hits"]["hits"]]
-    )
-    # we may have multiple variants per gene in the results, so we
-    # need to drop duplicates here.
-    return samples_genes_dosages_df.drop_duplicates()
+    builder = _SampleGeneDosageBuilder()
+    builder.add_hits(resp["hits"]["hits"])
 
+    return builder.to_table()
 
-def _get_num_slices(
+
+def _process_response(resp: dict[str, Any]) -> pd.DataFrame:
+    """Postprocess query response from opensearch client."""
+    return _response_table(resp).to_pandas()
+
+
+@ray.remote
+class AnnotationQueryProcessor:
+    """Fetches slices of annotation queries, as tables of samples, genes and dosages"""
+
+    def __init__(self, search_client_args: dict):
+        self.client = AsyncOpenSearch(**search_client_args)
+
+    async def process_query(self, query_args: dict) -> tuple[pa.Table, int]:
+        """Fetch every page of the query's hits, returning their table, and the number of hits"""
+        builder = _SampleGeneDosageBuilder()
+        async for hits in iter_hit_pages(self.client, query_args):
+            builder.add_hits(hits)
+
+        return builder.to_table(), builder.n_hits
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def _fetch_slice(client: OpenSearch, query_args: dict) -> tuple[pa.Table, int]:
+    """Fetch every page of the query's hits with a blocking client, as AnnotationQueryProcessor does"""
+    builder = _SampleGeneDosageBuilder()
+    for hits in iter_hit_pages_sync(client, query_args):
+        builder.add_hits(hits)
+
+    return builder.to_table(), builder.n_hits
+
+
+def _plan_slices(
     client: OpenSearch,
     index_name: str,
     query: dict[str, Any],
-) -> tuple[int, int]:
-    """Count number of hits for the index."""
-    get_num_slices_query = query["body"].copy()
-    get_num_slices_query.pop("sort", None)
-    get_num_slices_query.pop("track_total_hits", None)
+    num_workers: int,
+) -> SlicePlan:
+    """Count number of hits for the query, and plan the slices they are fetched in."""
+    count_query = query["body"].copy()
+    count_query.pop("sort", None)
+    count_query.pop("track_total_hits", None)
 
-    response = client.count(body=get_num_slices_query, index=index_name)
+    response = client.count(body=count_query, index=index_name)
 
     n_docs: int = response["count"]
     if n_docs < 1:
@@ -152,36 +251,114 @@ def _get_num_slices(
         )
         raise RuntimeError(err_msg)
 
-    num_slices_necessary = math.ceil(n_docs / OPENSEARCH_QUERY_CONFIG.max_query_size)
-    num_slices_planned = min(num_slices_necessary, OPENSEARCH_QUERY_CONFIG.max_slices)
-    return max(num_slices_planned, 1), n_docs
+    return plan_slices(
+        num_docs=n_docs,
+        settings=get_index_slice_settings(client, index_name),
+        num_workers=num_workers,
+        max_query_size=OPENSEARCH_QUERY_CONFIG.max_query_size,
+        max_slices=OPENSEARCH_QUERY_CONFIG.max_slices,
+    )
 
 
-def _run_annotation_query(
+def _iter_slice_tables(
+    client: OpenSearch,
     query: dict[str, Any],
+    num_slices: int,
+    search_client_args: dict | None,
+    num_workers: int,
+) -> Iterator[tuple[pa.Table, int]]:
+    """Fetch each slice of the query, yielding its table and number of hits as each completes."""
+    if search_client_args is None:
+        for slice_id in range(num_slices):
+            body = (
+                prepare_slice_query_body(query["body"], slice_id, num_slices)
+                if num_slices > 1
+                else query["body"].copy()
+            )
+            yield _fetch_slice(client, {**query, "body": body})
+        return
+
+    actor_constructor = AnnotationQueryProcessor.options(  # type: ignore
+        max_concurrency=OPENSEARCH_QUERY_CONFIG.max_concurrency_per_worker
+    )
+    actors = [actor_constructor.remote(search_client_args) for _ in range(min(num_workers, num_slices))]
+
+    def fetch(actor, search_args: dict, _slice_id: int):
+        return actor.process_query.remote({**query, **search_args})
+
+    try:
+        for _, result, _ in iter_fetched_slices(
+            actors,
+            fetch,
+            query["body"],
+            num_slices,
+            OPENSEARCH_QUERY_CONFIG.max_concurrency_per_worker,
+        ):
+            yield result
+    finally:
+        ray.get([actor.close.remote() for actor in actors])
+
+
+def iter_annotation_query_tables(
+    user_query_string: str,
     index_name: str,
     client: OpenSearch,
-) -> pd.DataFrame:
-    """Given query and index contained in SaveJobData, run query and return results as dataframe."""
-    num_slices, _ = _get_num_slices(client, index_name, query)
+    search_client_args: dict | None = None,
+) -> Iterator[pa.Table]:
+    """
+    Run a query over a point in time of the index, yielding a table of the samples, genes and
+    dosages of each slice of its hits, as each slice completes.
+
+    The hits are split into slices, each paged through with search_after, so queries of any size
+    are fetched in requests of at most `OPENSEARCH_QUERY_CONFIG.max_query_size` hits.
+
+    Args:
+      user_query_string: The query string
+      index_name: The index to query
+      client: The client that counts the hits, and creates the point in time;
+        if `search_client_args` is None, it also fetches the slices, one at a time
+      search_client_args: The arguments of the AsyncOpenSearch clients of Ray actors
+        that fetch the slices concurrently, as the save handler does
+
+    Yields:
+      pa.Table: The table of each slice, with the columns sample_id and gene_name,
+        dictionary-encoded, chrom, pos, ref, alt, and the int8 dosage,
+        which is null for missing genotypes
+    """
+    query = _build_opensearch_query_from_query_string(user_query_string)
+
+    num_workers = 1
+    if search_client_args is not None:
+        if not ray.is_initialized():
+            ray.init()
+        num_workers = int(ray.available_resources().get("CPU", 1))
+
+    slice_plan = _plan_slices(client, index_name, query, num_workers)
+    logger.info(
+        "Fetching %d hits in %d slices, across %d shards",
+        slice_plan.num_docs,
+        slice_plan.num_slices,
+        slice_plan.num_shards,
+    )
+
     point_in_time = client.create_point_in_time(  # type: ignore[attr-defined]
         index=index_name, params={"keep_alive": OPENSEARCH_QUERY_CONFIG.keep_alive}
     )
+    pit_id = point_in_time["pit_id"]
     try:  # make sure we clean up the PIT index properly no matter what happens in this block
-        pit_id = point_in_time["pit_id"]
         query["body"]["pit"] = {"id": pit_id}
         query["body"]["size"] = OPENSEARCH_QUERY_CONFIG.max_query_size
-        query_results = []
-        for slice_id in range(num_slices):
-            slice_query = query.copy()
-            if num_slices > 1:
-                # Slice queries require max > 1
-                slice_query["slice"] = {"id": slice_id, "max": num_slices}
-            query_result = _execute_query(
-                client,
-                query_args=query,
-            )
-            query_results.append(query_result)
+
+        n_hits = 0
+        for table, slice_hits in _iter_slice_tables(
+            client, query, slice_plan.num_slices, search_client_args, num_workers
+        ):
+            n_hits += slice_hits
+            yield table
+
+        if n_hits != slice_plan.num_docs:
+            err_msg = f"Expected {slice_plan.num_docs} hits for the query, fetched {n_hits}"
+            raise RuntimeError(err_msg)
     except Exception as e:
         err_msg = (
             f"Encountered exception: {e!r} while running opensearch_query, "
@@ -191,10 +368,9 @@ def _run_annotation_query(
             f"opensearch_query_config: {OPENSEARCH_QUERY_CONFIG}\n"
         )
         logger.exception(err_msg, exc_info=e)
-        client.delete_point_in_time(body={"pit_id": pit_id})  # type: ignore[attr-defined]
         raise
-    client.delete_point_in_time(body={"pit_id": pit_id})  # type: ignore[attr-defined]
-    return pd.concat(query_results)
+    finally:
+        client.delete_point_in_time(body={"pit_id": pit_id})  # type: ignore[attr-defined]
 
 
 def _build_opensearch_query_from_query_string(query_string: str) -> dict[str, Any]:
@@ -213,7 +389,6 @@ def _build_opensearch_query_from_query_string(query_string: str) -> dict[str, An
                     },
                 },
             },
-            "sort": "_doc",
         },
         "_source_includes": OUTPUT_FIELDS,
     }
@@ -224,34 +399,299 @@ def get_annotation_result_from_query(
     user_query_string: str,
     index_name: str,
     client: OpenSearch,
+    search_client_args: dict | None = None,
 ) -> pd.DataFrame:
-    """Given a query and index, return a dataframe of variant / sample_id records matching query."""
-    query = _build_opensearch_query_from_query_string(user_query_string)
-    return _run_annotation_query(query, index_name, client)
+    """
+    Given a query and index, return a dataframe of variant / sample_id records matching query.
+
+    The slices of the query are fetched as `iter_annotation_query_tables` fetches them.
+    """
+    tables = list(
+        iter_annotation_query_tables(user_query_string, index_name, client, search_client_args)
+    )
+    return pa.concat_tables(tables).to_pandas()
+
+
+def _proteomic_sample_codes(
+    sample_ids: Any,  # noqa: ANN401 (array-like of sample ids)
+    get_tracking_id: Callable[[str], str],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Map proteomic sample ids to tracking ids, calling `get_tracking_id` once per distinct sample id,
+    returning the code of each sample's tracking id, and the distinct tracking ids.
+    """
+    codes, uniques = pd.factorize(np.asarray(sample_ids, dtype=object))
+    tracking_codes, tracking_ids = pd.factorize(
+        np.array([get_tracking_id(sample_id) for sample_id in uniques], dtype=object)
+    )
+    return np.where(codes >= 0, tracking_codes[codes], -1), np.asarray(tracking_ids, dtype=object)
+
+
+class ProteomicsIndex:
+    """
+    The abundances of a proteomics dataset, indexed by (sample code, gene code)
+
+    Sample tracking ids and gene names are dictionary-encoded once, and each abundance is keyed
+    by `sample_code * n_genes + gene_code`, with the keys sorted, so joining rows of annotation
+    results is a binary search of their keys. Abundances sharing a key keep the order they have
+    in the dataset.
+
+    Args:
+        sample_ids (np.ndarray): The distinct tracking ids of the samples, indexed by sample code
+        gene_names (np.ndarray): The distinct gene names, indexed by gene code
+        keys (np.ndarray): The sorted int64 key of each abundance
+        abundances (pa.Table): The columns of each abundance, other than its sample and gene,
+            in the order of `keys`
+    """
+
+    def __init__(
+        self, sample_ids: np.ndarray, gene_names: np.ndarray, keys: np.ndarray, abundances: pa.Table
+    ):
+        if len(keys) != abundances.num_rows:
+            raise ValueError(
+                f"Expected one abundance per key, got {len(keys)} keys and {abundances.num_rows} rows"
+            )
+
+        self.sample_ids = sample_ids
+        self.gene_names = gene_names
+        self.keys = keys
+        self.abundances = abundances
+
+        self._sample_codes = {sample_id: code for code, sample_id in enumerate(sample_ids)}
+        self._gene_codes = {gene_name: code for code, gene_name in enumerate(gene_names)}
+
+    @classmethod
+    def _from_codes(
+        cls,
+        sample_codes: np.ndarray,
+        sample_ids: np.ndarray,
+        gene_codes: np.ndarray,
+        gene_names: np.ndarray,
+        abundances: pa.Table,
+    ) -> "ProteomicsIndex":
+        keys = sample_codes.astype(np.int64) * len(gene_names) + gene_codes
+        # Abundances without a sample or gene can't be joined
+        keys[(sample_codes < 0) | (gene_codes < 0)] = -1
+
+        order = np.argsort(keys, kind="stable")
+        order = order[keys[order] >= 0]
+
+        return cls(sample_ids, np.asarray(gene_names, dtype=object), keys[order], abundances.take(order))
+
+    @classmethod
+    def from_tandem_mass_tag_dataset(
+        cls,
+        tmt_dataset: TandemMassTagDataset,
+        get_tracking_id_from_proteomic_sample_id: Callable[[str], str] = (lambda x: x),
+    ) -> "ProteomicsIndex":
+        """Index the abundances of a TMT dataset, without melting its abundance df"""
+        sample_columns = tmt_dataset.get_sample_columns()
+        column_codes, sample_ids = _proteomic_sample_codes(
+            sample_columns, get_tracking_id_from_proteomic_sample_id
+        )
+        row_codes, gene_names = pd.factorize(tmt_dataset.abundance_df.index)
+
+        # In the order of the melted abundance df: by sample column, then by gene row
+        n_rows = len(row_codes)
+        abundances = tmt_dataset.abundance_df[sample_columns].to_numpy().T.ravel()
+
+        return cls._from_codes(
+            np.repeat(column_codes, n_rows),
+            sample_ids,
+            np.tile(row_codes, len(column_codes)),
+            gene_names,
+            pa.table({"value": abundances}),
+        )
+
+    @classmethod
+    def from_long_df(
+        cls,
+        proteomics_df: pd.DataFrame,
+        get_tracking_id_from_proteomic_sample_id: Callable[[str], str] = (lambda x: x),
+    ) -> "ProteomicsIndex":
+        """Index a proteomics df with sample_id and gene_name columns, and one row per abundance"""
+        sample_codes, sample_ids = _proteomic_sample_codes(
+            proteomics_df["sample_id"], get_tracking_id_from_proteomic_sample_id
+        )
+        gene_codes, gene_names = pd.factorize(proteomics_df["gene_name"])
+
+        return cls._from_codes(
+            sample_codes,
+            sample_ids,
+            gene_codes,
+            gene_names,
+            pa.Table.from_pandas(
+                proteomics_df.drop(columns=["sample_id", "gene_name"]), preserve_index=False
+            ),
+        )
+
+    @classmethod
+    def from_dataset(
+        cls,
+        dataset: TandemMassTagDataset | pd.DataFrame,
+        get_tracking_id_from_proteomic_sample_id: Callable[[str], str] = (lambda x: x),
+    ) -> "ProteomicsIndex":
+        """Index a TMT dataset, or a proteomics df with one row per abundance"""
+        if isinstance(dataset, TandemMassTagDataset):
+            return cls.from_tandem_mass_tag_dataset(dataset, get_tracking_id_from_proteomic_sample_id)
+
+        return cls.from_long_df(dataset, get_tracking_id_from_proteomic_sample_id)
+
+    def _lookup_codes(
+        self,
+        column: pa.ChunkedArray,
+        codes: dict[Any, int],
+        get_id: Callable[[str], str] | None = None,
+    ) -> np.ndarray:
+        """The code of each value of an annotation column, or -1 for values not in the dataset"""
+        chunk_codes = [np.empty(0, dtype=np.int32)]
+        for chunk in column.chunks:
+            if not pa.types.is_dictionary(chunk.type):
+                chunk = chunk.dictionary_encode()
+
+            dictionary = chunk.dictionary.to_pylist()
+            if get_id is not None:
+                dictionary = [get_id(value) if value is not None else None for value in dictionary]
+
+            # The last code is that of null values
+            value_codes = np.array([codes.get(value, -1) for value in dictionary] + [-1], dtype=np.int32)
+            chunk_codes.append(value_codes[chunk.indices.fill_null(len(dictionary)).to_numpy()])
+
+        return np.concatenate(chunk_codes)
+
+    def join(
+        self,
+        annotation_table: pa.Table,
+        get_tracking_id_from_genomic_sample_id: Callable[[str], str] = (lambda x: x),
+        batch_size: int | None = None,
+    ) -> Iterator[pa.Table]:
+        """
+        Inner join rows of annotation results to the abundances of their sample and gene,
+        in batches of at most `batch_size` annotation rows.
+
+        Yields, for each batch, the table of the batch's joined rows: the annotation's columns,
+        with sample_id (the tracking id) and gene_name dictionary-encoded with the index's
+        dictionaries, followed by the abundance's columns. At least one, possibly empty,
+        table is yielded.
+        """
+        sample_codes = self._lookup_codes(
+            annotation_table.column("sample_id"),
+            self._sample_codes,
+            get_tracking_id_from_genomic_sample_id,
+        )
+        gene_codes = self._lookup_codes(annotation_table.column("gene_name"), self._gene_codes)
+
+        keys = sample_codes.astype(np.int64) * len(self.gene_names) + gene_codes
+        keys[(sample_codes < 0) | (gene_codes < 0)] = -1
+
+        sample_dictionary = pa.array(self.sample_ids, pa.string())
+        gene_dictionary = pa.array(self.gene_names, pa.string())
+
+        batch_size = batch_size or max(annotation_table.num_rows, 1)
+        for start in range(0, max(annotation_table.num_rows, 1), batch_size):
+            batch_keys = keys[start : start + batch_size]
+
+            lo = np.searchsorted(self.keys, batch_keys, side="left")
+            hi = np.searchsorted(self.keys, batch_keys, side="right")
+            counts = np.where(batch_keys >= 0, hi - lo, 0)
+
+            # Each annotation row, repeated once per abundance it matches
+            left = np.repeat(np.arange(len(batch_keys)), counts)
+            right = np.repeat(lo, counts) + (
+                np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+            )
+
+            joined = annotation_table.slice(start, len(batch_keys)).take(left)
+            joined = joined.set_column(
+                joined.schema.get_field_index("sample_id"),
+                "sample_id",
+                pa.DictionaryArray.from_arrays(
+                    pa.array(sample_codes[start + left], pa.int32()), sample_dictionary
+                ),
+            )
+            joined = joined.set_column(
+                joined.schema.get_field_index("gene_name"),
+                "gene_name",
+                pa.DictionaryArray.from_arrays(
+                    pa.array(gene_codes[start + left], pa.int32()), gene_dictionary
+                ),
+            )
+
+            abundances = self.abundances.take(right)
+            for name, column in zip(abundances.column_names, abundances.columns, strict=True):
+                joined = joined.append_column(name, column)
+
+            yield joined
 
 
 def join_annotation_result_to_proteomics_dataset(
     query_result_df: pd.DataFrame,
-    tmt_dataset: TandemMassTagDataset,
+    tmt_dataset: TandemMassTagDataset | pd.DataFrame,
     get_tracking_id_from_genomic_sample_id: Callable[[str], str] = (lambda x: x),
     get_tracking_id_from_proteomic_sample_id: Callable[[str], str] = (lambda x: x),
 ) -> pd.DataFrame:
     """
     Args:
       query_result_df: pd.DataFrame containing result from get_annotation_result_from_query
-      tmt_dataset: TamdemMassTagDataset
+      tmt_dataset: TamdemMassTagDataset, or a pd.DataFrame with sample_id and gene_name columns,
+        and one row per abundance
       get_tracking_id_from_proteomic_sample_id: Callable mapping proteomic sample IDs to tracking IDs
       get_tracking_id_from_genomic_sample_id: Callable mapping genomic sample IDs to tracking IDs
     """
-    query_result_df = query_result_df.copy()
-    proteomics_df = tmt_dataset.get_melted_abundance_df()
-
-    query_result_df.sample_id = query_result_df.sample_id.apply(get_tracking_id_from_genomic_sample_id)
-    proteomics_df.sample_id = proteomics_df.sample_id.apply(get_tracking_id_from_proteomic_sample_id)
+    proteomics_index = ProteomicsIndex.from_dataset(
+        tmt_dataset, get_tracking_id_from_proteomic_sample_id
+    )
+    query_result_table = pa.Table.from_pandas(query_result_df, preserve_index=False)
 
-    joined_df = query_result_df.merge(
-        proteomics_df,
-        left_on=["sample_id", "gene_name"],
-        right_on=["sample_id", "gene_name"],
+    joined_tables = list(
+        proteomics_index.join(query_result_table, get_tracking_id_from_genomic_sample_id)
     )
-    return joined_df
+    return pa.concat_tables(joined_tables).to_pandas()
+
+
+def write_annotation_proteomics_join(
+    annotation_tables: Iterable[pa.Table],
+    proteomics_index: ProteomicsIndex,
+    path: str,
+    get_tracking_id_from_genomic_sample_id: Callable[[str], str] = (lambda x: x),
+    batch_size: int = PROTEOMICS_JOIN_BATCH_SIZE,
+) -> int:
+    """
+    Join annotation results, such as the slices yielded by `iter_annotation_query_tables`,
+    to a proteomics dataset, writing the joined rows to a feather file as each batch is joined.
+
+    Args:
+      annotation_tables: The tables of annotation results
+      proteomics_index: The index of the proteomics dataset
+      path: The path of the feather file to write
+      get_tracking_id_from_genomic_sample_id: Callable mapping genomic sample IDs to tracking IDs
+      batch_size: The maximum number of annotation rows joined at a time
+
+    Returns:
+      int: The number of joined rows written
+    """
+    writer: pa.ipc.RecordBatchFileWriter | None = None
+    schema: pa.Schema | None = None
+    n_rows = 0
+    try:
+        for annotation_table in annotation_tables:
+            for joined in proteomics_index.join(
+                annotation_table, get_tracking_id_from_genomic_sample_id, batch_size
+            ):
+                if writer is None:
+                    schema = joined.schema
+                    writer = pa.ipc.new_file(path, schema, options=_FEATHER_WRITE_OPTIONS)
+                elif joined.schema != schema:
+                    joined = joined.cast(schema)
+
+                if joined.num_rows > 0:
+                    writer.write_table(joined)
+                    n_rows += joined.num_rows
+
+        if writer is None:
+            raise ValueError("Expected at least one table of annotation results to join")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
@@ -4,8 +4,15 @@ from dataclasses import dataclass
 from io import StringIO
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from bystro.proteomics.fragpipe_utils import check_df_starts_with_cols, prep_annotation_df
+import pyarrow as pa  # type: ignore
+from bystro.proteomics.fragpipe_utils import (
+    AbundanceMatrix,
+    check_table_starts_with_cols,
+    prep_annotation_df,
+    read_fragpipe_tsv,
+)
 
 PG_MATRIX_COLS = ["Protein.Group", "Protein.Ids", "Protein.Names", "Genes", "First.Protein.Description"]
 
@@ -18,22 +25,35 @@ class DataIndependentAnalysisDataset:
     annotation_df: pd.DataFrame
 
 
-def _prep_pg_matrix_df(pg_matrix_df: pd.DataFrame) -> pd.DataFrame:
+def _get_pg_matrix_abundance_matrix(
+    raw_pg_matrix_table: pa.Table, dtype: type = np.float32
+) -> AbundanceMatrix:
+    """Gather the sample columns of a pg_matrix, those after PG_MATRIX_COLS, indexed by Protein.Ids."""
+    check_table_starts_with_cols(raw_pg_matrix_table, PG_MATRIX_COLS)
+    sample_cols = raw_pg_matrix_table.column_names[len(PG_MATRIX_COLS) :]
+    return AbundanceMatrix.from_table(raw_pg_matrix_table, "Protein.Ids", sample_cols, dtype=dtype)
+
+
+def _prep_pg_matrix_df(raw_pg_matrix_table: pa.Table) -> pd.DataFrame:
     """Prep pg_matrix_df, setting Protein.IDs as index and dropping extraneous columns."""
-    check_df_starts_with_cols(pg_matrix_df, PG_MATRIX_COLS)
-    pg_matrix_df = pg_matrix_df.set_index("Protein.Ids")
-    pg_matrix_df = pg_matrix_df.drop(
-        ["Protein.Group", "Protein.Names", "Genes", "First.Protein.Description"], axis="columns"
-    )
+    pg_matrix_df = _get_pg_matrix_abundance_matrix(raw_pg_matrix_table, dtype=np.float64).to_df()
+    pg_matrix_df.index.name = "Protein.Ids"
     return pg_matrix_df
 
 
+def load_data_independent_analysis_abundance_matrix(
+    pg_matrix_filename: Path | str | StringIO, dtype: type = np.float32
+) -> AbundanceMatrix:
+    """Load the abundances of a Fragpipe data-independent analysis pg_matrix."""
+    return _get_pg_matrix_abundance_matrix(read_fragpipe_tsv(pg_matrix_filename), dtype=dtype)
+
+
 def load_data_independent_analysis_dataset(
     pg_matrix_filename: Path | str | StringIO, annotation_filename: Path | str | StringIO
 ) -> DataIndependentAnalysisDataset:
     """Load and prep Fragpipe tandem mass tag datasets."""
-    raw_pg_matrix_df = pd.read_csv(pg_matrix_filename, sep="\t")
+    raw_pg_matrix_table = read_fragpipe_tsv(pg_matrix_filename)
     raw_annotation_df = pd.read_csv(annotation_filename, sep="\t")
-    pg_matrix_df = _prep_pg_matrix_df(raw_pg_matrix_df)
+    pg_matrix_df = _prep_pg_matrix_df(raw_pg_matrix_table)
     annotation_df = prep_annotation_df(raw_annotation_df)
     return DataIndependentAnalysisDataset(pg_matrix_df, annotation_df)
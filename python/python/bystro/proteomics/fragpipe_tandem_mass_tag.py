@@ -2,11 +2,22 @@
 
 from dataclasses import dataclass
 from io import StringIO
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from bystro.proteomics.fragpipe_utils import check_df_starts_with_cols, prep_annotation_df
+import pyarrow as pa  # type: ignore
+from bystro.proteomics.fragpipe_utils import (
+    AbundanceMatrix,
+    check_df_starts_with_cols,
+    check_table_starts_with_cols,
+    prep_annotation_df,
+    read_fragpipe_tsv,
+)
 
 ABUNDANCE_COLS = ["Index", "NumberPSM", "ProteinID", "MaxPepProb", "ReferenceIntensity"]
+# The columns of an abundance df that are not samples, besides its index
+NON_SAMPLE_ABUNDANCE_COLS = ABUNDANCE_COLS[1:]
 
 
 @dataclass(frozen=True)
@@ -23,10 +34,14 @@ class TandemMassTagDataset:
             err_msg = "Received abundance_df with unexpected columns"
             raise ValueError(err_msg) from e
 
+    def get_sample_columns(self) -> pd.Index:
+        """Return the sample columns of the abundance df"""
+        return self.abundance_df.columns.drop(NON_SAMPLE_ABUNDANCE_COLS)
+
     def get_melted_abundance_df(self) -> pd.DataFrame:
         """Return a melted abundance df with columns [gene_name, sample_id, value]"""
         abundance_df = self.abundance_df
-        columns_to_drop = ["NumberPSM", "ProteinID", "MaxPepProb", "ReferenceIntensity"]
+        columns_to_drop = NON_SAMPLE_ABUNDANCE_COLS
         final_column_ordering = ["sample_id", "gene_name", "value"]
         melted_df_with_unsorted_columns = (
             abundance_df.drop(columns=columns_to_drop)
@@ -36,23 +51,54 @@ class TandemMassTagDataset:
         return melted_df_with_unsorted_columns[final_column_ordering]
 
 
-def _prep_abundance_df(abundance_df: pd.DataFrame) -> pd.DataFrame:
+def _get_sample_cols(raw_abundance_table: pa.Table) -> list[str]:
+    """Return the sample columns of a raw abundance table: those after ReferenceIntensity."""
+    check_table_starts_with_cols(raw_abundance_table, ABUNDANCE_COLS)
+    return raw_abundance_table.column_names[len(ABUNDANCE_COLS) :]
+
+
+def _prep_abundance_df(raw_abundance_table: pa.Table) -> pd.DataFrame:
     """Prep abundance_df, setting index and normalizing abundances by ReferenceIntensity."""
-    check_df_starts_with_cols(abundance_df, ABUNDANCE_COLS)
-    abundance_df = abundance_df.set_index("Index")
-    first_sample_column_idx = abundance_df.columns.to_list().index("ReferenceIntensity") + 1
-    sample_columns = abundance_df.columns[first_sample_column_idx:]
-    for sample_column in sample_columns:
-        abundance_df[sample_column] -= abundance_df.ReferenceIntensity
+    abundance_matrix = AbundanceMatrix.from_table(
+        raw_abundance_table,
+        "Index",
+        _get_sample_cols(raw_abundance_table),
+        reference_col="ReferenceIntensity",
+        dtype=np.float64,
+    )
+    abundance_df = pd.concat(
+        [
+            raw_abundance_table.select(NON_SAMPLE_ABUNDANCE_COLS)
+            .to_pandas()
+            .set_axis(pd.Index(abundance_matrix.protein_ids)),
+            abundance_matrix.to_df(),
+        ],
+        axis="columns",
+    )
+    abundance_df.index.name = "Index"
     return abundance_df
 
 
+def load_tandem_mass_tag_abundance_matrix(
+    abundance_filename: Path | str | StringIO, dtype: type = np.float32
+) -> AbundanceMatrix:
+    """Load the abundances of a Fragpipe tandem mass tag dataset, normalized by ReferenceIntensity."""
+    raw_abundance_table = read_fragpipe_tsv(abundance_filename)
+    return AbundanceMatrix.from_table(
+        raw_abundance_table,
+        "Index",
+        _get_sample_cols(raw_abundance_table),
+        reference_col="ReferenceIntensity",
+        dtype=dtype,
+    )
+
+
 def load_tandem_mass_tag_dataset(
-    abundance_filename: str | StringIO, annotation_filename: str | StringIO
+    abundance_filename: Path | str | StringIO, annotation_filename: Path | str | StringIO
 ) -> TandemMassTagDataset:
     """Load and prep Fragpipe tandem mass tag datasets."""
-    raw_abundance_df = pd.read_csv(abundance_filename, sep="\t")
+    raw_abundance_table = read_fragpipe_tsv(abundance_filename)
     raw_annotation_df = pd.read_csv(annotation_filename, sep="\t")
-    abundance_df = _prep_abundance_df(raw_abundance_df)
+    abundance_df = _prep_abundance_df(raw_abundance_table)
     annotation_df = prep_annotation_df(raw_annotation_df)
     return TandemMassTagDataset(abundance_df, annotation_df)
@@ -1,9 +1,35 @@
 """Provide various utilities for ingestion of Fragpipe file formats."""
 
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from io import BytesIO, StringIO
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa  # type: ignore
+import pyarrow.csv as csv  # type: ignore
+
+logger = logging.getLogger(__file__)
 
 ANNOTATION_COLS = ["plex", "channel", "sample", "sample_name", "condition", "replicate"]
 
+# When set, Fragpipe tsvs read from disk are cached as Arrow IPC files in this directory,
+# keyed by the hash of their contents, so that later loads of the same file are memory-mapped
+# rather than parsed. Not cached if unset
+PROTEOMICS_CACHE_DIR = os.getenv("PROTEOMICS_CACHE_DIR", "")
+
+# Bumped whenever the way tsvs are parsed changes, so that stale cached tables aren't read
+_CACHE_VERSION = "1"
+_HASH_CHUNK_SIZE = 1 << 20
+
+_TSV_PARSE_OPTIONS = csv.ParseOptions(delimiter="\t")
+# Match pd.read_csv, which reads empty and "NA"-like strings as missing
+_TSV_CONVERT_OPTIONS = csv.ConvertOptions(strings_can_be_null=True)
+
 
 def check_df_starts_with_cols(df: pd.DataFrame, expected_cols: list[str]) -> None:
     """Check that df cols contain expected cols as a prefix."""
@@ -15,7 +41,168 @@ def check_df_starts_with_cols(df: pd.DataFrame, expected_cols: list[str]) -> Non
         raise ValueError(err_msg)
 
 
+def check_table_starts_with_cols(table: pa.Table, expected_cols: list[str]) -> None:
+    """Check that table cols contain expected cols as a prefix."""
+    actual_cols = table.column_names
+    if actual_cols[: len(expected_cols)] != expected_cols:
+        err_msg = f"expected table to begin with cols: {expected_cols}, got cols: {actual_cols} instead."
+        raise ValueError(err_msg)
+
+
 def prep_annotation_df(annotation_df: pd.DataFrame) -> pd.DataFrame:
     """Prep annotation df, using 'sample' column as index."""
     check_df_starts_with_cols(annotation_df, ANNOTATION_COLS)
     return annotation_df.set_index("sample")
+
+
+def _stat_key(filename: Path) -> str:
+    """A key that changes whenever the file at `filename` is replaced or modified"""
+    stat = filename.stat()
+    key = f"{filename.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _hash_file(filename: Path) -> str:
+    digest = hashlib.sha256()
+    with filename.open("rb") as file:
+        while chunk := file.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_tsv(source: Path | BytesIO) -> pa.Table:
+    return csv.read_csv(
+        source if isinstance(source, BytesIO) else str(source),
+        parse_options=_TSV_PARSE_OPTIONS,
+        convert_options=_TSV_CONVERT_OPTIONS,
+    )
+
+
+def _write_cache_file(cache_filename: Path, write: Callable[[Path], None]) -> None:
+    """Write a cache file atomically, so that concurrent readers never see a partial file"""
+    tmp_filename = cache_filename.with_name(f"{cache_filename.name}.{os.getpid()}.tmp")
+    try:
+        cache_filename.parent.mkdir(parents=True, exist_ok=True)
+        write(tmp_filename)
+        os.replace(tmp_filename, cache_filename)
+    except OSError as e:
+        logger.warning("Couldn't write cache file %s: %s", cache_filename, e)
+        tmp_filename.unlink(missing_ok=True)
+
+
+def _write_cached_table(table: pa.Table, cache_filename: Path) -> None:
+    def write(tmp_filename: Path) -> None:
+        with pa.ipc.new_file(str(tmp_filename), table.schema) as writer:
+            writer.write_table(table)
+
+    _write_cache_file(cache_filename, write)
+
+
+def read_fragpipe_tsv(filename: Path | str | StringIO, cache_dir: str | None = None) -> pa.Table:
+    """
+    Read a Fragpipe tsv as an Arrow table.
+
+    When a cache directory is configured, files read from disk are cached, keyed by the hash
+    of their contents, so that reading the same file again memory-maps the cached table
+    instead of parsing the tsv. The hash of a file is itself cached by its path, size,
+    and modification time, so that unchanged files aren't read to be hashed.
+
+    Args:
+        filename: The path of the tsv, or its contents
+        cache_dir: The directory of cached tables, PROTEOMICS_CACHE_DIR by default;
+            an empty string disables the cache
+
+    Returns:
+        pa.Table: The columns of the tsv
+    """
+    if isinstance(filename, StringIO):
+        return _parse_tsv(BytesIO(filename.getvalue().encode()))
+
+    filename = Path(filename)
+    cache_dir = PROTEOMICS_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return _parse_tsv(filename)
+
+    key_filename = Path(cache_dir) / "keys" / f"{_stat_key(filename)}.v{_CACHE_VERSION}"
+    try:
+        content_hash = key_filename.read_text()
+    except FileNotFoundError:
+        content_hash = _hash_file(filename)
+
+        def write_key(tmp_filename: Path) -> None:
+            tmp_filename.write_text(content_hash)
+
+        _write_cache_file(key_filename, write_key)
+
+    cache_filename = Path(cache_dir) / f"{content_hash}.v{_CACHE_VERSION}.arrow"
+    if cache_filename.exists():
+        with pa.memory_map(str(cache_filename)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    table = _parse_tsv(filename)
+    _write_cached_table(table, cache_filename)
+    return table
+
+
+@dataclass(frozen=True)
+class AbundanceMatrix:
+    """Represent abundances as a C-contiguous (proteins x samples) matrix, with its row and col ids."""
+
+    abundances: np.ndarray
+    protein_ids: np.ndarray
+    sample_ids: np.ndarray
+
+    def __post_init__(self) -> None:
+        if self.abundances.shape != (len(self.protein_ids), len(self.sample_ids)):
+            err_msg = (
+                f"Expected abundances of shape {(len(self.protein_ids), len(self.sample_ids))}, "
+                f"got {self.abundances.shape}"
+            )
+            raise ValueError(err_msg)
+
+    @classmethod
+    def from_table(
+        cls,
+        table: pa.Table,
+        protein_id_col: str,
+        sample_cols: list[str],
+        reference_col: str | None = None,
+        dtype: type = np.float32,
+    ) -> "AbundanceMatrix":
+        """
+        Gather the sample columns of a table into a matrix of abundances.
+
+        Args:
+            table: The table, with one row per protein
+            protein_id_col: The column of protein ids
+            sample_cols: The columns of sample abundances
+            reference_col: If given, the column of reference intensities,
+                subtracted from every sample's abundance of the protein
+            dtype: The dtype of the matrix
+
+        Returns:
+            AbundanceMatrix: The abundances, of shape (n_proteins, n_samples)
+        """
+        abundances = np.empty((table.num_rows, len(sample_cols)), dtype=dtype)
+        arrow_type = pa.from_numpy_dtype(abundances.dtype)
+        for j, sample_col in enumerate(sample_cols):
+            abundances[:, j] = table.column(sample_col).cast(arrow_type).to_numpy()
+
+        if reference_col is not None:
+            reference = table.column(reference_col).cast(arrow_type).to_numpy()
+            abundances -= reference[:, np.newaxis]
+
+        return cls(
+            abundances,
+            table.column(protein_id_col).to_numpy(),
+            np.array(sample_cols, dtype=object),
+        )
+
+    def to_df(self) -> pd.DataFrame:
+        """Return the abundances as a (proteins x samples) df, sharing the matrix's memory"""
+        return pd.DataFrame(
+            self.abundances,
+            index=pd.Index(self.protein_ids),
+            columns=pd.Index(self.sample_ids),
+            copy=False,
+        )
@@ -11,9 +11,11 @@ from datetime import datetime, timezone
 from bystro.beanstalkd.worker import listen, QueueConf, ProgressPublisher
 from bystro.beanstalkd.messages import BaseMessage, CompletedJobMessage, SubmittedJobMessage
 from bystro.proteomics.annotation_interface import (
-    get_annotation_result_from_query,
-    join_annotation_result_to_proteomics_dataset,
+    ProteomicsIndex,
+    iter_annotation_query_tables,
+    write_annotation_proteomics_join,
 )
+from bystro.search.utils.opensearch import gather_opensearch_args
 
 logger = logging.getLogger(__file__)
 
@@ -53,7 +55,9 @@ def _load_queue_conf(queue_conf_path: str) -> QueueConf:
     return QueueConf(addresses=beanstalk_conf["addresses"], tubes=beanstalk_conf["tubes"])
 
 
-def handler_fn(_publisher: ProgressPublisher, job_data: ProteomicsJobData) -> str:
+def handler_fn(
+    _publisher: ProgressPublisher, job_data: ProteomicsJobData, search_conf: dict | None = None
+) -> str:
     logger.info("Processing Proteomics job: %s", job_data)
 
     Path(job_data.out_dir).mkdir(parents=True, exist_ok=True)
@@ -69,16 +73,20 @@ def handler_fn(_publisher: ProgressPublisher, job_data: ProteomicsJobData) -> st
             logger.exception(pandas_exception)
             raise ValueError(f"Failed to read {job_data.data_path}; not arrow feather or .tsv")
 
-    client = OpenSearch()
-    annotation_df = get_annotation_result_from_query(
-        job_data.annotation_query, job_data.index_name, client
+    # With a search config, the query's slices are fetched concurrently, by Ray actors
+    search_client_args = gather_opensearch_args(search_conf) if search_conf is not None else None
+    client = OpenSearch(**search_client_args) if search_client_args is not None else OpenSearch()
+    annotation_tables = iter_annotation_query_tables(
+        job_data.annotation_query, job_data.index_name, client, search_client_args
     )
 
-    joined_df = join_annotation_result_to_proteomics_dataset(annotation_df, gene_abundance_df)
     timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-
     result_path = Path(job_data.out_dir) / f"joined.{timestamp}.feather"
-    joined_df.to_feather(result_path)
+
+    # Each slice of annotation results is joined and written as it is fetched
+    proteomics_index = ProteomicsIndex.from_dataset(gene_abundance_df)
+    n_rows = write_annotation_proteomics_join(annotation_tables, proteomics_index, str(result_path))
+    logger.info("Wrote %d joined rows", n_rows)
 
     logger.info("Proteomics job completed. Results saved to %s", result_path)
     return str(result_path)
@@ -97,15 +105,19 @@ def completed_msg_fn(
     )
 
 
-def main(queue_conf: QueueConf) -> None:
+def main(queue_conf: QueueConf, search_conf: dict | None = None) -> None:
     logger.info(
         "Proteomics worker is listening on addresses: %s, tube: %s...",
         queue_conf.addresses,
         PROTEOMICS_TUBE,
     )
+
+    def handler(publisher: ProgressPublisher, job_data: ProteomicsJobData) -> str:
+        return handler_fn(publisher, job_data, search_conf)
+
     listen(
         ProteomicsJobData,
-        handler_fn,
+        handler,
         submit_msg_fn,
         completed_msg_fn,
         queue_conf,
@@ -121,7 +133,19 @@ if __name__ == "__main__":
         help="Path to the beanstalkd queue config yaml file (e.g., beanstalk1.yml)",
         required=True,
     )
+    parser.add_argument(
+        "--search_conf",
+        type=Path,
+        help="Path to the opensearch config yaml file (e.g. elasticsearch.yml)",
+        required=False,
+    )
     args = parser.parse_args()
 
     queue_conf = _load_queue_conf(args.queue_conf)
-    main(queue_conf)
+
+    search_conf = None
+    if args.search_conf is not None:
+        with Path(args.search_conf).open(encoding="utf-8") as search_config_file:
+            search_conf = YAML(typ="safe").load(search_config_file)
+
+    main(queue_conf, search_conf)
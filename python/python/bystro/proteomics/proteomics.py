@@ -6,22 +6,36 @@ from io import StringIO
 from pathlib import Path
 from typing import TypeVar
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa  # type: ignore
+
+from bystro.proteomics.fragpipe_utils import AbundanceMatrix, read_fragpipe_tsv
 
 T = TypeVar("T")
 
 
 def load_fragpipe_dataset(fname: str | Path | StringIO) -> pd.DataFrame:
     """Load a fragpipe dataset and prep it according to type of dataset."""
-    return _prep_fragpipe_dataset(_load_fragpipe_tsv(fname))
+    fragpipe_df = load_fragpipe_abundance_matrix(fname, dtype=np.float64).to_df().T
+    fragpipe_df.columns.name = "gene"
+    fragpipe_df.index.name = "sample"
+    return fragpipe_df
+
+
+def load_fragpipe_abundance_matrix(
+    fname: str | Path | StringIO, dtype: type = np.float32
+) -> AbundanceMatrix:
+    """Load a fragpipe dataset as a (genes x samples) matrix, normalized by reference intensities."""
+    return _prep_fragpipe_dataset(_load_fragpipe_tsv(fname), dtype)
 
 
 # ------------------------------- END PUBLIC API -------------------------------
 
 
-def _load_fragpipe_tsv(fname: str | Path | StringIO) -> pd.DataFrame:
+def _load_fragpipe_tsv(fname: str | Path | StringIO) -> pa.Table:
     """Read a fragpipe dataset from disk."""
-    return pd.read_csv(fname, sep="\t", index_col="Index")
+    return read_fragpipe_tsv(fname)
 
 
 def _list_startswith(xs: Sequence[T], ys: Sequence[T]) -> bool:
@@ -29,48 +43,60 @@ def _list_startswith(xs: Sequence[T], ys: Sequence[T]) -> bool:
     return xs[: len(ys)] == ys
 
 
-def _prep_fragpipe_dataset(fragpipe_dataset: pd.DataFrame) -> pd.DataFrame:
+def _prep_fragpipe_dataset(fragpipe_table: pa.Table, dtype: type) -> AbundanceMatrix:
     """Recognize dataset type and dispatch appropriate preprocessing function."""
     type1_columns = ["Gene", "Peptide", "ReferenceIntensity"]
     type2_columns = ["NumberPSM", "Proteins", "ReferenceIntensity"]
-    actual_columns = list(fragpipe_dataset.columns)
+    actual_columns = [column for column in fragpipe_table.column_names if column != "Index"]
     if _list_startswith(actual_columns, type1_columns):
-        fragpipe_df = _prep_fragpipe_dataset_type1(fragpipe_dataset)
-    elif _list_startswith(actual_columns, type2_columns):
-        fragpipe_df = _prep_fragpipe_dataset_type2(fragpipe_dataset)
-    else:
-        err_msg = (
-            f"Dataset format not recognized: "
-            f"expected columns to begin with {type1_columns} or {type2_columns}"
-        )
-        raise ValueError(err_msg)
-    fragpipe_df.columns.name = "gene"
-    fragpipe_df.index.name = "sample"
-    return fragpipe_df
-
-
-def _subtract_reference_intensities(fragpipe_df: pd.DataFrame) -> pd.DataFrame:
-    """Normalize dataframe by reference intensities."""
-    reference_intensities = fragpipe_df["ReferenceIntensity"]
-    fragpipe_df = fragpipe_df.subtract(reference_intensities, axis=0)
-    fragpipe_df = fragpipe_df.drop(["ReferenceIntensity"], axis=1)
-    return fragpipe_df
-
-
-def _prep_fragpipe_dataset_type1(fragpipe_df: pd.DataFrame) -> pd.DataFrame:
+        sample_columns = actual_columns[len(type1_columns) :]
+        return _prep_fragpipe_dataset_type1(fragpipe_table, sample_columns, dtype)
+    if _list_startswith(actual_columns, type2_columns):
+        sample_columns = actual_columns[len(type2_columns) :]
+        return _prep_fragpipe_dataset_type2(fragpipe_table, sample_columns, dtype)
+    err_msg = (
+        f"Dataset format not recognized: "
+        f"expected columns to begin with {type1_columns} or {type2_columns}"
+    )
+    raise ValueError(err_msg)
+
+
+def _group_means(values: np.ndarray, group_codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """Average the rows of each group, skipping missing values, as DataFrame.groupby(...).mean does."""
+    in_group = group_codes >= 0
+    values, group_codes = values[in_group], group_codes[in_group]
+    present = ~np.isnan(values)
+
+    sums = np.zeros((n_groups, values.shape[1]), dtype=values.dtype)
+    counts = np.zeros((n_groups, values.shape[1]), dtype=np.int64)
+    np.add.at(sums, group_codes, np.where(present, values, 0))
+    np.add.at(counts, group_codes, present)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts.astype(values.dtype)
+
+
+def _prep_fragpipe_dataset_type1(
+    fragpipe_table: pa.Table, sample_columns: list[str], dtype: type
+) -> AbundanceMatrix:
     """Prep fragpipe dataset where multiple peptides map into gene."""
-    fragpipe_df = fragpipe_df.drop(["Peptide"], axis="columns")
-    fragpipe_df = fragpipe_df.groupby("Gene").apply(
-        lambda g: g.mean(axis="index")
-    )  # average over all peptides belonging to gene
-    fragpipe_df = _subtract_reference_intensities(fragpipe_df)
-    fragpipe_df = fragpipe_df.T  # convert to (samples X genes)
-    return fragpipe_df
-
-
-def _prep_fragpipe_dataset_type2(fragpipe_df: pd.DataFrame) -> pd.DataFrame:
+    peptide_matrix = AbundanceMatrix.from_table(
+        fragpipe_table, "Gene", ["ReferenceIntensity", *sample_columns], dtype=dtype
+    )
+    # average over all peptides belonging to gene, genes sorted as groupby sorts them
+    gene_codes, genes = pd.factorize(peptide_matrix.protein_ids, sort=True)
+    gene_means = _group_means(peptide_matrix.abundances, gene_codes, len(genes))
+    return AbundanceMatrix(
+        np.ascontiguousarray(gene_means[:, 1:] - gene_means[:, :1]),
+        np.asarray(genes, dtype=object),
+        np.array(sample_columns, dtype=object),
+    )
+
+
+def _prep_fragpipe_dataset_type2(
+    fragpipe_table: pa.Table, sample_columns: list[str], dtype: type
+) -> AbundanceMatrix:
     """Prep fragpipe dataset where peptide aggregation has already been performed."""
-    fragpipe_df = fragpipe_df.drop(["NumberPSM", "Proteins"], axis="columns")
-    fragpipe_df = _subtract_reference_intensities(fragpipe_df)
-    fragpipe_df = fragpipe_df.T  # convert to (samples X genes)
-    return fragpipe_df
+    return AbundanceMatrix.from_table(
+        fragpipe_table, "Index", sample_columns, reference_col="ReferenceIntensity", dtype=dtype
+    )
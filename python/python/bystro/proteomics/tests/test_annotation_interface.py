@@ -4,11 +4,20 @@ from typing import Any
 import msgspec
 import numpy as np
 import pandas as pd
+import pyarrow as pa  # type: ignore
+import pyarrow.feather as feather  # type: ignore
+import pytest
 
 from bystro.proteomics.annotation_interface import (
+    OPENSEARCH_QUERY_CONFIG,
+    ProteomicsIndex,
+    _flatten,
     _process_response,
+    _response_table,
+    iter_annotation_query_tables,
     join_annotation_result_to_proteomics_dataset,
     get_annotation_result_from_query,
+    write_annotation_proteomics_join,
 )
 from bystro.proteomics.fragpipe_tandem_mass_tag import (
     ABUNDANCE_COLS,
@@ -22,17 +31,28 @@ with TEST_RESPONSE_FILENAME.open("rb") as f:
 
 
 class MockOpenSearch:
-    def __init__(*args: Any, **kwargs: Any) -> None:
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
         del args, kwargs
-        pass
+        self.search_bodies: list[dict] = []
 
-    def search(*args, **kwargs) -> dict:
-        del args, kwargs
-        return TEST_RESPONSE
+    def search(self, *args, **kwargs) -> dict:
+        """Return a page of the hits of TEST_RESPONSE, in the query's slice, after its search_after"""
+        del args
+        body = kwargs["body"]
+        self.search_bodies.append(dict(body))
+
+        hits = TEST_RESPONSE["hits"]["hits"]
+        if "slice" in body:
+            hits = hits[body["slice"]["id"] :: body["slice"]["max"]]
+        if "search_after" in body:
+            sort_values = [hit["sort"] for hit in hits]
+            hits = hits[sort_values.index(body["search_after"]) + 1 :]
+
+        return {"hits": {"total": {"value": len(hits)}, "hits": hits[: body["size"]]}}
 
     def count(*args, **kwargs) -> dict:
         del args, kwargs
-        return {"count": 1}
+        return {"count": TEST_RESPONSE["hits"]["total"]["value"]}
 
     def create_point_in_time(*args, **kwargs) -> dict:
         del args, kwargs
@@ -54,6 +74,32 @@ def test_get_annotation_results_from_query():
     assert (1610, 7) == samples_and_genes_df.shape
 
 
+def test_get_annotation_results_from_query_sliced(monkeypatch):
+    monkeypatch.setattr(OPENSEARCH_QUERY_CONFIG, "max_query_size", 100)
+    mock_client = MockOpenSearch()
+
+    samples_and_genes_df = get_annotation_result_from_query(
+        "exonic", "mock_index_name", mock_client  # type: ignore
+    )
+
+    assert (1610, 7) == samples_and_genes_df.shape
+    # 876 hits are fetched in 4 slices of up to 100 hits a page
+    slices = {body["slice"]["id"] for body in mock_client.search_bodies}
+    assert slices == {0, 1, 2, 3}
+    assert all(body["slice"]["max"] == 4 for body in mock_client.search_bodies)
+    assert len(mock_client.search_bodies) == 4 * 4
+    # Pages are ordered by _id, which search_after needs to be a total order
+    assert all(body["sort"] == [{"_id": "asc"}] for body in mock_client.search_bodies)
+
+
+def test_iter_annotation_query_tables_hit_count_checked(monkeypatch):
+    mock_client = MockOpenSearch()
+    monkeypatch.setattr(mock_client, "count", lambda **_: {"count": 1000})
+
+    with pytest.raises(RuntimeError, match="Expected 1000 hits"):
+        list(iter_annotation_query_tables("exonic", "mock_index_name", mock_client))  # type: ignore
+
+
 def tests__process_response():
     ans = _process_response(TEST_RESPONSE)
     assert (1610, 7) == ans.shape
@@ -67,6 +113,65 @@ def tests__process_response():
     assert expected_dosage_values == actual_dosage_values
 
 
+def _hit(pos: str, genes: list, **samples: list) -> dict:
+    return {
+        "_source": {
+            "chrom": [["chr1"]],
+            "pos": [[pos]],
+            "ref": [["A"]],
+            "alt": [["T"]],
+            "refSeq": {"name2": [genes]},
+            **samples,
+        }
+    }
+
+
+def test__response_table():
+    hits = [
+        _hit(
+            "1",
+            [["GENE1"], ["GENE2"], ["GENE1"]],
+            heterozygotes=[[["s1"], ["s2"]]],
+            missingGenos=[["s3"]],
+        ),
+        _hit("2", [["GENE2"]], homozygotes=[[["s1"]]], heterozygotes=None),
+        # The same variant as the first hit, whose rows are duplicates
+        _hit("1", [["GENE1"]], heterozygotes=[[["s2"]]]),
+        _hit("3", [["GENE3"]]),
+    ]
+    table = _response_table({"hits": {"hits": hits, "total": {"value": len(hits)}}})
+
+    assert pa.types.is_dictionary(table.schema.field("sample_id").type)
+    assert pa.types.is_dictionary(table.schema.field("gene_name").type)
+    assert table.schema.field("dosage").type == pa.int8()
+
+    assert table.to_pydict() == {
+        "sample_id": ["s1", "s2", "s3", "s1", "s2", "s3", "s1"],
+        "chrom": ["chr1"] * 7,
+        "pos": [1, 1, 1, 1, 1, 1, 2],
+        "ref": ["A"] * 7,
+        "alt": ["T"] * 7,
+        "gene_name": ["GENE1", "GENE1", "GENE1", "GENE2", "GENE2", "GENE2", "GENE2"],
+        "dosage": [1, 1, None, 1, 1, None, 2],
+    }
+
+
+def test__response_table_no_hits():
+    table = _response_table({"hits": {"hits": [], "total": {"value": 0}}})
+
+    assert table.num_rows == 0
+    assert table.column_names == ["sample_id", "chrom", "pos", "ref", "alt", "gene_name", "dosage"]
+    # typed as tables with hits are, so that they can be concatenated
+    assert table.schema.equals(
+        _response_table({"hits": {"hits": [_hit("1", [["GENE1"]])], "total": {"value": 1}}}).schema
+    )
+
+
+def test__flatten():
+    assert _flatten("a") == ["a"]
+    assert _flatten([[["a"], ["b"]], "c", [[[["d"]]]]]) == ["a", "b", "c", "d"]
+
+
 def test_join_annotation_result_to_proteomics_dataset():
     # Step 1: Get an annotation query result
     user_query_string = "exonic (gnomad.genomes.af:<0.1 || gnomad.exomes.af:<0.1)"
@@ -102,3 +207,80 @@ def test_join_annotation_result_to_proteomics_dataset():
     assert (140, 8) == joined_df.shape
     assert set(shared_proteomics_sample_ids) == set(joined_df.sample_id)
     assert set(shared_proteomics_gene_names) == set(joined_df.gene_name)
+
+
+PROTEOMICS_DF = pd.DataFrame(
+    {
+        "sample_id": ["p1", "p1", "p2", "p2", "p3"],
+        "gene_name": ["gene1", "gene1", "gene1", "gene2", None],
+        "abundance": [1.0, 2.0, 3.0, 4.0, 5.0],
+    }
+)
+
+ANNOTATION_TABLE = pa.table(
+    {
+        "sample_id": ["g1", "g2", "g2", None, "g9"],
+        "gene_name": ["gene1", "gene2", "gene1", "gene1", "gene1"],
+        "dosage": pa.array([1, 2, 1, 1, 2], pa.int8()),
+    }
+)
+
+
+def test_proteomics_index_join():
+    proteomics_index = ProteomicsIndex.from_long_df(PROTEOMICS_DF, lambda x: x.replace("p", "s"))
+    (joined,) = proteomics_index.join(ANNOTATION_TABLE, lambda x: x.replace("g", "s"))
+
+    assert joined.column_names == ["sample_id", "gene_name", "dosage", "abundance"]
+    assert pa.types.is_dictionary(joined.schema.field("sample_id").type)
+    # Annotation rows match every abundance of their sample and gene, in the dataset's order
+    assert joined.to_pydict() == {
+        "sample_id": ["s1", "s1", "s2", "s2"],
+        "gene_name": ["gene1", "gene1", "gene2", "gene1"],
+        "dosage": [1, 1, 2, 1],
+        "abundance": [1.0, 2.0, 4.0, 3.0],
+    }
+
+
+def test_proteomics_index_join_batched():
+    proteomics_index = ProteomicsIndex.from_long_df(PROTEOMICS_DF, lambda x: x.replace("p", "g"))
+
+    joined_tables = list(proteomics_index.join(ANNOTATION_TABLE, batch_size=2))
+
+    assert [table.num_rows for table in joined_tables] == [3, 1, 0]
+    assert pa.concat_tables(joined_tables).equals(
+        pa.concat_tables(proteomics_index.join(ANNOTATION_TABLE))
+    )
+
+
+def test_write_annotation_proteomics_join(tmp_path):
+    proteomics_index = ProteomicsIndex.from_long_df(PROTEOMICS_DF, lambda x: x.replace("p", "g"))
+    path = str(tmp_path / "joined.feather")
+
+    n_rows = write_annotation_proteomics_join(
+        [ANNOTATION_TABLE.slice(0, 2), ANNOTATION_TABLE.slice(2)], proteomics_index, path, batch_size=1
+    )
+
+    joined = feather.read_table(path)
+    assert n_rows == joined.num_rows == 4
+    assert joined.equals(pa.concat_tables(proteomics_index.join(ANNOTATION_TABLE)))
+
+    with pytest.raises(ValueError, match="at least one table"):
+        write_annotation_proteomics_join([], proteomics_index, path)
+
+
+def test_write_annotation_proteomics_join_empty_table_first(tmp_path):
+    proteomics_index = ProteomicsIndex.from_long_df(PROTEOMICS_DF, lambda x: x.replace("p", "s"))
+    path = str(tmp_path / "joined.feather")
+
+    # Slices with no hits may complete before those with hits
+    empty_table = _response_table({"hits": {"hits": [], "total": {"value": 0}}})
+    hits = [_hit("1", [["gene1"]], heterozygotes=[[["s1"], ["s2"]]])]
+    annotation_table = _response_table({"hits": {"hits": hits, "total": {"value": 1}}})
+
+    n_rows = write_annotation_proteomics_join([empty_table, annotation_table], proteomics_index, path)
+
+    joined = feather.read_table(path)
+    assert n_rows == joined.num_rows == 3
+    assert joined.schema.field("pos").type == pa.int64()
+    assert joined.column("chrom").to_pylist() == ["chr1"] * 3
+    assert joined.column("abundance").to_pylist() == [1.0, 2.0, 3.0]
@@ -1,7 +1,9 @@
 from io import StringIO
 
+import numpy as np
 import pandas as pd
 from bystro.proteomics.fragpipe_tandem_mass_tag import (
+    load_tandem_mass_tag_abundance_matrix,
     load_tandem_mass_tag_dataset,
 )
 from pandas.testing import assert_frame_equal
@@ -92,3 +94,16 @@ def test_load_tandem_mass_tag_dataset():
     tandem_mass_tag_dataset = load_tandem_mass_tag_dataset(abundance_handle, annotation_handle)
     assert_frame_equal(expected_abundance_df, tandem_mass_tag_dataset.abundance_df)
     assert_frame_equal(expected_annotation_df, tandem_mass_tag_dataset.annotation_df)
+
+
+def test_load_tandem_mass_tag_abundance_matrix():
+    abundance_handle = StringIO(raw_abundance_df.to_csv(index=False, sep="\t"))
+    abundance_matrix = load_tandem_mass_tag_abundance_matrix(abundance_handle)
+    sample_columns = list(raw_abundance_df.columns[5:])
+
+    assert abundance_matrix.abundances.dtype == np.float32
+    assert abundance_matrix.protein_ids.tolist() == list(expected_abundance_df.index)
+    assert abundance_matrix.sample_ids.tolist() == sample_columns
+    np.testing.assert_allclose(
+        abundance_matrix.abundances, expected_abundance_df[sample_columns].to_numpy(), atol=1e-5
+    )
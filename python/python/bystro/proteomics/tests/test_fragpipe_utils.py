@@ -1,9 +1,19 @@
 import re
 import pytest
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa  # type: ignore
 
-from bystro.proteomics.fragpipe_utils import check_df_starts_with_cols
+from bystro.proteomics import fragpipe_utils
+from bystro.proteomics.fragpipe_utils import (
+    AbundanceMatrix,
+    check_df_starts_with_cols,
+    check_table_starts_with_cols,
+    read_fragpipe_tsv,
+)
+
+TSV_CONTENTS = "Index\tReferenceIntensity\tSample1\tSample2\nA1BG\t30.0\t30.5\t29.0\nA2M\t31.0\t\t32.0\n"
 
 
 def test_check_df_starts_with_cols_happy_path():
@@ -25,3 +35,71 @@ def test_check_df_cols_raises():
     )
     with pytest.raises(ValueError, match=err_msg):
         check_df_starts_with_cols(actual_df, expected_cols)
+
+
+def test_check_table_starts_with_cols_raises():
+    table = pa.table({"a": [1], "b": [2]})
+    check_table_starts_with_cols(table, ["a"])
+    with pytest.raises(ValueError, match="expected table to begin with cols"):
+        check_table_starts_with_cols(table, ["b"])
+
+
+def test_abundance_matrix_from_table():
+    table = pa.table(
+        {
+            "Index": ["A1BG", "A2M"],
+            "ReferenceIntensity": [30.0, 31.0],
+            "Sample1": [30.5, None],
+            "Sample2": [29, 32],
+        }
+    )
+    abundance_matrix = AbundanceMatrix.from_table(
+        table, "Index", ["Sample1", "Sample2"], reference_col="ReferenceIntensity"
+    )
+
+    assert abundance_matrix.abundances.dtype == np.float32
+    assert abundance_matrix.abundances.flags.c_contiguous
+    np.testing.assert_array_equal(abundance_matrix.abundances, [[0.5, -1.0], [np.nan, 1.0]])
+    assert abundance_matrix.protein_ids.tolist() == ["A1BG", "A2M"]
+
+    abundance_df = abundance_matrix.to_df()
+    assert abundance_df.columns.tolist() == ["Sample1", "Sample2"]
+    assert np.shares_memory(abundance_df.to_numpy(), abundance_matrix.abundances)
+
+
+def test_read_fragpipe_tsv_cached(tmp_path, monkeypatch):
+    tsv_filename = tmp_path / "abundances.tsv"
+    tsv_filename.write_text(TSV_CONTENTS)
+    cache_dir = tmp_path / "cache"
+
+    table = read_fragpipe_tsv(tsv_filename, cache_dir=str(cache_dir))
+    (cache_filename,) = cache_dir.glob("*.arrow")
+
+    assert table.column_names == ["Index", "ReferenceIntensity", "Sample1", "Sample2"]
+    assert table.column("Sample1").null_count == 1
+
+    # Reading the unchanged file again finds its cached table without hashing it
+    with monkeypatch.context() as patch:
+        patch.setattr(fragpipe_utils, "_hash_file", pytest.fail)
+        assert read_fragpipe_tsv(tsv_filename, cache_dir=str(cache_dir)).equals(table)
+
+    # A file with the same contents, at another path, reads the same cached table
+    renamed_filename = tmp_path / "renamed.tsv"
+    tsv_filename.rename(renamed_filename)
+    assert read_fragpipe_tsv(renamed_filename, cache_dir=str(cache_dir)).equals(table)
+    assert list(cache_dir.glob("*.arrow")) == [cache_filename]
+
+    # A file with other contents is cached separately
+    renamed_filename.write_text(TSV_CONTENTS.replace("30.5", "30.6"))
+    assert not read_fragpipe_tsv(renamed_filename, cache_dir=str(cache_dir)).equals(table)
+    assert len(list(cache_dir.glob("*.arrow"))) == 2
+
+
+def test_read_fragpipe_tsv_uncached(tmp_path):
+    tsv_filename = tmp_path / "abundances.tsv"
+    tsv_filename.write_text(TSV_CONTENTS)
+
+    table = read_fragpipe_tsv(tsv_filename, cache_dir="")
+
+    assert list(tmp_path.iterdir()) == [tsv_filename]
+    assert table.num_rows == 2
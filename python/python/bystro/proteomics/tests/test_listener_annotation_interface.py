@@ -1,5 +1,7 @@
 from msgspec import json
 import pandas as pd
+import pyarrow as pa  # type: ignore
+import pyarrow.feather as feather  # type: ignore
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -19,6 +21,14 @@ FAKE_PROTEOMICS_DATA = pd.DataFrame(
     {"sample_id": ["sample1", "sample2"], "gene_name": ["gene1", "gene2"], "abundance": [100, 200]}
 )
 
+FAKE_ANNOTATION_TABLE = pa.table(
+    {
+        "sample_id": ["sample1", "sample1", "sample3"],
+        "gene_name": ["gene1", "gene2", "gene1"],
+        "dosage": [1, 2, 1],
+    }
+)
+
 FAKE_ANNOTATION_QUERY = "gene_name:TP53"
 FAKE_INDEX_NAME = "mock_index"
 
@@ -39,19 +49,19 @@ def test_submit_fn():
 def test_handler_fn_happy_path(tmpdir, mocker):
     mocker.patch(
         "bystro.proteomics.listener_annotation_interface.ds.dataset",
-        return_value=mocker.Mock(to_table=mocker.Mock(to_pandas=mocker.Mock(return_value=FAKE_PROTEOMICS_DATA)))
+        return_value=mocker.Mock(
+            to_table=mocker.Mock(
+                return_value=mocker.Mock(to_pandas=mocker.Mock(return_value=FAKE_PROTEOMICS_DATA))
+            )
+        )
     )
     mocker.patch(
         "bystro.proteomics.listener_annotation_interface.pd.read_csv",
         return_value=FAKE_PROTEOMICS_DATA
     )
     mocker.patch(
-        "bystro.proteomics.listener_annotation_interface.get_annotation_result_from_query",
-        return_value=pd.DataFrame()
-        )
-    mocker.patch(
-        "bystro.proteomics.listener_annotation_interface.join_annotation_result_to_proteomics_dataset",
-        return_value=pd.DataFrame()
+        "bystro.proteomics.listener_annotation_interface.iter_annotation_query_tables",
+        return_value=iter([FAKE_ANNOTATION_TABLE])
     )
     mocker.patch(
         "bystro.proteomics.listener_annotation_interface.OpenSearch",
@@ -75,6 +85,12 @@ def test_handler_fn_happy_path(tmpdir, mocker):
 
     assert result == expected_path
 
+    joined = feather.read_table(result).to_pandas()
+    assert joined["sample_id"].tolist() == ["sample1"]
+    assert joined["gene_name"].tolist() == ["gene1"]
+    assert joined["dosage"].tolist() == [1]
+    assert joined["abundance"].tolist() == [100]
+
 
 def test_completion_fn(tmpdir):
     proteomics_job_data = ProteomicsJobData(
@@ -1,8 +1,14 @@
+import os
+
 import pytest
 
 from bystro.proteomics.uniprot_id_gene_name_mapping import (
+    _load_mapping,
+    _UniprotIdGeneNameIndex,
     get_uniprot_ids_from_gene_name,
     get_gene_names_from_uniprot_id,
+    map_gene_names,
+    map_uniprot_ids,
 )
 
 
@@ -34,3 +40,36 @@ def test_get_gene_names_from_uniprot_ids():
 def test_get_gene_names_from_uniprot_id_bad_input():
     with pytest.raises(ValueError, match="Couldn't find Uniprot ID FOO"):
         get_gene_names_from_uniprot_id("FOO")
+
+
+def test_map_uniprot_ids():
+    assert map_uniprot_ids(["P42345", "FOO", "A0A8V8TRG9"]).tolist() == ["MTOR", None, "MTOR"]
+    assert map_uniprot_ids([]).tolist() == []
+
+
+def test_map_gene_names():
+    assert map_gene_names(["FOO", "MTOR"]).tolist() == [None, "P42345"]
+
+
+def test_load_mapping_sidecar(tmp_path):
+    mapping_filename = tmp_path / "mapping.csv"
+    sidecar_filename = tmp_path / "mapping.arrow"
+    mapping_filename.write_text("uniprot_accession,gene_name\nP1,G1\nP2,G2\nP1,G3\nP3,\n")
+
+    mapping = _load_mapping(mapping_filename, sidecar_filename)
+    assert sidecar_filename.exists()
+    assert _load_mapping(mapping_filename, sidecar_filename).equals(mapping)
+
+    index = _UniprotIdGeneNameIndex(mapping)
+    assert index.gene_names_of_rows(index.by_uniprot_id.rows_of("P1")) == ["G1", "G3"]
+    assert index.gene_names_of_rows(index.by_uniprot_id.rows_of("P3")) == []
+    assert index.by_uniprot_id.rows_of("P4") is None
+
+    # A csv newer than the sidecar is read again
+    mapping_filename.write_text("uniprot_accession,gene_name\nP4,G4\n")
+    sidecar_mtime = sidecar_filename.stat().st_mtime
+    os.utime(mapping_filename, (sidecar_mtime + 1, sidecar_mtime + 1))
+
+    index = _UniprotIdGeneNameIndex(_load_mapping(mapping_filename, sidecar_filename))
+    assert index.uniprot_ids_of_rows(index.by_gene_name.rows_of("G4")) == ["P4"]
+    assert index.by_gene_name.rows_of("G1") is None
@@ -1,38 +1,218 @@
-"""Provide functions to convert Uniprot IDs to gene names and vice versa."""
+"""
+Provide functions to convert Uniprot IDs to gene names and vice versa.
 
+The mapping is loaded on first use, not at import. It is read from a binary Arrow sidecar of the
+mapping csv, with both columns dictionary-encoded, which is written the first time the csv is read,
+and rewritten whenever the csv is newer than it. Lookups go through an index of the mapping: the
+code of each Uniprot ID and gene name, and, for each code, the rows of the mapping it appears in.
+"""
+
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa  # type: ignore
+import pyarrow.compute as pc  # type: ignore
+import pyarrow.csv as csv  # type: ignore
 
 from bystro.utils.config import BYSTRO_PROJECT_ROOT
 
+logger = logging.getLogger(__file__)
 
 _MAPPING_FILENAME = (
     BYSTRO_PROJECT_ROOT / "python/python/bystro/proteomics" / "uniprot_id_gene_name_mapping.csv"
 )
-try:
-    _UNIPROT_ID_GENE_NAME_MAPPING = pd.read_csv(_MAPPING_FILENAME)
-except FileNotFoundError as e:
-    err_msg = (
-        "Uniprot ID / gene name mapping file not found: "
-        "run scripts/get_uniprot_id_gene_name_mapping.py to create it"
+_MAPPING_SIDECAR_FILENAME = _MAPPING_FILENAME.with_suffix(".arrow")
+
+
+class _MappingColumnIndex:
+    """
+    The rows of the mapping in which each distinct value of one of its columns appears
+
+    Args:
+        values (pa.Array): The distinct values of the column, indexed by code
+        codes (np.ndarray): The code of the column's value in each row of the mapping, or -1 for nulls
+    """
+
+    def __init__(self, values: pa.Array, codes: np.ndarray):
+        self.distinct_values = pd.Index(values.to_numpy(zero_copy_only=False))
+
+        # The rows of each code, in the order of the mapping, are rows[offsets[code]:offsets[code + 1]]
+        self.rows = np.argsort(codes, kind="stable")
+        self.rows = self.rows[codes[self.rows] >= 0]
+        self.offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(self.distinct_values)))]
+        )
+
+    def codes(self, values: Sequence[str]) -> np.ndarray:
+        """The code of each value, or -1 for values not in the column"""
+        return self.distinct_values.get_indexer(pd.Index(values, dtype=object))
+
+    def rows_of(self, value: str) -> np.ndarray | None:
+        """The rows in which the value appears, in the order of the mapping, or None if it doesn't"""
+        (code,) = self.codes([value])
+        if code < 0:
+            return None
+        return self.rows[self.offsets[code] : self.offsets[code + 1]]
+
+    def first_rows(self, values: Sequence[str]) -> np.ndarray:
+        """The first row in which each value appears, or -1 for values not in the column"""
+        codes = self.codes(values)
+        found = codes >= 0
+        first_rows = np.full(len(codes), -1, dtype=np.int64)
+        first_rows[found] = self.rows[self.offsets[codes[found]]]
+        return first_rows
+
+
+class _UniprotIdGeneNameIndex:
+    """
+    The Uniprot ID / gene name mapping, indexed by both columns
+
+    Args:
+        mapping (pa.Table): The mapping, with dictionary-encoded
+            uniprot_accession and gene_name columns, one row per (Uniprot ID, gene name) pair
+    """
+
+    def __init__(self, mapping: pa.Table):
+        mapping = mapping.combine_chunks()
+        uniprot_ids = mapping.column("uniprot_accession").chunk(0)
+        gene_names = mapping.column("gene_name").chunk(0)
+
+        self.uniprot_id_codes = uniprot_ids.indices.fill_null(-1).to_numpy()
+        self.gene_name_codes = gene_names.indices.fill_null(-1).to_numpy()
+
+        self.by_uniprot_id = _MappingColumnIndex(uniprot_ids.dictionary, self.uniprot_id_codes)
+        self.by_gene_name = _MappingColumnIndex(gene_names.dictionary, self.gene_name_codes)
+
+    def gene_names_of_rows(self, rows: np.ndarray) -> list[str]:
+        codes = self.gene_name_codes[rows]
+        return self.by_gene_name.distinct_values[codes[codes >= 0]].tolist()
+
+    def uniprot_ids_of_rows(self, rows: np.ndarray) -> list[str]:
+        codes = self.uniprot_id_codes[rows]
+        return self.by_uniprot_id.distinct_values[codes[codes >= 0]].tolist()
+
+
+def _read_mapping_csv(mapping_filename: Path) -> pa.Table:
+    try:
+        mapping = csv.read_csv(
+            mapping_filename,
+            convert_options=csv.ConvertOptions(
+                column_types={"uniprot_accession": pa.string(), "gene_name": pa.string()},
+                strings_can_be_null=True,
+            ),
+        )
+    except FileNotFoundError as e:
+        err_msg = (
+            "Uniprot ID / gene name mapping file not found: "
+            "run scripts/get_uniprot_id_gene_name_mapping.py to create it"
+        )
+        raise FileNotFoundError(err_msg) from e
+
+    return pa.table(
+        {
+            "uniprot_accession": pc.dictionary_encode(mapping.column("uniprot_accession")),
+            "gene_name": pc.dictionary_encode(mapping.column("gene_name")),
+        }
     )
-    raise FileNotFoundError(err_msg) from e
+
+
+def _write_mapping_sidecar(mapping: pa.Table, sidecar_filename: Path) -> None:
+    """Write the sidecar atomically, so that concurrent readers never see a partial file"""
+    tmp_filename = sidecar_filename.with_name(f"{sidecar_filename.name}.{os.getpid()}.tmp")
+    try:
+        with pa.ipc.new_file(str(tmp_filename), mapping.schema) as writer:
+            writer.write_table(mapping.combine_chunks())
+        os.replace(tmp_filename, sidecar_filename)
+    except OSError as e:
+        # The mapping is still usable, it will just be read from the csv next time
+        logger.warning("Couldn't write Uniprot ID / gene name sidecar %s: %s", sidecar_filename, e)
+        tmp_filename.unlink(missing_ok=True)
+
+
+def _sidecar_is_current(mapping_filename: Path, sidecar_filename: Path) -> bool:
+    if not sidecar_filename.exists():
+        return False
+    if not mapping_filename.exists():
+        return True
+    return sidecar_filename.stat().st_mtime >= mapping_filename.stat().st_mtime
+
+
+def _load_mapping(mapping_filename: Path, sidecar_filename: Path) -> pa.Table:
+    """Read the mapping from its sidecar if it is current, otherwise from the csv, writing the sidecar"""
+    if _sidecar_is_current(mapping_filename, sidecar_filename):
+        with pa.memory_map(str(sidecar_filename)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    mapping = _read_mapping_csv(mapping_filename)
+    _write_mapping_sidecar(mapping, sidecar_filename)
+    return mapping
+
+
+@lru_cache(maxsize=1)
+def _get_mapping_index() -> _UniprotIdGeneNameIndex:
+    return _UniprotIdGeneNameIndex(_load_mapping(_MAPPING_FILENAME, _MAPPING_SIDECAR_FILENAME))
 
 
 def get_gene_names_from_uniprot_id(uniprot_id: str) -> list[str]:
     """Return a list of gene names associated with the given Uniprot ID."""
-    uniprot_idx = _UNIPROT_ID_GENE_NAME_MAPPING.uniprot_accession == uniprot_id
-    if not uniprot_idx.sum():
+    index = _get_mapping_index()
+    rows = index.by_uniprot_id.rows_of(uniprot_id)
+    if rows is None:
         err_msg = f"Couldn't find Uniprot ID {uniprot_id} in mapping"
         raise ValueError(err_msg)
-    gene_names = _UNIPROT_ID_GENE_NAME_MAPPING[uniprot_idx].gene_name
-    return [gene_name for gene_name in gene_names if pd.notna(gene_name)]
+    return index.gene_names_of_rows(rows)
 
 
 def get_uniprot_ids_from_gene_name(gene_name: str) -> list[str]:
     """Return a list of Uniprot IDs associated with the given gene name."""
-    gene_name_idx = _UNIPROT_ID_GENE_NAME_MAPPING.gene_name == gene_name
-    if not gene_name_idx.sum():
+    index = _get_mapping_index()
+    rows = index.by_gene_name.rows_of(gene_name)
+    if rows is None:
         err_msg = f"Couldn't find gene name {gene_name} in gene name"
         raise ValueError(err_msg)
-    uniprot_ids = _UNIPROT_ID_GENE_NAME_MAPPING[gene_name_idx].uniprot_accession
-    return list(uniprot_ids)
+    return index.uniprot_ids_of_rows(rows)
+
+
+def map_uniprot_ids(uniprot_ids: Sequence[str]) -> np.ndarray:
+    """
+    Map each Uniprot ID to its first gene name in the mapping.
+
+    Args:
+        uniprot_ids: The Uniprot IDs
+
+    Returns:
+        np.ndarray: The gene name of each Uniprot ID, as an object array,
+        with None for Uniprot IDs not in the mapping or without a gene name
+    """
+    index = _get_mapping_index()
+    rows = index.by_uniprot_id.first_rows(uniprot_ids)
+    codes = np.where(rows >= 0, index.gene_name_codes[rows], -1)
+    return _values_of_codes(index.by_gene_name.distinct_values, codes)
+
+
+def map_gene_names(gene_names: Sequence[str]) -> np.ndarray:
+    """
+    Map each gene name to its first Uniprot ID in the mapping.
+
+    Args:
+        gene_names: The gene names
+
+    Returns:
+        np.ndarray: The Uniprot ID of each gene name, as an object array,
+        with None for gene names not in the mapping
+    """
+    index = _get_mapping_index()
+    rows = index.by_gene_name.first_rows(gene_names)
+    codes = np.where(rows >= 0, index.uniprot_id_codes[rows], -1)
+    return _values_of_codes(index.by_uniprot_id.distinct_values, codes)
+
+
+def _values_of_codes(values: pd.Index, codes: np.ndarray) -> np.ndarray:
+    mapped = np.full(len(codes), None, dtype=object)
+    mapped[codes >= 0] = values[codes[codes >= 0]]
+    return mapped
@@ -7,11 +7,14 @@ import argparse
 import os
 import subprocess
 import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from ruamel.yaml import YAML
 
 from bystro.beanstalkd.messages import SubmissionID, SubmittedJobMessage
 from bystro.beanstalkd.worker import ProgressPublisher, QueueConf, listen
+from bystro.search.save.row_index import write_annotation_row_index
 from bystro.search.utils.annotation import get_config_file_path
 from bystro.search.utils.messages import IndexJobCompleteMessage, IndexJobData, IndexJobResults
 
@@ -149,14 +152,25 @@ def main():
         annotation_path = os.path.join(beanstalkd_job_data.input_dir, inputs.annotation)
         m_path = get_config_file_path(conf_dir, beanstalkd_job_data.assembly, ".mapping.y*ml")
 
-        header_fields = run_handler_with_config(
-            index_name=beanstalkd_job_data.index_name,
-            submission_id=beanstalkd_job_data.submission_id,
-            mapping_config=m_path,
-            opensearch_config=search_conf,
-            queue_config=queue_conf,
-            annotation_path=annotation_path,
-        )
+        # Saves from the annotation seek to their hits using its row index,
+        # which is built while the annotation is indexed, rather than by the first save
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            row_index_written = executor.submit(write_annotation_row_index, annotation_path)
+
+            header_fields = run_handler_with_config(
+                index_name=beanstalkd_job_data.index_name,
+                submission_id=beanstalkd_job_data.submission_id,
+                mapping_config=m_path,
+                opensearch_config=search_conf,
+                queue_config=queue_conf,
+                annotation_path=annotation_path,
+            )
+
+            try:
+                row_index_written.result()
+            except (OSError, EOFError, ValueError):
+                # Saves read unindexed annotations in full
+                traceback.print_exc()
 
         return header_fields
 
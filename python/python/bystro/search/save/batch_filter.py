@@ -0,0 +1,38 @@
+"""
+Columnar filter protocol for the search/save pipeline.
+
+Pipeline filters implement `make_filter(header_fields)`, which returns a function that decides,
+one row at a time, whether a row should be dropped. Filters may additionally implement
+`make_batch_filter(header_fields)`, which returns a `BatchFilter`. A `BatchFilter` names the
+annotation columns it needs, and computes a keep-mask for a whole batch of rows from those
+columns at once.
+"""
+
+from typing import Callable, NamedTuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Column index -> the raw bytes values of that column, for each row in the batch
+ColumnBatch = dict[int, NDArray[np.bytes_]]
+
+
+class BatchFilter(NamedTuple):
+    """
+    A filter that operates on a batch of rows at once
+
+    Attributes:
+        fields: list[int]
+            Indices of the annotation columns that `keep` reads
+        keep: Callable[[ColumnBatch], NDArray[np.bool_]]
+            Given the values of `fields` for a batch of rows, returns a boolean mask
+            that is True for the rows to retain
+    """
+
+    fields: list[int]
+    keep: Callable[[ColumnBatch], NDArray[np.bool_]]
+
+
+def supports_batch_filter(filter_msg: object) -> bool:
+    """Whether a pipeline filter implements the `make_batch_filter` protocol"""
+    return callable(getattr(type(filter_msg), "make_batch_filter", None))
@@ -33,6 +33,15 @@ for missingness, sample_maf, heterozygosity, homozygosity in zip(
     )
 
 
+# The same values, as the column arrays a batch filter receives
+columns = {
+    missingness_idx: np.array([doc[missingness_idx] for doc in docs]),
+    sample_maf_idx: np.array([doc[sample_maf_idx] for doc in docs]),
+    heterozygosity_idx: np.array([doc[heterozygosity_idx] for doc in docs]),
+    homozygosity_idx: np.array([doc[homozygosity_idx] for doc in docs]),
+}
+
+
 def naive_drop_row_if_out_of_hwe(
     chi2_crit: float,
     n: float,
@@ -82,6 +91,19 @@ def test_drop_row_hwe(benchmark):
     benchmark(loop)
 
 
+def test_batch_drop_rows_hwe(benchmark):
+    batch_filter = HWEFilter(num_samples=N, crit_value=0.025).make_batch_filter(header_row)
+
+    def run():
+        assert batch_filter is not None
+
+        keep = batch_filter.keep(columns)
+
+        assert len(keep) == SAMPLE_SIZE
+
+    benchmark(run)
+
+
 def test_naive_drop_row_hwe(benchmark):
     num_samples = N
     crit_value = 0.025
@@ -2,8 +2,13 @@ from typing import Callable
 import math
 
 from msgspec import Struct
+import numpy as np
+from numpy.typing import NDArray
 from scipy.stats import norm  # type: ignore
 
+from bystro.search.save.batch_filter import BatchFilter, ColumnBatch
+from bystro.search.save.block_reader import parse_float_field
+
 
 class BinomialMafFilter(
     Struct,
@@ -50,9 +55,14 @@ class BinomialMafFilter(
     estimates: list[str]
     crit_value: float | None = 0.025
 
-    def make_filter(self, header_fields: list[bytes]) -> Callable[[list[bytes]], bool] | None:
+    def _prepare(
+        self, header_fields: list[bytes]
+    ) -> tuple[int, float, float, list[int], int, int, int] | None:
+        """
+        Get the total number of alleles, the private maf threshold, the z critical value,
+        and the indices of the estimate, missingness, sampleMaf, and alt columns
+        """
         private_maf = self.private_maf
-        snp_only = self.snp_only
         num_samples = self.num_samples
         estimates = self.estimates
         alpha = self.crit_value
@@ -97,6 +107,33 @@ class BinomialMafFilter(
         if alt_idx == -1:
             raise ValueError("Alt field not found in header fields")
 
+        return (
+            total_alleles,
+            private_maf,
+            z_crit,
+            estimate_field_indices,
+            missingness_idx,
+            sample_maf_idx,
+            alt_idx,
+        )
+
+    def make_filter(self, header_fields: list[bytes]) -> Callable[[list[bytes]], bool] | None:
+        params = self._prepare(header_fields)
+
+        if params is None:
+            return None
+
+        (
+            total_alleles,
+            private_maf,
+            z_crit,
+            estimate_field_indices,
+            missingness_idx,
+            sample_maf_idx,
+            alt_idx,
+        ) = params
+        snp_only = self.snp_only
+
         def binom_filter(row: list[bytes]):
             if snp_only and len(row[alt_idx]) > 1:
                 return False
@@ -133,3 +170,64 @@ class BinomialMafFilter(
             return True
 
         return binom_filter
+
+    def make_batch_filter(self, header_fields: list[bytes]) -> BatchFilter | None:
+        params = self._prepare(header_fields)
+
+        if params is None:
+            return None
+
+        (
+            total_alleles,
+            private_maf,
+            z_crit,
+            estimate_field_indices,
+            missingness_idx,
+            sample_maf_idx,
+            alt_idx,
+        ) = params
+        snp_only = self.snp_only
+
+        def binom_batch_filter(columns: ColumnBatch) -> NDArray[np.bool_]:
+            """
+            Vectorized `binom_filter`: rows are "decided" at the point where
+            `binom_filter` would return, and left undecided otherwise
+            """
+            n = total_alleles * (1.0 - parse_float_field(columns[missingness_idx]))
+            sample_maf = parse_float_field(columns[sample_maf_idx])
+            k = n * sample_maf
+            is_rare = (sample_maf <= private_maf) | ((n == total_alleles) & (k < 1.5))
+
+            keep = np.zeros(len(n), dtype=np.bool_)
+            decided = np.zeros(len(n), dtype=np.bool_)
+
+            if snp_only:
+                decided = np.char.str_len(columns[alt_idx]) > 1
+                keep |= decided
+
+            # Rows with no called alleles are dropped
+            decided |= n == 0
+
+            tested = np.zeros(len(n), dtype=np.int64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                for field_idx in estimate_field_indices:
+                    estimate = columns[field_idx]
+                    active = ~decided & (estimate != b"NA")
+                    p = parse_float_field(estimate)
+
+                    within_expectation = (np.abs(k - n * p) / np.sqrt(n * p * (1 - p))) <= z_crit
+                    keep_row = active & (
+                        ((p == 1) & ~is_rare) | ((p <= private_maf) & is_rare) | within_expectation
+                    )
+
+                    keep |= keep_row
+                    decided |= keep_row
+                    tested += active & ~keep_row
+
+            # Very rare mutations may be private to the sample, so we don't want to filter them out
+            keep |= ~decided & (tested == 0) & is_rare
+
+            return keep
+
+        fields = [missingness_idx, sample_maf_idx, alt_idx, *estimate_field_indices]
+        return BatchFilter(fields=fields, keep=binom_batch_filter)
@@ -0,0 +1,193 @@
+"""
+Block-based reading of Bystro annotation TSV streams.
+
+Bystro annotations have one variant per line, with a fixed number of tab-separated columns.
+Rather than reading them one line at a time, we read large byte chunks and locate row
+boundaries in bulk using NumPy. Columns are then extracted, for only the rows we need,
+without splitting those rows into Python objects.
+"""
+
+import os
+from typing import IO, Iterator
+
+import numpy as np
+from numpy.typing import NDArray
+
+from bystro.search.save.c_block_reader import (  # type: ignore
+    gather_spans,
+    locate_fields,
+    parse_float_bytes,
+)
+
+NEWLINE = ord("\n")
+
+# How many bytes of the (decompressed) annotation to read at a time
+READ_CHUNK_SIZE = int(os.getenv("SAVE_ANNOTATION_READ_CHUNK_SIZE", 32 * 1024 * 1024))
+
+
+class RowBlock:
+    """
+    A run of complete rows read from an annotation stream
+
+    Attributes:
+        data: bytes
+            The raw bytes of the rows, including newlines
+        row_offset: int
+            Index of the first row in the block, relative to the first row of the stream
+        starts: NDArray[np.int64]
+            Byte offset of the first byte of each row
+        ends: NDArray[np.int64]
+            Byte offset one past the last byte of each row, excluding the newline
+        stops: NDArray[np.int64]
+            Byte offset one past the newline of each row; the start of the next row
+    """
+
+    __slots__ = ("data", "row_offset", "starts", "ends", "stops", "_buffer")
+
+    def __init__(
+        self,
+        data: bytes,
+        row_offset: int,
+        starts: NDArray[np.int64],
+        ends: NDArray[np.int64],
+        stops: NDArray[np.int64],
+    ):
+        self.data = data
+        self.row_offset = row_offset
+        self.starts = starts
+        self.ends = ends
+        self.stops = stops
+        self._buffer = np.frombuffer(data, dtype=np.uint8)
+
+    @staticmethod
+    def from_bytes(data: bytes, row_offset: int = 0) -> "RowBlock":
+        """
+        Locate all rows in `data`.
+
+        Every row must be terminated by a newline, except optionally the last one,
+        which is the case for the final row of a file that lacks a trailing newline.
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buffer == NEWLINE).astype(np.int64)
+
+        ends = newlines
+        stops = newlines + 1
+        if len(data) > 0 and data[-1] != NEWLINE:
+            ends = np.append(ends, len(data))
+            stops = np.append(stops, len(data))
+
+        starts = np.empty_like(stops)
+        if len(starts) > 0:
+            starts[0] = 0
+            starts[1:] = stops[:-1]
+
+        return RowBlock(data, row_offset, starts, ends, stops)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def end_row(self) -> int:
+        """Index one past the last row in the block, relative to the first row of the stream"""
+        return self.row_offset + len(self.starts)
+
+    def rows(self, indices: NDArray[np.int64]) -> list[bytes]:
+        """Get the contents of the rows at `indices`, without their newlines"""
+        data = self.data
+        return [
+            data[start:end]
+            for start, end in zip(self.starts[indices].tolist(), self.ends[indices].tolist())
+        ]
+
+    def raw(self, indices: NDArray[np.int64]) -> bytes:
+        """
+        Get the raw bytes of the rows at `indices`, including their newlines.
+
+        `indices` must be sorted in ascending order. Runs of adjacent rows are
+        copied as a single slice.
+        """
+        if len(indices) == 0:
+            return b""
+
+        run_breaks = np.flatnonzero(np.diff(indices) != 1)
+        run_firsts = np.concatenate(([indices[0]], indices[run_breaks + 1]))
+        run_lasts = np.concatenate((indices[run_breaks], [indices[-1]]))
+
+        view = memoryview(self.data)
+        return b"".join(
+            view[start:stop]
+            for start, stop in zip(self.starts[run_firsts].tolist(), self.stops[run_lasts].tolist())
+        )
+
+    def fields(
+        self, indices: NDArray[np.int64], field_indices: list[int]
+    ) -> dict[int, NDArray[np.bytes_]]:
+        """
+        Get the values of the columns `field_indices` for each of the rows at `indices`.
+
+        Each row is scanned only up to the last requested column, and the values
+        are gathered into fixed-width bytes arrays without splitting any rows.
+
+        Raises:
+            ValueError: If any of the requested rows has fewer than `max(field_indices) + 1` columns.
+        """
+        if len(indices) == 0:
+            return {field_idx: np.array([], dtype=np.bytes_) for field_idx in field_indices}
+
+        field_starts, field_ends = locate_fields(
+            self._buffer,
+            self.starts[indices],
+            self.ends[indices],
+            np.asarray(field_indices, dtype=np.int64),
+        )
+
+        return {
+            field_idx: gather_spans(self._buffer, field_starts[k], field_ends[k])
+            for k, field_idx in enumerate(field_indices)
+        }
+
+    def field(self, indices: NDArray[np.int64], field_idx: int) -> NDArray[np.bytes_]:
+        """Get the value of column `field_idx` for each of the rows at `indices`"""
+        return self.fields(indices, [field_idx])[field_idx]
+
+
+def iter_row_blocks(
+    fh: IO[bytes], chunk_size: int = READ_CHUNK_SIZE, row_offset: int = 0
+) -> Iterator[RowBlock]:
+    """
+    Read `fh` in chunks of roughly `chunk_size` bytes, yielding blocks of complete rows.
+
+    Args:
+        fh (IO[bytes]): The stream to read; should be positioned at the start of a row
+        chunk_size (int, optional): The number of bytes to read at a time
+        row_offset (int, optional): The index of the first row in the stream. Defaults to 0.
+
+    Yields:
+        RowBlock: The next block of complete rows
+    """
+    remainder = b""
+    while True:
+        chunk = fh.read(chunk_size)
+
+        if not chunk:
+            if remainder:
+                yield RowBlock.from_bytes(remainder, row_offset)
+            return
+
+        data = remainder + chunk if remainder else chunk
+
+        last_newline = data.rfind(b"\n")
+        if last_newline == -1:
+            remainder = data
+            continue
+
+        remainder = data[last_newline + 1 :]
+        block = RowBlock.from_bytes(data[: last_newline + 1], row_offset)
+        row_offset = block.end_row
+
+        yield block
+
+
+def parse_float_field(values: NDArray[np.bytes_]) -> NDArray[np.float64]:
+    """Parse a column of numeric annotation values, treating `NA` as NaN"""
+    return parse_float_bytes(values)
@@ -0,0 +1,170 @@
+cimport cython
+from libc.math cimport NAN
+from libc.stdlib cimport free, malloc, strtod
+from libc.string cimport memcpy
+
+import numpy as np
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def locate_fields(
+    const unsigned char[:] buffer,
+    const long long[:] row_starts,
+    const long long[:] row_ends,
+    const long long[:] field_indices):
+    """
+    Find the byte span of each requested column in each row.
+
+    Each row is only scanned up to the end of the last requested column,
+    so columns near the start of long rows are cheap to locate.
+
+    Args:
+        buffer: The raw bytes of the rows
+        row_starts: Byte offset of the first byte of each row
+        row_ends: Byte offset one past the last byte of each row, excluding the newline
+        field_indices: The column indices to locate, in any order
+
+    Returns:
+        tuple[NDArray[np.int64], NDArray[np.int64]]: The start and end byte offsets
+        of each column in each row, each of shape (len(field_indices), len(row_starts))
+
+    Raises:
+        ValueError: If any row has fewer columns than required
+    """
+    cdef Py_ssize_t n_rows = row_starts.shape[0]
+    cdef Py_ssize_t n_fields = field_indices.shape[0]
+    cdef Py_ssize_t i, k
+    cdef long long pos, row_end, field_start, field_idx, max_field_idx = -1
+    cdef bint short_row = False
+
+    for k in range(n_fields):
+        if field_indices[k] < 0:
+            raise ValueError("Column indices must be non-negative")
+        if field_indices[k] > max_field_idx:
+            max_field_idx = field_indices[k]
+
+    field_starts = np.zeros((n_fields, n_rows), dtype=np.int64)
+    field_ends = np.zeros((n_fields, n_rows), dtype=np.int64)
+
+    if n_fields == 0:
+        return field_starts, field_ends
+
+    cdef long long[:, :] starts_view = field_starts
+    cdef long long[:, :] ends_view = field_ends
+
+    with nogil:
+        for i in range(n_rows):
+            pos = row_starts[i]
+            row_end = row_ends[i]
+            field_idx = 0
+            field_start = pos
+
+            while True:
+                if pos == row_end or buffer[pos] == 9:
+                    for k in range(n_fields):
+                        if field_indices[k] == field_idx:
+                            starts_view[k, i] = field_start
+                            ends_view[k, i] = pos
+
+                    if field_idx == max_field_idx:
+                        break
+
+                    if pos == row_end:
+                        short_row = True
+                        break
+
+                    field_idx += 1
+                    field_start = pos + 1
+
+                pos += 1
+
+            if short_row:
+                break
+
+    if short_row:
+        raise ValueError(f"Row has fewer than {max_field_idx + 1} columns")
+
+    return field_starts, field_ends
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def gather_spans(const unsigned char[:] buffer, const long long[:] starts, const long long[:] ends):
+    """Copy the byte spans [starts, ends) of `buffer` into a fixed-width bytes array"""
+    cdef Py_ssize_t n_rows = starts.shape[0]
+    cdef Py_ssize_t i
+    cdef long long width = 1
+
+    for i in range(n_rows):
+        if ends[i] - starts[i] > width:
+            width = ends[i] - starts[i]
+
+    out = np.zeros(n_rows, dtype=f"S{width}")
+
+    if n_rows == 0:
+        return out
+
+    cdef unsigned char[:, :] out_view = out.view(np.uint8).reshape(n_rows, width)
+
+    with nogil:
+        for i in range(n_rows):
+            if ends[i] > starts[i]:
+                memcpy(&out_view[i, 0], &buffer[starts[i]], ends[i] - starts[i])
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parse_float_bytes(values):
+    """
+    Parse a fixed-width bytes array (dtype `S<n>`) of numbers into a float64 array,
+    treating `NA` as NaN
+
+    Raises:
+        ValueError: If any value is neither a number nor `NA`
+    """
+    cdef Py_ssize_t n_rows = values.shape[0]
+    cdef Py_ssize_t width = values.dtype.itemsize
+    cdef Py_ssize_t i, length
+    cdef char *text
+    cdef char *end
+
+    out = np.empty(n_rows, dtype=np.float64)
+
+    if n_rows == 0:
+        return out
+
+    cdef const unsigned char[:, :] chars = np.ascontiguousarray(values).view(np.uint8).reshape(
+        n_rows, width
+    )
+    cdef double[:] out_view = out
+
+    # Values fill the whole width when they are the longest in the array,
+    # in which case they are not NUL terminated, so we copy each into a terminated buffer
+    text = <char *> malloc(width + 1)
+    if text == NULL:
+        raise MemoryError()
+
+    try:
+        for i in range(n_rows):
+            length = 0
+            while length < width and chars[i, length] != 0:
+                length += 1
+
+            if length == 2 and chars[i, 0] == b"N" and chars[i, 1] == b"A":
+                out_view[i] = NAN
+                continue
+
+            memcpy(text, &chars[i, 0], length)
+            text[length] = 0
+
+            out_view[i] = strtod(text, &end)
+
+            if length == 0 or end != text + length:
+                raise ValueError(f"could not convert {values[i]!r} to float")
+    finally:
+        free(text)
+
+    return out
@@ -1,10 +1,14 @@
-def drop_row_if_out_of_hwe(
-    chi2_crit: float,
-    n: float,
-    missingness: float,
-    sampleMaf: float,
-    heterozygosity: float,
-    homozygosity: float) -> bool:
+cimport cython
+import numpy as np
+
+
+cdef inline bint _out_of_hwe(
+    double chi2_crit,
+    double n,
+    double missingness,
+    double sampleMaf,
+    double heterozygosity,
+    double homozygosity) nogil:
 
     cdef float p, n_updated
     cdef float expect_hets, expect_homozygotes_ref, expect_homozygotes_alt
@@ -33,4 +37,43 @@ def drop_row_if_out_of_hwe(
         + (((homozygotes_alt - expect_homozygotes_alt) ** 2) / expect_homozygotes_alt)
     )
 
-    return test > chi2_crit
\ No newline at end of file
+    return test > chi2_crit
+
+
+def drop_row_if_out_of_hwe(
+    chi2_crit: float,
+    n: float,
+    missingness: float,
+    sampleMaf: float,
+    heterozygosity: float,
+    homozygosity: float) -> bool:
+
+    return _out_of_hwe(chi2_crit, n, missingness, sampleMaf, heterozygosity, homozygosity)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def drop_rows_if_out_of_hwe(
+    double chi2_crit,
+    double n,
+    const double[:] missingness,
+    const double[:] sampleMaf,
+    const double[:] heterozygosity,
+    const double[:] homozygosity):
+    """Vectorized drop_row_if_out_of_hwe, returning a boolean array of the rows to drop"""
+
+    cdef Py_ssize_t i, n_rows = missingness.shape[0]
+
+    if sampleMaf.shape[0] != n_rows or heterozygosity.shape[0] != n_rows or homozygosity.shape[0] != n_rows:
+        raise ValueError("All columns must have the same length")
+
+    drop = np.empty(n_rows, dtype=np.bool_)
+    cdef unsigned char[:] drop_view = drop.view(np.uint8)
+
+    with nogil:
+        for i in range(n_rows):
+            drop_view[i] = _out_of_hwe(
+                chi2_crit, n, missingness[i], sampleMaf[i], heterozygosity[i], homozygosity[i]
+            )
+
+    return drop
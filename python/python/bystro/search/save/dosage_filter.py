@@ -0,0 +1,153 @@
+"""
+Filter a dosage matrix to the loci of a saved annotation, in process, with Arrow
+
+This is an alternative to the `dosage-filter` binary. It reads the parent dosage matrix
+(an Arrow IPC / feather file whose first column holds each variant's `chrom:pos:ref:alt` locus)
+with `pyarrow.dataset`, and writes the rows whose locus was kept, in their original order,
+with a streaming feather writer.
+
+`pc.is_in` builds a hash table of its value set on every call, which for millions of loci
+costs more than the lookup itself, so rather than calling it once per record batch,
+the locus column alone is scanned first, and looked up in chunks of
+SAVE_DOSAGE_FILTER_LOOKUP_ROWS rows. The full record batches are then streamed,
+and only those holding kept loci are written.
+"""
+
+import logging
+import os
+
+import psutil
+import pyarrow as pa  # type: ignore
+import pyarrow.compute as pc  # type: ignore
+import pyarrow.csv as csv  # type: ignore
+import pyarrow.dataset as ds  # type: ignore
+
+from bystro.beanstalkd.worker import ProgressReporter
+from bystro.utils.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+# The number of dosage matrix rows whose loci are looked up at once
+SAVE_DOSAGE_FILTER_LOOKUP_ROWS = int(os.getenv("SAVE_DOSAGE_FILTER_LOOKUP_ROWS", 4_000_000))
+# The compression of the filtered dosage matrix, matching that of the dosage-filter binary
+DOSAGE_MATRIX_COMPRESSION = "zstd"
+
+
+def read_loci_file(loci_path: str) -> pa.Array:
+    """Read a file of loci, one per line, as an Arrow string array"""
+    if os.stat(loci_path).st_size == 0:
+        return pa.array([], type=pa.string())
+
+    table = csv.read_csv(
+        loci_path,
+        read_options=csv.ReadOptions(column_names=["locus"]),
+        parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=csv.ConvertOptions(column_types={"locus": pa.string()}),
+    )
+
+    return table.column("locus").combine_chunks()
+
+
+def _memory_usage_mb() -> float:
+    return psutil.Process(os.getpid()).memory_info().rss / 1024**2
+
+
+def _locus_mask(
+    dataset: ds.Dataset, locus_column: str, value_set: pa.Array, lookup_rows: int
+) -> pa.ChunkedArray:
+    """Find which rows of the dataset have a locus in `value_set`, in row order"""
+    masks: list[pa.ChunkedArray] = []
+    pending: list[pa.Array] = []
+    n_pending = 0
+
+    def lookup():
+        masks.append(pc.is_in(pa.chunked_array(pending, type=value_set.type), value_set=value_set))
+        pending.clear()
+
+    for batch in dataset.to_batches(columns=[locus_column]):
+        pending.append(batch.column(0))
+        n_pending += batch.num_rows
+
+        if n_pending >= lookup_rows:
+            lookup()
+            n_pending = 0
+
+    if pending:
+        lookup()
+
+    return pa.chunked_array([chunk for mask in masks for chunk in mask.chunks], type=pa.bool_())
+
+
+def filter_dosage_matrix_arrow(
+    parent_dosage_matrix_path: str,
+    dosage_out_path: str,
+    loci: pa.Array,
+    reporter: ProgressReporter,
+    progress_frequency: int,
+    lookup_rows: int = SAVE_DOSAGE_FILTER_LOOKUP_ROWS,
+) -> int:
+    """
+    Write the rows of a dosage matrix whose locus is in `loci`
+
+    Args:
+        parent_dosage_matrix_path (str): The dosage matrix to filter, in feather format,
+            with the locus of each row in its first column
+        dosage_out_path (str): The filtered dosage matrix to write
+        loci (pa.Array): The loci to keep, as `chrom:pos:ref:alt` strings
+        reporter (ProgressReporter): The progress reporter
+        progress_frequency (int): The number of rows between progress messages
+        lookup_rows (int, optional): The number of rows whose loci are looked up at once
+
+    Returns:
+        int: The number of rows written
+    """
+    with Timer() as timer:
+        dataset = ds.dataset(parent_dosage_matrix_path, format="feather")
+        locus_column = dataset.schema.names[0]
+
+        value_set = pc.unique(loci.cast(dataset.schema.field(locus_column).type))
+        mask = _locus_mask(dataset, locus_column, value_set, lookup_rows)
+
+        logger.info(
+            "Looked up %d loci in %d dosage matrix rows; memory usage: %s (MB)",
+            len(value_set),
+            len(mask),
+            _memory_usage_mb(),
+        )
+
+        n_rows_read = 0
+        n_rows_kept = 0
+        next_report = progress_frequency
+        write_options = pa.ipc.IpcWriteOptions(compression=DOSAGE_MATRIX_COMPRESSION)
+        with pa.OSFile(dosage_out_path, "wb") as sink, pa.ipc.new_file(
+            sink, dataset.schema, options=write_options
+        ) as writer:
+            for batch in dataset.to_batches():
+                batch_mask = mask.slice(n_rows_read, batch.num_rows)
+                n_rows_read += batch.num_rows
+
+                n_batch_kept = pc.sum(batch_mask).as_py() or 0
+                if n_batch_kept > 0:
+                    writer.write_batch(batch.filter(batch_mask.combine_chunks()))
+                    n_rows_kept += n_batch_kept
+
+                if n_rows_read >= next_report:
+                    reporter.message.remote(  # type: ignore
+                        f"Dosage matrix: Filtered {n_rows_read} of {len(mask)} variants. "
+                        f"{n_rows_kept} kept."
+                    )
+                    next_report = (n_rows_read // progress_frequency + 1) * progress_frequency
+
+    logger.info(
+        "Filtering dosage matrix in process took %s seconds (%d rows read, %d kept); "
+        "memory usage: %s (MB)",
+        timer.elapsed_time,
+        n_rows_read,
+        n_rows_kept,
+        _memory_usage_mb(),
+    )
+    reporter.message.remote(  # type: ignore
+        f"Dosage matrix: {n_rows_kept} variants kept, of {n_rows_read}."
+    )
+
+    return n_rows_kept
@@ -3,47 +3,91 @@
 # TODO 2023-05-08: Track number of skipped entries
 # TODO 2023-05-08: Implement distributed pipeline/filters/transforms
 # TODO 2023-05-08: Support sort queries
-# TODO 2023-05-08: get max_slices from opensearch index settings
 
+import errno
 import gc
 import logging
 import math
 import os
 import psutil
 import pathlib
+import shutil
 import subprocess
+import tempfile
 import time
-from typing import Callable
+from typing import IO, AsyncIterator, Callable, Iterable, Iterator
 
+import msgspec
 from opensearchpy import OpenSearch, AsyncOpenSearch
 
 from numpy.typing import NDArray
 import numpy as np
 import ray
 
-from bystro.beanstalkd.worker import ProgressPublisher, ProgressReporter, get_progress_reporter
+from bystro.beanstalkd.worker import (
+    BufferedProgressReporter,
+    ProgressPublisher,
+    ProgressReporter,
+    ProgressStats,
+    get_progress_reporter,
+)
+from bystro.search.save.batch_filter import BatchFilter, supports_batch_filter
+from bystro.search.save.block_reader import READ_CHUNK_SIZE, RowBlock, iter_row_blocks
+from bystro.search.save.dosage_filter import filter_dosage_matrix_arrow, read_loci_file
+from bystro.search.save.hit_runs import PackedLoci, merge_hit_runs, remove_hit_runs, write_hit_run
+from bystro.search.save.result_cache import SaveResultCache, get_index_uuids, save_cache_key
+from bystro.search.save.row_index import (
+    ROW_INDEX_STRIDE,
+    ROW_INDEX_SUFFIX,
+    RowIndex,
+    RowIndexBuilder,
+)
+from bystro.search.save.slice_planner import get_index_slice_settings, plan_slices
 from bystro.search.utils.annotation import AnnotationOutputs, Statistics
-from bystro.search.utils.messages import SaveJobData
+from bystro.search.utils.messages import DosageFilterType, PipelineType, SaveJobData
 from bystro.search.utils.opensearch import gather_opensearch_args
+from bystro.search.utils.sliced_fetch import (
+    iter_fetched_slices,
+    iter_hit_pages,
+    prepare_slice_query_body,
+)
+from bystro.utils.bgzf import GZI_SUFFIX, BgzfReader
 from bystro.utils.compress import get_compress_from_pipe_cmd, get_decompress_to_pipe_cmd
-from bystro.utils.timer import Timer
+from bystro.utils.instrumentation import count, span
 
 
 logger = logging.getLogger(__name__)
 
 MAX_QUERY_SIZE = 10_000
-# TODO 2024-04-26 @akotlar Investigate the impact of large numbers of slices
-# and whether 20_000 slices is a reasonable limit
+# Our own limit on the number of slices; the index's max_slices_per_scroll setting also applies,
+# see slice_planner.plan_slices
 MAX_SLICES = 20_000
 KEEP_ALIVE = "1d"
 MAX_CONCURRENCY_PER_THREAD = 4
-SAVE_LOCI_BATCH_WRITE_SIZE = int(os.getenv("SAVE_LOCI_BATCH_WRITE_SIZE", 500_000))
 # Annotations are reported by filtered input row;
 # this is very rapid, so to avoid spamming the user with messages,
 # we only report every 5 million rows by default
 ANNOTATION_MINIMUM_REPORTING_INTERVAL = int(
     os.getenv("ANNOTATION_MINIMUM_REPORTING_INTERVAL", 5_000_000)
 )
+# When the parent annotation has a .gzi index and a row index, and the hits are within at most
+# this fraction of it, only the parts of the annotation holding hits are decompressed and filtered
+SAVE_ANNOTATION_SEEK_MAX_FRACTION = float(os.getenv("SAVE_ANNOTATION_SEEK_MAX_FRACTION", 0.25))
+# Queries with at least this many hits have their hits collected on disk, in sorted runs,
+# rather than in memory, so that memory use is bounded by SAVE_HITS_MEMORY_BUDGET_MB
+SAVE_SPILL_HITS_THRESHOLD = int(os.getenv("SAVE_SPILL_HITS_THRESHOLD", 20_000_000))
+# The approximate memory, in megabytes, to use when merging hits collected on disk
+SAVE_HITS_MEMORY_BUDGET_MB = int(os.getenv("SAVE_HITS_MEMORY_BUDGET_MB", 1024))
+# The maximum number of hits an actor holds in memory before writing them to disk as a run
+SAVE_SPILL_RUN_SIZE = int(os.getenv("SAVE_SPILL_RUN_SIZE", 1_000_000))
+
+# How the dosage matrix is filtered for jobs that don't choose: "go" runs the dosage-filter binary,
+# "arrow" filters it in process, see dosage_filter.filter_dosage_matrix_arrow
+SAVE_DOSAGE_FILTER = os.getenv("SAVE_DOSAGE_FILTER", "go")
+# When enabled, each slice is fetched a page at a time in document id order, and the annotation
+# and dosage matrix are filtered as every slice is fetched past each row,
+# rather than after every hit has been fetched and sorted
+SAVE_PIPELINED = os.getenv("SAVE_PIPELINED", "false").lower() in ("1", "true")
 
 # How many scroll requests for each worker to handle
 PARALLEL_SCROLL_CHUNK_INCREMENT = 2
@@ -53,6 +97,21 @@ MINIMUM_RECORDS_TO_ENABLE_REPORTING = 100_000
 # These are the fields that are required to define a locus
 # They are used to filter the dosage matrix
 FIELDS_TO_QUERY = ["chrom", "pos", "inputRef", "alt"]
+# When enabled, only document ids are fetched from the search engine,
+# and each locus is instead read from the FIELDS_TO_QUERY columns of the annotation row we keep.
+# Document ids are then collected in memory, however many hits the query has
+SAVE_LOCI_FROM_ANNOTATION = os.getenv("SAVE_LOCI_FROM_ANNOTATION", "false").lower() in ("1", "true")
+# Document ids are annotation row numbers, as strings, so sorting by _id orders them lexically;
+# the pipelined save instead sorts them numerically, to consume the hits in annotation order
+DOC_ID_SORT = [
+    {
+        "_script": {
+            "type": "number",
+            "order": "asc",
+            "script": {"lang": "painless", "source": "Long.parseLong(doc['_id'].value)"},
+        }
+    }
+]
 
 ray.init(ignore_reinit_error=True, address="auto")
 
@@ -80,35 +139,25 @@ def _clean_query(input_query_body: dict):
 
 @ray.remote
 class AsyncQueryProcessor:
-    REPORT_INCREMENT = 40_000
-
     def __init__(self, search_client_args: dict, reporter):
         # Initialize the async OpenSearch client during actor construction
         self.client = AsyncOpenSearch(**search_client_args)
-        self.last_reported_count = 0
-        self.reporter = reporter
+        # Every fetch worker reports, so reports are batched rather than sent for each query
+        self.reporter = BufferedProgressReporter(reporter)
+
+    def _iter_hits(self, query: dict) -> AsyncIterator[list[dict]]:
+        """Fetch every page of hits for the query, using search_after for pagination"""
+        return iter_hit_pages(self.client, query)
+
+    def _report_fetched(self, n_fetched: int):
+        self.reporter.increment(n_fetched, "Fetched", "variants")
 
     async def process_query(self, query: dict) -> tuple[NDArray[np.int32], NDArray]:
         doc_ids: list[int] = []
         loci: list[str] = []
-        search_after = None  # Initialize search_after for pagination
-
-        # Ensure there is a sort parameter in the query
-        if "sort" not in query.get("body", {}):
-            query.setdefault("body", {}).update(
-                {"sort": [{"_id": "asc"}]}  # Sorting by ID in ascending order
-            )
-
-        while True:
-            if search_after:
-                query["body"]["search_after"] = search_after
-
-            resp = await self.client.search(**query)
 
-            if not resp["hits"]["hits"]:
-                break  # Exit the loop if no more documents are found
-
-            for doc in resp["hits"]["hits"]:
+        async for hits in self._iter_hits(query):
+            for doc in hits:
                 src = doc["fields"]
                 doc_id = int(doc["_id"])
                 locus = (
@@ -117,19 +166,10 @@ class AsyncQueryProcessor:
                 doc_ids.append(doc_id)
                 loci.append(locus)
 
-            # Update search_after to the sort value of the last document retrieved
-            search_after = resp["hits"]["hits"][-1]["sort"]
-
         if not doc_ids:
             return np.array([], dtype=np.int32), np.array([], dtype=object)
 
-        self.last_reported_count += len(doc_ids)
-
-        if self.last_reported_count > self.REPORT_INCREMENT:
-            self.reporter.increment_and_write_progress_message.remote(
-                self.last_reported_count, "Fetched", "variants"
-            )
-            self.last_reported_count = 0
+        self._report_fetched(len(doc_ids))
 
         all_doc_ids = np.array(doc_ids, dtype=np.int32)
         all_loci = np.array(loci, dtype=object)
@@ -140,15 +180,117 @@ class AsyncQueryProcessor:
 
         return all_doc_ids, all_loci
 
-    def close(self):
-        if self.last_reported_count > 0:
-            self.reporter.increment_and_write_progress_message.remote(  # type: ignore
-                self.last_reported_count, "Fetched", "variants"
+    async def process_query_ids(self, query: dict) -> NDArray[np.int32]:
+        """Fetch only the document ids of the query's hits, in sorted order"""
+        doc_id_pages: list[NDArray[np.int32]] = []
+
+        async for hits in self._iter_hits(query):
+            doc_id_pages.append(np.array([int(doc["_id"]) for doc in hits], dtype=np.int32))
+
+        if not doc_id_pages:
+            return np.array([], dtype=np.int32)
+
+        all_doc_ids = np.concatenate(doc_id_pages)
+
+        self._report_fetched(len(all_doc_ids))
+
+        return np.sort(all_doc_ids, kind="stable")
+
+    async def process_query_page(
+        self, query: dict
+    ) -> tuple[NDArray[np.int32], NDArray | None, list | None]:
+        """
+        Fetch a single page of the query's hits, which must be sorted by DOC_ID_SORT
+
+        Returns:
+            tuple[NDArray[np.int32], NDArray | None, list | None]: The document ids of the page's hits,
+            their loci, or None if the query doesn't fetch their fields,
+            and the search_after of the next page, or None if this is the last page
+        """
+        resp = await self.client.search(**query)
+        hits = resp["hits"]["hits"]
+
+        doc_ids = np.array([int(doc["_id"]) for doc in hits], dtype=np.int32)
+        loci = None
+        if "fields" in query["body"]:
+            loci = np.array(
+                [
+                    f"{upper_chr(src['chrom'][0])}:{src['pos'][0]}:{src['inputRef'][0]}:{src['alt'][0]}"
+                    for src in (doc["fields"] for doc in hits)
+                ],
+                dtype=object,
+            )
+
+        if hits:
+            self._report_fetched(len(hits))
+
+        search_after = hits[-1]["sort"] if len(hits) == query["body"].get("size", 10) else None
+
+        return doc_ids, loci, search_after
+
+    async def process_query_to_disk(
+        self, query: dict, run_path_prefix: str, run_size: int = SAVE_SPILL_RUN_SIZE
+    ) -> tuple[list[str], int]:
+        """
+        Fetch the query's hits, writing them to disk in runs sorted by document id,
+        each of at most `run_size` hits, with loci stored as `PackedLoci`
+
+        Returns:
+            tuple[list[str], int]: The paths of the runs written, and the number of hits fetched
+        """
+        run_paths: list[str] = []
+        n_hits = 0
+
+        doc_ids: list[int] = []
+        chroms: list[str] = []
+        positions: list[int] = []
+        refs: list[str] = []
+        alts: list[str] = []
+
+        def spill():
+            run_path = f"{run_path_prefix}.{len(run_paths)}.run"
+            write_hit_run(
+                run_path,
+                np.array(doc_ids, dtype=np.int32),
+                PackedLoci.from_fields(chroms, positions, refs, alts),
             )
-            self.last_reported_count = 0
+            run_paths.append(run_path)
+
+            for values in (doc_ids, chroms, positions, refs, alts):
+                values.clear()
+
+        async for hits in self._iter_hits(query):
+            for doc in hits:
+                src = doc["fields"]
+                doc_ids.append(int(doc["_id"]))
+                chroms.append(upper_chr(src["chrom"][0]))
+                positions.append(int(src["pos"][0]))
+                refs.append(src["inputRef"][0])
+                alts.append(src["alt"][0])
+
+            n_hits += len(hits)
+
+            if len(doc_ids) >= run_size:
+                spill()
+
+        if doc_ids:
+            spill()
 
+        self._report_fetched(n_hits)
 
-def _get_num_slices(client, index_name, max_query_size, max_slices, query) -> tuple[int, int]:
+        return run_paths, n_hits
+
+    async def close(self) -> ProgressStats:
+        """Report any remaining progress, returning the reporting counters"""
+        # Wait for the report to arrive, so that it precedes the final, forced, report
+        report = self.reporter.flush()
+        if report is not None:
+            await report
+
+        return self.reporter.stats
+
+
+def _count_hits(client, index_name, query) -> int:
     """Count number of hits for the index"""
     query_no_sort = query.copy()
     if "sort" in query_no_sort:
@@ -163,34 +305,253 @@ def _get_num_slices(client, index_name, max_query_size, max_slices, query) -> tu
     if n_docs == 0:
         raise RuntimeError("No documents found for the query")
 
-    # TODO 2024-04-26 @akotlar now that we use search_after within process_query,
-    # it appears we no logner need to worry about slop
-    # however, for now we will keep it, just in case there are hidden consequences
-    # such as inflating the number of slices required past OpenSearch comfort for
-    # the index size
-    # or inflating the query size to the maximum allowed, which stresses OpenSearch too much
-    expected_query_size_with_loss = max_query_size * 0.85
+    return n_docs
+
+
+def _count_slice_hits(result) -> int:
+    """Get the number of hits from the result of any of AsyncQueryProcessor's fetch methods"""
+    if isinstance(result, np.ndarray):
+        # process_query_ids
+        return len(result)
+
+    if isinstance(result[0], list):
+        # process_query_to_disk
+        return result[1]
+
+    # process_query
+    return len(result[0])
+
+
+def _fetch_slices(
+    actors: list, fetch: Callable, query: dict, num_slices: int, max_in_flight_per_actor: int
+) -> tuple[list, NDArray[np.float64], NDArray[np.int64]]:
+    """
+    Fetch every slice of the query, dispatching slices to actors as they have capacity,
+    as `iter_fetched_slices` does, and collect the results in order of the slices
+
+    Args:
+        actors (list): The AsyncQueryProcessor actors
+        fetch (Callable): Called with an actor, a query body, and a slice id,
+            to start fetching the slice, returning a Ray object reference
+        query (dict): The query
+        num_slices (int): The number of slices; 1 means the query is not sliced
+        max_in_flight_per_actor (int): The maximum number of slices an actor fetches at once
+
+    Returns:
+        tuple[list, NDArray[np.float64], NDArray[np.int64]]: The result of each slice,
+        and the latency, in seconds, and number of hits of each slice
+    """
+    results: list = [None] * num_slices
+    latencies = np.zeros(num_slices, dtype=np.float64)
+    hits = np.zeros(num_slices, dtype=np.int64)
+
+    for slice_id, result, latency in iter_fetched_slices(
+        actors, fetch, query, num_slices, max_in_flight_per_actor
+    ):
+        results[slice_id] = result
+        latencies[slice_id] = latency
+        hits[slice_id] = _count_slice_hits(result)
+
+    return results, latencies, hits
+
+
+# A run of hits: every hit with a document id below the first element, not in a previous run,
+# as sorted document ids, and their loci or None
+HitChunk = tuple[int, NDArray[np.int32], NDArray | PackedLoci | None]
+
+
+def _iter_slice_hits_in_order(
+    actors: list,
+    fetch: Callable,
+    query: dict,
+    num_slices: int,
+    max_in_flight_per_actor: int,
+) -> Iterator[HitChunk]:
+    """
+    Fetch every slice of the query a page at a time, merging the pages of the slices into runs of hits
+    in document id order, each yielded as soon as every slice has been fetched past it
+
+    Each slice is paged through in document id order, so once every slice has returned a page
+    ending past some document id, every hit before it is known. Pages are dispatched to actors
+    as they have capacity, as `_fetch_slices` does, those of the slices fetched the least far first,
+    since they hold back the hits that can be yielded. A slice isn't fetched further while it has hits
+    not yet yielded, so that fetching runs at most a page per slice ahead of a slower caller.
+
+    Args:
+        actors (list): The AsyncQueryProcessor actors
+        fetch (Callable): Called with an actor and the search arguments of a page, to start fetching it,
+            returning a Ray object reference to the result of `AsyncQueryProcessor.process_query_page`
+        query (dict): The query, sorted by DOC_ID_SORT
+        num_slices (int): The number of slices; 1 means the query is not sliced
+        max_in_flight_per_actor (int): The maximum number of pages an actor fetches at once
+
+    Yields:
+        HitChunk: Runs of hits, in document id order
+    """
+    end_row = int(np.iinfo(np.int64).max)
+
+    bodies = [
+        prepare_slice_query_body(query, slice_id, num_slices) if num_slices > 1 else query.copy()
+        for slice_id in range(num_slices)
+    ]
+    # Every hit of a slice before its fetched_to has been fetched
+    fetched_to = np.zeros(num_slices, dtype=np.int64)
+    fetching = np.zeros(num_slices, dtype=bool)
+    buffered: dict[int, tuple[NDArray[np.int32], NDArray | None]] = {}
+
+    in_flight: dict[ray.ObjectRef, tuple[int, int, float]] = {}
+    actor_in_flight = [0] * len(actors)
+    latencies = np.zeros(num_slices, dtype=np.float64)
+    slice_hits = np.zeros(num_slices, dtype=np.int64)
+
+    def dispatch():
+        for slice_id in np.argsort(fetched_to, kind="stable").tolist():
+            if fetched_to[slice_id] == end_row:
+                return
+
+            if fetching[slice_id] or slice_id in buffered:
+                continue
+
+            actor_index = int(np.argmin(actor_in_flight))
+            if actor_in_flight[actor_index] >= max_in_flight_per_actor:
+                return
+
+            ref = fetch(actors[actor_index], {"body": bodies[slice_id]})
+            in_flight[ref] = (actor_index, slice_id, time.perf_counter())
+            actor_in_flight[actor_index] += 1
+            fetching[slice_id] = True
+
+    def take(watermark: int) -> tuple[NDArray[np.int32], NDArray | None]:
+        doc_id_parts: list[NDArray[np.int32]] = []
+        loci_parts: list[NDArray] = []
+        for slice_id in list(buffered):
+            doc_ids, loci = buffered[slice_id]
+            stop = int(np.searchsorted(doc_ids, watermark, side="left"))
+            if stop == 0:
+                continue
+
+            doc_id_parts.append(doc_ids[:stop])
+            if loci is not None:
+                loci_parts.append(loci[:stop])
+
+            if stop == len(doc_ids):
+                del buffered[slice_id]
+            else:
+                buffered[slice_id] = (doc_ids[stop:], loci[stop:] if loci is not None else None)
+
+        if not doc_id_parts:
+            return np.array([], dtype=np.int32), None
+
+        doc_ids = np.concatenate(doc_id_parts)
+        order = np.argsort(doc_ids, kind="stable")
+        return doc_ids[order], np.concatenate(loci_parts)[order] if loci_parts else None
+
+    yielded_to = 0
+    dispatch()
+    while in_flight:
+        done, _ = ray.wait(list(in_flight), num_returns=1)
+
+        for ref in done:
+            actor_index, slice_id, started = in_flight.pop(ref)
+            actor_in_flight[actor_index] -= 1
+            fetching[slice_id] = False
+
+            doc_ids, loci, search_after = ray.get(ref)
+            latencies[slice_id] += time.perf_counter() - started
+            slice_hits[slice_id] += len(doc_ids)
+
+            if len(doc_ids) > 0:
+                buffered[slice_id] = (doc_ids, loci)
+                fetched_to[slice_id] = int(doc_ids[-1]) + 1
+
+            if search_after is None:
+                fetched_to[slice_id] = end_row
+            else:
+                bodies[slice_id]["search_after"] = search_after
+
+        watermark = int(fetched_to.min())
+        if watermark > yielded_to:
+            doc_ids, loci = take(watermark)
+            yield watermark, doc_ids, loci
+            yielded_to = watermark
+
+        dispatch()
+
+    _log_slice_stats(latencies, slice_hits)
 
-    num_slices_required = math.ceil(n_docs / expected_query_size_with_loss)
-    if num_slices_required > max_slices:
-        num_slices_required = max_slices
 
-    logger.info("Constructed query with %d slices for %d hits", num_slices_required, n_docs)
+def _log_slice_stats(latencies: NDArray[np.float64], hits: NDArray[np.int64]):
+    """Log the distributions of per-slice latencies and hit counts"""
+    if len(latencies) == 0:
+        return
+
+    try:
+        latencies_ms = np.round(latencies * 1000).astype(np.int64)
+        logger.info(
+            "Slice latency (ms) distribution:\n%s",
+            count_in_ranges_numpy(latencies_ms, min_bin_size=10, max_bins=50),
+        )
+        logger.info(
+            "Slice hits distribution:\n%s", count_in_ranges_numpy(hits, min_bin_size=100, max_bins=50)
+        )
+    except Exception as e:
+        logger.warning("Failed to calculate bins due to %s", e)
+
+    slowest = np.argsort(latencies)[::-1][:5]
+    logger.info(
+        "Slice latency (s): median %.3f, p95 %.3f, max %.3f. Slowest slices (id: seconds, hits): %s",
+        np.median(latencies),
+        np.percentile(latencies, 95),
+        latencies.max(),
+        ", ".join(f"{i}: {latencies[i]:.3f}, {hits[i]}" for i in slowest.tolist()),
+    )
 
-    return max(num_slices_required, 1), n_docs
 
+def _log_progress_stats(reporters: str, stats: list[ProgressStats]):
+    """Log the summed reporting counters of a group of progress reporters"""
+    if not stats:
+        return
+
+    total = stats[0]
+    for reporter_stats in stats[1:]:
+        total = total.merge(reporter_stats)
 
-def _prepare_query_body(query, slice_id, num_slices):
-    """Prepare the query body for the slice"""
-    body = query.copy()
-    body["slice"] = {"id": slice_id, "max": num_slices}
-    return body
+    logger.info(
+        "Progress reporting of %s (%d reporters): %d reports sent in %d flushes (%d coalesced); "
+        "flushing took %.3f seconds in total, at most %.3f seconds",
+        reporters,
+        len(stats),
+        total.n_calls,
+        total.n_flushes,
+        total.n_coalesced,
+        total.flush_seconds,
+        total.max_flush_seconds,
+    )
 
 
 def upper_chr(chrom: str):
     return chrom[0:3] + chrom[3:].upper()
 
 
+def _dosage_filter_cmd(
+    parent_dosage_matrix_path: str,
+    dosage_out_path: str,
+    loci_path: str,
+    queue_config_path: str,
+    progress_frequency: int,
+    submission_id: str,
+) -> str:
+    # call the dosage-filter program, which takes an --input --output --loci
+    # --progress-frequency --queue-config --job-submission-id args
+    # and filters the dosage matrix to only include the loci in the loci file
+    return (
+        f"{_GO_HANDLER_BINARY_PATH} --input {parent_dosage_matrix_path} --output {dosage_out_path} "
+        f"--loci {loci_path} --progress-frequency {progress_frequency} "
+        f"--queue-config {queue_config_path} "
+        f"--job-submission-id {submission_id}"
+    )
+
+
 def run_dosage_filter(
     parent_dosage_matrix_path: str,
     dosage_out_path: str,
@@ -213,14 +574,13 @@ def run_dosage_filter(
         RuntimeError: If the binary execution fails or if there is an error in the stderr output.
     """
 
-    # call the dosage-filter program, which takes an --input --output --loci
-    # --progress-frequency --queue-config --job-submission-id args
-    # and filters the dosage matrix to only include the loci in the loci file
-    dosage_filter_cmd = (
-        f"{_GO_HANDLER_BINARY_PATH} --input {parent_dosage_matrix_path} --output {dosage_out_path} "
-        f"--loci {loci_path} --progress-frequency {progress_frequency} "
-        f"--queue-config {queue_config_path} "
-        f"--job-submission-id {submission_id}"
+    dosage_filter_cmd = _dosage_filter_cmd(
+        parent_dosage_matrix_path,
+        dosage_out_path,
+        loci_path,
+        queue_config_path,
+        progress_frequency,
+        submission_id,
     )
 
     logger.info("Beginning to filter genotypes using command `%s`", dosage_filter_cmd)
@@ -235,13 +595,11 @@ def run_dosage_filter(
     return
 
 
-def count_in_ranges_numpy(numbers):
+def count_in_ranges_numpy(numbers, min_bin_size: int = 100, max_bins: int = 100):
     if len(numbers) == 0:
         return "No data provided"
 
     max_value = numbers.max() + 1  # Ensure the highest value is included in the range
-    min_bin_size = 100  # Minimum bin size
-    max_bins = 100  # Maximum number of bins
 
     # Calculate optimal bin size
     optimal_bin_size = max(min_bin_size, np.ceil(max_value / max_bins))
@@ -335,264 +693,1258 @@ def sort_loci_and_doc_ids(
     return all_doc_ids_np, all_loci_np, n_hits
 
 
-def filter_annotation(
-    stats: Statistics,
-    annotation_path: str,
-    parent_annotation_path: str,
-    job_data: SaveJobData,
-    doc_ids_sorted: NDArray[np.int32],
-    loci_sorted: NDArray,
-    n_hits: int,
-    reporter: ProgressReporter,
-    reporting_interval: int,
-    loci_file_path: str,
-):
-    reporting_interval = max(ANNOTATION_MINIMUM_REPORTING_INTERVAL, reporting_interval)
+def sort_doc_ids(results: list[NDArray[np.int32]]) -> tuple[NDArray[np.int32], int]:
+    """Combine and sort the document ids returned by `AsyncQueryProcessor.process_query_ids`"""
+    if len(results) == 0:
+        return np.array([], dtype=np.int32), 0
 
-    reporter.message.remote(  # type: ignore
-        (
-            "Filtering annotation file and re-generating stats. "
-            f"Reporting progress every ~{reporting_interval} rows."
+    try:
+        n_hits_list_np: NDArray[np.uint32] = np.array(
+            [len(doc_ids) for doc_ids in results], dtype=np.uint32
         )
-    )
+        logger.info("Query hits per slice distribution:\n%s", count_in_ranges_numpy(n_hits_list_np))
+        del n_hits_list_np
+    except Exception as e:
+        logger.warning("Failed to calculate bins due to %s", e)
 
-    filtered_loci = ""
+    start = time.time()
+    all_doc_ids_np = np.sort(np.concatenate(results), kind="stable")
+    logger.info("Sorting document ids took %s seconds", time.time() - start)
 
-    current_target_index = 0
-    n_retained = 0
-    with Timer() as timer:
-        bgzip_cmd = get_compress_from_pipe_cmd(annotation_path)
-        bgzip_decompress_cmd = get_decompress_to_pipe_cmd(parent_annotation_path)
-        bystro_stats_cmd = stats.stdin_cli_stats_command
+    return all_doc_ids_np, len(all_doc_ids_np)
 
-        with (
-            subprocess.Popen(bystro_stats_cmd, shell=True, stdin=subprocess.PIPE) as stats_fh,
-            subprocess.Popen(bgzip_cmd, shell=True, stdin=subprocess.PIPE) as p,
-            subprocess.Popen(bgzip_decompress_cmd, shell=True, stdout=subprocess.PIPE) as in_fh,
-            open(loci_file_path, "w") as loci_fh,
-        ):
-            if in_fh.stdout is None:
-                raise IOError("Failed to open annotation file for reading.")
 
-            if p.stdin is None:
-                raise IOError("Failed to open filtered annotation file for writing.")
+def merge_spilled_hits(
+    results: list[tuple[list[str], int]], out_path: str, memory_budget: int
+) -> tuple[NDArray[np.int32], PackedLoci, int]:
+    """
+    Merge the hit runs written by `AsyncQueryProcessor.process_query_to_disk` into a single
+    run sorted by document id, holding roughly at most `memory_budget` bytes of hits in memory.
 
-            if stats_fh.stdin is None:
-                raise IOError("Failed to open stats file for writing.")
+    The input runs are removed once merged.
 
-            i = -1
-            header_written = False
-            header_fields = None
-            filters: list[Callable[[list[bytes]], bool]] = []
-            start = time.time()
-            for line in iter(in_fh.stdout.readline, b""):
-                if not header_written:
-                    p.stdin.write(line)
-                    stats_fh.stdin.write(line)
-                    header_written = True
-
-                    if job_data.pipeline is not None and len(job_data.pipeline) > 0:
-                        header_fields = line.rstrip().split(b"\t")
-                        filters = []
-                        for filter_msg in job_data.pipeline:
-                            filter_fn = filter_msg.make_filter(header_fields)
-
-                            if filter_fn is not None:
-                                filters.append(filter_fn)
-                    continue
-
-                i += 1
-                # doc_ids_sorted is a sorted list of document_ids, which are the indices in the
-                # annotation file that we wish to keep
-                # we iterate over input file lines (indexed by i), finding those lines that
-                # are in doc_ids_sorted
-                # because doc_ids_sorted is sorted in ascending order,
-                # and we are reading the file from the beginning, we are guaranteed
-                # that if i != doc_ids_sorted[current_target_index]
-                # i is less than doc_ids_sorted[current_target_index]
-                # or we have reached the end of doc_ids_sorted
-
-                if i == doc_ids_sorted[current_target_index]:
-                    filtered = False
-                    if len(filters) > 0:
-                        src = line.rstrip().split(b"\t")
-
-                        for filter_fn in filters:
-                            if filter_fn(src):
-                                filtered = True
-                                break
-
-                    if not filtered:
-                        p.stdin.write(line)
-                        stats_fh.stdin.write(line)
-
-                        n_retained += 1
-                        filtered_loci += loci_sorted[current_target_index] + "\n"
-
-                        if current_target_index % SAVE_LOCI_BATCH_WRITE_SIZE == 0:
-                            loci_fh.write(filtered_loci)
-                            filtered_loci = ""
-
-                    # Move to the next target line number, if any
-                    current_target_index += 1
-
-                    if current_target_index >= n_hits:
-                        break
-
-                if (i + 1) % reporting_interval == 0:
-                    end = time.time()
-
-                    reporter.message.remote(  # type: ignore
-                        (
-                            f"Annotation: Filtered {i + 1} variants. {n_retained} kept. "
-                            f"Took {end - start:.0f} seconds."
-                        )
-                    )
-                    start = time.time()
+    Args:
+        results (list[tuple[list[str], int]]): The run paths and number of hits of each slice
+        out_path (str): The path to write the merged run to
+        memory_budget (int): The approximate number of bytes of hits to hold in memory
 
-            if len(filtered_loci) > 0:
-                loci_fh.write(filtered_loci)
-                filtered_loci = ""
+    Returns:
+        tuple[NDArray[np.int32], PackedLoci, int]: The memory-mapped sorted document ids,
+        their loci, and the number of hits
+    """
+    process = psutil.Process(os.getpid())
+    start = time.time()
 
-            loci_fh.close()
-            p.stdin.close()  # Close the stdin to signal that we're done sending input
-            stats_fh.stdin.close()  # Close the stdin to signal that we're done sending input
+    run_paths = [run_path for slice_run_paths, _ in results for run_path in slice_run_paths]
 
-            p.wait()
-            stats_fh.wait()
+    try:
+        n_hits_list_np: NDArray[np.uint32] = np.array(
+            [n_slice_hits for _, n_slice_hits in results], dtype=np.uint32
+        )
+        logger.info("Query hits per slice distribution:\n%s", count_in_ranges_numpy(n_hits_list_np))
+        del n_hits_list_np
+    except Exception as e:
+        logger.warning("Failed to calculate bins due to %s", e)
 
-            reporter.message.remote("Annotation: Completed filtering.")  # type: ignore
+    try:
+        merged = merge_hit_runs(run_paths, out_path, memory_budget)
+    finally:
+        remove_hit_runs(run_paths)
 
-    reporter.message.remote(f"Annotation: {n_retained} variants survived filtering.")  # type: ignore
+    logger.info(
+        "Merging %d hit runs took %s seconds, memory usage after merging: %s (MB)",
+        len(run_paths),
+        time.time() - start,
+        process.memory_info().rss / 1024**2,
+    )
 
-    logger.info("Filtering annotation and generating stats took %s seconds", timer.elapsed_time)
+    return merged.doc_ids, merged.loci, len(merged)
 
-    return n_retained
 
+def _make_filters(
+    pipeline: PipelineType, header_fields: list[bytes]
+) -> tuple[list[BatchFilter], list[Callable[[list[bytes]], bool]]]:
+    """
+    Build the pipeline's filters for the annotation with the given header.
 
-def filter_dosage_matrix(
-    dosage_out_path: str,
-    parent_dosage_matrix_path: str,
-    job_data: SaveJobData,
-    reporter: ProgressReporter,
-    queue_config_path: str,
-    reporting_interval: int,
-    loci_file_path: str,
-):
-    if not (
-        os.path.exists(parent_dosage_matrix_path)
-        and os.stat(parent_dosage_matrix_path).st_size > 0
-        and os.path.exists(loci_file_path)
-        and os.stat(loci_file_path).st_size > 0
-    ):
-        logger.info("No dosage matrix to filter")
-        reporter.message.remote("No dosage matrix to filter.")  # type: ignore
-        # Touch the output file to avoid errors downstream
-        pathlib.Path(dosage_out_path).touch()
-        return
+    If every filter in the pipeline supports the columnar `make_batch_filter` protocol,
+    batch filters are returned, otherwise per-row filters are.
+    """
+    batch_filters: list[BatchFilter] = []
+    row_filters: list[Callable[[list[bytes]], bool]] = []
 
-    reporter.message.remote(  # type: ignore
-        f"Filtering dosage matrix file. Reporting progress every ~{reporting_interval} variants"
-    )
+    if pipeline is None or len(pipeline) == 0:
+        return batch_filters, row_filters
 
-    with Timer() as timer:
-        run_dosage_filter(
-            parent_dosage_matrix_path=parent_dosage_matrix_path,
-            dosage_out_path=dosage_out_path,
-            loci_path=loci_file_path,
-            queue_config_path=queue_config_path,
-            progress_frequency=reporting_interval,
-            submission_id=str(job_data.submission_id),
-        )
-    logger.info("Filtering dosage matrix took %s seconds", timer.elapsed_time)
+    if all(supports_batch_filter(filter_msg) for filter_msg in pipeline):
+        for filter_msg in pipeline:
+            batch_filter = filter_msg.make_batch_filter(header_fields)
 
+            if batch_filter is not None:
+                batch_filters.append(batch_filter)
 
-def filter_annotation_and_dosage_matrix(
-    job_data: SaveJobData,
-    reporter: ProgressReporter,
-    doc_ids_sorted: NDArray[np.int32],
-    loci_sorted: NDArray,
-    n_hits: int,
-    queue_config_path: str,
-) -> AnnotationOutputs:
-    output_dir = os.path.dirname(job_data.output_base_path)
-    basename = os.path.basename(job_data.output_base_path)
+        return batch_filters, row_filters
 
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
-    outputs, stats = AnnotationOutputs.from_path(
-        output_dir, basename, job_data.input_file_names.config, compress=True
-    )
+    for filter_msg in pipeline:
+        filter_fn = filter_msg.make_filter(header_fields)
 
-    parent_dosage_matrix_path = os.path.join(
-        job_data.input_dir, job_data.input_file_names.dosage_matrix_out_path
-    )
-    parent_annotation_path = os.path.join(job_data.input_dir, job_data.input_file_names.annotation)
+        if filter_fn is not None:
+            row_filters.append(filter_fn)
 
-    dosage_out_path = os.path.join(output_dir, outputs.dosage_matrix_out_path)
+    return batch_filters, row_filters
 
-    annotation_path = os.path.join(output_dir, outputs.annotation)
 
-    reporting_interval = max(MINIMUM_RECORDS_TO_ENABLE_REPORTING, math.ceil(n_hits * REPORTING_INTERVAL))
+def _apply_row_filters(
+    filters: list[Callable[[list[bytes]], bool]], rows: list[bytes]
+) -> NDArray[np.bool_]:
+    """Get a mask of the rows to keep, which are the rows that no filter drops"""
+    keep = (not any(filter_fn(row.rstrip().split(b"\t")) for filter_fn in filters) for row in rows)
+    return np.fromiter(keep, dtype=np.bool_, count=len(rows))
 
-    loci_file_path = os.path.join(output_dir, f"{basename}_loci.txt")
 
-    logger.info(
-        "Memory usage before filter_annotation: %s (MB)",
-        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-    )
+def _apply_batch_filters(
+    filters: list[BatchFilter], block: RowBlock, rows: NDArray[np.int64]
+) -> NDArray[np.bool_]:
+    """Get a mask of the rows to keep, parsing each column needed by the filters once"""
+    field_indices = sorted({field_idx for batch_filter in filters for field_idx in batch_filter.fields})
+    columns = block.fields(rows, field_indices)
 
-    n_results = filter_annotation(
-        stats=stats,
-        annotation_path=annotation_path,
-        parent_annotation_path=parent_annotation_path,
-        job_data=job_data,
-        doc_ids_sorted=doc_ids_sorted,
-        loci_sorted=loci_sorted,
-        n_hits=n_hits,
-        reporter=reporter,
-        reporting_interval=reporting_interval,
-        loci_file_path=loci_file_path,
-    )
+    keep = np.ones(len(rows), dtype=np.bool_)
+    for batch_filter in filters:
+        keep &= batch_filter.keep(columns)
 
-    del doc_ids_sorted
-    del loci_sorted
-    gc.collect()
+    return keep
 
-    logger.info(
-        "Memory usage after filter_annotation: %s (MB)",
-        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-    )
 
-    filter_dosage_matrix(
-        dosage_out_path=dosage_out_path,
-        parent_dosage_matrix_path=parent_dosage_matrix_path,
-        loci_file_path=loci_file_path,
-        job_data=job_data,
-        reporter=reporter,
-        queue_config_path=queue_config_path,
-        reporting_interval=reporting_interval,
-    )
+def _locus_field_indices(header_fields: list[bytes]) -> list[int]:
+    """Find the columns of the annotation that define a locus, in FIELDS_TO_QUERY order"""
+    missing = [field for field in FIELDS_TO_QUERY if field.encode() not in header_fields]
+    if missing:
+        raise ValueError(f"Annotation is missing the columns required to define a locus: {missing}")
 
-    logger.info(
-        "Memory usage after filter_dosage_matrix: %s (MB)",
-        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-    )
+    return [header_fields.index(field.encode()) for field in FIELDS_TO_QUERY]
 
-    reporter.increment.remote(n_results, True)  # type: ignore
 
-    return outputs
+def _format_loci(block: RowBlock, rows: NDArray[np.int64], locus_fields: list[int]) -> str:
+    """Format the loci of the rows at `rows` as `chrom:pos:ref:alt` lines, as process_query does"""
+    columns = block.fields(rows, locus_fields)
+    chrom_idx, pos_idx, ref_idx, alt_idx = locus_fields
 
+    return b"".join(
+        [
+            b"%s%s:%s:%s:%s\n" % (chrom[0:3], chrom[3:].upper(), pos, ref, alt)
+            for chrom, pos, ref, alt in zip(
+                columns[chrom_idx].tolist(),
+                columns[pos_idx].tolist(),
+                columns[ref_idx].tolist(),
+                columns[alt_idx].tolist(),
+            )
+        ]
+    ).decode("utf-8")
+
+
+def _filter_block(
+    block: RowBlock,
+    doc_ids: NDArray[np.int32],
+    loci: NDArray | PackedLoci | None,
+    batch_filters: list[BatchFilter],
+    row_filters: list[Callable[[list[bytes]], bool]],
+    locus_fields: list[int] | None,
+) -> tuple[bytes, str, NDArray[np.int64]]:
+    """
+    Select the rows `doc_ids` from a block, and apply the pipeline filters to them
 
-async def go(  # pylint:disable=invalid-name
-    job_data: SaveJobData, search_conf: dict, publisher: ProgressPublisher, queue_config_path: str
-) -> AnnotationOutputs:
-    """Main function for running the query and writing the output"""
-    search_client_args = gather_opensearch_args(search_conf)
-    client = OpenSearch(**search_client_args)
+    Args:
+        block (RowBlock): The rows read from the annotation
+        doc_ids (NDArray[np.int32]): The sorted row numbers to select, all of which are in the block
+        loci (NDArray | PackedLoci | None): The locus of each row to select,
+            or None to read the loci from the rows
+        batch_filters (list[BatchFilter]): The columnar filters from the pipeline
+        row_filters (list[Callable[[list[bytes]], bool]]): The per-row filters from the pipeline
+        locus_fields (list[int] | None): The columns defining a locus, required if `loci` is None
 
-    query = _clean_query(job_data.query_body)
-    num_slices, num_docs = _get_num_slices(
-        client, job_data.index_name, MAX_QUERY_SIZE, MAX_SLICES, query
+    Returns:
+        tuple[bytes, str, NDArray[np.int64]]: The raw rows kept, their loci as lines,
+        and the size of each row kept, including its newline
+    """
+    target_rows = doc_ids.astype(np.int64) - block.row_offset
+
+    if len(target_rows) > 0 and (len(batch_filters) > 0 or len(row_filters) > 0):
+        if len(batch_filters) > 0:
+            keep = _apply_batch_filters(batch_filters, block, target_rows)
+        else:
+            keep = _apply_row_filters(row_filters, block.rows(target_rows))
+        target_rows = target_rows[keep]
+        if loci is not None:
+            loci = loci[keep]
+
+    if len(target_rows) == 0:
+        return b"", "", np.array([], dtype=np.int64)
+
+    if loci is not None:
+        loci_text = "\n".join(loci.tolist()) + "\n"
+    else:
+        loci_text = _format_loci(block, target_rows, locus_fields)  # type: ignore
+
+    row_sizes = block.stops[target_rows] - block.starts[target_rows]
+
+    return block.raw(target_rows), loci_text, row_sizes
+
+
+def _plan_annotation_seek(
+    parent_annotation_path: str, doc_ids_sorted: NDArray[np.int32]
+) -> tuple[RowIndex, list[tuple[int, int, int]]] | None:
+    """
+    Decide whether to read only the parts of the parent annotation that hold the hits
+
+    This requires the annotation to be BGZF compressed, with a `.gzi` index and a row index
+    built from the annotation as it is now, and the hits to be concentrated in at most
+    SAVE_ANNOTATION_SEEK_MAX_FRACTION of the annotation.
+
+    Returns:
+        tuple[RowIndex, list[tuple[int, int, int]]] | None: The row index, and the first row,
+        start and end offsets of each span to read, or None to read the whole annotation
+    """
+    gzi_path = parent_annotation_path + GZI_SUFFIX
+    row_index_path = parent_annotation_path + ROW_INDEX_SUFFIX
+
+    if not (os.path.exists(gzi_path) and os.path.exists(row_index_path)):
+        return None
+
+    try:
+        row_index = RowIndex.from_path(row_index_path)
+
+        # An annotation regenerated at the same path leaves the index of the earlier one behind
+        if not row_index.describes(parent_annotation_path):
+            raise ValueError(f"{row_index_path} was built from another version of the annotation")
+
+        if len(doc_ids_sorted) > 0 and doc_ids_sorted[-1] >= row_index.n_rows:
+            raise ValueError(
+                f"Hit {doc_ids_sorted[-1]} is past the {row_index.n_rows} rows of {row_index_path}"
+            )
+
+        segments = row_index.segments(doc_ids_sorted, READ_CHUNK_SIZE)
+    except (OSError, ValueError) as e:
+        logger.warning("Cannot seek into %s, reading it in full: %s", parent_annotation_path, e)
+        return None
+
+    seek_size = sum(end - start for _, start, end in segments)
+    if seek_size > SAVE_ANNOTATION_SEEK_MAX_FRACTION * row_index.data_size:
+        logger.info(
+            "Hits span %d of %d annotation bytes, reading the annotation in full",
+            seek_size,
+            row_index.data_size,
+        )
+        return None
+
+    return row_index, segments
+
+
+def _partition_segments(
+    segments: list[tuple[int, int, int]], n_groups: int
+) -> list[list[tuple[int, int, int]]]:
+    """Split segments into at most `n_groups` contiguous groups of roughly equal size in bytes"""
+    sizes = np.array([end - start for _, start, end in segments], dtype=np.int64)
+    preceding = np.cumsum(sizes) - sizes
+    group_ids = np.minimum(preceding * n_groups // max(int(sizes.sum()), 1), n_groups - 1)
+
+    groups: list[list[tuple[int, int, int]]] = []
+    for segment, group_id, previous_group_id in zip(
+        segments, group_ids.tolist(), [-1, *group_ids[:-1].tolist()]
+    ):
+        if group_id != previous_group_id:
+            groups.append([])
+        groups[-1].append(segment)
+
+    return groups
+
+
+@ray.remote
+def _filter_annotation_segments(
+    parent_annotation_path: str,
+    segments: list[tuple[int, int, int]],
+    doc_ids: NDArray[np.int32],
+    loci: NDArray | PackedLoci | None,
+    pipeline: PipelineType,
+    header_fields: list[bytes],
+) -> tuple[bytes, str, NDArray[np.int64], int]:
+    """
+    Read and filter the hits in some spans of a BGZF annotation
+
+    Args:
+        parent_annotation_path (str): The annotation, which must have a `.gzi` index
+        segments (list[tuple[int, int, int]]): The first row, start and end offsets of each span
+        doc_ids (NDArray[np.int32]): The sorted row numbers to select, all of which are in the spans
+        loci (NDArray | PackedLoci | None): The locus of each row to select, or None
+        pipeline (PipelineType): The filters to apply
+        header_fields (list[bytes]): The columns of the annotation
+
+    Returns:
+        tuple[bytes, str, NDArray[np.int64], int]: The raw rows kept, their loci as lines,
+        the size of each row kept, and the number of rows read
+    """
+    batch_filters, row_filters = _make_filters(pipeline, header_fields)
+    locus_fields = _locus_field_indices(header_fields) if loci is None else None
+
+    kept_parts: list[bytes] = []
+    loci_parts: list[str] = []
+    row_sizes_parts: list[NDArray[np.int64]] = [np.array([], dtype=np.int64)]
+    n_rows_read = 0
+
+    current_target_index = 0
+    with BgzfReader(parent_annotation_path) as reader:
+        for first_row, start, end in segments:
+            block = RowBlock.from_bytes(reader.read(start, end), first_row)
+            next_target_index = int(np.searchsorted(doc_ids, block.end_row, side="left"))
+
+            kept, loci_text, row_sizes = _filter_block(
+                block,
+                doc_ids[current_target_index:next_target_index],
+                loci[current_target_index:next_target_index] if loci is not None else None,
+                batch_filters,
+                row_filters,
+                locus_fields,
+            )
+            kept_parts.append(kept)
+            loci_parts.append(loci_text)
+            row_sizes_parts.append(row_sizes)
+            n_rows_read += len(block)
+            current_target_index = next_target_index
+
+    return b"".join(kept_parts), "".join(loci_parts), np.concatenate(row_sizes_parts), n_rows_read
+
+
+def _filter_annotation_seek(
+    parent_annotation_path: str,
+    row_index: RowIndex,
+    segments: list[tuple[int, int, int]],
+    outputs: list[IO[bytes]],
+    loci_fh: IO[str],
+    pipeline: PipelineType,
+    doc_ids_sorted: NDArray[np.int32],
+    loci_sorted: NDArray | PackedLoci | None,
+    n_hits: int,
+    reporter: ProgressReporter,
+) -> tuple[int, int, RowIndex]:
+    """
+    Filter only the spans of a BGZF annotation that hold hits, reading disjoint spans in parallel
+
+    The results are written in order, so the output is the same as that of `_filter_annotation_stream`
+
+    Returns:
+        tuple[int, int, RowIndex]: The number of rows kept, the number of rows read,
+        and the row index of the rows written
+    """
+    with BgzfReader(parent_annotation_path) as reader:
+        header = reader.read(0, row_index.header_size)
+
+    for out in outputs:
+        out.write(header)
+    row_index_builder = RowIndexBuilder(len(header), ROW_INDEX_STRIDE)
+
+    header_fields = header.rstrip().split(b"\t")
+    # Fail before dispatching any work if the loci cannot be read from the annotation
+    if loci_sorted is None:
+        _locus_field_indices(header_fields)
+
+    n_workers = max(1, min(int(ray.available_resources().get("CPU", 1)), len(segments)))
+    groups = _partition_segments(segments, n_workers)
+
+    reporter.message.remote(  # type: ignore
+        f"Annotation: Reading {len(segments)} spans holding hits, in {len(groups)} parallel groups."
+    )
+
+    doc_ids_sorted = doc_ids_sorted[:n_hits]
+    pipeline_ref = ray.put(pipeline)
+
+    tasks = []
+    for i, group in enumerate(groups):
+        lo = int(np.searchsorted(doc_ids_sorted, group[0][0], side="left"))
+        hi = (
+            int(np.searchsorted(doc_ids_sorted, groups[i + 1][0][0], side="left"))
+            if i + 1 < len(groups)
+            else n_hits
+        )
+
+        tasks.append(
+            _filter_annotation_segments.remote(
+                parent_annotation_path,
+                group,
+                np.asarray(doc_ids_sorted[lo:hi]),
+                loci_sorted[lo:hi] if loci_sorted is not None else None,
+                pipeline_ref,
+                header_fields,
+            )
+        )
+
+    n_retained = 0
+    n_rows_read = 0
+    for i, task in enumerate(tasks):
+        kept, loci_text, row_sizes, n_group_rows_read = ray.get(task)
+
+        for out in outputs:
+            out.write(kept)
+        loci_fh.write(loci_text)
+        row_index_builder.add_rows(row_sizes)
+
+        n_retained += len(row_sizes)
+        n_rows_read += n_group_rows_read
+
+        reporter.message.remote(  # type: ignore
+            f"Annotation: Filtered {i + 1} of {len(tasks)} groups ({n_rows_read} variants). "
+            f"{n_retained} kept."
+        )
+
+    return n_retained, n_rows_read, row_index_builder.build()
+
+
+class HitCursor:
+    """
+    Walk runs of sorted hits in document id order, as the annotation rows they select are read
+
+    The runs may be produced while they are consumed, such as by the pipelined save,
+    which yields the hits before a document id as soon as every slice has been fetched past it.
+    """
+
+    def __init__(self, chunks: Iterable[HitChunk], has_loci: bool):
+        self.has_loci = has_loci
+        self._chunks = iter(chunks)
+        self._end_row = 0
+        self._doc_ids: NDArray[np.int32] = np.array([], dtype=np.int32)
+        self._loci: NDArray | PackedLoci | None = None
+        self._position = 0
+        self._done = False
+
+    @staticmethod
+    def from_sorted(doc_ids_sorted: NDArray[np.int32], loci_sorted: NDArray | PackedLoci | None):
+        """Walk hits that have all been fetched and sorted"""
+        return HitCursor(
+            [(np.iinfo(np.int64).max, doc_ids_sorted, loci_sorted)], has_loci=loci_sorted is not None
+        )
+
+    def _advance(self) -> bool:
+        try:
+            self._end_row, self._doc_ids, self._loci = next(self._chunks)
+        except StopIteration:
+            self._done = True
+            return False
+
+        self._position = 0
+        return True
+
+    def take(self, end_row: int) -> list[tuple[NDArray[np.int32], NDArray | PackedLoci | None]]:
+        """Take the document ids, and loci, of the hits before `end_row`, in one part for each run"""
+        parts = []
+        while True:
+            remaining = self._doc_ids[self._position :]
+            stop = self._position + int(np.searchsorted(remaining, end_row, side="left"))
+
+            if stop > self._position:
+                parts.append(
+                    (
+                        self._doc_ids[self._position : stop],
+                        self._loci[self._position : stop] if self._loci is not None else None,
+                    )
+                )
+                self._position = stop
+
+            if self._position < len(self._doc_ids) or self._end_row >= end_row or not self._advance():
+                return parts
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether every hit has been taken, waiting for the next run if the current one is taken"""
+        while self._position >= len(self._doc_ids):
+            if self._done or not self._advance():
+                return True
+
+        return False
+
+
+def _filter_annotation_stream(
+    parent_annotation_path: str,
+    outputs: list[IO[bytes]],
+    loci_fh: IO[str],
+    pipeline: PipelineType,
+    hits: HitCursor,
+    reporter: ProgressReporter,
+    reporting_interval: int,
+) -> tuple[int, int, RowIndex]:
+    """
+    Filter the annotation in a single pass over the whole decompressed annotation
+
+    Returns:
+        tuple[int, int, RowIndex]: The number of rows kept, the number of rows read,
+        and the row index of the rows written
+    """
+    n_retained = 0
+    n_rows_read = 0
+
+    bgzip_decompress_cmd = get_decompress_to_pipe_cmd(parent_annotation_path)
+    with subprocess.Popen(bgzip_decompress_cmd, shell=True, stdout=subprocess.PIPE) as in_fh:
+        if in_fh.stdout is None:
+            raise IOError("Failed to open annotation file for reading.")
+
+        header = in_fh.stdout.readline()
+        for out in outputs:
+            out.write(header)
+        row_index_builder = RowIndexBuilder(len(header), ROW_INDEX_STRIDE)
+
+        header_fields = header.rstrip().split(b"\t")
+        batch_filters, row_filters = _make_filters(pipeline, header_fields)
+
+        # When we have not fetched the loci, we read them from the rows we keep
+        locus_fields = _locus_field_indices(header_fields) if not hits.has_loci else None
+
+        # The hits are document_ids, which are the indices in the annotation file that we wish
+        # to keep, in sorted order
+        # For each block of rows read from the annotation, the hits that fall within
+        # that block are the next hits in order, found by binary search
+        next_report = reporting_interval
+        start = time.time()
+        interval_start = start
+        for block in iter_row_blocks(in_fh.stdout):
+            for doc_ids, loci in hits.take(block.end_row):
+                kept, loci_text, row_sizes = _filter_block(
+                    block, doc_ids, loci, batch_filters, row_filters, locus_fields
+                )
+
+                if len(row_sizes) > 0:
+                    for out in outputs:
+                        out.write(kept)
+                    loci_fh.write(loci_text)
+                    row_index_builder.add_rows(row_sizes)
+
+                n_retained += len(row_sizes)
+
+            n_rows_read = block.end_row
+
+            if n_rows_read >= next_report:
+                end = time.time()
+
+                reporter.message.remote(  # type: ignore
+                    (
+                        f"Annotation: Filtered {n_rows_read} variants. {n_retained} kept. "
+                        f"Took {end - interval_start:.0f} seconds "
+                        f"({n_rows_read / max(end - start, 1e-9):.0f} variants/second)."
+                    )
+                )
+                next_report = (n_rows_read // reporting_interval + 1) * reporting_interval
+                interval_start = time.time()
+
+            if hits.exhausted:
+                break
+
+    return n_retained, n_rows_read, row_index_builder.build()
+
+
+def _write_row_index(annotation_path: str, row_index: RowIndex) -> None:
+    """
+    Write the row index of a filtered annotation alongside it
+
+    Only BGZF annotations, for which the compressor has written a `.gzi` index, support seeking,
+    so no row index is written for other annotations
+    """
+    gzi_path = annotation_path + GZI_SUFFIX
+    if not os.path.exists(gzi_path):
+        logger.info("No .gzi index was written for %s, skipping its row index", annotation_path)
+        return
+
+    row_index.with_blocks(gzi_path).with_fingerprint(annotation_path).write(
+        annotation_path + ROW_INDEX_SUFFIX
+    )
+
+
+def _write_filtered_annotation(
+    stats: Statistics,
+    annotation_path: str,
+    loci_fh: IO[str],
+    reporter: ProgressReporter,
+    filter_rows: Callable[[list[IO[bytes]]], tuple[int, int, RowIndex]],
+) -> int:
+    """
+    Write the filtered annotation, its statistics and its row index
+
+    Args:
+        stats (Statistics): The statistics to generate for the filtered annotation
+        annotation_path (str): The filtered annotation to write
+        loci_fh (IO[str]): Where `filter_rows` writes the loci, closed once the rows are written
+        reporter (ProgressReporter): The progress reporter
+        filter_rows (Callable[[list[IO[bytes]]], tuple[int, int, RowIndex]]): Writes the header and
+            the rows kept to each output, returning the number of rows kept, the number read,
+            and the row index of the rows written
+
+    Returns:
+        int: The number of rows kept
+    """
+    with span("filter_annotation") as timer:
+        bgzip_cmd = get_compress_from_pipe_cmd(annotation_path)
+        bystro_stats_cmd = stats.stdin_cli_stats_command
+
+        with (
+            subprocess.Popen(bystro_stats_cmd, shell=True, stdin=subprocess.PIPE) as stats_fh,
+            subprocess.Popen(bgzip_cmd, shell=True, stdin=subprocess.PIPE) as p,
+        ):
+            if p.stdin is None:
+                raise IOError("Failed to open filtered annotation file for writing.")
+
+            if stats_fh.stdin is None:
+                raise IOError("Failed to open stats file for writing.")
+
+            n_retained, n_rows_read, row_index = filter_rows([p.stdin, stats_fh.stdin])
+
+            loci_fh.close()
+            p.stdin.close()  # Close the stdin to signal that we're done sending input
+            stats_fh.stdin.close()  # Close the stdin to signal that we're done sending input
+
+            p.wait()
+            stats_fh.wait()
+
+            _write_row_index(annotation_path, row_index)
+
+            reporter.message.remote("Annotation: Completed filtering.")  # type: ignore
+
+    rows_per_second = n_rows_read / max(timer.elapsed_time, 1e-9)
+    reporter.message.remote(  # type: ignore
+        f"Annotation: {n_retained} variants survived filtering. "
+        f"Scanned {n_rows_read} variants at {rows_per_second:.0f} variants/second."
+    )
+
+    logger.info(
+        "Filtering annotation and generating stats took %s seconds (%d rows read, %.0f rows/second)",
+        timer.elapsed_time,
+        n_rows_read,
+        rows_per_second,
+    )
+
+    return n_retained
+
+
+def filter_annotation(
+    stats: Statistics,
+    annotation_path: str,
+    parent_annotation_path: str,
+    job_data: SaveJobData,
+    doc_ids_sorted: NDArray[np.int32],
+    loci_sorted: NDArray | PackedLoci | None,
+    n_hits: int,
+    reporter: ProgressReporter,
+    reporting_interval: int,
+    loci_file_path: str,
+):
+    reporting_interval = max(ANNOTATION_MINIMUM_REPORTING_INTERVAL, reporting_interval)
+
+    reporter.message.remote(  # type: ignore
+        (
+            "Filtering annotation file and re-generating stats. "
+            f"Reporting progress every ~{reporting_interval} rows."
+        )
+    )
+
+    # When the parent annotation is indexed, and the hits are sparse,
+    # we decompress only the parts of the annotation that hold them
+    seek_plan = _plan_annotation_seek(parent_annotation_path, doc_ids_sorted[:n_hits])
+
+    with open(loci_file_path, "w") as loci_fh:
+
+        def filter_rows(outputs: list[IO[bytes]]) -> tuple[int, int, RowIndex]:
+            if seek_plan is None:
+                return _filter_annotation_stream(
+                    parent_annotation_path,
+                    outputs,
+                    loci_fh,
+                    job_data.pipeline,
+                    HitCursor.from_sorted(doc_ids_sorted[:n_hits], loci_sorted),
+                    reporter,
+                    reporting_interval,
+                )
+
+            row_index, segments = seek_plan
+            return _filter_annotation_seek(
+                parent_annotation_path,
+                row_index,
+                segments,
+                outputs,
+                loci_fh,
+                job_data.pipeline,
+                doc_ids_sorted,
+                loci_sorted,
+                n_hits,
+                reporter,
+            )
+
+        return _write_filtered_annotation(stats, annotation_path, loci_fh, reporter, filter_rows)
+
+
+def filter_annotation_pipelined(
+    stats: Statistics,
+    annotation_path: str,
+    parent_annotation_path: str,
+    job_data: SaveJobData,
+    hits: HitCursor,
+    reporter: ProgressReporter,
+    reporting_interval: int,
+    loci_fh: IO[str],
+) -> int:
+    """
+    Filter the annotation while its hits are still being fetched
+
+    The annotation is read in a single pass, consuming the hits of each block of rows as soon as
+    they are available, so unlike `filter_annotation` it never seeks into indexed annotations,
+    which requires knowing every hit up front.
+
+    Args:
+        stats (Statistics): The statistics to generate for the filtered annotation
+        annotation_path (str): The filtered annotation to write
+        parent_annotation_path (str): The annotation to filter
+        job_data (SaveJobData): The save job, whose pipeline is applied
+        hits (HitCursor): The hits, in document id order
+        reporter (ProgressReporter): The progress reporter
+        reporting_interval (int): The number of rows between progress messages
+        loci_fh (IO[str]): Where the loci of the rows kept are written, closed once they are
+
+    Returns:
+        int: The number of rows kept
+    """
+    reporting_interval = max(ANNOTATION_MINIMUM_REPORTING_INTERVAL, reporting_interval)
+
+    reporter.message.remote(  # type: ignore
+        (
+            "Filtering annotation file and re-generating stats, while fetching variants. "
+            f"Reporting progress every ~{reporting_interval} rows."
+        )
+    )
+
+    def filter_rows(outputs: list[IO[bytes]]) -> tuple[int, int, RowIndex]:
+        return _filter_annotation_stream(
+            parent_annotation_path,
+            outputs,
+            loci_fh,
+            job_data.pipeline,
+            hits,
+            reporter,
+            reporting_interval,
+        )
+
+    return _write_filtered_annotation(stats, annotation_path, loci_fh, reporter, filter_rows)
+
+
+def _dosage_filter_type(job_data: SaveJobData) -> DosageFilterType:
+    """The job's choice of dosage filter, or SAVE_DOSAGE_FILTER if it has none"""
+    return job_data.dosage_filter or SAVE_DOSAGE_FILTER  # type: ignore
+
+
+def filter_dosage_matrix(
+    dosage_out_path: str,
+    parent_dosage_matrix_path: str,
+    job_data: SaveJobData,
+    reporter: ProgressReporter,
+    queue_config_path: str,
+    reporting_interval: int,
+    loci_file_path: str,
+):
+    if not (
+        os.path.exists(parent_dosage_matrix_path)
+        and os.stat(parent_dosage_matrix_path).st_size > 0
+        and os.path.exists(loci_file_path)
+        and os.stat(loci_file_path).st_size > 0
+    ):
+        logger.info("No dosage matrix to filter")
+        reporter.message.remote("No dosage matrix to filter.")  # type: ignore
+        # Touch the output file to avoid errors downstream
+        pathlib.Path(dosage_out_path).touch()
+        return
+
+    reporter.message.remote(  # type: ignore
+        f"Filtering dosage matrix file. Reporting progress every ~{reporting_interval} variants"
+    )
+
+    with span("filter_dosage_matrix") as timer:
+        if _dosage_filter_type(job_data) == "arrow":
+            filter_dosage_matrix_arrow(
+                parent_dosage_matrix_path=parent_dosage_matrix_path,
+                dosage_out_path=dosage_out_path,
+                loci=read_loci_file(loci_file_path),
+                reporter=reporter,
+                progress_frequency=reporting_interval,
+            )
+        else:
+            run_dosage_filter(
+                parent_dosage_matrix_path=parent_dosage_matrix_path,
+                dosage_out_path=dosage_out_path,
+                loci_path=loci_file_path,
+                queue_config_path=queue_config_path,
+                progress_frequency=reporting_interval,
+                submission_id=str(job_data.submission_id),
+            )
+    logger.info("Filtering dosage matrix took %s seconds", timer.elapsed_time)
+
+
+class StreamingDosageFilter:
+    """
+    Stream loci to the dosage filter as the annotation filter writes them
+
+    Loci are written to the loci file, and to a named pipe that the dosage filter reads its loci
+    from, so the dosage filter reads the loci while the annotation is filtered, and starts
+    filtering the dosage matrix as soon as the last locus is written, rather than being started
+    once the loci file is complete.
+
+    The dosage filter is only started once the first locus is written, so that, as in
+    `filter_dosage_matrix`, an empty dosage matrix is written when no loci are kept.
+    """
+
+    def __init__(
+        self,
+        loci_file_path: str,
+        dosage_out_path: str,
+        parent_dosage_matrix_path: str,
+        job_data: SaveJobData,
+        reporter: ProgressReporter,
+        queue_config_path: str,
+        reporting_interval: int,
+    ):
+        self.loci_file_path = loci_file_path
+        self.dosage_out_path = dosage_out_path
+        self.parent_dosage_matrix_path = parent_dosage_matrix_path
+        self.job_data = job_data
+        self.reporter = reporter
+        self.queue_config_path = queue_config_path
+        self.reporting_interval = reporting_interval
+
+        self._fifo_path = f"{loci_file_path}.fifo"
+        self._has_dosage_matrix = (
+            os.path.exists(parent_dosage_matrix_path) and os.stat(parent_dosage_matrix_path).st_size > 0
+        )
+        self._loci_fh: IO[str] = open(loci_file_path, "w")  # noqa: SIM115
+        self._pipe: IO[str] | None = None
+        self._process: subprocess.Popen | None = None
+        self._stderr: IO[bytes] | None = None
+        self._started = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        self.close()
+
+        if exc_type is not None and self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+        if self._stderr is not None:
+            self._stderr.close()
+
+        if os.path.exists(self._fifo_path):
+            os.remove(self._fifo_path)
+
+    def _read_stderr(self) -> str:
+        assert self._stderr is not None
+        self._stderr.seek(0)
+        return self._stderr.read().decode(errors="replace")
+
+    def _start(self) -> IO[str]:
+        os.mkfifo(self._fifo_path)
+
+        # Dosage filter output is written to a file rather than a pipe, since we don't read
+        # the pipe until the dosage filter exits, and it would block once the pipe is full
+        self._stderr = tempfile.TemporaryFile()  # noqa: SIM115
+        dosage_filter_cmd = _dosage_filter_cmd(
+            self.parent_dosage_matrix_path,
+            self.dosage_out_path,
+            self._fifo_path,
+            self.queue_config_path,
+            self.reporting_interval,
+            str(self.job_data.submission_id),
+        )
+
+        logger.info(
+            "Beginning to filter genotypes, streaming loci, using command `%s`", dosage_filter_cmd
+        )
+        self.reporter.message.remote(  # type: ignore
+            "Filtering dosage matrix file while filtering the annotation. "
+            f"Reporting progress every ~{self.reporting_interval} variants"
+        )
+
+        self._started = time.perf_counter()
+        self._process = subprocess.Popen(dosage_filter_cmd, stderr=self._stderr, shell=True)
+
+        # Opening a named pipe for writing blocks until it is opened for reading,
+        # so we poll, in case the dosage filter exits without opening it
+        while True:
+            try:
+                fd = os.open(self._fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+
+                if self._process.poll() is not None:
+                    raise RuntimeError(f"Binary execution failed: {self._read_stderr()}") from e
+
+                time.sleep(0.01)
+
+        os.set_blocking(fd, True)
+        return os.fdopen(fd, "w")
+
+    def write(self, loci_text: str) -> int:
+        """Write loci, one per line, to the loci file and to the dosage filter"""
+        self._loci_fh.write(loci_text)
+
+        if len(loci_text) == 0 or not self._has_dosage_matrix:
+            return len(loci_text)
+
+        if self._pipe is None:
+            self._pipe = self._start()
+
+        try:
+            self._pipe.write(loci_text)
+        except BrokenPipeError as e:
+            raise RuntimeError(f"Binary execution failed: {self._read_stderr()}") from e
+
+        return len(loci_text)
+
+    def close(self):
+        """Signal to the dosage filter that every locus has been written"""
+        self._loci_fh.close()
+
+        if self._pipe is not None and not self._pipe.closed:
+            try:
+                self._pipe.close()
+            except BrokenPipeError as e:
+                raise RuntimeError(f"Binary execution failed: {self._read_stderr()}") from e
+
+    def wait(self):
+        """Wait for the dosage filter to finish filtering the dosage matrix"""
+        self.close()
+
+        if self._process is None:
+            logger.info("No dosage matrix to filter")
+            self.reporter.message.remote("No dosage matrix to filter.")  # type: ignore
+            # Touch the output file to avoid errors downstream
+            pathlib.Path(self.dosage_out_path).touch()
+            return
+
+        self._process.wait()
+        elapsed_time = time.perf_counter() - self._started
+
+        if self._process.returncode != 0:
+            raise RuntimeError(f"Binary execution failed: {self._read_stderr()}")
+
+        logger.info("Filtering dosage matrix took %s seconds", elapsed_time)
+
+
+def _materialize_cached_result(
+    cache: SaveResultCache, cache_key: str, job_data: SaveJobData, publisher: ProgressPublisher
+) -> AnnotationOutputs | None:
+    """Write the cached outputs of an identical save, if there is one"""
+    output_dir = os.path.dirname(job_data.output_base_path)
+    basename = os.path.basename(job_data.output_base_path)
+
+    entry = cache.materialize(cache_key, output_dir, basename)
+    if entry is None:
+        return None
+
+    logger.info("Reusing cached save result %s for %s", cache_key, job_data.output_base_path)
+
+    reporter = get_progress_reporter(publisher)
+    reporter.message.remote(  # type: ignore
+        "Found the results of an identical search and save; reusing them."
+    )
+    reporter.increment.remote(entry.n_variants, True)  # type: ignore
+    ray.get(reporter.flush.remote())  # type: ignore
+
+    outputs, _ = AnnotationOutputs.from_path(
+        output_dir, basename, job_data.input_file_names.config, compress=True
+    )
+
+    return _with_row_index(outputs, os.path.join(output_dir, outputs.annotation))
+
+
+class _SavePaths(msgspec.Struct, frozen=True):
+    """The paths of a save job's inputs and outputs"""
+
+    annotation: str
+    parent_annotation: str
+    dosage_out: str
+    parent_dosage_matrix: str
+    loci_file: str
+
+
+def _prepare_outputs(job_data: SaveJobData) -> tuple[AnnotationOutputs, Statistics, _SavePaths]:
+    output_dir = os.path.dirname(job_data.output_base_path)
+    basename = os.path.basename(job_data.output_base_path)
+
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    outputs, stats = AnnotationOutputs.from_path(
+        output_dir, basename, job_data.input_file_names.config, compress=True
+    )
+
+    paths = _SavePaths(
+        annotation=os.path.join(output_dir, outputs.annotation),
+        parent_annotation=os.path.join(job_data.input_dir, job_data.input_file_names.annotation),
+        dosage_out=os.path.join(output_dir, outputs.dosage_matrix_out_path),
+        parent_dosage_matrix=os.path.join(
+            job_data.input_dir, job_data.input_file_names.dosage_matrix_out_path
+        ),
+        loci_file=os.path.join(output_dir, f"{basename}_loci.txt"),
+    )
+
+    return outputs, stats, paths
+
+
+def _with_row_index(outputs: AnnotationOutputs, annotation_path: str) -> AnnotationOutputs:
+    if os.path.exists(annotation_path + ROW_INDEX_SUFFIX):
+        outputs = msgspec.structs.replace(outputs, row_index=outputs.annotation + ROW_INDEX_SUFFIX)
+
+    return outputs
+
+
+def filter_annotation_and_dosage_matrix(
+    job_data: SaveJobData,
+    reporter: ProgressReporter,
+    doc_ids_sorted: NDArray[np.int32],
+    loci_sorted: NDArray | PackedLoci | None,
+    n_hits: int,
+    queue_config_path: str,
+) -> tuple[AnnotationOutputs, int]:
+    outputs, stats, paths = _prepare_outputs(job_data)
+
+    reporting_interval = max(MINIMUM_RECORDS_TO_ENABLE_REPORTING, math.ceil(n_hits * REPORTING_INTERVAL))
+
+    logger.info(
+        "Memory usage before filter_annotation: %s (MB)",
+        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+    )
+
+    n_results = filter_annotation(
+        stats=stats,
+        annotation_path=paths.annotation,
+        parent_annotation_path=paths.parent_annotation,
+        job_data=job_data,
+        doc_ids_sorted=doc_ids_sorted,
+        loci_sorted=loci_sorted,
+        n_hits=n_hits,
+        reporter=reporter,
+        reporting_interval=reporting_interval,
+        loci_file_path=paths.loci_file,
+    )
+
+    del doc_ids_sorted
+    del loci_sorted
+    gc.collect()
+
+    logger.info(
+        "Memory usage after filter_annotation: %s (MB)",
+        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+    )
+
+    filter_dosage_matrix(
+        dosage_out_path=paths.dosage_out,
+        parent_dosage_matrix_path=paths.parent_dosage_matrix,
+        loci_file_path=paths.loci_file,
+        job_data=job_data,
+        reporter=reporter,
+        queue_config_path=queue_config_path,
+        reporting_interval=reporting_interval,
+    )
+
+    logger.info(
+        "Memory usage after filter_dosage_matrix: %s (MB)",
+        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+    )
+
+    reporter.increment.remote(n_results, True)  # type: ignore
+
+    return _with_row_index(outputs, paths.annotation), n_results
+
+
+def filter_annotation_and_dosage_matrix_pipelined(
+    job_data: SaveJobData,
+    reporter: ProgressReporter,
+    hits: HitCursor,
+    n_hits: int,
+    queue_config_path: str,
+) -> tuple[AnnotationOutputs, int]:
+    """
+    Filter the annotation as the hits are fetched, and the dosage matrix as the loci are written
+
+    Args:
+        job_data (SaveJobData): The save job
+        reporter (ProgressReporter): The progress reporter
+        hits (HitCursor): The hits, in document id order, which may still be being fetched
+        n_hits (int): The expected number of hits, used to set the reporting interval
+        queue_config_path (str): The beanstalkd queue configuration, for the dosage filter
+
+    Returns:
+        tuple[AnnotationOutputs, int]: The outputs written, and the number of variants saved
+    """
+    outputs, stats, paths = _prepare_outputs(job_data)
+
+    reporting_interval = max(MINIMUM_RECORDS_TO_ENABLE_REPORTING, math.ceil(n_hits * REPORTING_INTERVAL))
+
+    def filter_rows(loci_fh: IO[str]) -> int:
+        return filter_annotation_pipelined(
+            stats=stats,
+            annotation_path=paths.annotation,
+            parent_annotation_path=paths.parent_annotation,
+            job_data=job_data,
+            hits=hits,
+            reporter=reporter,
+            reporting_interval=reporting_interval,
+            loci_fh=loci_fh,
+        )
+
+    if _dosage_filter_type(job_data) == "arrow":
+        # The in-process dosage filter looks up every locus at once,
+        # so it can't consume the loci as they are written
+        with open(paths.loci_file, "w") as loci_fh:
+            n_results = filter_rows(loci_fh)
+
+        filter_dosage_matrix(
+            dosage_out_path=paths.dosage_out,
+            parent_dosage_matrix_path=paths.parent_dosage_matrix,
+            loci_file_path=paths.loci_file,
+            job_data=job_data,
+            reporter=reporter,
+            queue_config_path=queue_config_path,
+            reporting_interval=reporting_interval,
+        )
+    else:
+        with StreamingDosageFilter(
+            loci_file_path=paths.loci_file,
+            dosage_out_path=paths.dosage_out,
+            parent_dosage_matrix_path=paths.parent_dosage_matrix,
+            job_data=job_data,
+            reporter=reporter,
+            queue_config_path=queue_config_path,
+            reporting_interval=reporting_interval,
+        ) as dosage_filter:
+            n_results = filter_rows(dosage_filter)  # type: ignore
+            dosage_filter.wait()
+
+    logger.info(
+        "Memory usage after filtering the annotation and dosage matrix: %s (MB)",
+        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+    )
+
+    reporter.increment.remote(n_results, True)  # type: ignore
+
+    return _with_row_index(outputs, paths.annotation), n_results
+
+
+def _save_pipelined(
+    job_data: SaveJobData,
+    search_client_args: dict,
+    query: dict,
+    num_docs: int,
+    num_slices: int,
+    num_cpus: int,
+    reporter: ProgressReporter,
+    queue_config_path: str,
+) -> tuple[AnnotationOutputs, int]:
+    """
+    Fetch the hits a page of each slice at a time, filtering the annotation as every slice is fetched
+    past each of its rows, see `_iter_slice_hits_in_order`
+
+    Args:
+        job_data (SaveJobData): The save job
+        search_client_args (dict): The arguments for the search clients
+        query (dict): The query, with its point in time
+        num_docs (int): The number of hits
+        num_slices (int): The number of slices to fetch the hits in
+        num_cpus (int): The number of fetch workers
+        reporter (ProgressReporter): The progress reporter
+        queue_config_path (str): The beanstalkd queue configuration, for the dosage filter
+
+    Returns:
+        tuple[AnnotationOutputs, int]: The outputs written, and the number of variants saved
+    """
+    actor_constructor = AsyncQueryProcessor.options(  # type: ignore
+        max_concurrency=MAX_CONCURRENCY_PER_THREAD
+    )
+    actors = [
+        actor_constructor.remote(search_client_args, reporter)  # type: ignore
+        for _ in range(max(1, min(num_cpus, num_slices)))
+    ]
+
+    logger.info("Pipelining save of %d hits, in %d slices", num_docs, num_slices)
+
+    def hit_chunks() -> Iterator[HitChunk]:
+        n_hits = 0
+        for chunk in _iter_slice_hits_in_order(
+            actors,
+            lambda actor, body: actor.process_query_page.remote(body),
+            {**query, "sort": DOC_ID_SORT},
+            num_slices,
+            MAX_CONCURRENCY_PER_THREAD,
+        ):
+            n_hits += len(chunk[1])
+            yield chunk
+
+        # Report any remaining rows
+        _log_progress_stats("fetch workers", ray.get([actor.close.remote() for actor in actors]))
+        reporter.increment_and_write_progress_message.remote(  # type: ignore
+            0, "Fetched", "variants", force=True
+        )
+        reporter.clear_progress.remote()  # type: ignore
+
+        if n_hits != num_docs:
+            raise RuntimeError(
+                "Number of hits does not match the number of documents. Expected %d, got %d"
+                % (num_docs, n_hits)
+            )
+
+        reporter.message.remote(  # type: ignore
+            f"OK: The number of fetched variants ({n_hits}) equals the number expected ({num_docs})"
+        )
+
+    chunks = hit_chunks()
+    with span("fetch_and_filter") as timer:
+        outputs, n_results = filter_annotation_and_dosage_matrix_pipelined(
+            job_data=job_data,
+            reporter=reporter,
+            hits=HitCursor(chunks, has_loci=not SAVE_LOCI_FROM_ANNOTATION),
+            n_hits=num_docs,
+            queue_config_path=queue_config_path,
+        )
+
+        # The annotation may end before the last hits have been consumed;
+        # they are still fetched, to verify the number of hits
+        for _ in chunks:
+            pass
+
+    logger.info("Fetching and filtering took %s seconds", timer.elapsed_time)
+
+    return outputs, n_results
+
+
+def _save(
+    job_data: SaveJobData,
+    search_client_args: dict,
+    client: OpenSearch,
+    query: dict,
+    publisher: ProgressPublisher,
+    queue_config_path: str,
+) -> tuple[AnnotationOutputs, int]:
+    """Run the query and write the output, returning the outputs and the number of variants saved"""
+    num_docs = _count_hits(client, job_data.index_name, query)
+
+    num_cpus = int(ray.available_resources().get("CPU", 1))
+    slice_plan = plan_slices(
+        num_docs=num_docs,
+        settings=get_index_slice_settings(client, job_data.index_name),
+        num_workers=num_cpus,
+        max_query_size=MAX_QUERY_SIZE,
+        max_slices=MAX_SLICES,
+    )
+    num_slices = slice_plan.num_slices
+
+    logger.info(
+        "Constructed query with %d slices for %d hits, across %d shards (at most %d slices allowed)",
+        num_slices,
+        num_docs,
+        slice_plan.num_shards,
+        slice_plan.max_slices,
     )
     pit_id = client.create_point_in_time(index=job_data.index_name, params={"keep_alive": KEEP_ALIVE})["pit_id"]  # type: ignore   # noqa: E501
 
@@ -605,7 +1957,8 @@ async def go(  # pylint:disable=invalid-name
 
     query["pit"] = {"id": pit_id}
     query["size"] = MAX_QUERY_SIZE
-    query["fields"] = FIELDS_TO_QUERY
+    if not SAVE_LOCI_FROM_ANNOTATION:
+        query["fields"] = FIELDS_TO_QUERY
     query["_source"] = False
 
     logger.info(
@@ -613,50 +1966,79 @@ async def go(  # pylint:disable=invalid-name
         psutil.Process(os.getpid()).memory_info().rss / 1024**2,
     )
 
-    try:
-        num_cpus = ray.available_resources().get("CPU", 1)
-
-        actor_index = 0
-        reqs = []
-
-        # slice api requires more than 1 slice
-        actor_constructor = AsyncQueryProcessor.options(  # type: ignore
-            max_concurrency=MAX_CONCURRENCY_PER_THREAD
+    if SAVE_PIPELINED:
+        try:
+            outputs, n_results = _save_pipelined(
+                job_data=job_data,
+                search_client_args=search_client_args,
+                query=query,
+                num_docs=num_docs,
+                num_slices=num_slices,
+                num_cpus=num_cpus,
+                reporter=reporter,
+                queue_config_path=queue_config_path,
+            )
+        finally:
+            client.delete_point_in_time(body={"pit_id": pit_id})  # type: ignore[attr-defined]
+            client.close()
+
+        # The pending reports are written before the job's completion message is sent
+        ray.get(reporter.flush.remote())  # type: ignore
+        _log_progress_stats("the save", [ray.get(reporter.get_stats.remote())])  # type: ignore
+        count("variants_saved", n_results)
+        return outputs, n_results
+
+    # For very large queries, actors write their hits to disk in sorted runs,
+    # which are then merged, rather than sending them all back to be sorted in memory
+    # Document ids alone, fetched when SAVE_LOCI_FROM_ANNOTATION is enabled, are collected in memory
+    spill_dir = None
+    if not SAVE_LOCI_FROM_ANNOTATION and num_docs >= SAVE_SPILL_HITS_THRESHOLD:
+        spill_dir = os.path.join(
+            os.path.dirname(job_data.output_base_path),
+            f"{os.path.basename(job_data.output_base_path)}_hits",
         )
+        pathlib.Path(spill_dir).mkdir(parents=True, exist_ok=True)
 
-        with Timer() as timer:
-            if num_slices == 1:
-                actor = actor_constructor.remote(search_client_args, reporter)  # type: ignore
+        logger.info(
+            "Query has %d hits, at least %d; collecting hits on disk in %s",
+            num_docs,
+            SAVE_SPILL_HITS_THRESHOLD,
+            spill_dir,
+        )
 
-                results = ray.get([actor.process_query.remote({"body": query})])
+    def fetch(actor, body: dict, slice_id: int):
+        if SAVE_LOCI_FROM_ANNOTATION:
+            return actor.process_query_ids.remote(body)
 
-                # Report any remaining rows
-                ray.get(actor.close.remote())
-            else:
-                actors = []
-                for _ in range(int(num_cpus)):
-                    actors.append(actor_constructor.remote(search_client_args, reporter))  # type: ignore
+        if spill_dir is None:
+            return actor.process_query.remote(body)
 
-                for slice_id in range(num_slices):
+        return actor.process_query_to_disk.remote(body, os.path.join(spill_dir, f"slice_{slice_id}"))
 
-                    # Prepare the query body for this specific slice
-                    body = {"body": _prepare_query_body(query, slice_id, num_slices)}
+    try:
+        actor_constructor = AsyncQueryProcessor.options(  # type: ignore
+            max_concurrency=MAX_CONCURRENCY_PER_THREAD
+        )
 
-                    # Select an actor for this task in a round-robin fashion
-                    actor = actors[actor_index]
+        with span("fetch") as timer:
+            # slice api requires more than 1 slice, so an unsliced query is fetched by a single actor
+            actors = [
+                actor_constructor.remote(search_client_args, reporter)  # type: ignore
+                for _ in range(min(num_cpus, num_slices))
+            ]
 
-                    # Call process_query for this slice
-                    res = actor.process_query.remote(body)
-                    reqs.append(res)
+            results, slice_latencies, slice_hits = _fetch_slices(
+                actors, fetch, query, num_slices, MAX_CONCURRENCY_PER_THREAD
+            )
 
-                    # Move to the next actor for the next slice
-                    actor_index = (actor_index + 1) % len(actors)
+            # Report any remaining rows
+            progress_stats = ray.get([actor.close.remote() for actor in actors])
 
-                results = ray.get(reqs)
-                ray.get([actor.close.remote() for actor in actors])
+        _log_slice_stats(slice_latencies, slice_hits)
+        _log_progress_stats("fetch workers", progress_stats)
     finally:
         # Cleanup the PIT ID
-        client.delete_point_in_time(body={"pit_id": pit_id})
+        client.delete_point_in_time(body={"pit_id": pit_id})  # type: ignore[attr-defined]
         client.close()
 
     reporter.increment_and_write_progress_message.remote(  # type: ignore
@@ -671,30 +2053,95 @@ async def go(  # pylint:disable=invalid-name
         psutil.Process(os.getpid()).memory_info().rss / 1024**2,
     )
 
-    doc_ids_sorted, loci_sorted, n_hits = sort_loci_and_doc_ids(results)
+    loci_sorted: NDArray | PackedLoci | None
+    try:
+        if SAVE_LOCI_FROM_ANNOTATION:
+            doc_ids_sorted, n_hits = sort_doc_ids(results)
+            loci_sorted = None
+        elif spill_dir is None:
+            doc_ids_sorted, loci_sorted, n_hits = sort_loci_and_doc_ids(results)
+        else:
+            doc_ids_sorted, loci_sorted, n_hits = merge_spilled_hits(
+                results,
+                os.path.join(spill_dir, "merged.run"),
+                SAVE_HITS_MEMORY_BUDGET_MB * 1024**2,
+            )
+        del results
 
-    logger.info(
-        "Memory usage after query result sorting: %s (MB)",
-        psutil.Process(os.getpid()).memory_info().rss / 1024**2,
-    )
+        logger.info(
+            "Memory usage after query result sorting: %s (MB)",
+            psutil.Process(os.getpid()).memory_info().rss / 1024**2,
+        )
+
+        if n_hits != num_docs:
+            raise RuntimeError(
+                "Number of hits does not match the number of documents. Expected %d, got %d"
+                % (num_docs, n_hits)
+            )
 
-    if n_hits != num_docs:
-        raise RuntimeError(
-            "Number of hits does not match the number of documents. Expected %d, got %d"
-            % (num_docs, n_hits)
+        reporter.message.remote(  # type: ignore
+            f"OK: The number of fetched variants ({n_hits}) equals the number expected ({num_docs})"
         )
 
-    reporter.message.remote(  # type: ignore
-        f"OK: The number of fetched variants ({n_hits}) equals the number expected ({num_docs})"
-    )
+        outputs, n_results = filter_annotation_and_dosage_matrix(
+            job_data=job_data,
+            reporter=reporter,
+            doc_ids_sorted=doc_ids_sorted,
+            loci_sorted=loci_sorted,
+            n_hits=n_hits,
+            queue_config_path=queue_config_path,
+        )
+    finally:
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # The pending reports are written before the job's completion message is sent
+    ray.get(reporter.flush.remote())  # type: ignore
+    _log_progress_stats("the save", [ray.get(reporter.get_stats.remote())])  # type: ignore
+    count("variants_saved", n_results)
+    return outputs, n_results
+
 
-    outputs = filter_annotation_and_dosage_matrix(
+async def go(  # pylint:disable=invalid-name
+    job_data: SaveJobData, search_conf: dict, publisher: ProgressPublisher, queue_config_path: str
+) -> AnnotationOutputs:
+    """Main function for running the query and writing the output"""
+    search_client_args = gather_opensearch_args(search_conf)
+    client = OpenSearch(**search_client_args)
+
+    query = _clean_query(job_data.query_body)
+
+    # Saves of the same query and pipeline, of the same build of the index, have the same outputs
+    cache = SaveResultCache.from_env()
+    cache_key = None
+    index_uuids = get_index_uuids(client, job_data.index_name) if cache is not None else None
+    if cache is not None and index_uuids is not None:
+        cache.invalidate_index(job_data.index_name, index_uuids)
+        cache_key = save_cache_key(job_data, query, index_uuids)
+
+        outputs = _materialize_cached_result(cache, cache_key, job_data, publisher)
+        if outputs is not None:
+            client.close()
+            return outputs
+
+    outputs, n_results = _save(
         job_data=job_data,
-        reporter=reporter,
-        doc_ids_sorted=doc_ids_sorted,
-        loci_sorted=loci_sorted,
-        n_hits=n_hits,
+        search_client_args=search_client_args,
+        client=client,
+        query=query,
+        publisher=publisher,
         queue_config_path=queue_config_path,
     )
 
+    if cache is not None and cache_key is not None and index_uuids is not None:
+        cache.store(
+            cache_key,
+            output_dir=os.path.dirname(job_data.output_base_path),
+            basename=os.path.basename(job_data.output_base_path),
+            outputs=outputs,
+            index_name=job_data.index_name,
+            index_uuids=index_uuids,
+            n_variants=n_results,
+        )
+
     return outputs
@@ -0,0 +1,475 @@
+"""
+Compact, on-disk storage of search hits for bounded-memory saves.
+
+A search hit is a document id, which is the row index of the variant in the parent annotation,
+and the variant's locus, `chrom:pos:ref:alt`. Rather than holding loci as Python strings,
+`PackedLoci` stores them as a chromosome code, a uint32 position, and offsets into a byte buffer
+of concatenated reference and alternate alleles.
+
+`AsyncQueryProcessor` actors write sorted runs of hits to disk with `write_hit_run`, and the
+driver combines them with `merge_hit_runs`, a k-way merge whose memory use is bounded by a
+configurable budget rather than by the number of hits. Runs are single files that are read
+through memory maps, so the merged hits can be consumed without being loaded into memory.
+"""
+
+import json
+import os
+from typing import Iterable
+
+import numpy as np
+from numpy.typing import NDArray
+
+_MAGIC = b"BYSTROHR"
+_VERSION = 1
+_ALIGNMENT = 8
+
+# Approximate bytes held in memory per hit during a merge:
+# the doc id, chromosome code, position, and allele offsets, their sort keys, and a few alleles
+MERGE_BYTES_PER_HIT = 64
+
+
+class PackedLoci:
+    """
+    Loci stored as parallel arrays
+
+    The reference allele of locus `i` is `alleles[allele_offsets[2 * i]:allele_offsets[2 * i + 1]]`,
+    and its alternate allele is `alleles[allele_offsets[2 * i + 1]:allele_offsets[2 * i + 2]]`.
+
+    Attributes:
+        chroms: list[str]
+            The chromosome names that `chrom_codes` index into
+        chrom_codes: NDArray[np.uint16]
+            The index of each locus' chromosome in `chroms`
+        positions: NDArray[np.uint32]
+            The position of each locus
+        allele_offsets: NDArray[np.int64]
+            Offsets into `alleles`, of length `2 * len(self) + 1`
+        alleles: NDArray[np.uint8]
+            The concatenated reference and alternate alleles
+    """
+
+    __slots__ = ("chroms", "chrom_codes", "positions", "allele_offsets", "alleles")
+
+    def __init__(
+        self,
+        chroms: list[str],
+        chrom_codes: NDArray[np.uint16],
+        positions: NDArray[np.uint32],
+        allele_offsets: NDArray[np.int64],
+        alleles: NDArray[np.uint8],
+    ):
+        if len(allele_offsets) != 2 * len(chrom_codes) + 1:
+            raise ValueError("allele_offsets must have 2 * len(chrom_codes) + 1 entries")
+
+        if len(positions) != len(chrom_codes):
+            raise ValueError("positions and chrom_codes must have the same length")
+
+        self.chroms = chroms
+        self.chrom_codes = chrom_codes
+        self.positions = positions
+        self.allele_offsets = allele_offsets
+        self.alleles = alleles
+
+    @staticmethod
+    def from_fields(
+        chroms: Iterable[str], positions: Iterable[int], refs: Iterable[str], alts: Iterable[str]
+    ) -> "PackedLoci":
+        """Pack loci given as parallel sequences of chromosome, position, reference and alternate"""
+        chrom_table: dict[str, int] = {}
+        chrom_codes = np.array(
+            [chrom_table.setdefault(chrom, len(chrom_table)) for chrom in chroms], dtype=np.uint16
+        )
+        positions_np = np.array(list(positions), dtype=np.uint32)
+
+        alleles: list[bytes] = []
+        for ref, alt in zip(refs, alts):
+            alleles.append(ref.encode("ascii"))
+            alleles.append(alt.encode("ascii"))
+
+        if len(alleles) != 2 * len(chrom_codes):
+            raise ValueError("chroms, refs and alts must have the same length")
+
+        allele_offsets = np.zeros(len(alleles) + 1, dtype=np.int64)
+        np.cumsum([len(allele) for allele in alleles], out=allele_offsets[1:])
+
+        return PackedLoci(
+            chroms=list(chrom_table),
+            chrom_codes=chrom_codes,
+            positions=positions_np,
+            allele_offsets=allele_offsets,
+            alleles=np.frombuffer(b"".join(alleles), dtype=np.uint8),
+        )
+
+    @staticmethod
+    def empty() -> "PackedLoci":
+        return PackedLoci(
+            chroms=[],
+            chrom_codes=np.array([], dtype=np.uint16),
+            positions=np.array([], dtype=np.uint32),
+            allele_offsets=np.zeros(1, dtype=np.int64),
+            alleles=np.array([], dtype=np.uint8),
+        )
+
+    def __len__(self) -> int:
+        return len(self.chrom_codes)
+
+    def __getitem__(self, key: slice | NDArray) -> "PackedLoci":
+        """
+        Select loci by a slice with step 1, which returns a view,
+        or by an integer index array or boolean mask, which returns a compacted copy
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Only slices with a step of 1 are supported")
+            stop = max(start, stop)
+
+            return PackedLoci(
+                chroms=self.chroms,
+                chrom_codes=self.chrom_codes[start:stop],
+                positions=self.positions[start:stop],
+                allele_offsets=self.allele_offsets[2 * start : 2 * stop + 1],
+                alleles=self.alleles,
+            )
+
+        indices = np.asarray(key)
+        if indices.dtype == np.bool_:
+            indices = np.flatnonzero(indices)
+
+        allele_offsets, alleles = _gather_alleles(self.allele_offsets, self.alleles, indices)
+
+        return PackedLoci(
+            chroms=self.chroms,
+            chrom_codes=self.chrom_codes[indices],
+            positions=self.positions[indices],
+            allele_offsets=allele_offsets,
+            alleles=alleles,
+        )
+
+    def tolist(self) -> list[str]:
+        """Format the loci as `chrom:pos:ref:alt` strings"""
+        if len(self) == 0:
+            return []
+
+        base = int(self.allele_offsets[0])
+        alleles = self.alleles[base : int(self.allele_offsets[-1])].tobytes().decode("ascii")
+        offsets = (self.allele_offsets - base).tolist()
+        chroms = self.chroms
+
+        return [
+            f"{chroms[code]}:{pos}:{alleles[offsets[2 * i] : offsets[2 * i + 1]]}:"
+            f"{alleles[offsets[2 * i + 1] : offsets[2 * i + 2]]}"
+            for i, (code, pos) in enumerate(zip(self.chrom_codes.tolist(), self.positions.tolist()))
+        ]
+
+
+def _gather_alleles(
+    allele_offsets: NDArray[np.int64], alleles: NDArray[np.uint8], indices: NDArray
+) -> tuple[NDArray[np.int64], NDArray[np.uint8]]:
+    """Copy the alleles of the loci at `indices` into a new, compact allele buffer"""
+    src_starts = allele_offsets[2 * indices]
+    lengths = allele_offsets[2 * indices + 2] - src_starts
+
+    # Each locus' reference and alternate alleles are adjacent, so we copy them together
+    out_locus_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=out_locus_offsets[1:])
+
+    gather = np.repeat(src_starts - out_locus_offsets[:-1], lengths) + np.arange(
+        out_locus_offsets[-1], dtype=np.int64
+    )
+
+    out_offsets = np.empty(2 * len(indices) + 1, dtype=np.int64)
+    out_offsets[0:-1:2] = out_locus_offsets[:-1]
+    out_offsets[1::2] = out_locus_offsets[:-1] + (allele_offsets[2 * indices + 1] - src_starts)
+    out_offsets[-1] = out_locus_offsets[-1]
+
+    return out_offsets, alleles[gather]
+
+
+class HitRun:
+    """
+    A run of hits, sorted by document id, stored in a single memory-mapped file
+
+    Attributes:
+        path: str
+            Path of the run file
+        doc_ids: NDArray[np.int32]
+            Sorted document ids
+        loci: PackedLoci
+            The locus of each document
+    """
+
+    __slots__ = ("path", "doc_ids", "loci")
+
+    def __init__(self, path: str, doc_ids: NDArray[np.int32], loci: PackedLoci):
+        self.path = path
+        self.doc_ids = doc_ids
+        self.loci = loci
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @staticmethod
+    def from_path(path: str) -> "HitRun":
+        header, offsets = _read_header(path)
+        n_hits = header["n_hits"]
+        n_allele_bytes = header["n_allele_bytes"]
+
+        def _map(name: str, dtype, length: int):
+            if length == 0:
+                return np.array([], dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode="r", offset=offsets[name], shape=(length,))
+
+        loci = PackedLoci(
+            chroms=header["chroms"],
+            chrom_codes=_map("chrom_codes", np.uint16, n_hits),
+            positions=_map("positions", np.uint32, n_hits),
+            allele_offsets=_map("allele_offsets", np.int64, 2 * n_hits + 1),
+            alleles=_map("alleles", np.uint8, n_allele_bytes),
+        )
+
+        return HitRun(path, _map("doc_ids", np.int32, n_hits), loci)
+
+
+_ARRAY_LAYOUT: list[tuple[str, np.dtype]] = [
+    ("doc_ids", np.dtype(np.int32)),
+    ("chrom_codes", np.dtype(np.uint16)),
+    ("positions", np.dtype(np.uint32)),
+    ("allele_offsets", np.dtype(np.int64)),
+    ("alleles", np.dtype(np.uint8)),
+]
+
+
+def _layout(header_bytes: bytes, n_hits: int, n_allele_bytes: int) -> tuple[dict[str, int], int]:
+    """Get the byte offset of each array in a run file, and the total file size"""
+    lengths = {
+        "doc_ids": n_hits,
+        "chrom_codes": n_hits,
+        "positions": n_hits,
+        "allele_offsets": 2 * n_hits + 1,
+        "alleles": n_allele_bytes,
+    }
+
+    offset = len(_MAGIC) + 8 + len(header_bytes)
+    offsets = {}
+    for name, dtype in _ARRAY_LAYOUT:
+        offset += -offset % _ALIGNMENT
+        offsets[name] = offset
+        offset += lengths[name] * dtype.itemsize
+
+    return offsets, offset
+
+
+def _encode_header(n_hits: int, n_allele_bytes: int, chroms: list[str]) -> bytes:
+    return json.dumps(
+        {"version": _VERSION, "n_hits": n_hits, "n_allele_bytes": n_allele_bytes, "chroms": chroms}
+    ).encode("utf-8")
+
+
+def _read_header(path: str) -> tuple[dict, dict[str, int]]:
+    with open(path, "rb") as fh:
+        magic = fh.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a hit run file")
+
+        header_length = int.from_bytes(fh.read(8), "little")
+        header_bytes = fh.read(header_length)
+
+    header = json.loads(header_bytes)
+    if header.get("version") != _VERSION:
+        raise ValueError(f"Unsupported hit run version {header.get('version')} in {path}")
+
+    offsets, _ = _layout(header_bytes, header["n_hits"], header["n_allele_bytes"])
+    return header, offsets
+
+
+def _create_run_file(
+    path: str, n_hits: int, n_allele_bytes: int, chroms: list[str]
+) -> dict[str, NDArray]:
+    """Create a run file of the given size, returning writable maps of its arrays"""
+    header_bytes = _encode_header(n_hits, n_allele_bytes, chroms)
+    offsets, size = _layout(header_bytes, n_hits, n_allele_bytes)
+
+    with open(path, "wb") as fh:
+        fh.write(_MAGIC)
+        fh.write(len(header_bytes).to_bytes(8, "little"))
+        fh.write(header_bytes)
+        fh.truncate(size)
+
+    lengths = {
+        "doc_ids": n_hits,
+        "chrom_codes": n_hits,
+        "positions": n_hits,
+        "allele_offsets": 2 * n_hits + 1,
+        "alleles": n_allele_bytes,
+    }
+
+    arrays: dict[str, NDArray] = {}
+    for name, dtype in _ARRAY_LAYOUT:
+        if lengths[name] == 0:
+            arrays[name] = np.empty(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r+", offset=offsets[name], shape=(lengths[name],)
+            )
+
+    return arrays
+
+
+def write_hit_run(path: str, doc_ids: NDArray[np.int32], loci: PackedLoci) -> int:
+    """
+    Sort hits by document id and write them to `path` as a run file
+
+    Returns:
+        int: The number of hits written
+    """
+    if len(doc_ids) != len(loci):
+        raise ValueError("doc_ids and loci must have the same length")
+
+    order = np.argsort(doc_ids, kind="stable")
+    sorted_loci = loci[order]
+
+    n_allele_bytes = int(sorted_loci.allele_offsets[-1])
+    arrays = _create_run_file(path, len(doc_ids), n_allele_bytes, sorted_loci.chroms)
+
+    arrays["doc_ids"][:] = doc_ids[order]
+    arrays["chrom_codes"][:] = sorted_loci.chrom_codes
+    arrays["positions"][:] = sorted_loci.positions
+    arrays["allele_offsets"][:] = sorted_loci.allele_offsets
+    arrays["alleles"][:] = sorted_loci.alleles
+
+    for array in arrays.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    return len(doc_ids)
+
+
+def merge_hit_runs(run_paths: list[str], out_path: str, memory_budget: int) -> HitRun:
+    """
+    Merge sorted hit runs into a single sorted run at `out_path`
+
+    At most roughly `memory_budget` bytes of hits are held in memory at once,
+    regardless of the number of hits: each run is consumed in windows whose size
+    is the budget divided evenly among the runs.
+
+    Args:
+        run_paths (list[str]): Paths of the runs to merge
+        out_path (str): Path of the merged run
+        memory_budget (int): The approximate number of bytes of hits to hold in memory
+
+    Returns:
+        HitRun: The merged run, memory-mapped from `out_path`
+    """
+    runs = [HitRun.from_path(path) for path in run_paths]
+    runs = [run for run in runs if len(run) > 0]
+
+    chrom_remaps: list[NDArray[np.uint16]] = []
+    chrom_table: dict[str, int] = {}
+    for run in runs:
+        chrom_remaps.append(
+            np.array(
+                [chrom_table.setdefault(chrom, len(chrom_table)) for chrom in run.loci.chroms],
+                dtype=np.uint16,
+            )
+        )
+    chroms = list(chrom_table)
+
+    n_hits = sum(len(run) for run in runs)
+    n_allele_bytes = sum(int(run.loci.allele_offsets[-1]) for run in runs)
+    out = _create_run_file(out_path, n_hits, n_allele_bytes, chroms)
+
+    window = max(1, memory_budget // (MERGE_BYTES_PER_HIT * max(len(runs), 1)))
+    cursors = [0] * len(runs)
+
+    out_hit = 0
+    out_allele = 0
+    while out_hit < n_hits:
+        # Hits at or below the bound can be emitted: every run's next unread hit is above it
+        bound = None
+        for run, cursor in zip(runs, cursors):
+            end = cursor + window
+            if end < len(run):
+                last = int(run.doc_ids[end - 1])
+                bound = last if bound is None else min(bound, last)
+
+        doc_id_parts = []
+        loci_parts = []
+        for i, (run, cursor) in enumerate(zip(runs, cursors)):
+            if cursor >= len(run):
+                continue
+
+            end = min(cursor + window, len(run))
+            doc_ids = np.asarray(run.doc_ids[cursor:end])
+            if bound is not None:
+                end = cursor + int(np.searchsorted(doc_ids, bound, side="right"))
+                doc_ids = doc_ids[: end - cursor]
+
+            if end == cursor:
+                continue
+
+            loci = run.loci[cursor:end]
+            base = int(loci.allele_offsets[0])
+            doc_id_parts.append(doc_ids)
+            loci_parts.append(
+                PackedLoci(
+                    chroms=chroms,
+                    chrom_codes=chrom_remaps[i][np.asarray(loci.chrom_codes)],
+                    positions=np.asarray(loci.positions),
+                    allele_offsets=np.asarray(loci.allele_offsets) - base,
+                    alleles=np.asarray(loci.alleles[base : int(loci.allele_offsets[-1])]),
+                )
+            )
+            cursors[i] = end
+
+        batch_doc_ids = np.concatenate(doc_id_parts)
+        batch_loci = _concatenate_loci(loci_parts, chroms)
+
+        order = np.argsort(batch_doc_ids, kind="stable")
+        batch_loci = batch_loci[order]
+        n_batch = len(order)
+        n_batch_alleles = int(batch_loci.allele_offsets[-1])
+
+        out["doc_ids"][out_hit : out_hit + n_batch] = batch_doc_ids[order]
+        out["chrom_codes"][out_hit : out_hit + n_batch] = batch_loci.chrom_codes
+        out["positions"][out_hit : out_hit + n_batch] = batch_loci.positions
+        out["allele_offsets"][2 * out_hit : 2 * (out_hit + n_batch) + 1] = (
+            batch_loci.allele_offsets + out_allele
+        )
+        out["alleles"][out_allele : out_allele + n_batch_alleles] = batch_loci.alleles
+
+        out_hit += n_batch
+        out_allele += n_batch_alleles
+
+    for array in out.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+    del out
+
+    return HitRun.from_path(out_path)
+
+
+def _concatenate_loci(parts: list[PackedLoci], chroms: list[str]) -> PackedLoci:
+    """Concatenate compact loci that share the same chromosome table"""
+    if len(parts) == 0:
+        return PackedLoci.empty()
+
+    allele_offsets = [parts[0].allele_offsets]
+    allele_base = int(parts[0].allele_offsets[-1])
+    for part in parts[1:]:
+        allele_offsets.append(part.allele_offsets[1:] + allele_base)
+        allele_base += int(part.allele_offsets[-1])
+
+    return PackedLoci(
+        chroms=chroms,
+        chrom_codes=np.concatenate([part.chrom_codes for part in parts]),
+        positions=np.concatenate([part.positions for part in parts]),
+        allele_offsets=np.concatenate(allele_offsets),
+        alleles=np.concatenate([part.alleles for part in parts]),
+    )
+
+
+def remove_hit_runs(run_paths: Iterable[str]) -> None:
+    for path in run_paths:
+        if os.path.exists(path):
+            os.remove(path)
@@ -2,8 +2,12 @@ import logging
 from typing import Callable
 
 from msgspec import Struct
+import numpy as np
+from numpy.typing import NDArray
 from scipy.stats import chi2  # type: ignore
-from bystro.search.save.c_hwe import drop_row_if_out_of_hwe  # type: ignore
+from bystro.search.save.batch_filter import BatchFilter, ColumnBatch
+from bystro.search.save.block_reader import parse_float_field
+from bystro.search.save.c_hwe import drop_row_if_out_of_hwe, drop_rows_if_out_of_hwe  # type: ignore
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +38,11 @@ class HWEFilter(
     num_samples: int
     crit_value: float | None = 0.025
 
-    def make_filter(self, header_fields: list[bytes]) -> FilterFunctionType | None:
+    def _prepare(self, header_fields: list[bytes]) -> tuple[float, float, list[int]] | None:
+        """
+        Get the chi2 critical value, number of samples, and the indices of the
+        missingness, sampleMaf, heterozygosity, and homozygosity columns
+        """
         if self.num_samples <= 0:
             logger.warning(
                 "To perform the HWE filter, number of samples must be greater than 0, got %s",
@@ -64,6 +72,21 @@ class HWEFilter(
         if homozygosity_idx == -1:
             raise ValueError("homozygosity column not found in header")
 
+        return (
+            chi2_crit,
+            n_samples,
+            [missingness_idx, sample_maf_idx, heterozygosity_idx, homozygosity_idx],
+        )
+
+    def make_filter(self, header_fields: list[bytes]) -> FilterFunctionType | None:
+        params = self._prepare(header_fields)
+
+        if params is None:
+            return None
+
+        chi2_crit, n_samples, fields = params
+        [missingness_idx, sample_maf_idx, heterozygosity_idx, homozygosity_idx] = fields
+
         def filter_function(row: list[bytes]) -> bool:
             return drop_row_if_out_of_hwe(
                 chi2_crit=chi2_crit,
@@ -75,3 +98,24 @@ class HWEFilter(
             )
 
         return filter_function
+
+    def make_batch_filter(self, header_fields: list[bytes]) -> BatchFilter | None:
+        params = self._prepare(header_fields)
+
+        if params is None:
+            return None
+
+        chi2_crit, n_samples, fields = params
+        [missingness_idx, sample_maf_idx, heterozygosity_idx, homozygosity_idx] = fields
+
+        def keep(columns: ColumnBatch) -> NDArray[np.bool_]:
+            return ~drop_rows_if_out_of_hwe(
+                chi2_crit,
+                n_samples,
+                parse_float_field(columns[missingness_idx]),
+                parse_float_field(columns[sample_maf_idx]),
+                parse_float_field(columns[heterozygosity_idx]),
+                parse_float_field(columns[homozygosity_idx]),
+            )
+
+        return BatchFilter(fields=fields, keep=keep)
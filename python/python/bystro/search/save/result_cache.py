@@ -0,0 +1,322 @@
+"""
+Cache the outputs of save jobs, to reuse them when the same search is saved again
+
+Users often re-run the same search and save while iterating on downstream analyses.
+A save's outputs are determined by the index searched, the query, and the filter pipeline,
+so those, cleaned of options that don't affect which variants are saved, are hashed into a key.
+When a save's key is cached, its outputs are hard-linked (or, across filesystems, copied)
+from the cache, rather than fetching the hits and filtering the annotation and dosage matrix again.
+
+The key includes the uuid of every searched index, which changes when the index is rebuilt,
+so entries of a rebuilt index are never used, and are removed by `invalidate_index`.
+Entries are evicted least recently used first, to keep the cache within its size limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any
+
+import msgspec
+from msgspec import Struct
+
+from bystro.search.utils.annotation import AnnotationOutputs
+from bystro.search.utils.messages import SaveJobData
+from bystro.utils.bgzf import GZI_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# The directory to cache save results in; results are not cached when this is not set
+SAVE_RESULT_CACHE_DIR = os.getenv("SAVE_RESULT_CACHE_DIR")
+# The maximum total size of the cached results, in gigabytes
+SAVE_RESULT_CACHE_MAX_GB = float(os.getenv("SAVE_RESULT_CACHE_MAX_GB", 100))
+
+_VERSION = 1
+_ENTRY_FILE = "entry.json"
+_RESULT_BASENAME = "result"
+_TMP_PREFIX = ".tmp-"
+
+
+class CacheEntry(Struct, frozen=True):
+    """
+    A cached save result
+
+    Attributes:
+        index_name: str
+            The name of the searched index, or index pattern
+        index_uuids: list[str]
+            The sorted uuids of the indices searched
+        suffixes: list[str]
+            The names of the cached output files, after the save's basename
+        size: int
+            The total size of the cached output files, in bytes
+        n_variants: int
+            The number of variants saved
+    """
+
+    index_name: str
+    index_uuids: list[str]
+    suffixes: list[str]
+    size: int
+    n_variants: int
+
+
+def get_index_uuids(client, index_name: str) -> list[str] | None:
+    """Get the sorted uuids of the indices matching `index_name`, or None if they can't be read"""
+    try:
+        response: dict[str, Any] = client.indices.get_settings(index=index_name)
+    except Exception as e:
+        logger.warning("Failed to read settings of index %s, not using the cache: %s", index_name, e)
+        return None
+
+    uuids = [
+        index_settings.get("settings", {}).get("index", {}).get("uuid")
+        for index_settings in response.values()
+    ]
+    if len(uuids) == 0 or None in uuids:
+        return None
+
+    return sorted(uuids)
+
+
+def save_cache_key(job_data: SaveJobData, cleaned_query: dict, index_uuids: list[str]) -> str:
+    """
+    Hash the parts of a save job that determine its outputs
+
+    Args:
+        job_data (SaveJobData): The save job
+        cleaned_query (dict): The job's query, cleaned by `_clean_query`
+        index_uuids (list[str]): The uuids of the indices searched
+
+    Returns:
+        str: The hex digest of the key
+    """
+    key = {
+        "version": _VERSION,
+        "index_name": job_data.index_name,
+        "index_uuids": sorted(index_uuids),
+        "query": cleaned_query,
+        "pipeline": msgspec.to_builtins(job_data.pipeline),
+        "annotation": os.path.join(job_data.input_dir, job_data.input_file_names.annotation),
+        "dosage_matrix": os.path.join(
+            job_data.input_dir, job_data.input_file_names.dosage_matrix_out_path
+        ),
+    }
+
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def _output_files(outputs: AnnotationOutputs) -> list[str]:
+    """The files written by a save, which are all named after the save's basename"""
+    files = [
+        outputs.annotation,
+        outputs.annotation + GZI_SUFFIX,
+        outputs.statistics.json,
+        outputs.statistics.tab,
+        outputs.statistics.qc,
+        outputs.dosage_matrix_out_path,
+    ]
+
+    if outputs.row_index is not None:
+        files.append(outputs.row_index)
+
+    return files
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class SaveResultCache:
+    """
+    A directory of cached save results, one subdirectory per key
+
+    Args:
+        cache_dir (str): The cache directory, created if it doesn't exist
+        max_size (int): The maximum total size of the cached results, in bytes
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def from_env() -> "SaveResultCache | None":
+        """The cache configured by SAVE_RESULT_CACHE_DIR, or None if caching is not enabled"""
+        if not SAVE_RESULT_CACHE_DIR:
+            return None
+
+        return SaveResultCache(SAVE_RESULT_CACHE_DIR, int(SAVE_RESULT_CACHE_MAX_GB * 1024**3))
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _read_entry(self, entry_dir: str) -> CacheEntry | None:
+        try:
+            with open(os.path.join(entry_dir, _ENTRY_FILE), "rb") as fh:
+                return msgspec.json.decode(fh.read(), type=CacheEntry)
+        except (OSError, msgspec.DecodeError):
+            return None
+
+    def _entries(self) -> list[tuple[str, CacheEntry, float]]:
+        """Every complete entry, with the time it was last used"""
+        entries = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.is_dir() or dir_entry.name.startswith(_TMP_PREFIX):
+                continue
+
+            entry = self._read_entry(dir_entry.path)
+            if entry is None:
+                continue
+
+            try:
+                last_used = os.stat(os.path.join(dir_entry.path, _ENTRY_FILE)).st_mtime
+            except OSError:
+                continue
+
+            entries.append((dir_entry.path, entry, last_used))
+
+        return entries
+
+    def _remove(self, entry_dir: str) -> None:
+        # Rename first, so that the entry disappears at once for concurrent readers
+        tmp_dir = os.path.join(
+            self.cache_dir, f"{_TMP_PREFIX}evict-{os.path.basename(entry_dir)}-{os.getpid()}"
+        )
+        try:
+            os.rename(entry_dir, tmp_dir)
+        except OSError:
+            return
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def materialize(self, key: str, output_dir: str, basename: str) -> CacheEntry | None:
+        """
+        Write the cached outputs for `key` into `output_dir`, named after `basename`
+
+        Returns:
+            CacheEntry | None: The entry, or None if `key` is not cached
+        """
+        entry_dir = self._entry_dir(key)
+        entry = self._read_entry(entry_dir)
+        if entry is None:
+            return None
+
+        os.makedirs(output_dir, exist_ok=True)
+        written: list[str] = []
+        try:
+            for suffix in entry.suffixes:
+                dst = os.path.join(output_dir, basename + suffix)
+                _link_or_copy(os.path.join(entry_dir, _RESULT_BASENAME + suffix), dst)
+                written.append(dst)
+
+            # The entry's modification time is its last use, for eviction
+            os.utime(os.path.join(entry_dir, _ENTRY_FILE))
+        except OSError as e:
+            # The entry may have been evicted while we were reading it
+            logger.warning("Failed to materialize cached save result %s: %s", key, e)
+            for path in written:
+                os.remove(path)
+            return None
+
+        return entry
+
+    def store(
+        self,
+        key: str,
+        output_dir: str,
+        basename: str,
+        outputs: AnnotationOutputs,
+        index_name: str,
+        index_uuids: list[str],
+        n_variants: int,
+    ) -> None:
+        """Cache the outputs of a save, then evict entries to keep the cache within its size limit"""
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        tmp_dir = os.path.join(self.cache_dir, f"{_TMP_PREFIX}{key}-{os.getpid()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        try:
+            suffixes: list[str] = []
+            size = 0
+            for name in _output_files(outputs):
+                path = os.path.join(output_dir, name)
+                if not name.startswith(basename) or not os.path.isfile(path):
+                    continue
+
+                suffix = name[len(basename) :]
+                _link_or_copy(path, os.path.join(tmp_dir, _RESULT_BASENAME + suffix))
+                suffixes.append(suffix)
+                size += os.stat(path).st_size
+
+            entry = CacheEntry(
+                index_name=index_name,
+                index_uuids=sorted(index_uuids),
+                suffixes=suffixes,
+                size=size,
+                n_variants=n_variants,
+            )
+            with open(os.path.join(tmp_dir, _ENTRY_FILE), "wb") as fh:
+                fh.write(msgspec.json.encode(entry))
+
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another save of the same key may have stored it first, in which case we keep theirs
+            if not os.path.exists(entry_dir):
+                logger.warning("Failed to cache save result %s: %s", key, e)
+            return
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        logger.info("Cached save result %s (%d bytes)", key, size)
+
+        self.evict()
+
+    def invalidate_index(self, index_name: str, index_uuids: list[str]) -> int:
+        """Remove the entries of `index_name` made before it was rebuilt, returning how many"""
+        index_uuids = sorted(index_uuids)
+
+        n_removed = 0
+        for entry_dir, entry, _ in self._entries():
+            if entry.index_name == index_name and entry.index_uuids != index_uuids:
+                self._remove(entry_dir)
+                n_removed += 1
+
+        if n_removed > 0:
+            logger.info("Removed %d cached save results of rebuilt index %s", n_removed, index_name)
+
+        return n_removed
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache is within its size limit"""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_size = sum(entry.size for _, entry, _ in entries)
+
+        n_removed = 0
+        for entry_dir, entry, _ in entries:
+            if total_size <= self.max_size:
+                break
+
+            self._remove(entry_dir)
+            total_size -= entry.size
+            n_removed += 1
+
+        if n_removed > 0:
+            logger.info("Evicted %d cached save results; %d bytes remain cached", n_removed, total_size)
+
+        return n_removed
@@ -0,0 +1,322 @@
+"""
+A sidecar index from annotation rows to their byte offsets in the uncompressed annotation.
+
+Search document ids are annotation row numbers (excluding the header). The row index records
+the uncompressed offset of every `stride`-th row, and, for BGZF annotations, the offsets of the
+block holding that row, so the rows around any document id can be located without reading the
+rows before them. Together with the `.gzi` index of a BGZF annotation, this lets us decompress
+only the blocks holding search hits.
+
+Row indices are written alongside saved annotations, as `AnnotationOutputs.row_index`,
+and alongside annotator outputs when they are indexed for search, by `write_annotation_row_index`.
+"""
+
+import gzip
+import os
+from typing import IO, Any
+
+import numpy as np
+from numpy.typing import NDArray
+
+from bystro.search.save.block_reader import iter_row_blocks
+from bystro.utils.bgzf import GZI_SUFFIX, read_gzi
+
+ROW_INDEX_SUFFIX = ".rowidx"
+# Every ROW_INDEX_STRIDE-th row's offset is recorded in the index
+ROW_INDEX_STRIDE = int(os.getenv("ANNOTATION_ROW_INDEX_STRIDE", 4096))
+
+_VERSION = 2
+
+
+def annotation_fingerprint(annotation_path: str) -> NDArray[np.int64]:
+    """
+    The size and modification time, in nanoseconds, of an annotation, and the size of its `.gzi` index,
+    or -1 if it has none, which change when the annotation is regenerated
+    """
+    stat = os.stat(annotation_path)
+    gzi_path = annotation_path + GZI_SUFFIX
+    gzi_size = os.stat(gzi_path).st_size if os.path.exists(gzi_path) else -1
+
+    return np.array([stat.st_size, stat.st_mtime_ns, gzi_size], dtype=np.int64)
+
+
+class RowIndex:
+    """
+    Offsets of every `stride`-th row of an uncompressed annotation
+
+    Attributes:
+        stride: int
+            The number of rows between recorded offsets
+        n_rows: int
+            The number of rows in the annotation, excluding the header
+        row_offsets: NDArray[np.int64]
+            The offset of rows `0, stride, 2 * stride, ...`,
+            followed by the offset of the end of the data
+        block_offsets: NDArray[np.int64] | None
+            For BGZF annotations, the compressed offset of the block holding each of `row_offsets`
+        block_data_offsets: NDArray[np.int64] | None
+            For BGZF annotations, the uncompressed offset of the block holding each of `row_offsets`
+        fingerprint: NDArray[np.int64] | None
+            The `annotation_fingerprint` of the annotation the index was built from, if recorded
+    """
+
+    __slots__ = (
+        "stride",
+        "n_rows",
+        "row_offsets",
+        "block_offsets",
+        "block_data_offsets",
+        "fingerprint",
+    )
+
+    def __init__(
+        self,
+        stride: int,
+        n_rows: int,
+        row_offsets: NDArray[np.int64],
+        block_offsets: NDArray[np.int64] | None = None,
+        block_data_offsets: NDArray[np.int64] | None = None,
+        fingerprint: NDArray[np.int64] | None = None,
+    ):
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+
+        if len(row_offsets) != -(-n_rows // stride) + 1:
+            raise ValueError("row_offsets must have ceil(n_rows / stride) + 1 entries")
+
+        if (block_offsets is None) != (block_data_offsets is None):
+            raise ValueError("block_offsets and block_data_offsets must be given together")
+
+        if block_offsets is not None and not (
+            len(block_offsets) == len(block_data_offsets) == len(row_offsets)  # type: ignore
+        ):
+            raise ValueError("block_offsets and block_data_offsets must be as long as row_offsets")
+
+        self.stride = stride
+        self.n_rows = n_rows
+        self.row_offsets = row_offsets
+        self.block_offsets = block_offsets
+        self.block_data_offsets = block_data_offsets
+        self.fingerprint = fingerprint
+
+    @property
+    def header_size(self) -> int:
+        """The size of the header, which precedes the first row"""
+        return int(self.row_offsets[0])
+
+    @property
+    def data_size(self) -> int:
+        """The size of the uncompressed annotation, including the header"""
+        return int(self.row_offsets[-1])
+
+    @staticmethod
+    def from_path(path: str) -> "RowIndex":
+        with np.load(path, allow_pickle=False) as npz:
+            version = int(npz["version"])
+            if version != _VERSION:
+                raise ValueError(f"Unsupported row index version {version} in {path}")
+
+            has_blocks = "block_offsets" in npz.files
+            has_fingerprint = "fingerprint" in npz.files
+            return RowIndex(
+                stride=int(npz["stride"]),
+                n_rows=int(npz["n_rows"]),
+                row_offsets=npz["row_offsets"].astype(np.int64),
+                block_offsets=npz["block_offsets"].astype(np.int64) if has_blocks else None,
+                block_data_offsets=(npz["block_data_offsets"].astype(np.int64) if has_blocks else None),
+                fingerprint=npz["fingerprint"].astype(np.int64) if has_fingerprint else None,
+            )
+
+    def write(self, path: str) -> None:
+        payload: dict[str, Any] = {
+            "version": _VERSION,
+            "stride": self.stride,
+            "n_rows": self.n_rows,
+            "row_offsets": self.row_offsets,
+        }
+        if self.block_offsets is not None and self.block_data_offsets is not None:
+            payload["block_offsets"] = self.block_offsets
+            payload["block_data_offsets"] = self.block_data_offsets
+        if self.fingerprint is not None:
+            payload["fingerprint"] = self.fingerprint
+
+        # Written to a temporary file first, since saves may read the index of a parent annotation
+        # while another save writes it. np.savez appends .npz to paths, but not to open files
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, **payload)
+        os.replace(tmp_path, path)
+
+    def with_blocks(self, gzi_path: str) -> "RowIndex":
+        """Add the offsets of the BGZF blocks holding each indexed row, using the `.gzi` index"""
+        compressed, uncompressed = read_gzi(gzi_path)
+        blocks = np.searchsorted(uncompressed, self.row_offsets, side="right") - 1
+
+        return RowIndex(
+            stride=self.stride,
+            n_rows=self.n_rows,
+            row_offsets=self.row_offsets,
+            block_offsets=compressed[blocks],
+            block_data_offsets=uncompressed[blocks],
+            fingerprint=self.fingerprint,
+        )
+
+    def with_fingerprint(self, annotation_path: str) -> "RowIndex":
+        """Record the `annotation_fingerprint` of the annotation the index describes"""
+        return RowIndex(
+            stride=self.stride,
+            n_rows=self.n_rows,
+            row_offsets=self.row_offsets,
+            block_offsets=self.block_offsets,
+            block_data_offsets=self.block_data_offsets,
+            fingerprint=annotation_fingerprint(annotation_path),
+        )
+
+    def describes(self, annotation_path: str) -> bool:
+        """Whether the index was built from the annotation as it is now, rather than an earlier one"""
+        return self.fingerprint is not None and np.array_equal(
+            self.fingerprint, annotation_fingerprint(annotation_path)
+        )
+
+    def segments(
+        self, doc_ids_sorted: NDArray[np.int32], max_segment_size: int
+    ) -> list[tuple[int, int, int]]:
+        """
+        Find the spans of the uncompressed annotation holding the rows `doc_ids_sorted`
+
+        Spans cover whole runs of `stride` rows. Adjacent runs are combined,
+        as long as the combined span is at most `max_segment_size` bytes.
+
+        Args:
+            doc_ids_sorted (NDArray[np.int32]): Sorted row numbers
+            max_segment_size (int): The size past which adjacent runs are not combined
+
+        Returns:
+            list[tuple[int, int, int]]: The first row, start offset and end offset of each span, in order
+
+        Raises:
+            ValueError: If any row number is not in the annotation
+        """
+        if len(doc_ids_sorted) == 0:
+            return []
+
+        if doc_ids_sorted[0] < 0 or doc_ids_sorted[-1] >= self.n_rows:
+            raise ValueError(f"Row numbers must be in [0, {self.n_rows})")
+
+        chunks = np.unique(doc_ids_sorted // self.stride).tolist()
+        row_offsets = self.row_offsets
+
+        segments: list[tuple[int, int, int]] = []
+        first_chunk = chunks[0]
+        last_chunk = chunks[0]
+        for chunk in chunks[1:]:
+            if (
+                chunk == last_chunk + 1
+                and row_offsets[chunk + 1] - row_offsets[first_chunk] <= max_segment_size
+            ):
+                last_chunk = chunk
+                continue
+
+            segments.append(
+                (
+                    first_chunk * self.stride,
+                    int(row_offsets[first_chunk]),
+                    int(row_offsets[last_chunk + 1]),
+                )
+            )
+            first_chunk = chunk
+            last_chunk = chunk
+
+        segments.append(
+            (first_chunk * self.stride, int(row_offsets[first_chunk]), int(row_offsets[last_chunk + 1]))
+        )
+
+        return segments
+
+
+class RowIndexBuilder:
+    """
+    Build a row index incrementally, from the sizes of the rows as they are written
+
+    Attributes:
+        stride: int
+            The number of rows between recorded offsets
+        n_rows: int
+            The number of rows added so far
+        data_size: int
+            The size of the header and rows added so far
+    """
+
+    def __init__(self, header_size: int, stride: int = ROW_INDEX_STRIDE):
+        self.stride = stride
+        self.n_rows = 0
+        self.data_size = header_size
+        self._offsets: list[NDArray[np.int64]] = []
+
+    def add_rows(self, row_sizes: NDArray[np.int64]) -> None:
+        """Record rows of the given sizes, in bytes including their newlines"""
+        if len(row_sizes) == 0:
+            return
+
+        row_starts = np.empty(len(row_sizes), dtype=np.int64)
+        row_starts[0] = self.data_size
+        np.cumsum(row_sizes[:-1], out=row_starts[1:])
+        row_starts[1:] += self.data_size
+
+        self._offsets.append(row_starts[-self.n_rows % self.stride :: self.stride])
+
+        self.n_rows += len(row_sizes)
+        self.data_size += int(row_sizes.sum())
+
+    def build(self) -> RowIndex:
+        return RowIndex(
+            stride=self.stride,
+            n_rows=self.n_rows,
+            row_offsets=np.concatenate([*self._offsets, [self.data_size]]).astype(np.int64),
+        )
+
+
+def build_row_index(fh: IO[bytes], stride: int = ROW_INDEX_STRIDE) -> RowIndex:
+    """
+    Index an uncompressed annotation stream, which must be positioned at the start of its header
+
+    Args:
+        fh (IO[bytes]): The uncompressed annotation
+        stride (int, optional): The number of rows between recorded offsets
+
+    Returns:
+        RowIndex: The index of the annotation
+    """
+    builder = RowIndexBuilder(len(fh.readline()), stride)
+
+    for block in iter_row_blocks(fh):
+        builder.add_rows(block.stops - block.starts)
+
+    return builder.build()
+
+
+def write_annotation_row_index(annotation_path: str, stride: int = ROW_INDEX_STRIDE) -> bool:
+    """
+    Write the row index of a BGZF annotation alongside it, so that saves from it can seek to their hits
+
+    The annotation is decompressed in full, so this is meant to run once, when the annotation is indexed
+    for search, rather than as part of a save.
+
+    Args:
+        annotation_path (str): The annotation
+        stride (int, optional): The number of rows between recorded offsets
+
+    Returns:
+        bool: Whether the index was written; it isn't for annotations without a `.gzi` index
+    """
+    gzi_path = annotation_path + GZI_SUFFIX
+    if not os.path.exists(gzi_path):
+        return False
+
+    with gzip.open(annotation_path, "rb") as fh:
+        row_index = build_row_index(fh, stride)  # type: ignore[arg-type]
+
+    row_index.with_blocks(gzi_path).with_fingerprint(annotation_path).write(
+        annotation_path + ROW_INDEX_SUFFIX
+    )
+    return True
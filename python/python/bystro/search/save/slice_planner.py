@@ -0,0 +1,154 @@
+"""
+Plan how a save query's hits are split into OpenSearch slices.
+
+Sliced searches split each shard's documents evenly among the slices assigned to it,
+so slices are sized per shard: the slice count is a multiple of the shard count whenever
+the index's `max_slices_per_scroll` setting allows. Slices are kept large enough to amortize
+the cost of each search, but numerous enough that every fetch worker has several to pull from,
+so that one slow slice does not hold up the rest.
+"""
+
+import logging
+import math
+import os
+from typing import Any
+
+from msgspec import Struct
+
+logger = logging.getLogger(__name__)
+
+# The number of hits we aim to have in each slice
+SAVE_TARGET_HITS_PER_SLICE = int(os.getenv("SAVE_TARGET_HITS_PER_SLICE", 100_000))
+# The minimum number of slices we aim to give each fetch worker, for load balancing
+SAVE_MIN_SLICES_PER_WORKER = int(os.getenv("SAVE_MIN_SLICES_PER_WORKER", 4))
+# OpenSearch's default for `index.max_slices_per_scroll`
+DEFAULT_MAX_SLICES_PER_SCROLL = 1024
+
+
+class IndexSliceSettings(Struct, frozen=True):
+    """
+    The settings of the searched indices that constrain slicing
+
+    Attributes:
+        num_shards: int
+            The total number of primary shards
+        max_slices_per_scroll: int
+            The maximum number of slices allowed in a sliced search
+    """
+
+    num_shards: int
+    max_slices_per_scroll: int
+
+
+class SlicePlan(Struct, frozen=True):
+    """
+    How to split a query's hits into slices
+
+    Attributes:
+        num_slices: int
+            The number of slices; 1 means the query is not sliced
+        num_docs: int
+            The number of hits
+        num_shards: int
+            The total number of primary shards searched
+        max_slices: int
+            The maximum number of slices the plan was allowed
+    """
+
+    num_slices: int
+    num_docs: int
+    num_shards: int
+    max_slices: int
+
+    @property
+    def hits_per_slice(self) -> float:
+        return self.num_docs / self.num_slices
+
+
+def get_index_slice_settings(client, index_name: str) -> IndexSliceSettings:
+    """
+    Read the shard count and `max_slices_per_scroll` of the indices matching `index_name`
+
+    If the settings can't be read, we assume a single shard and the OpenSearch default slice limit.
+    """
+    try:
+        response: dict[str, Any] = client.indices.get_settings(
+            index=index_name, params={"include_defaults": "true"}
+        )
+    except Exception as e:
+        logger.warning("Failed to read settings of index %s, using defaults: %s", index_name, e)
+        return IndexSliceSettings(num_shards=1, max_slices_per_scroll=DEFAULT_MAX_SLICES_PER_SCROLL)
+
+    num_shards = 0
+    max_slices_per_scroll: int | None = None
+    for index_settings in response.values():
+        settings = index_settings.get("settings", {}).get("index", {})
+        defaults = index_settings.get("defaults", {}).get("index", {})
+
+        num_shards += int(settings.get("number_of_shards", 1))
+
+        index_max_slices = int(
+            settings.get(
+                "max_slices_per_scroll",
+                defaults.get("max_slices_per_scroll", DEFAULT_MAX_SLICES_PER_SCROLL),
+            )
+        )
+        if max_slices_per_scroll is None or index_max_slices < max_slices_per_scroll:
+            max_slices_per_scroll = index_max_slices
+
+    return IndexSliceSettings(
+        num_shards=max(num_shards, 1),
+        max_slices_per_scroll=(
+            max_slices_per_scroll if max_slices_per_scroll is not None else DEFAULT_MAX_SLICES_PER_SCROLL
+        ),
+    )
+
+
+def plan_slices(
+    num_docs: int,
+    settings: IndexSliceSettings,
+    num_workers: int,
+    max_query_size: int,
+    max_slices: int,
+    target_hits_per_slice: int = SAVE_TARGET_HITS_PER_SLICE,
+    min_slices_per_worker: int = SAVE_MIN_SLICES_PER_WORKER,
+) -> SlicePlan:
+    """
+    Choose the number of slices for a query
+
+    Args:
+        num_docs (int): The number of hits
+        settings (IndexSliceSettings): The settings of the searched indices
+        num_workers (int): The number of fetch workers that slices are distributed among
+        max_query_size (int): The number of hits fetched per search request
+        max_slices (int): Our own limit on the number of slices
+        target_hits_per_slice (int, optional): The number of hits we aim to have in each slice
+        min_slices_per_worker (int, optional): The minimum number of slices we aim to give each worker
+
+    Returns:
+        SlicePlan: The plan
+    """
+    limit = max(1, min(max_slices, settings.max_slices_per_scroll))
+
+    # Slices of fewer hits than a single search request returns are not worth their overhead
+    most_useful_slices = math.ceil(num_docs / max_query_size)
+
+    num_slices = max(
+        math.ceil(num_docs / target_hits_per_slice),
+        min(num_workers * min_slices_per_worker, most_useful_slices),
+    )
+
+    if num_slices > 1:
+        # Give every shard the same number of slices
+        slices_per_shard = math.ceil(num_slices / settings.num_shards)
+        num_slices = slices_per_shard * settings.num_shards
+
+        if num_slices > limit:
+            num_slices = max(1, limit // settings.num_shards) * settings.num_shards
+            num_slices = min(num_slices, limit)
+
+    num_slices = max(1, min(num_slices, limit))
+
+    return SlicePlan(
+        num_slices=num_slices, num_docs=num_docs, num_shards=settings.num_shards, max_slices=limit
+    )
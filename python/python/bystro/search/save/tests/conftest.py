@@ -0,0 +1,9 @@
+import pytest
+
+from bystro.utils.tests.test_bgzf import write_bgzf as _write_bgzf
+
+
+@pytest.fixture
+def write_bgzf():
+    """Write test data as BGZF, as `bgzip --index` would, since bgzip may not be installed"""
+    return _write_bgzf
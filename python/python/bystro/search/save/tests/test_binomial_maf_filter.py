@@ -1,4 +1,6 @@
+import numpy as np
 import pytest
+
 from bystro.search.save.binomial_maf import BinomialMafFilter
 
 # make sample tsv with alt, missingness, sampleMaf, gnomad.exomes.af in that order
@@ -53,3 +55,51 @@ def test_snp_only_filtering():
 
     assert binom_filter is not None
     assert binom_filter(sample_tsv_row) in [True, False]  # depending on the expected behavior
+
+
+@pytest.mark.parametrize("snp_only", [True, False])
+def test_batch_filter_matches_row_filter(snp_only):
+    header = b"alt\tmissingness\tsampleMaf\tgnomad.exomes.af\tgnomad.genomes.af".split(b"\t")
+    filter_ = BinomialMafFilter(
+        private_maf=0.01,
+        snp_only=snp_only,
+        num_samples=100,
+        estimates=["gnomad.exomes.af", "gnomad.genomes.af"],
+        crit_value=0.025,
+    )
+    row_filter = filter_.make_filter(header)
+    batch_filter = filter_.make_batch_filter(header)
+
+    assert row_filter is not None
+    assert batch_filter is not None
+
+    rng = np.random.default_rng(0)
+    alts = [b"A", b"C", b"TT", b"-3"]
+    rows = []
+    for _ in range(2000):
+        missingness = rng.choice([0.0, 0.0, 0.1, 1.0])
+        sample_maf = rng.choice([0.001, 0.005, 0.05, 0.2, 0.5])
+        estimates = [
+            b"NA" if rng.random() < 0.3 else bytes(f"{rng.choice([0.002, 0.04, 0.05, 0.3])}", "utf-8")
+            for _ in range(2)
+        ]
+        rows.append(
+            [
+                alts[rng.integers(len(alts))],
+                bytes(f"{missingness}", "utf-8"),
+                bytes(f"{sample_maf}", "utf-8"),
+                *estimates,
+            ]
+        )
+
+    columns = {idx: np.array([row[idx] for row in rows]) for idx in batch_filter.fields}
+    keep = batch_filter.keep(columns)
+
+    assert keep.tolist() == [not row_filter(row) for row in rows]
+
+
+def test_batch_filter_disabled():
+    filter_ = BinomialMafFilter(
+        private_maf=0.01, snp_only=False, num_samples=100, estimates=[], crit_value=0.025
+    )
+    assert filter_.make_batch_filter(sample_tsv_header) is None
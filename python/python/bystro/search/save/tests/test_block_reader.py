@@ -0,0 +1,86 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from bystro.search.save.block_reader import RowBlock, iter_row_blocks, parse_float_field
+
+ROWS = [b"chr1\t100\tA\t0.5", b"chr1\t200\tC\tNA", b"chr2\t300\tG\t0.25", b"chrX\t400\tT\t1e-3"]
+
+
+def test_row_block_locates_rows():
+    block = RowBlock.from_bytes(b"\n".join(ROWS) + b"\n", row_offset=10)
+
+    assert len(block) == 4
+    assert block.end_row == 14
+    assert block.rows(np.arange(4)) == ROWS
+    assert block.raw(np.array([1, 2])) == ROWS[1] + b"\n" + ROWS[2] + b"\n"
+    assert block.raw(np.array([0, 3])) == ROWS[0] + b"\n" + ROWS[3] + b"\n"
+    assert block.raw(np.array([], dtype=np.int64)) == b""
+
+
+def test_row_block_without_trailing_newline():
+    block = RowBlock.from_bytes(b"\n".join(ROWS))
+
+    assert len(block) == 4
+    assert block.rows(np.array([3])) == [ROWS[3]]
+    assert block.raw(np.array([2, 3])) == ROWS[2] + b"\n" + ROWS[3]
+
+
+def test_row_block_field():
+    block = RowBlock.from_bytes(b"\n".join(ROWS) + b"\n")
+
+    assert block.field(np.arange(4), 0).tolist() == [b"chr1", b"chr1", b"chr2", b"chrX"]
+    assert block.field(np.array([0, 2]), 1).tolist() == [b"100", b"300"]
+    assert block.field(np.array([1, 3]), 3).tolist() == [b"NA", b"1e-3"]
+
+    with pytest.raises(ValueError, match="fewer than 5 columns"):
+        block.field(np.array([0]), 4)
+
+
+def test_row_block_fields():
+    block = RowBlock.from_bytes(b"\n".join(ROWS) + b"\n")
+
+    columns = block.fields(np.array([0, 3]), [3, 0])
+
+    assert columns[0].tolist() == [b"chr1", b"chrX"]
+    assert columns[3].tolist() == [b"0.5", b"1e-3"]
+    assert block.fields(np.array([], dtype=np.int64), [1])[1].tolist() == []
+
+
+def test_parse_float_field():
+    block = RowBlock.from_bytes(b"\n".join(ROWS) + b"\n")
+
+    values = parse_float_field(block.field(np.arange(4), 3))
+    assert np.isnan(values[1])
+    assert np.array_equal(values[[0, 2, 3]], [0.5, 0.25, 0.001])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 1024])
+def test_iter_row_blocks(chunk_size):
+    data = b"\n".join(ROWS) + b"\n"
+
+    blocks = list(iter_row_blocks(BytesIO(data), chunk_size=chunk_size))
+
+    rows = []
+    expected_offset = 0
+    for block in blocks:
+        assert block.row_offset == expected_offset
+        expected_offset = block.end_row
+        rows.extend(block.rows(np.arange(len(block))))
+
+    assert rows == ROWS
+
+
+def test_iter_row_blocks_with_row_offset_and_no_trailing_newline():
+    blocks = list(iter_row_blocks(BytesIO(b"\n".join(ROWS)), chunk_size=20, row_offset=5))
+
+    assert blocks[0].row_offset == 5
+    assert blocks[-1].end_row == 9
+    assert blocks[-1].rows(np.array([len(blocks[-1]) - 1])) == [ROWS[-1]]
+
+
+@pytest.mark.parametrize("value", [b"", b"abc", b"0.5x"])
+def test_parse_float_field_invalid(value):
+    with pytest.raises(ValueError, match="could not convert"):
+        parse_float_field(np.array([b"0.5", value]))
@@ -0,0 +1,102 @@
+from unittest.mock import MagicMock
+
+import pyarrow as pa  # type: ignore
+import pyarrow.feather as feather  # type: ignore
+import pytest
+
+from bystro.search.save.dosage_filter import filter_dosage_matrix_arrow, read_loci_file
+from bystro.search.save.handler import filter_dosage_matrix
+
+LOCI = [f"chr1:{pos}:A:T" for pos in range(10)]
+
+
+def _write_dosage_matrix(path, batch_size: int = 4) -> pa.Table:
+    table = pa.table(
+        {
+            "locus": LOCI,
+            "sample1": pa.array(range(10), type=pa.uint16()),
+            "sample2": pa.array([None if pos % 3 == 0 else 2 for pos in range(10)], type=pa.uint16()),
+        }
+    )
+
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=batch_size):
+            writer.write_batch(batch)
+
+    return table
+
+
+def test_read_loci_file(tmp_path):
+    loci_path = tmp_path / "loci.txt"
+    loci_path.write_text("chr1:1:A:T\nchr2:5:G:C\n")
+
+    assert read_loci_file(str(loci_path)).to_pylist() == ["chr1:1:A:T", "chr2:5:G:C"]
+
+    loci_path.write_text("")
+    assert read_loci_file(str(loci_path)).to_pylist() == []
+
+
+@pytest.mark.parametrize("lookup_rows", [1, 3, 100])
+def test_filter_dosage_matrix_arrow(tmp_path, lookup_rows):
+    table = _write_dosage_matrix(tmp_path / "parent.feather")
+    reporter = MagicMock()
+
+    # Loci may be duplicated, and may not be in the dosage matrix
+    loci = pa.array(["chr1:8:A:T", "chr1:0:A:T", "chr1:3:A:T", "chr1:4:A:T", "chr1:3:A:T", "chrX:1:A:T"])
+
+    n_kept = filter_dosage_matrix_arrow(
+        str(tmp_path / "parent.feather"),
+        str(tmp_path / "out.feather"),
+        loci,
+        reporter,
+        progress_frequency=4,
+        lookup_rows=lookup_rows,
+    )
+
+    filtered = feather.read_table(str(tmp_path / "out.feather"))
+
+    assert n_kept == 4
+    assert filtered.schema == table.schema
+    # Rows are written in the order of the dosage matrix
+    assert filtered == table.take([0, 3, 4, 8])
+    assert reporter.message.remote.call_count == 3
+
+
+def test_filter_dosage_matrix_arrow_keeps_nothing(tmp_path):
+    table = _write_dosage_matrix(tmp_path / "parent.feather")
+
+    n_kept = filter_dosage_matrix_arrow(
+        str(tmp_path / "parent.feather"),
+        str(tmp_path / "out.feather"),
+        pa.array(["chrX:1:A:T"]),
+        MagicMock(),
+        progress_frequency=100,
+    )
+
+    filtered = feather.read_table(str(tmp_path / "out.feather"))
+
+    assert n_kept == 0
+    assert filtered.num_rows == 0
+    assert filtered.schema == table.schema
+
+
+def test_filter_dosage_matrix_selects_arrow(tmp_path, mocker):
+    table = _write_dosage_matrix(tmp_path / "parent.feather")
+    (tmp_path / "loci.txt").write_text("chr1:2:A:T\nchr1:9:A:T\n")
+    run_dosage_filter = mocker.patch("bystro.search.save.handler.run_dosage_filter")
+
+    job_data = MagicMock()
+    job_data.dosage_filter = "arrow"
+
+    filter_dosage_matrix(
+        dosage_out_path=str(tmp_path / "out.feather"),
+        parent_dosage_matrix_path=str(tmp_path / "parent.feather"),
+        job_data=job_data,
+        reporter=MagicMock(),
+        queue_config_path="queue.yml",
+        reporting_interval=10,
+        loci_file_path=str(tmp_path / "loci.txt"),
+    )
+
+    run_dosage_filter.assert_not_called()
+    assert feather.read_table(str(tmp_path / "out.feather")) == table.take([2, 9])
@@ -1,3 +1,5 @@
+import asyncio
+import os
 from io import BytesIO
 from unittest.mock import patch, MagicMock
 
@@ -7,10 +9,22 @@ import pytest
 import ray
 
 from bystro.beanstalkd.worker import get_progress_reporter
+from bystro.search.save.hit_runs import PackedLoci, write_hit_run
+from bystro.search.save.hwe import HWEFilter
+from bystro.search.save.row_index import RowIndex, RowIndexBuilder, write_annotation_row_index
 from bystro.search.save.handler import (
     AsyncQueryProcessor,
     sort_loci_and_doc_ids,
+    sort_doc_ids,
+    merge_spilled_hits,
+    count_in_ranges_numpy,
+    _fetch_slices,
+    _iter_slice_hits_in_order,
+    _plan_annotation_seek,
+    HitCursor,
+    StreamingDosageFilter,
     filter_annotation,
+    filter_annotation_pipelined,
     filter_dosage_matrix,
 )
 
@@ -66,6 +80,165 @@ async def test_process_query(OpenSearchMock, search_client_args, query_args, moc
     assert loci == ["chr1:100:A:T", "chr2:200:G:C"]
 
 
+@ray.remote
+class _SliceFetcher:
+    def __init__(self, slow_slice_id: int):
+        self.slow_slice_id = slow_slice_id
+        self.slice_ids: list[int] = []
+
+    async def fetch(self, body: dict, slice_id: int):
+        self.slice_ids.append(slice_id)
+
+        await asyncio.sleep(1 if slice_id == self.slow_slice_id else 0.01)
+
+        expected_slice = body["body"].get("slice")
+        assert expected_slice is None or expected_slice == {"id": slice_id, "max": 12}
+
+        return np.arange(slice_id, dtype=np.int32)
+
+    def fetched(self) -> list[int]:
+        return self.slice_ids
+
+
+def test_fetch_slices_dispatches_dynamically():
+    actors = [_SliceFetcher.remote(0) for _ in range(3)]  # type: ignore
+    ray.get([actor.fetched.remote() for actor in actors])
+
+    results, latencies, hits = _fetch_slices(
+        actors,
+        lambda actor, body, slice_id: actor.fetch.remote(body, slice_id),
+        {"query": {"match_all": {}}},
+        num_slices=12,
+        max_in_flight_per_actor=1,
+    )
+
+    assert [len(result) for result in results] == list(range(12))
+    assert hits.tolist() == list(range(12))
+    assert latencies[0] >= 0.5
+
+    # The other slices are fetched by the other actors while the slow slice is fetched,
+    # rather than some of them waiting behind it
+    fetched = ray.get([actor.fetched.remote() for actor in actors])
+    assert sorted(slice_id for slice_ids in fetched for slice_id in slice_ids) == list(range(12))
+    assert [0] in fetched
+
+
+def test_fetch_slices_unsliced():
+    actors = [_SliceFetcher.remote(-1)]  # type: ignore
+
+    results, _, hits = _fetch_slices(
+        actors,
+        lambda actor, body, slice_id: actor.fetch.remote(body, slice_id),
+        {"query": {"match_all": {}}},
+        num_slices=1,
+        max_in_flight_per_actor=4,
+    )
+
+    assert len(results) == 1
+    assert hits.tolist() == [0]
+
+
+@ray.remote
+class _PageFetcher:
+    def __init__(self, slices: list[list[int]], page_size: int):
+        self.slices = slices
+        self.page_size = page_size
+
+    async def fetch_page(self, body: dict):
+        slice_id = body["body"].get("slice", {"id": 0})["id"]
+        after = body["body"].get("search_after", [-1])[0]
+
+        page = [doc_id for doc_id in self.slices[slice_id] if doc_id > after][: self.page_size]
+        search_after = [page[-1]] if len(page) == self.page_size else None
+
+        return (
+            np.array(page, dtype=np.int32),
+            np.array([f"l{doc_id}" for doc_id in page], dtype=object),
+            search_after,
+        )
+
+
+@pytest.mark.parametrize("num_slices", [1, 3])
+def test_iter_slice_hits_in_order(num_slices):
+    doc_ids = list(range(0, 60, 2))
+    slices = [doc_ids[slice_id::num_slices] for slice_id in range(num_slices)]
+    actors = [_PageFetcher.remote(slices, 4) for _ in range(2)]  # type: ignore
+
+    n_fetched = 0
+
+    def fetch(actor, body):
+        nonlocal n_fetched
+        n_fetched += 1
+        return actor.fetch_page.remote(body)
+
+    chunks = []
+    fetched_before_first_chunk = None
+    for chunk in _iter_slice_hits_in_order(
+        actors, fetch, {"query": {"match_all": {}}}, num_slices, max_in_flight_per_actor=2
+    ):
+        if fetched_before_first_chunk is None:
+            fetched_before_first_chunk = n_fetched
+        chunks.append(chunk)
+
+    ends = [end for end, _, _ in chunks]
+    assert ends == sorted(set(ends))
+    assert ends[-1] == np.iinfo(np.int64).max
+
+    start = 0
+    for end, chunk_doc_ids, loci in chunks:
+        assert all(start <= doc_id < end for doc_id in chunk_doc_ids.tolist())
+        if len(chunk_doc_ids) > 0:
+            assert loci.tolist() == [f"l{doc_id}" for doc_id in chunk_doc_ids.tolist()]
+        start = end
+
+    assert [doc_id for _, chunk_doc_ids, _ in chunks for doc_id in chunk_doc_ids.tolist()] == doc_ids
+
+    # Hits are yielded while later pages are still to be fetched
+    assert fetched_before_first_chunk is not None
+    assert fetched_before_first_chunk < n_fetched
+
+
+def test_hit_cursor():
+    chunks = [
+        (4, np.array([1, 3], dtype=np.int32), np.array(["l1", "l3"], dtype=object)),
+        (8, np.array([], dtype=np.int32), np.array([], dtype=object)),
+        (12, np.array([8, 9, 11], dtype=np.int32), np.array(["l8", "l9", "l11"], dtype=object)),
+    ]
+    hits = HitCursor(chunks, has_loci=True)
+
+    def take(end_row):
+        parts = hits.take(end_row)
+        return [doc_id for doc_ids, _ in parts for doc_id in doc_ids.tolist()], [
+            locus for _, loci in parts for locus in loci.tolist()
+        ]
+
+    assert take(2) == ([1], ["l1"])
+    assert not hits.exhausted
+    # A block may span several chunks, including empty ones
+    assert take(9) == ([3, 8], ["l3", "l8"])
+    assert take(10) == ([9], ["l9"])
+    assert not hits.exhausted
+    assert take(20) == ([11], ["l11"])
+    assert hits.exhausted
+    assert take(30) == ([], [])
+
+
+def test_hit_cursor_from_sorted():
+    hits = HitCursor.from_sorted(np.array([0, 5], dtype=np.int32), None)
+
+    assert not hits.has_loci
+    assert [doc_ids.tolist() for doc_ids, _ in hits.take(3)] == [[0]]
+    assert not hits.exhausted
+    assert [doc_ids.tolist() for doc_ids, _ in hits.take(6)] == [[5]]
+    assert hits.exhausted
+
+
+def test_count_in_ranges_numpy_bin_size():
+    assert count_in_ranges_numpy(np.array([1, 2, 15, 37]), min_bin_size=10) == (
+        "0-9: 2\n10-19: 1\n30-39: 1"
+    )
+
+
 def test_empty_input():
     doc_ids_sorted, loci_sorted, n_hits = sort_loci_and_doc_ids([])
     assert np.array_equal(doc_ids_sorted, np.array([], dtype=np.int32))
@@ -105,6 +278,20 @@ def test_mixed_none_and_non_none_values():
     assert n_hits == expected_output[2]
 
 
+def test_sort_doc_ids():
+    assert sort_doc_ids([])[1] == 0
+
+    doc_ids_sorted, n_hits = sort_doc_ids(
+        [
+            np.array([7, 9], dtype=np.int32),
+            np.array([], dtype=np.int32),
+            np.array([1, 8], dtype=np.int32),
+        ]
+    )
+    assert np.array_equal(doc_ids_sorted, np.array([1, 7, 8, 9], dtype=np.int32))
+    assert n_hits == 4
+
+
 def test_single_element():
     input_data: list[tuple[NDArray[np.int32], NDArray]] = [
         (np.array([1], dtype=np.int32), np.array(["doc1"], dtype=object))
@@ -297,6 +484,442 @@ def test_filter_annotation_excludes_correct_loci3(mock_dependencies, tmp_path):
     assert loci_file_path.read_text() == ""
 
 
+def test_filter_annotation_selects_sparse_rows(mocker, tmp_path):
+    rows = [f"row{i}\t{i}\n".encode() for i in range(1000)]
+
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(b"header1\theader2\n" + b"".join(rows))
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    mocker.patch("subprocess.Popen", side_effect=[stats_mock, out_mock, in_mock])
+
+    stats = MagicMock()
+    job_data = MagicMock()
+    job_data.pipeline = None
+
+    doc_ids_sorted = np.array([0, 1, 2, 500, 998], dtype=np.int32)
+    loci_sorted = np.array(["l0", "l1", "l2", "l500", "l998"], dtype=object)
+    loci_file_path = tmp_path / "loci.txt"
+
+    retained_count = filter_annotation(
+        stats,
+        "path.gz",
+        "parent_path",
+        job_data,
+        doc_ids_sorted,
+        loci_sorted,
+        len(doc_ids_sorted),
+        MagicMock(),
+        10,
+        loci_file_path,
+    )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+
+    assert retained_count == 5
+    assert written == b"header1\theader2\n" + b"".join(rows[i] for i in doc_ids_sorted)
+    assert loci_file_path.read_text() == "l0\nl1\nl2\nl500\nl998\n"
+
+
+def test_filter_annotation_pipelined(mocker, tmp_path):
+    rows = [f"row{i}\t{i}\n".encode() for i in range(1000)]
+
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(b"header1\theader2\n" + b"".join(rows))
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    mocker.patch("subprocess.Popen", side_effect=[stats_mock, out_mock, in_mock])
+
+    job_data = MagicMock()
+    job_data.pipeline = None
+
+    consumed = []
+
+    def chunks():
+        for end, doc_ids in [(300, [0, 1, 2]), (600, [500]), (900, []), (1000, [998])]:
+            consumed.append(end)
+            yield end, np.array(doc_ids, dtype=np.int32), np.array(
+                [f"l{doc_id}" for doc_id in doc_ids], dtype=object
+            )
+
+    loci_file_path = tmp_path / "loci.txt"
+    with open(loci_file_path, "w") as loci_fh:
+        retained_count = filter_annotation_pipelined(
+            MagicMock(),
+            "path.gz",
+            "parent_path",
+            job_data,
+            HitCursor(chunks(), has_loci=True),
+            MagicMock(),
+            10,
+            loci_fh,
+        )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+
+    assert consumed == [300, 600, 900, 1000]
+    assert retained_count == 5
+    assert written == b"header1\theader2\n" + b"".join(rows[i] for i in [0, 1, 2, 500, 998])
+    assert loci_file_path.read_text() == "l0\nl1\nl2\nl500\nl998\n"
+
+
+def test_filter_annotation_uses_batch_filters(mocker, tmp_path):
+    header = b"chrom\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+    rows = [
+        b"chr1\t0.5\t0\t0.99\t0.01\n",  # out of HWE
+        b"chr1\t0.5\t0\t0.5\t0.25\n",  # in HWE
+        b"chr2\t0.5\t1\t0.5\t0.25\n",  # all missing
+        b"chr2\t0\t0\t0.1\t0.2\n",  # sampleMaf of 0 is skipped
+    ]
+
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(header + b"".join(rows))
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    mocker.patch("subprocess.Popen", side_effect=[stats_mock, out_mock, in_mock])
+
+    hwe_filter = HWEFilter(num_samples=100, crit_value=0.05)
+    make_filter = mocker.spy(HWEFilter, "make_filter")
+    job_data = MagicMock()
+    job_data.pipeline = [hwe_filter]
+
+    doc_ids_sorted = np.array([0, 1, 2, 3], dtype=np.int32)
+    loci_sorted = np.array(["l0", "l1", "l2", "l3"], dtype=object)
+    loci_file_path = tmp_path / "loci.txt"
+
+    retained_count = filter_annotation(
+        MagicMock(),
+        "path.gz",
+        "parent_path",
+        job_data,
+        doc_ids_sorted,
+        loci_sorted,
+        len(doc_ids_sorted),
+        MagicMock(),
+        10,
+        loci_file_path,
+    )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+
+    make_filter.assert_not_called()
+    assert retained_count == 2
+    assert written == header + rows[1] + rows[3]
+    assert loci_file_path.read_text() == "l1\nl3\n"
+
+
+def test_filter_annotation_with_packed_loci(mocker, tmp_path):
+    header = b"chrom\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+    rows = [
+        b"chr1\t0.5\t0\t0.99\t0.01\n",  # out of HWE
+        b"chr1\t0.5\t0\t0.5\t0.25\n",  # in HWE
+        b"chr2\t0.5\t0\t0.5\t0.25\n",  # in HWE
+    ]
+
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(header + b"".join(rows))
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    mocker.patch("subprocess.Popen", side_effect=[stats_mock, out_mock, in_mock])
+
+    job_data = MagicMock()
+    job_data.pipeline = [HWEFilter(num_samples=100, crit_value=0.05)]
+
+    doc_ids_sorted = np.array([0, 1, 2], dtype=np.int32)
+    loci_sorted = PackedLoci.from_fields(
+        ["chr1", "chr1", "chr2"], [100, 200, 300], ["A", "C", "G"], ["T", "-1", "+AC"]
+    )
+    loci_file_path = tmp_path / "loci.txt"
+
+    retained_count = filter_annotation(
+        MagicMock(),
+        "path.gz",
+        "parent_path",
+        job_data,
+        doc_ids_sorted,
+        loci_sorted,
+        len(doc_ids_sorted),
+        MagicMock(),
+        10,
+        loci_file_path,
+    )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+
+    assert retained_count == 2
+    assert written == header + rows[1] + rows[2]
+    assert loci_file_path.read_text() == "chr1:200:C:-1\nchr2:300:G:+AC\n"
+
+
+def test_filter_annotation_derives_loci_from_annotation(mocker, tmp_path):
+    header = b"chrom\tpos\ttype\tinputRef\talt\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+    rows = [
+        b"chr1\t100\tSNP\tA\tT\t0.5\t0\t0.99\t0.01\n",  # out of HWE
+        b"chrx\t200\tDEL\tC\t-1\t0.5\t0\t0.5\t0.25\n",  # in HWE
+        b"chr2\t300\tSNP\tG\tA\t0.5\t0\t0.5\t0.25\n",  # not a hit
+        b"chrM\t400\tINS\tG\t+AC\t0.5\t0\t0.5\t0.25\n",  # in HWE
+    ]
+
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(header + b"".join(rows))
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    mocker.patch("subprocess.Popen", side_effect=[stats_mock, out_mock, in_mock])
+
+    job_data = MagicMock()
+    job_data.pipeline = [HWEFilter(num_samples=100, crit_value=0.05)]
+
+    doc_ids_sorted = np.array([0, 1, 3], dtype=np.int32)
+    loci_file_path = tmp_path / "loci.txt"
+
+    retained_count = filter_annotation(
+        MagicMock(),
+        "path.gz",
+        "parent_path",
+        job_data,
+        doc_ids_sorted,
+        None,
+        len(doc_ids_sorted),
+        MagicMock(),
+        10,
+        loci_file_path,
+    )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+
+    assert retained_count == 2
+    assert written == header + rows[1] + rows[3]
+    # Matches the loci process_query builds, which upper-case the chromosome after "chr"
+    assert loci_file_path.read_text() == "chrX:200:C:-1\nchrM:400:G:+AC\n"
+
+
+def test_filter_annotation_without_locus_columns(mocker, tmp_path):
+    in_mock = MagicMock()
+    in_mock.__enter__.return_value = in_mock
+    in_mock.stdout = BytesIO(b"chrom\tpos\nchr1\t100\n")
+    mocker.patch("subprocess.Popen", side_effect=[MagicMock(), MagicMock(), in_mock])
+
+    job_data = MagicMock()
+    job_data.pipeline = None
+
+    with pytest.raises(ValueError, match="missing the columns required to define a locus"):
+        filter_annotation(
+            MagicMock(),
+            "path.gz",
+            "parent_path",
+            job_data,
+            np.array([0], dtype=np.int32),
+            None,
+            1,
+            MagicMock(),
+            10,
+            tmp_path / "loci.txt",
+        )
+
+
+def _run_filter_annotation(
+    mocker, tmp_path, parent_path, in_stdout, doc_ids_sorted, loci_sorted, annotation_path="path.gz"
+):
+    out_mock = MagicMock()
+    out_mock.__enter__.return_value = out_mock
+    stats_mock = MagicMock()
+    stats_mock.__enter__.return_value = stats_mock
+    side_effect = [stats_mock, out_mock]
+    if in_stdout is not None:
+        in_mock = MagicMock()
+        in_mock.__enter__.return_value = in_mock
+        in_mock.stdout = in_stdout
+        side_effect.append(in_mock)
+    popen = mocker.patch("subprocess.Popen", side_effect=side_effect)
+
+    job_data = MagicMock()
+    job_data.pipeline = [HWEFilter(num_samples=100, crit_value=0.05)]
+    loci_file_path = tmp_path / "loci.txt"
+
+    retained_count = filter_annotation(
+        MagicMock(),
+        annotation_path,
+        parent_path,
+        job_data,
+        doc_ids_sorted,
+        loci_sorted,
+        len(doc_ids_sorted),
+        MagicMock(),
+        10,
+        loci_file_path,
+    )
+
+    written = b"".join(call.args[0] for call in out_mock.stdin.write.call_args_list)
+    stats_written = b"".join(call.args[0] for call in stats_mock.stdin.write.call_args_list)
+    assert written == stats_written
+
+    return retained_count, written, loci_file_path.read_text(), popen.call_count
+
+
+@pytest.mark.parametrize("with_loci", [False, True])
+def test_filter_annotation_seeks_indexed_annotation(mocker, tmp_path, write_bgzf, with_loci):
+    header = b"chrom\tpos\ttype\tinputRef\talt\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+    rows = [
+        f"chr{i % 22 + 1}\t{i * 100}\tSNP\tA\tT\t0.5\t0\t{0.99 if i % 3 == 0 else 0.5}\t0.25\n".encode()
+        for i in range(500)
+    ]
+    data = header + b"".join(rows)
+
+    parent_path = str(tmp_path / "parent.annotation.tsv.gz")
+    write_bgzf(parent_path, data, block_size=300)
+    mocker.patch("bystro.search.save.handler.SAVE_ANNOTATION_SEEK_MAX_FRACTION", 1.0)
+
+    doc_ids_sorted = np.array([0, 3, 4, 100, 101, 102, 377, 498, 499], dtype=np.int32)
+    loci_sorted = (
+        np.array([f"chr{i % 22 + 1}:{i * 100}:A:T" for i in doc_ids_sorted], dtype=object)
+        if with_loci
+        else None
+    )
+
+    # Until the parent is indexed, it is read as a stream, and saves don't index it
+    stream_result = _run_filter_annotation(
+        mocker, tmp_path, parent_path, BytesIO(data), doc_ids_sorted, loci_sorted
+    )
+    assert not os.path.exists(parent_path + ".rowidx")
+
+    assert write_annotation_row_index(parent_path, stride=16)
+    seek_result = _run_filter_annotation(
+        mocker, tmp_path, parent_path, None, doc_ids_sorted, loci_sorted
+    )
+
+    # The seek path does not decompress the whole annotation
+    assert seek_result[3] == 2
+    assert stream_result[3] == 3
+
+    assert seek_result[:3] == stream_result[:3]
+
+    kept = [i for i in doc_ids_sorted if i % 3 != 0]
+    assert seek_result[0] == len(kept)
+    assert seek_result[1] == header + b"".join(rows[i] for i in kept)
+    assert seek_result[2] == "".join(f"chr{i % 22 + 1}:{i * 100}:A:T\n" for i in kept)
+
+
+def test_plan_annotation_seek_rejects_stale_row_index(tmp_path, write_bgzf):
+    data = b"chrom\tpos\n" + b"".join(f"chr1\t{i}\n".encode() for i in range(10))
+    parent_path = str(tmp_path / "parent.annotation.tsv.gz")
+    write_bgzf(parent_path, data, block_size=20)
+
+    builder = RowIndexBuilder(len(b"chrom\tpos\n"), stride=2)
+    builder.add_rows(np.array([len(line) for line in data.splitlines(keepends=True)[1:]]))
+    row_index = builder.build().with_blocks(parent_path + ".gzi")
+
+    # An index that doesn't record the annotation it describes is not trusted
+    row_index.write(parent_path + ".rowidx")
+    assert _plan_annotation_seek(parent_path, np.array([3], dtype=np.int32)) is None
+
+    row_index.with_fingerprint(parent_path).write(parent_path + ".rowidx")
+    assert _plan_annotation_seek(parent_path, np.array([3], dtype=np.int32)) is not None
+    assert _plan_annotation_seek(parent_path, np.array([3, 10], dtype=np.int32)) is None
+
+    # Regenerating the annotation invalidates its index
+    write_bgzf(parent_path, data + b"chr1\t10\n", block_size=20)
+    assert _plan_annotation_seek(parent_path, np.array([3], dtype=np.int32)) is None
+
+
+def test_filter_annotation_writes_row_index(mocker, tmp_path):
+    header = b"chrom\tpos\ttype\tinputRef\talt\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+    rows = [
+        f"chr1\t{i}\tSNP\tA\tT\t0.5\t0\t{0.99 if i % 3 == 0 else 0.5}\t0.25\n".encode()
+        for i in range(50)
+    ]
+
+    # The compressor writes the .gzi index of the output; here, a single-block index
+    annotation_path = str(tmp_path / "out.annotation.tsv.gz")
+    with open(annotation_path + ".gzi", "wb") as fh:
+        fh.write(b"\x00" * 8)
+    open(annotation_path, "wb").close()
+
+    mocker.patch("bystro.search.save.handler.ROW_INDEX_STRIDE", 4)
+    _, written, _, _ = _run_filter_annotation(
+        mocker,
+        tmp_path,
+        str(tmp_path / "unindexed.tsv.gz"),
+        BytesIO(header + b"".join(rows)),
+        np.arange(0, 50, 2, dtype=np.int32),
+        None,
+        annotation_path=annotation_path,
+    )
+
+    row_index = RowIndex.from_path(annotation_path + ".rowidx")
+    lines = written.splitlines(keepends=True)
+    builder = RowIndexBuilder(len(lines[0]), stride=4)
+    builder.add_rows(np.array([len(line) for line in lines[1:]], dtype=np.int64))
+    expected = builder.build()
+
+    assert row_index.n_rows == expected.n_rows == 16
+    assert np.array_equal(row_index.row_offsets, expected.row_offsets)
+    assert np.array_equal(row_index.block_offsets, np.zeros(5, dtype=np.int64))
+    assert row_index.describes(annotation_path)
+
+
+def test_filter_annotation_skips_row_index_without_gzi(mocker, tmp_path):
+    annotation_path = str(tmp_path / "out.annotation.tsv.gz")
+
+    _run_filter_annotation(
+        mocker,
+        tmp_path,
+        str(tmp_path / "unindexed.tsv.gz"),
+        BytesIO(
+            b"chrom\tpos\ttype\tinputRef\talt\tsampleMaf\tmissingness\theterozygosity\thomozygosity\n"
+            b"chr1\t1\tSNP\tA\tT\t0.5\t0\t0.5\t0.25\n"
+        ),
+        np.array([0], dtype=np.int32),
+        None,
+        annotation_path=annotation_path,
+    )
+
+    assert not (tmp_path / "out.annotation.tsv.gz.rowidx").exists()
+
+
+def test_merge_spilled_hits(tmp_path):
+    slices = [
+        ([5, 1], [("chr1", 50, "A", "T"), ("chr1", 10, "C", "G")]),
+        ([4, 2, 3], [("chr2", 40, "G", "A"), ("chrX", 20, "T", "C"), ("chr1", 30, "A", "-1")]),
+    ]
+
+    results = []
+    for i, (doc_ids, loci) in enumerate(slices):
+        run_path = str(tmp_path / f"slice_{i}.0.run")
+        write_hit_run(run_path, np.array(doc_ids, dtype=np.int32), PackedLoci.from_fields(*zip(*loci)))
+        results.append(([run_path], len(doc_ids)))
+
+    doc_ids_sorted, loci_sorted, n_hits = merge_spilled_hits(
+        results, str(tmp_path / "merged.run"), memory_budget=1
+    )
+
+    assert n_hits == 5
+    assert doc_ids_sorted.tolist() == [1, 2, 3, 4, 5]
+    assert loci_sorted.tolist() == [
+        "chr1:10:C:G",
+        "chrX:20:T:C",
+        "chr1:30:A:-1",
+        "chr2:40:G:A",
+        "chr1:50:A:T",
+    ]
+    # The input runs are removed once merged
+    assert [path.name for path in tmp_path.iterdir()] == ["merged.run"]
+
+
 # Prepare common fixtures
 @pytest.fixture
 def mock_job_data():
@@ -368,3 +991,87 @@ def test_no_loci_provided(mock_exists, mock_stat, common_args, mock_dependencies
         mock_dependencies[2].message.remote.assert_called_once_with("No dosage matrix to filter.")
 
         mock_touch.assert_called_once_with()
+
+
+FAKE_DOSAGE_FILTER = """#!/usr/bin/env python3
+import sys
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+if args["--input"].endswith("fail"):
+    sys.exit("could not read dosage matrix")
+
+with open(args["--loci"]) as loci_fh, open(args["--output"], "w") as out_fh:
+    out_fh.write(loci_fh.read())
+"""
+
+
+@pytest.fixture
+def fake_dosage_filter(tmp_path, mocker):
+    binary_path = tmp_path / "dosage-filter"
+    binary_path.write_text(FAKE_DOSAGE_FILTER)
+    binary_path.chmod(0o755)
+    mocker.patch("bystro.search.save.handler._GO_HANDLER_BINARY_PATH", str(binary_path))
+
+
+def _streaming_dosage_filter(tmp_path, parent_dosage_matrix_name="parent.feather"):
+    return StreamingDosageFilter(
+        loci_file_path=str(tmp_path / "loci.txt"),
+        dosage_out_path=str(tmp_path / "out.feather"),
+        parent_dosage_matrix_path=str(tmp_path / parent_dosage_matrix_name),
+        job_data=MagicMock(submission_id=123),
+        reporter=MagicMock(),
+        queue_config_path="queue.yml",
+        reporting_interval=10,
+    )
+
+
+@pytest.mark.usefixtures("fake_dosage_filter")
+def test_streaming_dosage_filter(tmp_path):
+    (tmp_path / "parent.feather").write_bytes(b"dosages")
+
+    with _streaming_dosage_filter(tmp_path) as dosage_filter:
+        dosage_filter.write("")
+        dosage_filter.write("chr1:1:A:T\n")
+        dosage_filter.write("chr1:5:G:C\nchr2:9:T:A\n")
+        dosage_filter.wait()
+
+    expected = "chr1:1:A:T\nchr1:5:G:C\nchr2:9:T:A\n"
+    assert (tmp_path / "out.feather").read_text() == expected
+    assert (tmp_path / "loci.txt").read_text() == expected
+    assert not (tmp_path / "loci.txt.fifo").exists()
+
+
+@pytest.mark.usefixtures("fake_dosage_filter")
+def test_streaming_dosage_filter_without_loci(tmp_path):
+    (tmp_path / "parent.feather").write_bytes(b"dosages")
+
+    with _streaming_dosage_filter(tmp_path) as dosage_filter:
+        dosage_filter.write("")
+        dosage_filter.wait()
+
+    assert (tmp_path / "out.feather").read_text() == ""
+    assert (tmp_path / "loci.txt").read_text() == ""
+
+
+@pytest.mark.usefixtures("fake_dosage_filter")
+def test_streaming_dosage_filter_without_dosage_matrix(tmp_path):
+    with _streaming_dosage_filter(tmp_path) as dosage_filter:
+        dosage_filter.write("chr1:1:A:T\n")
+        dosage_filter.wait()
+
+    assert (tmp_path / "out.feather").read_text() == ""
+    assert (tmp_path / "loci.txt").read_text() == "chr1:1:A:T\n"
+
+
+@pytest.mark.usefixtures("fake_dosage_filter")
+def test_streaming_dosage_filter_failure(tmp_path):
+    (tmp_path / "parent.fail").write_bytes(b"dosages")
+
+    with (
+        pytest.raises(RuntimeError, match="could not read dosage matrix"),
+        _streaming_dosage_filter(tmp_path, "parent.fail") as dosage_filter,
+    ):
+        dosage_filter.write("chr1:1:A:T\n")
+        dosage_filter.wait()
+
+    assert not (tmp_path / "loci.txt.fifo").exists()
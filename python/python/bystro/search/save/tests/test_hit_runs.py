@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from bystro.search.save.hit_runs import (
+    HitRun,
+    PackedLoci,
+    merge_hit_runs,
+    remove_hit_runs,
+    write_hit_run,
+)
+
+
+def _random_hits(rng, n_hits, chroms):
+    doc_ids = rng.permutation(n_hits * 3)[:n_hits].astype(np.int32)
+    loci = [
+        (
+            chroms[rng.integers(len(chroms))],
+            int(rng.integers(1, 2**31)),
+            "".join(rng.choice(list("ACGT"), rng.integers(1, 4))),
+            "".join(rng.choice(list("ACGT-"), rng.integers(1, 6))),
+        )
+        for _ in range(n_hits)
+    ]
+    return doc_ids, loci
+
+
+def _pack(loci):
+    if len(loci) == 0:
+        return PackedLoci.empty()
+    return PackedLoci.from_fields(*zip(*loci))
+
+
+def _format(loci):
+    return [f"{chrom}:{pos}:{ref}:{alt}" for chrom, pos, ref, alt in loci]
+
+
+def test_packed_loci_round_trip():
+    loci = [("chr1", 100, "A", "T"), ("chrX", 2, "ACG", "-2"), ("chr1", 4_000_000_000, "C", "+TT")]
+    packed = _pack(loci)
+
+    assert len(packed) == 3
+    assert packed.chroms == ["chr1", "chrX"]
+    assert packed.tolist() == _format(loci)
+
+
+def test_packed_loci_selection():
+    loci = [("chr1", 100, "A", "T"), ("chrX", 2, "ACG", "-2"), ("chr2", 5, "C", "+TT")]
+    packed = _pack(loci)
+
+    assert packed[1:].tolist() == _format(loci[1:])
+    assert packed[1:2].tolist() == _format(loci[1:2])
+    assert packed[2:1].tolist() == []
+    assert packed[np.array([2, 0])].tolist() == _format([loci[2], loci[0]])
+    assert packed[np.array([False, True, True])].tolist() == _format(loci[1:])
+    assert packed[np.array([], dtype=np.int64)].tolist() == []
+
+    with pytest.raises(ValueError, match="step of 1"):
+        packed[::2]
+
+
+def test_write_and_open_hit_run(tmp_path):
+    rng = np.random.default_rng(0)
+    doc_ids, loci = _random_hits(rng, 50, ["chr1", "chr2", "chrM"])
+    path = str(tmp_path / "hits.run")
+
+    assert write_hit_run(path, doc_ids, _pack(loci)) == 50
+
+    run = HitRun.from_path(path)
+    order = np.argsort(doc_ids, kind="stable")
+
+    assert len(run) == 50
+    assert np.array_equal(run.doc_ids, doc_ids[order])
+    assert run.loci.tolist() == np.array(_format(loci), dtype=object)[order].tolist()
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / "not_a_run"
+    path.write_bytes(b"chrom\tpos\n")
+
+    with pytest.raises(ValueError, match="not a hit run file"):
+        HitRun.from_path(str(path))
+
+
+@pytest.mark.parametrize("memory_budget", [1, 64 * 7, 1024**2])
+def test_merge_hit_runs(tmp_path, memory_budget):
+    rng = np.random.default_rng(1)
+    doc_ids, loci = _random_hits(rng, 300, ["chr1", "chr2", "chr3", "chrX", "chrY"])
+    formatted = np.array(_format(loci), dtype=object)
+
+    # Each run has its own chromosome table, which the merge must reconcile
+    run_paths = []
+    for i, (start, end) in enumerate([(0, 120), (120, 125), (125, 125), (125, 300)]):
+        path = str(tmp_path / f"slice_{i}.run")
+        write_hit_run(path, doc_ids[start:end], _pack(loci[start:end]))
+        run_paths.append(path)
+
+    merged = merge_hit_runs(run_paths, str(tmp_path / "merged.run"), memory_budget)
+
+    order = np.argsort(doc_ids, kind="stable")
+    assert len(merged) == 300
+    assert np.array_equal(merged.doc_ids, doc_ids[order])
+    assert merged.loci.tolist() == formatted[order].tolist()
+
+    remove_hit_runs(run_paths)
+    assert not any((tmp_path / f"slice_{i}.run").exists() for i in range(4))
+
+
+def test_merge_no_hits(tmp_path):
+    path = str(tmp_path / "empty.run")
+    write_hit_run(path, np.array([], dtype=np.int32), PackedLoci.empty())
+
+    merged = merge_hit_runs([path], str(tmp_path / "merged.run"), 1024)
+
+    assert len(merged) == 0
+    assert merged.loci.tolist() == []
@@ -1,5 +1,7 @@
 from unittest.mock import patch
 
+import numpy as np
+
 from bystro.search.save.hwe import HWEFilter
 
 sample_header = b"sampleMaf\tmissingness\theterozygosity\thomozygosity".split(b"\t")
@@ -66,3 +68,28 @@ def test_makeHweFilter_low_num_samples(mock_log_warning):
         "To perform the HWE filter, number of samples must be greater than 0, got %s", 0
     )
     assert result is None
+
+
+def test_batch_filter_matches_row_filter():
+    hwe_filter = HWEFilter(num_samples=100, crit_value=0.05)
+    row_filter = hwe_filter.make_filter(sample_header)
+    batch_filter = hwe_filter.make_batch_filter(sample_header)
+
+    assert row_filter is not None
+    assert batch_filter is not None
+    assert batch_filter.fields == [1, 0, 2, 3]
+
+    rng = np.random.default_rng(0)
+    rows = [[bytes(f"{value}", "utf-8") for value in rng.random(4)] for _ in range(1000)]
+    rows.append([b"0.5", b"0", b"0.99", b"0.01"])
+    rows.append([b"0.5", b"1", b"0.5", b"0.25"])
+
+    columns = {idx: np.array([row[idx] for row in rows]) for idx in batch_filter.fields}
+    keep = batch_filter.keep(columns)
+
+    assert keep.dtype == np.bool_
+    assert keep.tolist() == [not row_filter(row) for row in rows]
+
+
+def test_batch_filter_no_samples():
+    assert HWEFilter(num_samples=0).make_batch_filter(sample_header) is None
@@ -0,0 +1,160 @@
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from bystro.search.save.hwe import HWEFilter
+from bystro.search.save.result_cache import (
+    SaveResultCache,
+    get_index_uuids,
+    save_cache_key,
+)
+from bystro.search.utils.annotation import AnnotationOutputs, StatisticsOutputs
+from bystro.search.utils.messages import SaveJobData
+
+
+def _job_data(query_body: dict, pipeline=None, index_name: str = "index") -> SaveJobData:
+    return SaveJobData(
+        submission_id="submit1",
+        assembly="hg38",
+        query_body=query_body,
+        input_dir="input_dir",
+        input_file_names=AnnotationOutputs(
+            annotation="input.annotation.tsv.gz",
+            sample_list="input.sample_list",
+            log="input.log",
+            config="input.yml",
+            statistics=StatisticsOutputs(json="json", tab="tab", qc="qc"),
+            dosage_matrix_out_path="input.dosage.feather",
+        ),
+        index_name=index_name,
+        output_base_path="output/saved",
+        field_names=["chrom"],
+        pipeline=pipeline,
+    )
+
+
+def _outputs(basename: str) -> AnnotationOutputs:
+    return AnnotationOutputs(
+        annotation=f"{basename}.annotation.tsv.gz",
+        sample_list=f"{basename}.sample_list",
+        log=f"{basename}.log",
+        config="input.yml",
+        statistics=StatisticsOutputs(
+            json=f"{basename}.statistics.json",
+            tab=f"{basename}.statistics.tsv",
+            qc=f"{basename}.statistics.qc.tsv",
+        ),
+        dosage_matrix_out_path=f"{basename}.dosage.feather",
+        row_index=f"{basename}.annotation.tsv.gz.rowidx",
+    )
+
+
+def _write_outputs(output_dir, basename: str, content: str, size: int = 10) -> AnnotationOutputs:
+    outputs = _outputs(basename)
+    os.makedirs(output_dir, exist_ok=True)
+    for name in [
+        outputs.annotation,
+        outputs.statistics.json,
+        outputs.statistics.tab,
+        outputs.statistics.qc,
+        outputs.dosage_matrix_out_path,
+        outputs.row_index,
+    ]:
+        with open(os.path.join(output_dir, name), "w") as fh:
+            fh.write(content * size)
+
+    return outputs
+
+
+def test_save_cache_key():
+    query = {"query": {"bool": {"must": [{"term": {"chrom": "chr1"}}], "filter": []}}}
+    reordered = {"query": {"bool": {"filter": [], "must": [{"term": {"chrom": "chr1"}}]}}}
+    pipeline = [HWEFilter(num_samples=10, crit_value=0.05)]
+
+    key = save_cache_key(_job_data(query), query, ["uuid1"])
+
+    assert key == save_cache_key(_job_data(reordered), reordered, ["uuid1"])
+    assert key != save_cache_key(_job_data(query), {"query": {"match_all": {}}}, ["uuid1"])
+    assert key != save_cache_key(_job_data(query, pipeline), query, ["uuid1"])
+    assert key != save_cache_key(_job_data(query, index_name="other"), query, ["uuid1"])
+    # A rebuilt index has a new uuid
+    assert key != save_cache_key(_job_data(query), query, ["uuid2"])
+
+
+def test_get_index_uuids():
+    client = MagicMock()
+    client.indices.get_settings.return_value = {
+        "index_b": {"settings": {"index": {"uuid": "uuid_b"}}},
+        "index_a": {"settings": {"index": {"uuid": "uuid_a"}}},
+    }
+    assert get_index_uuids(client, "index_*") == ["uuid_a", "uuid_b"]
+
+    client.indices.get_settings.return_value = {}
+    assert get_index_uuids(client, "index_*") is None
+
+    client.indices.get_settings.side_effect = RuntimeError("forbidden")
+    assert get_index_uuids(client, "index_*") is None
+
+
+def test_store_and_materialize(tmp_path):
+    cache = SaveResultCache(str(tmp_path / "cache"), max_size=10_000)
+    outputs = _write_outputs(tmp_path / "first", "first", "a")
+
+    assert cache.materialize("key", str(tmp_path / "second"), "second") is None
+
+    cache.store("key", str(tmp_path / "first"), "first", outputs, "index", ["uuid1"], n_variants=7)
+    entry = cache.materialize("key", str(tmp_path / "second"), "second")
+
+    assert entry is not None
+    assert entry.n_variants == 7
+    assert entry.size == 60
+    # The cached outputs are renamed after the new save, and the .gzi, which doesn't exist, is skipped
+    assert sorted(os.listdir(tmp_path / "second")) == sorted(
+        [
+            "second.annotation.tsv.gz",
+            "second.annotation.tsv.gz.rowidx",
+            "second.statistics.json",
+            "second.statistics.tsv",
+            "second.statistics.qc.tsv",
+            "second.dosage.feather",
+        ]
+    )
+    assert (tmp_path / "second" / "second.dosage.feather").read_text() == "a" * 10
+    # On the same filesystem, outputs are hard links rather than copies
+    assert (
+        os.stat(tmp_path / "second" / "second.dosage.feather").st_ino
+        == os.stat(tmp_path / "first" / "first.dosage.feather").st_ino
+    )
+
+
+def test_invalidate_index(tmp_path):
+    cache = SaveResultCache(str(tmp_path / "cache"), max_size=10_000)
+    outputs = _write_outputs(tmp_path / "out", "out", "a")
+
+    cache.store("old", str(tmp_path / "out"), "out", outputs, "index", ["uuid1"], n_variants=1)
+    cache.store("other", str(tmp_path / "out"), "out", outputs, "other", ["uuid3"], n_variants=1)
+    cache.store("new", str(tmp_path / "out"), "out", outputs, "index", ["uuid2"], n_variants=1)
+
+    assert cache.invalidate_index("index", ["uuid2"]) == 1
+    assert sorted(os.listdir(tmp_path / "cache")) == ["new", "other"]
+
+
+@pytest.mark.parametrize("use_first", [False, True])
+def test_evict_least_recently_used(tmp_path, use_first):
+    # Each result is 60 bytes, so the cache holds two
+    cache = SaveResultCache(str(tmp_path / "cache"), max_size=150)
+    outputs = _write_outputs(tmp_path / "out", "out", "a")
+
+    cache.store("first", str(tmp_path / "out"), "out", outputs, "index", ["uuid1"], n_variants=1)
+    os.utime(tmp_path / "cache" / "first" / "entry.json", (1, 1))
+    cache.store("second", str(tmp_path / "out"), "out", outputs, "index", ["uuid1"], n_variants=1)
+    os.utime(tmp_path / "cache" / "second" / "entry.json", (2, 2))
+
+    if use_first:
+        assert cache.materialize("first", str(tmp_path / "reused"), "reused") is not None
+
+    cache.store("third", str(tmp_path / "out"), "out", outputs, "index", ["uuid1"], n_variants=1)
+
+    expected = ["first", "third"] if use_first else ["second", "third"]
+    assert sorted(os.listdir(tmp_path / "cache")) == expected
@@ -0,0 +1,146 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from bystro.search.save.row_index import (
+    RowIndex,
+    RowIndexBuilder,
+    build_row_index,
+    write_annotation_row_index,
+)
+from bystro.utils.bgzf import BgzfReader
+
+HEADER = b"chrom\tpos\n"
+ROWS = [f"chr1\t{i * 10}\n".encode() for i in range(10)]
+DATA = HEADER + b"".join(ROWS)
+ROW_SIZES = np.array([len(row) for row in ROWS], dtype=np.int64)
+
+
+def _row_start(row: int) -> int:
+    return len(HEADER) + sum(len(r) for r in ROWS[:row])
+
+
+def _build_row_index(stride: int) -> RowIndex:
+    builder = RowIndexBuilder(len(HEADER), stride=stride)
+    builder.add_rows(ROW_SIZES)
+    return builder.build()
+
+
+@pytest.mark.parametrize("stride", [1, 3, 4, 20])
+def test_row_index_builder(stride):
+    builder = RowIndexBuilder(len(HEADER), stride=stride)
+    for start, end in [(0, 2), (2, 2), (2, 7), (7, 10)]:
+        builder.add_rows(ROW_SIZES[start:end])
+
+    row_index = builder.build()
+
+    assert row_index.n_rows == 10
+    assert row_index.header_size == len(HEADER)
+    assert row_index.data_size == len(DATA)
+    assert row_index.row_offsets.tolist() == [_row_start(row) for row in range(0, 10, stride)] + [
+        len(DATA)
+    ]
+
+
+def test_row_index_builder_empty():
+    row_index = RowIndexBuilder(len(HEADER), stride=4).build()
+
+    assert row_index.n_rows == 0
+    assert row_index.row_offsets.tolist() == [len(HEADER)]
+    assert row_index.segments(np.array([], dtype=np.int32), 100) == []
+
+
+def test_row_index_round_trip(tmp_path):
+    row_index = _build_row_index(stride=3)
+    path = str(tmp_path / "annotation.tsv.gz.rowidx")
+
+    row_index.write(path)
+    loaded = RowIndex.from_path(path)
+
+    assert loaded.stride == 3
+    assert loaded.n_rows == 10
+    assert np.array_equal(loaded.row_offsets, row_index.row_offsets)
+    assert [p.name for p in tmp_path.iterdir()] == ["annotation.tsv.gz.rowidx"]
+
+
+def test_row_index_segments():
+    row_index = _build_row_index(stride=3)
+
+    # Rows 0-2 and 3-5 are adjacent runs, and are combined; rows 9 is in the last run
+    segments = row_index.segments(np.array([1, 4, 9], dtype=np.int32), max_segment_size=len(DATA))
+    assert segments == [(0, _row_start(0), _row_start(6)), (9, _row_start(9), len(DATA))]
+
+    # Adjacent runs are not combined past the maximum segment size
+    segments = row_index.segments(np.array([1, 4], dtype=np.int32), max_segment_size=1)
+    assert segments == [(0, _row_start(0), _row_start(3)), (3, _row_start(3), _row_start(6))]
+
+    with pytest.raises(ValueError, match="Row numbers must be in"):
+        row_index.segments(np.array([10], dtype=np.int32), max_segment_size=1)
+
+
+def test_row_index_with_blocks(tmp_path, write_bgzf):
+    path = str(tmp_path / "annotation.tsv.gz")
+    write_bgzf(path, DATA, block_size=25)
+
+    row_index = _build_row_index(stride=3).with_blocks(path + ".gzi")
+    row_index.write(path + ".rowidx")
+    loaded = RowIndex.from_path(path + ".rowidx")
+
+    assert np.array_equal(loaded.block_offsets, row_index.block_offsets)
+    assert np.array_equal(loaded.block_data_offsets, row_index.block_data_offsets)
+
+    # Each indexed row is in the block recorded for it
+    with BgzfReader(path) as reader:
+        for chunk, row in enumerate(range(0, 10, 3)):
+            block = int(np.flatnonzero(reader.compressed_offsets == loaded.block_offsets[chunk])[0])
+            start = int(reader.uncompressed_offsets[block])
+
+            assert start == loaded.block_data_offsets[chunk] <= _row_start(row)
+            assert reader.read(_row_start(row), _row_start(row) + len(ROWS[row])) == ROWS[row]
+
+
+def test_row_index_fingerprint(tmp_path, write_bgzf):
+    path = str(tmp_path / "annotation.tsv.gz")
+    write_bgzf(path, DATA, block_size=25)
+
+    _build_row_index(stride=3).with_fingerprint(path).write(path + ".rowidx")
+    loaded = RowIndex.from_path(path + ".rowidx")
+
+    assert loaded.describes(path)
+    assert not _build_row_index(stride=3).describes(path)
+
+    # A regenerated annotation no longer matches
+    write_bgzf(path, DATA + ROWS[0], block_size=25)
+    assert not loaded.describes(path)
+
+
+@pytest.mark.parametrize("stride", [1, 3, 20])
+def test_build_row_index(stride):
+    row_index = build_row_index(BytesIO(DATA), stride=stride)
+
+    assert np.array_equal(row_index.row_offsets, _build_row_index(stride).row_offsets)
+    assert build_row_index(BytesIO(HEADER), stride=stride).n_rows == 0
+
+
+def test_write_annotation_row_index(tmp_path, write_bgzf):
+    path = str(tmp_path / "annotation.tsv.gz")
+    write_bgzf(path, DATA, block_size=25)
+
+    assert write_annotation_row_index(path, stride=3)
+    loaded = RowIndex.from_path(path + ".rowidx")
+
+    assert loaded.describes(path)
+    assert np.array_equal(loaded.row_offsets, _build_row_index(stride=3).row_offsets)
+    assert loaded.block_offsets is not None
+
+    # Annotations without a .gzi index can't be seeked into, so aren't indexed
+    unindexed_path = tmp_path / "unindexed.tsv.gz"
+    unindexed_path.write_bytes(b"")
+    assert not write_annotation_row_index(str(unindexed_path))
+    assert not (tmp_path / "unindexed.tsv.gz.rowidx").exists()
+
+
+def test_row_index_validates_offsets():
+    with pytest.raises(ValueError, match="row_offsets must have"):
+        RowIndex(stride=3, n_rows=10, row_offsets=np.zeros(3, dtype=np.int64))
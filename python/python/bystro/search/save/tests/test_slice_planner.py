@@ -0,0 +1,88 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from bystro.search.save.slice_planner import (
+    DEFAULT_MAX_SLICES_PER_SCROLL,
+    IndexSliceSettings,
+    get_index_slice_settings,
+    plan_slices,
+)
+
+
+def test_get_index_slice_settings():
+    client = MagicMock()
+    client.indices.get_settings.return_value = {
+        "index_a": {
+            "settings": {"index": {"number_of_shards": "3"}},
+            "defaults": {"index": {"max_slices_per_scroll": "1024"}},
+        },
+        "index_b": {
+            "settings": {"index": {"number_of_shards": "2", "max_slices_per_scroll": "64"}},
+            "defaults": {"index": {}},
+        },
+    }
+
+    settings = get_index_slice_settings(client, "index_*")
+
+    assert settings == IndexSliceSettings(num_shards=5, max_slices_per_scroll=64)
+    client.indices.get_settings.assert_called_once_with(
+        index="index_*", params={"include_defaults": "true"}
+    )
+
+
+def test_get_index_slice_settings_defaults_on_error():
+    client = MagicMock()
+    client.indices.get_settings.side_effect = RuntimeError("forbidden")
+
+    assert get_index_slice_settings(client, "index") == IndexSliceSettings(
+        num_shards=1, max_slices_per_scroll=DEFAULT_MAX_SLICES_PER_SCROLL
+    )
+
+
+@pytest.mark.parametrize(
+    "num_docs, num_shards, max_slices_per_scroll, num_workers, expected_slices",
+    [
+        # Fewer hits than a single request returns are never sliced
+        (5_000, 3, 1024, 8, 1),
+        # Enough slices for every worker to have several, as long as each is worth a request
+        (25_000, 1, 1024, 8, 3),
+        (1_000_000, 1, 1024, 8, 32),
+        # Large queries are split into slices of the target size, rounded up to a multiple of shards
+        (10_000_000, 1, 1024, 8, 100),
+        (10_000_000, 3, 1024, 8, 102),
+        # Slice counts are limited by max_slices_per_scroll, keeping a multiple of shards if possible
+        (10_000_000, 3, 50, 8, 48),
+        (10_000_000, 100, 50, 8, 50),
+        (10_000_000, 1, 1, 8, 1),
+    ],
+)
+def test_plan_slices(num_docs, num_shards, max_slices_per_scroll, num_workers, expected_slices):
+    plan = plan_slices(
+        num_docs=num_docs,
+        settings=IndexSliceSettings(num_shards=num_shards, max_slices_per_scroll=max_slices_per_scroll),
+        num_workers=num_workers,
+        max_query_size=10_000,
+        max_slices=20_000,
+        target_hits_per_slice=100_000,
+        min_slices_per_worker=4,
+    )
+
+    assert plan.num_slices == expected_slices
+    assert plan.num_docs == num_docs
+    assert plan.num_shards == num_shards
+    assert plan.hits_per_slice == num_docs / expected_slices
+
+
+def test_plan_slices_respects_max_slices():
+    plan = plan_slices(
+        num_docs=1_000_000_000,
+        settings=IndexSliceSettings(num_shards=7, max_slices_per_scroll=100_000),
+        num_workers=8,
+        max_query_size=10_000,
+        max_slices=1000,
+        target_hits_per_slice=100_000,
+    )
+
+    assert plan.num_slices == 994
+    assert plan.max_slices == 1000
@@ -92,6 +92,9 @@ class AnnotationOutputs(Struct, frozen=True, forbid_unknown_fields=True, rename=
             Basename of the header file, in the output directory
         archived: Optional[str]
             Basename of the archived annotation file, in the output directory
+        row_index: Optional[str]
+            Basename of the row index of the annotation, in the output directory,
+            which maps every Nth row to its compressed block and uncompressed offsets
     """
 
     annotation: str
@@ -102,6 +105,7 @@ class AnnotationOutputs(Struct, frozen=True, forbid_unknown_fields=True, rename=
     dosage_matrix_out_path: str
     header: str | None = None
     archived: str | None = None
+    row_index: str | None = None
 
     @staticmethod
     def from_path(
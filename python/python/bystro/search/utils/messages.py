@@ -1,3 +1,5 @@
+from typing import Literal
+
 from bystro.beanstalkd.messages import (
     BaseMessage,
     CompletedJobMessage,
@@ -31,6 +33,9 @@ class IndexJobCompleteMessage(CompletedJobMessage, frozen=True, kw_only=True):
 
 PipelineType = list[BinomialMafFilter | HWEFilter] | None
 
+# How the dosage matrix is filtered: by the `dosage-filter` binary, or in process with Arrow
+DosageFilterType = Literal["go", "arrow"]
+
 
 class SaveJobData(BaseMessage, frozen=True, forbid_unknown_fields=True, kw_only=True, rename="camel"):
     """Data for SaveFromQuery jobs received from beanstalkd"""
@@ -43,6 +48,7 @@ class SaveJobData(BaseMessage, frozen=True, forbid_unknown_fields=True, kw_only=
     output_base_path: str
     field_names: list[str]
     pipeline: PipelineType = None
+    dosage_filter: DosageFilterType | None = None
 
 
 class SaveJobResults(Struct, frozen=True, rename="camel"):
@@ -0,0 +1,140 @@
+"""
+Fetch the hits of an OpenSearch query by slice, in parallel, paginating each slice with search_after
+
+A query over a point in time is split into slices, and each slice is paged through with search_after,
+so no single request returns more than the query's `size` hits. Slices are fetched by Ray actors,
+each given the next slice as soon as one of its slices completes, and the results are yielded
+as the slices complete. This is the engine of the save handler's fetch, and of the proteomics
+annotation interface's queries.
+"""
+
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterator
+
+import ray
+
+# The sort used for search_after pagination, when the query has none
+DEFAULT_SORT = [{"_id": "asc"}]
+
+
+def _ensure_sort(query: dict[str, Any]) -> None:
+    """Ensure there is a sort parameter in the query, which search_after requires"""
+    if "sort" not in query.get("body", {}):
+        query.setdefault("body", {}).update({"sort": DEFAULT_SORT})
+
+
+async def iter_hit_pages(client, query: dict[str, Any]) -> AsyncIterator[list[dict]]:
+    """
+    Fetch every page of hits for the query with an async client, using search_after for pagination
+
+    Args:
+        client (AsyncOpenSearch): The client
+        query (dict): The arguments of `client.search`; the query's body is updated in place
+
+    Yields:
+        list[dict]: The hits of each page
+    """
+    _ensure_sort(query)
+
+    while True:
+        resp = await client.search(**query)
+
+        if not resp["hits"]["hits"]:
+            break  # Exit the loop if no more documents are found
+
+        yield resp["hits"]["hits"]
+
+        # Update search_after to the sort value of the last document retrieved
+        query["body"]["search_after"] = resp["hits"]["hits"][-1]["sort"]
+
+
+def iter_hit_pages_sync(client, query: dict[str, Any]) -> Iterator[list[dict]]:
+    """
+    Fetch every page of hits for the query with a blocking client, as `iter_hit_pages` does
+
+    Args:
+        client (OpenSearch): The client
+        query (dict): The arguments of `client.search`; the query's body is updated in place
+
+    Yields:
+        list[dict]: The hits of each page
+    """
+    _ensure_sort(query)
+
+    while True:
+        resp = client.search(**query)
+
+        if not resp["hits"]["hits"]:
+            break
+
+        yield resp["hits"]["hits"]
+
+        query["body"]["search_after"] = resp["hits"]["hits"][-1]["sort"]
+
+
+def prepare_slice_query_body(query: dict[str, Any], slice_id: int, num_slices: int) -> dict[str, Any]:
+    """Prepare the query body for the slice"""
+    body = query.copy()
+    body["slice"] = {"id": slice_id, "max": num_slices}
+    return body
+
+
+def iter_fetched_slices(
+    actors: list,
+    fetch: Callable,
+    query: dict[str, Any],
+    num_slices: int,
+    max_in_flight_per_actor: int,
+) -> Iterator[tuple[int, Any, float]]:
+    """
+    Fetch every slice of the query, dispatching slices to actors as they have capacity,
+    and yielding the result of each slice as it completes
+
+    Rather than assigning each actor a fixed share of the slices up front,
+    each actor has at most `max_in_flight_per_actor` slices at a time,
+    and is given the next slice as soon as one of its slices completes,
+    so that slow slices don't hold up the slices queued behind them.
+
+    Args:
+        actors (list): The fetch actors
+        fetch (Callable): Called with an actor, the search arguments of a slice, and a slice id,
+            to start fetching the slice, returning a Ray object reference
+        query (dict): The query body
+        num_slices (int): The number of slices; 1 means the query is not sliced
+        max_in_flight_per_actor (int): The maximum number of slices an actor fetches at once
+
+    Yields:
+        tuple[int, Any, float]: The slice id, the result of the fetch,
+        and the latency, in seconds, of the fetch, in the order the slices complete
+    """
+    pending = deque(range(num_slices))
+    in_flight: dict[ray.ObjectRef, tuple[int, int, float]] = {}
+
+    def dispatch(actor_index: int):
+        slice_id = pending.popleft()
+        body = (
+            {"body": prepare_slice_query_body(query, slice_id, num_slices)}
+            if num_slices > 1
+            else {"body": query}
+        )
+        ref = fetch(actors[actor_index], body, slice_id)
+        in_flight[ref] = (actor_index, slice_id, time.perf_counter())
+
+    for _ in range(max_in_flight_per_actor):
+        for actor_index in range(len(actors)):
+            if pending:
+                dispatch(actor_index)
+
+    while in_flight:
+        done, _ = ray.wait(list(in_flight), num_returns=1)
+
+        for ref in done:
+            actor_index, slice_id, started = in_flight.pop(ref)
+            result = ray.get(ref)
+            latency = time.perf_counter() - started
+
+            if pending:
+                dispatch(actor_index)
+
+            yield slice_id, result, latency
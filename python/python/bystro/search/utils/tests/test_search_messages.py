@@ -1,4 +1,6 @@
+import msgspec
 from msgspec import json
+import pytest
 
 from bystro.search.utils.annotation import AnnotationOutputs, StatisticsOutputs
 from bystro.search.utils.messages import (
@@ -50,6 +52,7 @@ def test_index_job_data_camel_decamel():
             "dosageMatrixOutPath": "dosage_matrix_out_path",
             "header": "header",
             "archived": None,
+            "rowIndex": None,
         },
         "indexName": "index_name",
         "assembly": "assembly",
@@ -148,11 +151,13 @@ def test_save_job_data_camel_decamel():
             "dosageMatrixOutPath": "dosage_matrix_out_path",
             "header": "header",
             "archived": None,
+            "rowIndex": None,
         },
         "indexName": "index_name",
         "outputBasePath": "output_base_path",
         "fieldNames": ["field1", "field2"],
         "pipeline": None,
+        "dosageFilter": None,
     }
     serialized_expected_value = json.encode(expected_value)
 
@@ -161,6 +166,14 @@ def test_save_job_data_camel_decamel():
     deserialized_values = json.decode(serialized_expected_value, type=SaveJobData)
     assert deserialized_values == job_data
 
+    arrow_job_data = json.decode(
+        json.encode({**expected_value, "dosageFilter": "arrow"}), type=SaveJobData
+    )
+    assert arrow_job_data.dosage_filter == "arrow"
+
+    with pytest.raises(msgspec.ValidationError):
+        json.decode(json.encode({**expected_value, "dosageFilter": "rust"}), type=SaveJobData)
+
 def test_save_job_results_camel_decamel():
     job_results = SaveJobResults(
         output_file_names=AnnotationOutputs(
@@ -190,6 +203,7 @@ def test_save_job_results_camel_decamel():
             "dosageMatrixOutPath": "dosage_matrix_out_path",
             "header": "header",
             "archived": None,
+            "rowIndex": None,
         }
     }
     serialized_expected_value = json.encode(expected_value)
@@ -235,6 +249,7 @@ def test_save_job_complete_message_camel_decamel():
                 "dosageMatrixOutPath": "dosage_matrix_out_path",
                 "header": "header",
                 "archived": None,
+                "rowIndex": None,
             }
         }
     }
@@ -0,0 +1,58 @@
+import asyncio
+
+from bystro.search.utils.sliced_fetch import (
+    DEFAULT_SORT,
+    iter_hit_pages,
+    iter_hit_pages_sync,
+    prepare_slice_query_body,
+)
+
+HITS = [{"_id": str(i), "sort": [i]} for i in range(5)]
+
+
+def _page(body: dict) -> dict:
+    start = body["search_after"][0] + 1 if "search_after" in body else 0
+    return {"hits": {"hits": HITS[start : start + body["size"]]}}
+
+
+class _Client:
+    def __init__(self):
+        self.bodies: list[dict] = []
+
+    def search(self, body: dict) -> dict:
+        self.bodies.append(dict(body))
+        return _page(body)
+
+
+class _AsyncClient(_Client):
+    async def search(self, body: dict) -> dict:  # type: ignore[override]
+        return super().search(body)
+
+
+def test_iter_hit_pages_sync():
+    client = _Client()
+
+    pages = list(iter_hit_pages_sync(client, {"body": {"size": 2}}))
+
+    assert [[hit["_id"] for hit in page] for page in pages] == [["0", "1"], ["2", "3"], ["4"]]
+    assert [body.get("search_after") for body in client.bodies] == [None, [1], [3], [4]]
+    assert all(body["sort"] == DEFAULT_SORT for body in client.bodies)
+
+
+def test_iter_hit_pages():
+    client = _AsyncClient()
+
+    async def collect():
+        return [page async for page in iter_hit_pages(client, {"body": {"size": 3, "sort": "_doc"}})]
+
+    pages = asyncio.run(collect())
+
+    assert [[hit["_id"] for hit in page] for page in pages] == [["0", "1", "2"], ["3", "4"]]
+    assert all(body["sort"] == "_doc" for body in client.bodies)
+
+
+def test_prepare_slice_query_body():
+    query = {"query": {"match_all": {}}, "size": 10}
+
+    assert prepare_slice_query_body(query, 2, 4) == {**query, "slice": {"id": 2, "max": 4}}
+    assert "slice" not in query
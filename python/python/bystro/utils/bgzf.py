@@ -0,0 +1,127 @@
+"""
+Random access into BGZF (blocked gzip) files, such as those written by `bgzip`.
+
+A BGZF file is a series of gzip members, or blocks, each holding at most 64KiB of uncompressed data.
+`bgzip --index` writes a `.gzi` index alongside the file, listing the compressed and uncompressed
+offset at which each block starts, which lets us decompress only the blocks covering a byte range.
+"""
+
+import os
+import zlib
+
+import numpy as np
+from numpy.typing import NDArray
+
+GZI_SUFFIX = ".gzi"
+
+_GZIP_MAGIC = b"\x1f\x8b\x08\x04"
+# Bytes 12-17 of every BGZF block header are the "BC" extra subfield,
+# whose 2-byte payload is the total size of the block minus 1
+_BGZF_SUBFIELD = b"BC\x02\x00"
+_BLOCK_HEADER_SIZE = 18
+
+
+def read_gzi(gzi_path: str) -> tuple[NDArray[np.int64], NDArray[np.int64]]:
+    """
+    Read a `.gzi` index
+
+    Returns:
+        tuple[NDArray[np.int64], NDArray[np.int64]]: The compressed and uncompressed offsets
+        at which each block starts, including the first block, which starts at 0 in both
+    """
+    with open(gzi_path, "rb") as fh:
+        n_entries = int.from_bytes(fh.read(8), "little")
+        entries = np.fromfile(fh, dtype="<u8", count=2 * n_entries)
+
+    if len(entries) != 2 * n_entries:
+        raise ValueError(f"{gzi_path} is truncated")
+
+    entries = entries.reshape(n_entries, 2).astype(np.int64)
+
+    compressed = np.concatenate(([0], entries[:, 0]))
+    uncompressed = np.concatenate(([0], entries[:, 1]))
+
+    return compressed, uncompressed
+
+
+class BgzfReader:
+    """
+    Read uncompressed byte ranges of a BGZF file, decompressing only the blocks that cover them
+
+    Attributes:
+        path: str
+            Path of the BGZF file
+        compressed_offsets: NDArray[np.int64]
+            The compressed offset at which each block starts
+        uncompressed_offsets: NDArray[np.int64]
+            The uncompressed offset at which each block starts
+    """
+
+    def __init__(self, path: str, gzi_path: str | None = None):
+        self.path = path
+        self.compressed_offsets, self.uncompressed_offsets = read_gzi(
+            gzi_path if gzi_path is not None else path + GZI_SUFFIX
+        )
+        self._file_size = os.path.getsize(path)
+        self._fh = open(path, "rb")  # noqa: SIM115
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._fh.close()
+
+    def block_range(self, start: int, end: int) -> tuple[int, int]:
+        """Get the indices of the first and last blocks covering the uncompressed range [start, end)"""
+        first = int(np.searchsorted(self.uncompressed_offsets, start, side="right")) - 1
+        last = int(np.searchsorted(self.uncompressed_offsets, max(start, end - 1), side="right")) - 1
+        return first, last
+
+    def read(self, start: int, end: int) -> bytes:
+        """
+        Read the uncompressed bytes [start, end)
+
+        Raises:
+            ValueError: If the file is not BGZF, or `end` is past the end of the data
+        """
+        if end <= start:
+            return b""
+
+        first, last = self.block_range(start, end)
+
+        compressed_start = int(self.compressed_offsets[first])
+        compressed_end = (
+            int(self.compressed_offsets[last + 1])
+            if last + 1 < len(self.compressed_offsets)
+            else self._file_size
+        )
+
+        self._fh.seek(compressed_start)
+        data = _inflate_blocks(self._fh.read(compressed_end - compressed_start), self.path)
+
+        data_start = start - int(self.uncompressed_offsets[first])
+        if data_start + (end - start) > len(data):
+            raise ValueError(f"Range [{start}, {end}) is past the end of {self.path}")
+
+        return data[data_start : data_start + (end - start)]
+
+
+def _inflate_blocks(data: bytes, path: str) -> bytes:
+    """Decompress a run of whole BGZF blocks"""
+    view = memoryview(data)
+    parts = []
+
+    pos = 0
+    while pos < len(data):
+        header = view[pos : pos + _BLOCK_HEADER_SIZE]
+        if header[0:4] != _GZIP_MAGIC or header[12:16] != _BGZF_SUBFIELD:
+            raise ValueError(f"{path} is not a BGZF file")
+
+        block_size = int.from_bytes(header[16:18], "little") + 1
+        parts.append(zlib.decompress(view[pos : pos + block_size], wbits=31))
+        pos += block_size
+
+    return b"".join(parts)
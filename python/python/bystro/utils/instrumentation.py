@@ -0,0 +1,377 @@
+"""
+Instrument jobs with named spans, counters, and peak memory sampling
+
+`listen` runs each job within a `JobMetrics`, which collects:
+    - spans: named, possibly nested, timed sections of the job, entered with `span`,
+      each recording its wall time and the process' resident memory when it ended
+    - counters: named totals, added to with `count`
+    - the peak resident memory of the process and its children, sampled on a background thread
+
+`span` and `count` can be called from anywhere in a handler; outside of a job, a span only times,
+as a `Timer`, and counts are dropped. When the job ends, its `JobReport` is written as JSON
+to BYSTRO_METRICS_REPORT_DIR, if set, and `MetricsRegistry` aggregates the reports of a listener's jobs,
+to be written in the Prometheus text format for a textfile collector to scrape.
+"""
+
+import os
+import threading
+from collections import defaultdict
+
+import msgspec
+import psutil
+from msgspec import Struct
+
+from bystro.utils.timer import Timer
+
+# The number of seconds between samples of resident memory
+BYSTRO_METRICS_RSS_INTERVAL = float(os.getenv("BYSTRO_METRICS_RSS_INTERVAL", 0.5))
+# The file a listener writes its metrics to, in the Prometheus text format; not written if unset
+BYSTRO_METRICS_PROMETHEUS_FILE = os.getenv("BYSTRO_METRICS_PROMETHEUS_FILE")
+# The directory a listener writes the JSON report of each job to; not written if unset
+BYSTRO_METRICS_REPORT_DIR = os.getenv("BYSTRO_METRICS_REPORT_DIR")
+
+SPAN_SEPARATOR = "/"
+
+
+class SpanReport(Struct, frozen=True):
+    """
+    A timed section of a job
+
+    Attributes:
+        name: str
+            The span's name, prefixed by the names of the spans it is nested in
+        start: float
+            The number of seconds from the start of the job to the start of the span
+        seconds: float
+            The span's wall time
+        rss_mb: float
+            The resident memory of the process when the span ended, in megabytes
+    """
+
+    name: str
+    start: float
+    seconds: float
+    rss_mb: float
+
+
+class JobReport(Struct, frozen=True):
+    """
+    The timing and memory report of a job
+
+    Attributes:
+        name: str
+            The kind of job, such as the tube it was submitted to
+        submission_id: str
+            The job's submission id
+        status: str
+            "completed" or "failed"
+        seconds: float
+            The job's wall time
+        peak_rss_mb: float
+            The peak resident memory of the process that ran the job's handler, and of its children,
+            in megabytes. Ray actors and tasks the handler starts run in other processes,
+            and are not counted
+        spans: list[SpanReport]
+            The job's spans, in the order they ended
+        counters: dict[str, float]
+            The job's counters
+    """
+
+    name: str
+    submission_id: str
+    status: str
+    seconds: float
+    peak_rss_mb: float
+    spans: list[SpanReport]
+    counters: dict[str, float]
+
+
+def _rss_bytes(process: psutil.Process, include_children: bool) -> int:
+    rss = process.memory_info().rss
+    if include_children:
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                # The child exited while we were sampling
+                continue
+
+    return rss
+
+
+class PeakRSSSampler:
+    """
+    Sample the resident memory of a process and its children on a background thread, keeping the peak
+
+    Args:
+        interval (float, optional): The number of seconds between samples
+        include_children (bool, optional): Whether to add the memory of child processes,
+            such as the binaries a handler pipes data through
+    """
+
+    def __init__(self, interval: float = BYSTRO_METRICS_RSS_INTERVAL, include_children: bool = True):
+        self._interval = interval
+        self._include_children = include_children
+        self._process = psutil.Process(os.getpid())
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self.peak_rss = 0
+
+    def sample(self) -> int:
+        rss = _rss_bytes(self._process, self._include_children)
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.sample()
+            except psutil.Error:
+                continue
+
+    def start(self):
+        self.sample()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="peak-rss-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> int:
+        """Stop sampling, returning the peak resident memory, in bytes"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.sample()
+        return self.peak_rss
+
+
+class Span(Timer):
+    """A `Timer` that records itself in the job it is entered in, if any"""
+
+    def __init__(self, name: str, metrics: "JobMetrics | None" = None):
+        self.name = name
+        self._metrics = metrics
+
+    def __enter__(self):
+        if self._metrics is not None:
+            self._metrics._enter_span(self)  # noqa: SLF001
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        if self._metrics is not None:
+            self._metrics._exit_span(self)  # noqa: SLF001
+
+
+class JobMetrics:
+    """
+    Collects the spans, counters, and peak memory of one job, while entered as a context manager
+
+    Args:
+        name (str): The kind of job, such as the tube it was submitted to
+        submission_id (str | int): The job's submission id
+        rss_interval (float, optional): The number of seconds between samples of resident memory
+    """
+
+    def __init__(
+        self, name: str, submission_id: str | int, rss_interval: float = BYSTRO_METRICS_RSS_INTERVAL
+    ):
+        self.name = name
+        self.submission_id = str(submission_id)
+        self.report: JobReport | None = None
+
+        self._sampler = PeakRSSSampler(rss_interval)
+        self._spans: list[SpanReport] = []
+        self._open_spans: list[str] = []
+        self._counters: dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+        self._timer = Timer()
+        self._previous: JobMetrics | None = None
+
+    def span(self, name: str) -> Span:
+        return Span(name, self)
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _enter_span(self, span: Span):
+        with self._lock:
+            self._open_spans.append(span.name)
+            span.name = SPAN_SEPARATOR.join(self._open_spans)
+
+    def _exit_span(self, span: Span):
+        rss = self._sampler.sample()
+        with self._lock:
+            self._open_spans.pop()
+            self._spans.append(
+                SpanReport(
+                    name=span.name,
+                    start=span.start_time - self._timer.start_time,
+                    seconds=span.elapsed_time,
+                    rss_mb=rss / 1024**2,
+                )
+            )
+
+    def __enter__(self):
+        global _current
+
+        self._previous = _current
+        _current = self
+        self._sampler.start()
+        self._timer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        global _current
+
+        self._timer.__exit__(exc_type, *exc_info)
+        peak_rss = self._sampler.stop()
+        _current = self._previous
+
+        self.report = JobReport(
+            name=self.name,
+            submission_id=self.submission_id,
+            status="completed" if exc_type is None else "failed",
+            seconds=self._timer.elapsed_time,
+            peak_rss_mb=peak_rss / 1024**2,
+            spans=list(self._spans),
+            counters=dict(self._counters),
+        )
+
+
+_current: JobMetrics | None = None
+
+
+def current_metrics() -> JobMetrics | None:
+    """The metrics of the job running in this process, if any"""
+    return _current
+
+
+def span(name: str) -> Span:
+    """Time a section of the running job, as a context manager yielding the span's `Timer`"""
+    return Span(name, _current)
+
+
+def count(name: str, value: float = 1):
+    """Add to a counter of the running job"""
+    if _current is not None:
+        _current.count(name, value)
+
+
+def job_report_path(report: JobReport, directory: str) -> str:
+    """The path in `directory` of a job's report"""
+    return os.path.join(directory, f"{report.name}.{report.submission_id}.metrics.json")
+
+
+def write_job_report(report: JobReport, path: str):
+    with open(path, "wb") as fh:
+        fh.write(msgspec.json.format(msgspec.json.encode(report)))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """Aggregates job reports into metrics, written in the Prometheus text format"""
+
+    def __init__(self):
+        self._jobs: dict[tuple[str, str], int] = defaultdict(int)
+        self._job_seconds: dict[str, float] = defaultdict(float)
+        self._job_count: dict[str, int] = defaultdict(int)
+        self._peak_rss: dict[str, float] = {}
+        self._span_seconds: dict[tuple[str, str], float] = defaultdict(float)
+        self._span_count: dict[tuple[str, str], int] = defaultdict(int)
+        self._counters: dict[tuple[str, str], float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, report: JobReport):
+        with self._lock:
+            self._jobs[(report.name, report.status)] += 1
+            self._job_seconds[report.name] += report.seconds
+            self._job_count[report.name] += 1
+            self._peak_rss[report.name] = report.peak_rss_mb * 1024**2
+
+            for span_report in report.spans:
+                self._span_seconds[(report.name, span_report.name)] += span_report.seconds
+                self._span_count[(report.name, span_report.name)] += 1
+
+            for counter, value in report.counters.items():
+                self._counters[(report.name, counter)] += value
+
+    def to_prometheus(self) -> str:
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix_and_labels, value in samples:
+                lines.append(f"{name}{suffix_and_labels} {value}")
+
+        with self._lock:
+            metric(
+                "bystro_jobs_total",
+                "counter",
+                "Jobs run, by job kind and status",
+                [
+                    (_labels(job=job, status=status), n_jobs)
+                    for (job, status), n_jobs in sorted(self._jobs.items())
+                ],
+            )
+            metric(
+                "bystro_job_seconds",
+                "summary",
+                "Wall time of jobs",
+                [
+                    sample
+                    for job in sorted(self._job_count)
+                    for sample in (
+                        (f"_sum{_labels(job=job)}", self._job_seconds[job]),
+                        (f"_count{_labels(job=job)}", self._job_count[job]),
+                    )
+                ],
+            )
+            metric(
+                "bystro_job_peak_rss_bytes",
+                "gauge",
+                "Peak resident memory of the last job, with its child processes",
+                [(_labels(job=job), rss) for job, rss in sorted(self._peak_rss.items())],
+            )
+            metric(
+                "bystro_span_seconds",
+                "summary",
+                "Wall time of job spans",
+                [
+                    sample
+                    for key in sorted(self._span_count)
+                    for sample in (
+                        (f"_sum{_labels(job=key[0], span=key[1])}", self._span_seconds[key]),
+                        (f"_count{_labels(job=key[0], span=key[1])}", self._span_count[key]),
+                    )
+                ],
+            )
+            metric(
+                "bystro_job_counter_total",
+                "counter",
+                "Job counters, summed over jobs",
+                [
+                    (_labels(job=job, counter=counter), value)
+                    for (job, counter), value in sorted(self._counters.items())
+                ],
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the metrics to `path`, replacing it at once so that scrapers never see a partial file"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write(self.to_prometheus())
+        os.replace(tmp_path, path)
@@ -0,0 +1,107 @@
+import gzip
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from bystro.utils.bgzf import BgzfReader, read_gzi
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def write_bgzf(path, data: bytes, block_size: int) -> None:
+    """Write `data` as BGZF blocks of `block_size` uncompressed bytes, with a bgzip-style .gzi index"""
+    offsets = []
+    compressed_offset = 0
+    with open(path, "wb") as fh:
+        for start in range(0, len(data), block_size):
+            if start > 0:
+                offsets.append((compressed_offset, start))
+
+            chunk = data[start : start + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(chunk) + compressor.flush()
+            block = (
+                b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+                + struct.pack("<H", 18 + len(cdata) + 8 - 1)
+                + cdata
+                + struct.pack("<II", zlib.crc32(chunk), len(chunk))
+            )
+            fh.write(block)
+            compressed_offset += len(block)
+
+        fh.write(BGZF_EOF)
+
+    with open(f"{path}.gzi", "wb") as fh:
+        fh.write(struct.pack("<Q", len(offsets)))
+        for compressed, uncompressed in offsets:
+            fh.write(struct.pack("<QQ", compressed, uncompressed))
+
+
+DATA = b"".join(f"row{i}\t{i * 7}\n".encode() for i in range(2000))
+
+
+def test_write_bgzf_is_gzip(tmp_path):
+    path = tmp_path / "data.gz"
+    write_bgzf(path, DATA, 1000)
+
+    assert gzip.decompress(path.read_bytes()) == DATA
+
+
+def test_read_gzi(tmp_path):
+    path = tmp_path / "data.gz"
+    write_bgzf(path, DATA, 1000)
+
+    compressed, uncompressed = read_gzi(f"{path}.gzi")
+
+    assert np.array_equal(uncompressed, np.arange(0, len(DATA), 1000))
+    assert compressed[0] == 0
+    assert np.all(np.diff(compressed) > 0)
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (0, 10),
+        (0, len(DATA)),
+        (999, 1001),
+        (1000, 2000),
+        (2500, 7777),
+        (len(DATA) - 5, len(DATA)),
+        (5, 5),
+    ],
+)
+def test_bgzf_reader_read(tmp_path, start, end):
+    path = tmp_path / "data.gz"
+    write_bgzf(path, DATA, 1000)
+
+    with BgzfReader(str(path)) as reader:
+        assert reader.read(start, end) == DATA[start:end]
+
+
+def test_bgzf_reader_block_range(tmp_path):
+    path = tmp_path / "data.gz"
+    write_bgzf(path, DATA, 1000)
+
+    with BgzfReader(str(path)) as reader:
+        assert reader.block_range(0, 1000) == (0, 0)
+        assert reader.block_range(999, 1001) == (0, 1)
+        assert reader.block_range(2500, 2501) == (2, 2)
+
+
+def test_bgzf_reader_past_end(tmp_path):
+    path = tmp_path / "data.gz"
+    write_bgzf(path, DATA, 1000)
+
+    with BgzfReader(str(path)) as reader, pytest.raises(ValueError, match="past the end"):
+        reader.read(len(DATA) - 5, len(DATA) + 5)
+
+
+def test_bgzf_reader_rejects_plain_gzip(tmp_path):
+    path = tmp_path / "data.gz"
+    path.write_bytes(gzip.compress(DATA))
+    (tmp_path / "data.gz.gzi").write_bytes(struct.pack("<Q", 0))
+
+    with BgzfReader(str(path)) as reader, pytest.raises(ValueError, match="not a BGZF file"):
+        reader.read(0, 10)
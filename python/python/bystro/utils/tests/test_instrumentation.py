@@ -0,0 +1,119 @@
+import os
+import time
+
+import pytest
+from msgspec import json
+
+from bystro.utils.instrumentation import (
+    JobMetrics,
+    JobReport,
+    MetricsRegistry,
+    count,
+    current_metrics,
+    job_report_path,
+    span,
+    write_job_report,
+)
+
+
+def test_job_metrics():
+    metrics = JobMetrics("save", 1, rss_interval=0.01)
+
+    with metrics:
+        assert current_metrics() is metrics
+
+        with span("fetch"):
+            time.sleep(0.05)
+            with span("filter") as timer:
+                count("variants", 10)
+                count("variants", 5)
+
+        assert timer.elapsed_time < 0.05
+
+    assert current_metrics() is None
+
+    report = metrics.report
+    assert report is not None
+    assert (report.name, report.submission_id, report.status) == ("save", "1", "completed")
+    # Spans are recorded as they end, with the names of the spans they are nested in
+    assert [span_report.name for span_report in report.spans] == ["fetch/filter", "fetch"]
+    assert report.spans[1].seconds >= 0.05
+    assert report.spans[0].start >= report.spans[1].start
+    assert report.seconds >= report.spans[1].seconds
+    assert report.peak_rss_mb >= max(span_report.rss_mb for span_report in report.spans) > 0
+    assert report.counters == {"variants": 15}
+
+
+def test_job_metrics_failed():
+    metrics = JobMetrics("save", 1)
+
+    with pytest.raises(ValueError), metrics, span("fetch"):
+        raise ValueError("failed")
+
+    assert metrics.report is not None
+    assert metrics.report.status == "failed"
+    assert [span_report.name for span_report in metrics.report.spans] == ["fetch"]
+
+
+def test_span_outside_job():
+    with span("fetch") as timer:
+        count("variants")
+
+    assert timer.elapsed_time >= 0
+
+
+def test_write_job_report(tmp_path):
+    metrics = JobMetrics("ancestry", "2")
+    with metrics, span("score_samples"):
+        count("samples", 3)
+
+    assert metrics.report is not None
+    report_path = job_report_path(metrics.report, str(tmp_path))
+    assert report_path == str(tmp_path / "ancestry.2.metrics.json")
+
+    write_job_report(metrics.report, report_path)
+
+    with open(report_path, "rb") as fh:
+        assert json.decode(fh.read(), type=JobReport) == metrics.report
+
+
+def _report(name: str, status: str, seconds: float) -> JobReport:
+    return JobReport(
+        name=name,
+        submission_id="1",
+        status=status,
+        seconds=seconds,
+        peak_rss_mb=2.0,
+        spans=[],
+        counters={"variants": 10},
+    )
+
+
+def test_metrics_registry(tmp_path):
+    registry = MetricsRegistry()
+    metrics = JobMetrics("save", 1)
+    with metrics, span("fetch"):
+        pass
+
+    assert metrics.report is not None
+    registry.observe(metrics.report)
+    registry.observe(_report("save", "failed", 2))
+    registry.observe(_report('an "odd" job', "completed", 1))
+
+    text = registry.to_prometheus()
+    lines = text.splitlines()
+
+    assert "# TYPE bystro_jobs_total counter" in lines
+    assert 'bystro_jobs_total{job="save",status="completed"} 1' in lines
+    assert 'bystro_jobs_total{job="save",status="failed"} 1' in lines
+    assert 'bystro_jobs_total{job="an \\"odd\\" job",status="completed"} 1' in lines
+    assert 'bystro_job_seconds_count{job="save"} 2' in lines
+    assert 'bystro_job_peak_rss_bytes{job="save"} 2097152.0' in lines
+    assert 'bystro_span_seconds_count{job="save",span="fetch"} 1' in lines
+    assert 'bystro_job_counter_total{job="save",counter="variants"} 10.0' in lines
+
+    path = str(tmp_path / "bystro.prom")
+    registry.write(path)
+    with open(path, encoding="utf-8") as fh:
+        assert fh.read() == text
+    assert os.listdir(tmp_path) == ["bystro.prom"]